@@ -15,9 +15,9 @@ from os.path import exists
 import sys
 
 ARCH = 'x86'
-if os.environ['PROCESSOR_ARCHITECTURE'] == 'AMD64':
+if os.environ.get('PROCESSOR_ARCHITECTURE') == 'AMD64':
     ARCH = 'x64'
-if os.environ['PROCESSOR_ARCHITECTURE'] == 'ARM64':
+if os.environ.get('PROCESSOR_ARCHITECTURE') == 'ARM64':
     raise Exception("Error Loading python module: this isn't currently known to work for ARM64 environments")
 
 # All the DLLs for AlphaVSS should be located in the ARCH dir for your system: AlphaVSS.Common.dll, AlphaVSS.x64.dll (or ALphaVSS.x86.dll)
@@ -26,4 +26,15 @@ if ALPHAVSS_BASE_PATH not in sys.path and exists(f'{ALPHAVSS_BASE_PATH}\\AlphaVS
     sys.path.append(ALPHAVSS_BASE_PATH)
     # you could have the DLLs somewhere else and already include that PATH in your system PATH
 
-from alphavss.models import VSSProvider, VSSSnapshotSet, VSSSnapshot
+# VSSProvider, VSSSnapshotSet & VSSSnapshot are imported from models (which loads the CLR) the first time they are used:
+# the pure python helpers (walker, etc) and the daemon client don't need the CLR, so they stay quick to import (and
+# importable, benchmarkable on other platforms)
+_MODELS_EXPORTS = ('VSSProvider', 'VSSSnapshotSet', 'VSSSnapshot')
+
+
+def __getattr__(name):
+    if name in _MODELS_EXPORTS:
+        from alphavss import models
+
+        return getattr(models, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
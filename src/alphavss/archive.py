@@ -0,0 +1,191 @@
+'''
+    Streamable backup archive format written by the BackupPipeline
+
+    The archive is a sequence of records that can be written to (and read back from) a pipe, nothing ever seeks:
+
+        MAGIC                                       b'AVSSARC1'
+        b'D' <H path_len> <I mode> <q mtime_ns> path                                 directory
+        b'F' <I file_id> <H path_len> <I mode> <Q size> <q mtime_ns> path            start of a file
+        b'C' <I file_id> <Q offset> <B codec> <I raw_len> <I data_len> data          chunk of a file's content
+        b'E' <I file_id> <B status>                                                  end of a file (status 0 = complete)
+        b'L' <H path_len> <H target_len> path target                                 hard link to a file ended before
+        b'Z'                                                                         end of the archive
+
+    Chunks of several files can be interleaved (files are read in parallel), they are tied back to their file by
+    file_id and carry their offset in the file.  Paths are stored with '/' separators, utf-8 encoded.  The E record
+    of a link's target comes before the link (the BackupPipeline writes the links after every file), a reader can
+    create the link as soon as it reads it.
+'''
+import lzma
+import time
+import zlib
+import struct
+from collections import namedtuple
+
+MAGIC = b'AVSSARC1'
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODECS = {'none': CODEC_NONE, 'zlib': CODEC_ZLIB, 'lzma': CODEC_LZMA}
+
+STATUS_OK = 0
+STATUS_FAILED = 1
+
+_DIR = struct.Struct('<HIq')
+_FILE = struct.Struct('<IHIQq')
+_CHUNK = struct.Struct('<IQBII')
+_END = struct.Struct('<IB')
+_LINK = struct.Struct('<HH')
+
+DirRecord = namedtuple('DirRecord', ['path', 'mode', 'mtime_ns'])
+FileRecord = namedtuple('FileRecord', ['file_id', 'path', 'mode', 'size', 'mtime_ns'])
+ChunkRecord = namedtuple('ChunkRecord', ['file_id', 'offset', 'codec', 'raw_len', 'data'])
+EndRecord = namedtuple('EndRecord', ['file_id', 'status'])
+LinkRecord = namedtuple('LinkRecord', ['path', 'target'])
+
+
+def codec_id(codec:object):
+    '''
+        'zlib' -> CODEC_ZLIB (ints are passed through)
+    '''
+    if isinstance(codec, int) and codec in CODECS.values():
+        return codec
+    if codec not in CODECS:
+        raise Exception(f'Unknown archive codec: {codec} (valid codecs: {", ".join(CODECS)})')
+
+    return CODECS[codec]
+
+
+def compress_chunk(data:bytes, codec:int, level:int=None):
+    '''
+        Compress a chunk, returns (codec used, compressed data, seconds spent)
+
+        Incompressible chunks are stored as CODEC_NONE.  This runs in the compression process pool, so it has to
+        stay a module level function (picklable)
+    '''
+    start = time.perf_counter()
+    if codec == CODEC_ZLIB:
+        payload = zlib.compress(data, 6 if level is None else level)
+    elif codec == CODEC_LZMA:
+        payload = lzma.compress(data, preset=1 if level is None else level)
+    else:
+        payload = data
+
+    if codec != CODEC_NONE and len(payload) >= len(data):
+        codec = CODEC_NONE
+        payload = data
+
+    return codec, payload, time.perf_counter() - start
+
+
+def decompress_chunk(codec:int, data:bytes):
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    if codec == CODEC_LZMA:
+        return lzma.decompress(data)
+    if codec == CODEC_NONE:
+        return data
+
+    raise Exception(f'Unknown codec in archive chunk: {codec}')
+
+
+def archive_path(*parts):
+    '''
+        Join path parts into an archive path ('/' separators, no leading or trailing '/')
+    '''
+    joined = '/'.join(part.replace('\\', '/').strip('/') for part in parts if part)
+    return joined.strip('/')
+
+
+class ArchiveWriter(object):
+    '''
+        Writes archive records to a stream (anything with a write() method), offset is the number of bytes written
+    '''
+    def __init__(self, stream:object):
+        self.stream = stream
+        self.offset = 0
+        self._write(MAGIC)
+
+    def _write(self, data):
+        self.stream.write(data)
+        self.offset += len(data)
+
+    def write_dir(self, path:str, mode:int, mtime_ns:int):
+        encoded = path.encode('utf-8')
+        self._write(b'D' + _DIR.pack(len(encoded), mode, mtime_ns) + encoded)
+
+    def start_file(self, file_id:int, path:str, mode:int, size:int, mtime_ns:int):
+        encoded = path.encode('utf-8')
+        self._write(b'F' + _FILE.pack(file_id, len(encoded), mode, size, mtime_ns) + encoded)
+
+    def write_chunk(self, file_id:int, offset:int, codec:int, raw_len:int, data:bytes):
+        self._write(b'C' + _CHUNK.pack(file_id, offset, codec, raw_len, len(data)))
+        self._write(data)
+
+    def end_file(self, file_id:int, status:int=STATUS_OK):
+        self._write(b'E' + _END.pack(file_id, status))
+
+    def write_link(self, path:str, target:str):
+        encoded = path.encode('utf-8')
+        encoded_target = target.encode('utf-8')
+        self._write(b'L' + _LINK.pack(len(encoded), len(encoded_target)) + encoded + encoded_target)
+
+    def close(self):
+        self._write(b'Z')
+        if hasattr(self.stream, 'flush'):
+            self.stream.flush()
+
+
+def _read_exact(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise Exception('Truncated archive')
+
+    return data
+
+
+def read_record(stream:object):
+    '''
+        Read the record at the current position of a stream, None at the end record of the archive
+
+        A stream that ends before a record does (including at a record boundary, with no end record) raises
+        Exception('Truncated archive')
+    '''
+    kind = stream.read(1)
+    if kind == b'C':
+        file_id, offset, codec, raw_len, data_len = _CHUNK.unpack(_read_exact(stream, _CHUNK.size))
+        return ChunkRecord(file_id, offset, codec, raw_len, _read_exact(stream, data_len))
+    if kind == b'F':
+        file_id, path_len, mode, size, mtime_ns = _FILE.unpack(_read_exact(stream, _FILE.size))
+        return FileRecord(file_id, _read_exact(stream, path_len).decode('utf-8'), mode, size, mtime_ns)
+    if kind == b'E':
+        return EndRecord(*_END.unpack(_read_exact(stream, _END.size)))
+    if kind == b'D':
+        path_len, mode, mtime_ns = _DIR.unpack(_read_exact(stream, _DIR.size))
+        return DirRecord(_read_exact(stream, path_len).decode('utf-8'), mode, mtime_ns)
+    if kind == b'L':
+        path_len, target_len = _LINK.unpack(_read_exact(stream, _LINK.size))
+        return LinkRecord(_read_exact(stream, path_len).decode('utf-8'), _read_exact(stream, target_len).decode('utf-8'))
+    if kind == b'Z':
+        return None
+    if not kind:
+        raise Exception('Truncated archive')
+
+    raise Exception(f'Corrupt archive: unknown record type {kind!r}')
+
+
+def iter_archive(stream:object):
+    '''
+        Generator returning DirRecord, FileRecord, ChunkRecord (compressed data), EndRecord and LinkRecord objects
+
+        Once a record has been returned the stream is positioned on the next one (stream.tell() is its offset)
+    '''
+    if _read_exact(stream, len(MAGIC)) != MAGIC:
+        raise Exception('Not an alphavss archive (bad magic)')
+
+    while True:
+        record = read_record(stream)
+        if record is None:
+            return
+        yield record
@@ -0,0 +1,292 @@
+'''
+    Volume capability cache (IsVolumeSupported, file system, shadow storage) and backup preflight planning
+
+    VSSSnapshotSet asks components.IsVolumeSupported() for every volume every time a set is built, even though the
+    answer changes about never.  CapabilityCache remembers, per volume GUID (drive letters move, GUIDs don't):
+
+        * supported: the IsVolumeSupported() answer
+        * filesystem: NTFS, ReFS...
+        * shadow_storage: whether the volume has a shadow storage (diff area) association
+
+    Entries expire after ttl seconds, the cache can be kept in a JSON file shared by every process (path).  Give it to
+    a VSSProvider (VSSProvider(capabilities=cache)) and its snapshot sets stop calling IsVolumeSupported().
+
+    plan() is a preflight for a backup request: it validates the volumes against the cache (probing only the unknown
+    ones, with an InitializeForBackup-only components object: no GatherWriterMetadata) and lists the VSS calls
+    models.py will make, before anything expensive is started.
+
+    Usage:
+        from alphavss.capabilities import CapabilityCache, plan
+
+        cache = CapabilityCache('C:\\ProgramData\\alphavss\\capabilities.json')
+        backup_plan = plan(['C:\\', 'D:\\'], cache=cache)
+        print(backup_plan)
+        if backup_plan.ok:
+            VSSSnapshotSet(volume_names=['C:\\', 'D:\\'], provider=VSSProvider(capabilities=cache))
+'''
+import os
+import sys
+import json
+import time
+from collections import namedtuple
+from alphavss.constants import Backup
+from alphavss.volumes import mount_key
+
+DEFAULT_TTL = 24 * 3600 # seconds
+MAX_VOLUMES_PER_SET = 64 # VSS limit on the snapshots of one set
+SNAPSHOT_FILESYSTEMS = ('NTFS', 'ReFS')
+
+VolumeCapabilities = namedtuple('VolumeCapabilities', ['guid_path', 'volume_name', 'supported', 'filesystem',
+                                                       'shadow_storage', 'checked'])
+
+
+def _default_volumes():
+    from alphavss.models import get_drives
+
+    return get_drives()
+
+
+def _default_shadow_storage():
+    from alphavss.volumes import query_shadow_storage
+
+    return query_shadow_storage()
+
+
+def _default_filesystem():
+    if sys.platform != 'win32':
+        return lambda guid_path: None
+    from alphavss.volumes import Win32VolumeAPI
+
+    return Win32VolumeAPI().filesystem
+
+
+class CapabilityCache(object):
+    '''
+        Volume capabilities keyed by volume GUID path (see the module docstring)
+    '''
+    def __init__(self, path:str=None, ttl:float=DEFAULT_TTL, volumes:object=None, shadow_storage:object=None,
+                 filesystem:object=None, clock:object=time.time, debug:bool=False):
+        '''
+            path: (str) JSON file the cache is loaded from and saved to (None: memory only)
+            ttl: (float) seconds an entry is trusted
+            volumes: (callable) returns the get_drives() mapping {'C:': volume GUID path} (default: get_drives)
+            shadow_storage: (callable) returns {volume GUID path: ShadowStorage} (default: volumes.query_shadow_storage)
+            filesystem: (callable) volume GUID path -> file system name (default: GetVolumeInformationW)
+            clock: (callable) time.time (replace it to simulate time, the file keeps wall clock times)
+            debug: (bool) enables enhanced output
+
+            The callables make the cache usable without Windows (ex. fixed mappings)
+        '''
+        self.path = path
+        self.ttl = ttl
+        self.volumes = volumes or _default_volumes
+        self.shadow_storage = shadow_storage or _default_shadow_storage
+        self.filesystem = filesystem
+        self.clock = clock
+        self.debug = debug
+        self.probes = 0
+        self.hits = 0
+        self._entries = {}
+        self._mapping = None
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as cache_file:
+                self._entries = json.load(cache_file)
+
+    def guid_of(self, volume_name:str):
+        '''
+            Volume GUID path of a volume name ('C:\\', 'D:\\Mounts\\Data\\', or a GUID path), None if it is unknown
+        '''
+        if volume_name.lower().startswith('\\\\?\\volume{'):
+            return volume_name if volume_name.endswith('\\') else f'{volume_name}\\'
+        key = mount_key(volume_name)
+        if self._mapping is None or key not in self._mapping:
+            # first use, or a volume mounted since
+            self._mapping = {mount_key(name): guid_path for name, guid_path in self.volumes().items()}
+
+        return self._mapping.get(key)
+
+    def get(self, volume_name:str):
+        '''
+            Cached VolumeCapabilities of a volume (None if it isn't cached or expired)
+        '''
+        guid_path = self.guid_of(volume_name)
+        entry = self._entries.get(guid_path) if guid_path else None
+        if entry is None or self.clock() - entry['checked'] > self.ttl:
+            return None
+
+        return VolumeCapabilities(guid_path, volume_name, entry['supported'], entry['filesystem'],
+                                  entry['shadow_storage'], entry['checked'])
+
+    def check(self, volume_names:list, components:object=None, provider:object=None):
+        '''
+            VolumeCapabilities of every volume (None for a volume with no GUID), probing the ones not cached with
+            components (an initialized VSS components object) or a probe components object of provider
+        '''
+        results = [self.get(volume_name) for volume_name in volume_names]
+        missing = [volume_name for volume_name, result in zip(volume_names, results)
+                   if result is None and self.guid_of(volume_name)]
+        self.hits += len(volume_names) - len(missing)
+        if missing:
+            probed = self._probe(missing, components, provider)
+            results = [result if result is not None else probed.get(volume_name)
+                       for volume_name, result in zip(volume_names, results)]
+
+        return results
+
+    def _probe(self, volume_names, components, provider):
+        if components is None:
+            components = probe_components(provider)
+        storage = self.shadow_storage()
+        if self.filesystem is None:
+            self.filesystem = _default_filesystem()
+        probed = {}
+        now = self.clock()
+        for volume_name in volume_names:
+            guid_path = self.guid_of(volume_name)
+            supported = bool(components.IsVolumeSupported(volume_name))
+            entry = {'supported': supported, 'filesystem': self.filesystem(guid_path),
+                     'shadow_storage': guid_path in storage, 'checked': now}
+            self._entries[guid_path] = entry
+            probed[volume_name] = VolumeCapabilities(guid_path, volume_name, entry['supported'], entry['filesystem'],
+                                                     entry['shadow_storage'], now)
+            self.probes += 1
+            if self.debug:
+                print(f'capabilities of {volume_name} ({guid_path}): {entry}')
+        self.save()
+
+        return probed
+
+    def is_supported(self, volume_name:str, components:object=None):
+        '''
+            The IsVolumeSupported() answer for volume_name (probed with components when it isn't cached)
+        '''
+        if self.guid_of(volume_name) is None:
+            # a volume the mapping doesn't know (a folder mount with the WMI resolver...): nothing to key it on
+            return components is not None and bool(components.IsVolumeSupported(volume_name))
+        result = self.check([volume_name], components=components)[0]
+
+        return result is not None and result.supported
+
+    def invalidate(self, volume_name:str=None):
+        '''
+            Forget a volume (every volume when volume_name is None)
+        '''
+        if volume_name is None:
+            self._entries = {}
+            self._mapping = None
+        else:
+            self._entries.pop(self.guid_of(volume_name), None)
+        self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as cache_file:
+            json.dump(self._entries, cache_file, indent=1)
+        os.replace(temp_path, self.path)
+
+
+def probe_components(provider:object=None, context:int=Backup):
+    '''
+        Components object initialized enough for IsVolumeSupported(): InitializeForBackup + SetContext, without the
+        GatherWriterMetadata of a backup
+    '''
+    if provider is None:
+        from alphavss.models import VSSProvider
+
+        provider = VSSProvider(operation='query', context=context)
+    components = provider.create_backup_components()
+    components.InitializeForBackup(None)
+    components.SetContext(provider.context)
+
+    return components
+
+
+class BackupPlan(object):
+    '''
+        Result of plan(): the volumes, the problems (the backup would fail), the warnings and the expected VSS calls
+    '''
+    def __init__(self, volume_names, context):
+        self.volume_names = volume_names
+        self.context = context
+        self.volumes = []
+        self.problems = []
+        self.warnings = []
+        self.calls = []
+
+    @property
+    def ok(self):
+        return not self.problems
+
+    def as_dict(self):
+        return {'volume_names': self.volume_names, 'context': self.context, 'ok': self.ok,
+                'volumes': [volume._asdict() if volume is not None else None for volume in self.volumes],
+                'problems': self.problems, 'warnings': self.warnings, 'calls': self.calls}
+
+    def __str__(self):
+        lines = [f'backup plan for {", ".join(self.volume_names)}: {"ok" if self.ok else "WILL FAIL"}']
+        lines += [f'    problem: {problem}' for problem in self.problems]
+        lines += [f'    warning: {warning}' for warning in self.warnings]
+        lines.append(f'    {len(self.calls)} VSS call(s): {", ".join(self.calls)}')
+
+        return '\n'.join(lines)
+
+
+def plan(volume_names:list, provider:object=None, cache:CapabilityCache=None, context:int=None):
+    '''
+        Preflight of VSSSnapshotSet(volume_names=volume_names, provider=provider): returns a BackupPlan
+
+        provider: (VSSProvider) the provider of the backup (its context, its capability cache), only used to probe
+                  volumes missing from the cache
+        cache: (CapabilityCache) default: the provider's, or a new memory only cache
+        context: (int) snapshot context (default: the provider's, or Backup)
+    '''
+    if cache is None:
+        cache = getattr(provider, 'capabilities', None) or CapabilityCache()
+    if context is None:
+        context = provider.context if provider is not None else Backup
+    backup_plan = BackupPlan(list(volume_names), context)
+
+    if len(volume_names) > MAX_VOLUMES_PER_SET:
+        backup_plan.problems.append(f'{len(volume_names)} volumes, a snapshot set holds {MAX_VOLUMES_PER_SET} at most')
+    known = [volume_name for volume_name in volume_names if cache.guid_of(volume_name)]
+    for volume_name in volume_names:
+        if volume_name not in known:
+            backup_plan.problems.append(f'{volume_name}: unknown volume')
+
+    uncached = [volume_name for volume_name in known if cache.get(volume_name) is None]
+    if uncached:
+        cache.check(uncached, provider=provider)
+    seen = {}
+    for volume_name in volume_names:
+        capabilities = cache.get(volume_name) if volume_name in known else None
+        backup_plan.volumes.append(capabilities)
+        if capabilities is None:
+            continue
+        if capabilities.guid_path in seen:
+            backup_plan.problems.append(f'{volume_name}: the same volume as {seen[capabilities.guid_path]}')
+        seen.setdefault(capabilities.guid_path, volume_name)
+        if not capabilities.supported:
+            backup_plan.problems.append(f'{volume_name}: not supported by the snapshot provider (IsVolumeSupported)')
+        if capabilities.filesystem and capabilities.filesystem not in SNAPSHOT_FILESYSTEMS:
+            backup_plan.warnings.append(f'{volume_name}: {capabilities.filesystem} file system')
+        if not capabilities.shadow_storage:
+            backup_plan.warnings.append(f'{volume_name}: no shadow storage configured (created on the first snapshot, '
+                                        f'default size)')
+
+    # the calls of VSSSnapshotSet(operation='backup') in models.py, in order
+    initialize = ['CreateVssBackupComponents', 'InitializeForBackup', f'SetContext({context})', 'GatherWriterMetadata']
+    backup_plan.calls += initialize
+    if cache is not getattr(provider, 'capabilities', None):
+        # without the cache on the provider the set asks again
+        backup_plan.calls += [f'IsVolumeSupported({volume_name})' for volume_name in volume_names]
+    backup_plan.calls.append('StartSnapshotSet')
+    for volume_name in volume_names:
+        backup_plan.calls.append(f'AddToSnapshotSet({volume_name})')
+        # every VSSSnapshot initializes components of its own
+        backup_plan.calls += initialize
+    backup_plan.calls += ['SetBackupState', 'PrepareForBackup', 'DoSnapshotSet']
+
+    return backup_plan
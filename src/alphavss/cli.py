@@ -0,0 +1,323 @@
+'''
+    alphavss command line: query, create, expose, unexpose, delete and prune snapshots, one operation or a batch
+
+    Every operation prints one JSON line (JSON Lines on stdout, made for automation):
+        {"op": "create", "ok": true, "result": {"set_id": "...", "snapshots": [...]}, "seconds": 4.21}
+        {"op": "expose", "ok": false, "error": "...", "seconds": 0.02}
+
+        * batch runs a file of operations (one command line per line, # comments) on one backend: the CLR, the
+          provider and the volume index are loaded once for all of them.  $SET, $SNAP and $SNAP_<drive letter> stand
+          for the set / snapshot IDs of the last create
+        * --timings adds per-phase durations (the VSS calls: InitializeForBackup, GatherWriterMetadata,
+          PrepareForBackup, DoSnapshotSet...) to every line, and a summary line with the startup costs
+        * --daemon sends the operations to a running alphavss daemon (see daemon.py) instead of loading VSS, its
+          --timings are the daemon's VSS calls
+        * prune never deletes a set whose creation time is unknown
+
+    Usage:
+        alphavss query --volume C:
+        alphavss --context 9 create C: D:
+        alphavss expose 3d13d6e5-b52a-44ca-a50e-02c80042e7bf R:
+        alphavss --context 9 prune --keep 7 --volume C:
+        alphavss --timings batch nightly.txt
+
+        nightly.txt:
+            create C: D:
+            expose $SNAP_C R:
+            # ...
+'''
+import sys
+import json
+import time
+import shlex
+import argparse
+from alphavss.constants import Backup, ExposedLocally, ExposedRemotely
+from alphavss.throttle import normalize_volume_name
+
+
+class _DaemonBackend(object):
+    '''
+        The backend methods, answered by a daemon
+    '''
+    def __init__(self, address):
+        from alphavss.daemon import SnapshotClient
+
+        self.client = SnapshotClient(address) if address else SnapshotClient()
+        self._timings_start = {}
+
+    @property
+    def timings(self):
+        '''
+            Seconds spent per VSS call by the daemon since reset_timings() (the daemon's totals are shared by all of
+            its clients: the calls of another client running at the same time are counted too)
+        '''
+        timings = {}
+        for phase, seconds in self.client.call('timings').items():
+            seconds -= self._timings_start.get(phase, 0.0)
+            if seconds > 0:
+                timings[phase] = seconds
+
+        return timings
+
+    def reset_timings(self):
+        # the daemon's totals stay, they are the start of the next operation
+        self._timings_start = self.client.call('timings')
+
+    def __getattr__(self, method):
+        from alphavss.daemon import METHODS
+
+        if method not in METHODS:
+            raise AttributeError(method)
+
+        return lambda **params: self.client.call(method, **params)
+
+
+def _add_commands(subparsers):
+    query = subparsers.add_parser('query', help='list the snapshot sets')
+    query.add_argument('--volume', action='append', help='only the sets with a snapshot of this volume (repeatable)')
+
+    create = subparsers.add_parser('create', help='take a snapshot set (DoSnapshotSet) of the volumes')
+    create.add_argument('volumes', nargs='+', help='ex. C: D:')
+
+    expose = subparsers.add_parser('expose', help='expose a snapshot')
+    expose.add_argument('snap_id')
+    expose.add_argument('path', help='drive letter or empty directory (share name with --remotely)')
+    expose.add_argument('--remotely', action='store_true', help='expose as a share')
+    expose.add_argument('--path-from-root', help='share this directory of the snapshot (with --remotely)')
+
+    unexpose = subparsers.add_parser('unexpose', help='unexpose a snapshot')
+    unexpose.add_argument('snap_id')
+
+    delete = subparsers.add_parser('delete', help='delete snapshot sets')
+    delete.add_argument('set_ids', nargs='+')
+    delete.add_argument('--force', action='store_true', help='delete even if the snapshots are exposed')
+
+    prune = subparsers.add_parser('prune', help='delete the old snapshot sets')
+    prune.add_argument('--keep', type=int, default=None, help='keep the newest KEEP sets')
+    prune.add_argument('--older-than', type=float, default=None, metavar='HOURS', help='delete the sets older than this')
+    prune.add_argument('--volume', action='append', help='only the sets with a snapshot of this volume (repeatable)')
+    prune.add_argument('--dry-run', action='store_true', help='report what would be deleted')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='alphavss', description='Volume Shadow Copy snapshots from the command line')
+    parser.add_argument('--context', type=int, default=Backup, help='snapshot context (0 = Backup, 9 = AppRollback)')
+    parser.add_argument('--daemon', nargs='?', const='', default=None, metavar='ADDRESS',
+                        help='send the operations to an alphavss daemon (default address if none is given)')
+    parser.add_argument('--memory', action='store_true', help='in-memory backend (no VSS, for testing)')
+    parser.add_argument('--timings', action='store_true', help='print per-phase durations')
+    parser.add_argument('--keep-going', action='store_true', help='keep running a batch after an operation fails')
+    parser.add_argument('--debug', action='store_true')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    _add_commands(subparsers)
+    batch = subparsers.add_parser('batch', help='run a file of operations ("-" for stdin)')
+    batch.add_argument('file')
+
+    return parser
+
+
+def build_batch_parser():
+    parser = argparse.ArgumentParser(prog='alphavss batch', add_help=False)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    _add_commands(subparsers)
+
+    return parser
+
+
+class CommandRunner(object):
+    '''
+        Runs the operations on one backend and prints their JSON lines
+    '''
+    def __init__(self, options:object, out:object=None):
+        self.options = options
+        self.out = out or sys.stdout
+        self.timings = {}
+        self.failed = 0
+        self.last_set = None
+        self.backend = self._backend()
+
+    def _backend(self):
+        start = time.perf_counter()
+        if self.options.memory:
+            from alphavss.daemon import MemoryBackend
+
+            backend = MemoryBackend(context=self.options.context, debug=self.options.debug)
+        elif self.options.daemon is not None:
+            backend = _DaemonBackend(self.options.daemon)
+        else:
+            # starts the CLR and loads AlphaVSS, usually the biggest part of a single operation
+            import alphavss.models #pylint:disable=W0611,C0415
+            from alphavss.daemon import VSSBackend
+
+            self.timings['load'] = time.perf_counter() - start
+            backend = VSSBackend(context=self.options.context, debug=self.options.debug)
+        self.timings['backend'] = time.perf_counter() - start - self.timings.get('load', 0.0)
+
+        return backend
+
+    def emit(self, line):
+        self.out.write(json.dumps(line) + '\n')
+        self.out.flush()
+
+    def run(self, command:object):
+        '''
+            Run one parsed command, prints its line, returns True when it succeeded
+        '''
+        if self.options.timings and hasattr(self.backend, 'reset_timings'):
+            self.backend.reset_timings()
+        start = time.perf_counter()
+        line = {'op': command.command}
+        try:
+            line['result'] = getattr(self, f'do_{command.command}')(command)
+            line['ok'] = True
+        except Exception as e: #pylint:disable=W0703
+            line['ok'] = False
+            line['error'] = str(e)
+            self.failed += 1
+        line['seconds'] = round(time.perf_counter() - start, 6)
+        if self.options.timings and hasattr(self.backend, 'timings'):
+            line['timings'] = {phase: round(seconds, 6) for phase, seconds in self.backend.timings.items()}
+        self.timings[command.command] = self.timings.get(command.command, 0.0) + line['seconds']
+        self.emit(line)
+
+        return line['ok']
+
+    def run_batch(self, lines:object):
+        parser = build_batch_parser()
+        for number, text in enumerate(lines, 1):
+            text = text.strip()
+            if not text or text.startswith('#'):
+                continue
+            try:
+                # not posix: the backslashes of Windows paths stay
+                args = [self.substitute(arg.strip('"')) for arg in shlex.split(text, posix=False)]
+                command = parser.parse_args(args)
+            except (SystemExit, Exception) as e: #pylint:disable=W0703
+                # argparse explains a bad command on stderr
+                error = 'invalid command' if isinstance(e, SystemExit) else str(e)
+                self.failed += 1
+                self.emit({'op': 'batch', 'ok': False, 'line': number, 'error': f'unable to run {text!r}: {error}'})
+                ok = False
+            else:
+                ok = self.run(command)
+            if not ok and not self.options.keep_going:
+                return False
+
+        return True
+
+    def substitute(self, arg):
+        '''
+            $SET, $SNAP, $SNAP_<drive letter>: IDs of the last snapshot set created
+        '''
+        if not arg.startswith('$'):
+            return arg
+        if self.last_set is None:
+            raise Exception(f'{arg} used before any create')
+        if arg == '$SET':
+            return self.last_set['set_id']
+        if arg == '$SNAP':
+            return self.last_set['snapshots'][0]['snap_id']
+        if arg.startswith('$SNAP_'):
+            volume = normalize_volume_name(arg[6:])
+            for snapshot in self.last_set['snapshots']:
+                if normalize_volume_name(snapshot['volume_name']) == volume:
+                    return snapshot['snap_id']
+            raise Exception(f'the last snapshot set has no snapshot of {volume}')
+
+        return arg
+
+    def _sets(self, volumes):
+        sets = self.backend.query(context=self.options.context)
+        if volumes:
+            volumes = {normalize_volume_name(volume) for volume in volumes}
+            sets = [info for info in sets
+                    if volumes & {normalize_volume_name(snapshot['volume_name']) for snapshot in info['snapshots']}]
+
+        return sets
+
+    def do_query(self, command):
+        return self._sets(command.volume)
+
+    def do_create(self, command):
+        volume_names = [f'{normalize_volume_name(volume)}\\' for volume in command.volumes]
+        self.last_set = self.backend.backup(volume_names=volume_names, context=self.options.context)
+
+        return self.last_set
+
+    def do_expose(self, command):
+        attributes = ExposedRemotely if command.remotely else ExposedLocally
+
+        return self.backend.expose(snap_id=command.snap_id, expose_path=command.path, attributes=attributes,
+                                   path_from_root=command.path_from_root)
+
+    def do_unexpose(self, command):
+        return self.backend.unexpose(snap_id=command.snap_id)
+
+    def do_delete(self, command):
+        return {set_id: self.backend.delete(set_id=set_id, force_delete=command.force) for set_id in command.set_ids}
+
+    def do_prune(self, command):
+        if command.keep is None and command.older_than is None:
+            raise Exception('prune needs --keep and/or --older-than')
+        # 'created' is a sortable local time (2022-07-27T21:04:05), a set of unknown age is never pruned
+        sets = self._sets(command.volume)
+        dated = sorted((info for info in sets if _created(info) is not None), key=_created, reverse=True)
+        expired = []
+        for number, info in enumerate(dated):
+            if command.keep is not None and number < command.keep:
+                continue
+            if command.older_than is not None:
+                cutoff = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(time.time() - command.older_than * 3600))
+                if _created(info) >= cutoff:
+                    continue
+            expired.append(info['set_id'])
+        if not command.dry_run:
+            for set_id in expired:
+                self.backend.delete(set_id=set_id, force_delete=False)
+
+        return {'deleted': expired, 'kept': [info['set_id'] for info in sets if info['set_id'] not in expired],
+                'dry_run': command.dry_run}
+
+    def summary(self):
+        if self.options.timings:
+            self.emit({'op': 'summary', 'ok': not self.failed, 'failed': self.failed,
+                       'timings': {name: round(seconds, 6) for name, seconds in self.timings.items()}})
+
+
+def _created(info):
+    '''
+        Creation time of the oldest snapshot of the set, None when one of them has none
+    '''
+    created = [snapshot.get('created') for snapshot in info['snapshots']]
+    if not created or not all(created):
+        return None
+
+    return min(created)
+
+
+def main(args:list=None):
+    '''
+        Entry point of the alphavss command, returns the exit code (1 if an operation failed)
+    '''
+    options = build_parser().parse_args(args)
+    try:
+        runner = CommandRunner(options)
+    except Exception as e: #pylint:disable=W0703
+        print(json.dumps({'op': 'start', 'ok': False, 'error': str(e)}))
+        return 1
+
+    if options.command == 'batch':
+        if options.file == '-':
+            runner.run_batch(sys.stdin)
+        else:
+            with open(options.file, 'r', encoding='utf-8') as batch_file:
+                runner.run_batch(batch_file)
+    else:
+        runner.run(options)
+    runner.summary()
+
+    return 1 if runner.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
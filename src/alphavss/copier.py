@@ -0,0 +1,464 @@
+'''
+    Parallel file copier for getting the contents of a VSSSnapshot out to a backup target
+
+    A single shutil.copytree() of an exposed snapshot copies one file at a time, which leaves the disks idle
+    between files (small file workloads) and waits on every read (large file workloads).
+
+    SnapshotCopier is fed by the SnapshotWalker and copies files on a pool of worker threads:
+        * os.copy_file_range() or os.sendfile() (in kernel copies) where the platform supports them
+        * otherwise a large, reusable (per worker) buffer filled with readinto() (no per-read allocations)
+        * file and directory timestamps are preserved
+        * files/s and MB/s are reported in the CopyStats returned by copy()
+        * a file that fails to copy goes to onerror (or stats.errors), an exception that escapes a worker (onerror
+          raising) stops the copy and is raised by copy()
+
+    Usage:
+        from alphavss.copier import SnapshotCopier
+
+        vss_set = VSSSnapshotSet(volume_names=['C:\\'])
+        snap = vss_set.snapshots[0]
+        snap.expose_snapshot('R:\\')
+        stats = SnapshotCopier(snap, 'E:\\backups\\C', walker_options={'exclude': ['pagefile.sys']}).copy()
+        print(stats)
+'''
+import os
+import sys
+import time
+import errno
+import queue
+import threading
+from alphavss.walker import SnapshotWalker, snapshot_root
+from alphavss.throttle import resolve_throttle
+from alphavss.links import LinkTracker
+
+DEFAULT_COPY_WORKERS = 8
+DEFAULT_BUFFER_SIZE = 1024 * 1024 # 1 MB
+
+# errors meaning "the in kernel copy isn't available here", the copy continues with readinto()
+_FALLBACK_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EBADF, errno.ENOTSUP, errno.EOPNOTSUPP)
+
+_DONE = object()
+
+
+def default_copy_method():
+    '''
+        Best copy method for this platform: 'copy_file_range', 'sendfile' or 'readinto'
+    '''
+    if hasattr(os, 'copy_file_range'):
+        return 'copy_file_range'
+    if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        # sendfile() only supports a regular file as the destination on linux
+        return 'sendfile'
+
+    return 'readinto'
+
+
+class WorkerPool(object):
+    '''
+        Worker threads running handle(item) for the items fed through a bounded queue
+
+        The first exception that escapes handle() stops the pool: put() returns False (the feed loop stops), the items
+        still queued are dropped and join() raises it.  Nothing can block on a pool whose workers died
+    '''
+    def __init__(self, handle:object, workers:int, maxsize:int, name:str, setup:object=None, teardown:object=None):
+        '''
+            handle: (callable) handle(item) or, with setup, handle(item, state)
+            workers: (int) threads
+            maxsize: (int) items that can wait in the queue before put() blocks
+            name: (str) thread name prefix
+            setup: (callable) setup() returns the state of a worker thread (ex. its buffer)
+            teardown: (callable) teardown(state) when the worker thread ends
+        '''
+        self.handle = handle
+        self.setup = setup
+        self.teardown = teardown
+        self.error = None
+        self.failed = threading.Event()
+        self._work = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._threads = []
+        for num in range(workers):
+            thread = threading.Thread(target=self._worker, name=f'{name}-{num}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker(self):
+        state = None
+        try:
+            if self.setup is not None:
+                state = self.setup()
+            while True:
+                item = self._work.get()
+                if item is _DONE:
+                    break
+                if self.failed.is_set():
+                    continue
+                if self.setup is not None:
+                    self.handle(item, state)
+                else:
+                    self.handle(item)
+        except BaseException as e: #pylint:disable=W0703
+            with self._lock:
+                if self.error is None:
+                    self.error = e
+            self.failed.set()
+        finally:
+            if self.teardown is not None and state is not None:
+                self.teardown(state)
+
+    def put(self, item:object):
+        '''
+            Queue an item (blocks while the queue is full), False once the pool has failed
+        '''
+        while not self.failed.is_set():
+            try:
+                self._work.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def join(self, check:bool=True):
+        '''
+            Wait for the queued items (dropped when a worker failed) and the workers, then raise the worker's exception
+            (check=False: the caller raises its own)
+        '''
+        if self.failed.is_set():
+            # dead workers don't take their share of the queue: make room for the _DONE markers
+            while True:
+                try:
+                    self._work.get_nowait()
+                except queue.Empty:
+                    break
+        for _ in self._threads:
+            # only the feeding thread puts: once drained there is room for every marker
+            self._work.put(_DONE)
+        for thread in self._threads:
+            thread.join()
+        if check and self.error is not None:
+            raise self.error
+
+
+class CopyStats(object):
+    '''
+        Counters (thread safe) for a copy run
+    '''
+    def __init__(self):
+        self.files = 0
+        self.dirs = 0
+        self.bytes = 0
+        self.skipped = 0
+        self.errors = 0
+        self.start = time.monotonic()
+        self.end = None
+        self._lock = threading.Lock()
+
+    def add(self, files:int=0, dirs:int=0, nbytes:int=0, skipped:int=0, errors:int=0):
+        with self._lock:
+            self.files += files
+            self.dirs += dirs
+            self.bytes += nbytes
+            self.skipped += skipped
+            self.errors += errors
+
+    def finish(self):
+        self.end = time.monotonic()
+
+    @property
+    def elapsed(self):
+        return (self.end or time.monotonic()) - self.start
+
+    @property
+    def files_per_sec(self):
+        return self.files / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def mb_per_sec(self):
+        return self.bytes / (1024 * 1024) / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self):
+        return {'files': self.files, 'dirs': self.dirs, 'bytes': self.bytes, 'skipped': self.skipped,
+                'errors': self.errors, 'elapsed': round(self.elapsed, 3),
+                'files_per_sec': round(self.files_per_sec, 1), 'mb_per_sec': round(self.mb_per_sec, 1)}
+
+    def __str__(self):
+        return (f'{self.files} file(s), {self.dirs} dir(s), {self.bytes / (1024 * 1024):.1f} MB in {self.elapsed:.2f}s '
+                f'({self.files_per_sec:.0f} files/s, {self.mb_per_sec:.1f} MB/s), '
+                f'{self.skipped} skipped, {self.errors} error(s)')
+
+
+def copy_file_data(src, dst, size:int, buf:bytearray, method:str='readinto', throttle:object=None):
+    '''
+        Copy size bytes from the src file object to the dst file object (both opened unbuffered), returns bytes copied
+
+        buf: (bytearray) reusable buffer for the readinto() method (and the chunk size for the in kernel methods)
+        method: (str) 'copy_file_range', 'sendfile' or 'readinto' (falls back to readinto when the in kernel
+                copy is refused)
+        throttle: (VolumeThrottle) rate limits (and measures the latency of) every read
+    '''
+    chunk = len(buf)
+    offset = 0
+    if method in ('copy_file_range', 'sendfile'):
+        src_fd = src.fileno()
+        dst_fd = dst.fileno()
+        try:
+            while offset < size:
+                count = min(chunk, size - offset)
+                if throttle is not None:
+                    with throttle.read(count):
+                        copied = _kernel_copy(method, src_fd, dst_fd, count, offset)
+                else:
+                    copied = _kernel_copy(method, src_fd, dst_fd, count, offset)
+                if not copied:
+                    break
+                offset += copied
+        except OSError as e:
+            if e.errno not in _FALLBACK_ERRNOS:
+                raise
+        else:
+            if offset >= size:
+                return offset
+        # continue where the in kernel copy stopped (the file may also have grown)
+        src.seek(offset)
+        dst.seek(offset)
+
+    view = memoryview(buf)
+    while True:
+        if throttle is not None:
+            with throttle.read(chunk):
+                read = src.readinto(view)
+        else:
+            read = src.readinto(view)
+        if not read:
+            break
+        dst.write(view[:read])
+        offset += read
+
+    return offset
+
+
+def _kernel_copy(method, src_fd, dst_fd, count, offset):
+    if method == 'copy_file_range':
+        return os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+
+    return os.sendfile(dst_fd, src_fd, offset, count)
+
+
+class SnapshotCopier(object):
+    '''
+        Copy the contents of a snapshot (or any directory tree) to a target directory with a pool of worker threads
+    '''
+    def __init__(self, snapshot:object, target:str, workers:int=DEFAULT_COPY_WORKERS, buffer_size:int=DEFAULT_BUFFER_SIZE,
+                 method:str=None, preserve_times:bool=True, walker_options:dict=None, throttle:object=None,
+                 hard_links:bool=False, onerror:object=None, debug:bool=False):
+        '''
+            snapshot: (str or VSSSnapshot) what to copy (see walker.snapshot_root())
+            target: (str) directory the files are copied into (created if it doesn't exist)
+            workers: (int) number of copy worker threads (more workers help small file workloads the most)
+            buffer_size: (int) size of each worker's reusable buffer
+            method: (str) 'copy_file_range', 'sendfile' or 'readinto' (default: the best one for the platform)
+            preserve_times: (bool) copy the access/modification times of files and directories
+            walker_options: (dict) keyword arguments for the SnapshotWalker (include, exclude, workers...)
+            throttle: (VolumeThrottle or IOScheduler) rate limits the reads (an IOScheduler is resolved with the
+                      snapshot's volume_name), shared with the walker unless walker_options has its own
+            hard_links: (bool) copy the data of a hard linked file once, its other paths become hard links in the
+                        target (see links.py)
+            onerror: (callable) called with (rel_path, exception) for every file that fails to copy (what it raises
+                     stops the copy and is raised by copy())
+            debug: (bool) enables enhanced output
+        '''
+        self.snapshot = snapshot
+        self.root = snapshot_root(snapshot)
+        self.target = target
+        if workers < 1:
+            raise Exception(f'SnapshotCopier needs at least 1 worker: {workers}')
+        self.workers = workers
+        self.buffer_size = buffer_size
+        self.method = method or default_copy_method()
+        if self.method not in ('copy_file_range', 'sendfile', 'readinto'):
+            raise Exception(f'Unknown copy method: {self.method}')
+        self.preserve_times = preserve_times
+        self.walker_options = walker_options or {}
+        self.throttle = resolve_throttle(throttle, snapshot)
+        self.hard_links = hard_links
+        self.links = 0
+        self.onerror = onerror
+        self.debug = debug
+        self.stats = None
+
+    def target_path(self, rel_path:str):
+        return os.path.join(self.target, rel_path)
+
+    def copy(self, entries:object=None):
+        '''
+            Copy everything, returns a CopyStats
+
+            entries: (iterable) WalkEntry objects to copy (default: a SnapshotWalker over the whole snapshot)
+        '''
+        if entries is None:
+            entries = SnapshotWalker(self.root, debug=self.debug, **self._walker_options())
+        self.stats = CopyStats()
+        os.makedirs(self.target, exist_ok=True)
+        pool = self._start()
+
+        # directory times have to be set after their files are written (writing a file changes the directory mtime)
+        dir_times = []
+        links = []
+        tracker = self._link_tracker()
+        try:
+            for entry in entries:
+                if entry.is_dir():
+                    self._make_dir(entry, dir_times)
+                elif entry.is_file():
+                    first = tracker.check(entry, entry.rel_path) if tracker is not None else None
+                    if first is not None:
+                        links.append((entry, first))
+                    elif not self._feed(pool, entry):
+                        # a worker failed, join() raises its error
+                        break
+                else:
+                    # symlinks/junctions/devices are not followed out of a snapshot
+                    self.stats.add(skipped=1)
+            else:
+                self._feed(pool, None)
+        except BaseException:
+            pool.join(check=False)
+            raise
+        else:
+            pool.join()
+        finally:
+            if tracker is not None:
+                tracker.close()
+
+        self._finish(links)
+
+        # deepest directories first, so a parent's times are set after its children
+        for path, times in sorted(dir_times, key=lambda item: item[0].count(os.sep), reverse=True):
+            try:
+                os.utime(path, ns=times)
+            except OSError as e:
+                if self.debug:
+                    print(f'unable to set the times of {path}: {e}')
+
+        self.stats.finish()
+        if self.debug:
+            print(f'copied {self.root} to {self.target}: {self.stats}')
+
+        return self.stats
+
+    # the steps of copy() a subclass can change (see packer.py)
+    def _walker_options(self):
+        '''
+            Keyword arguments of the SnapshotWalker of copy()
+        '''
+        walker_options = dict(self.walker_options)
+        walker_options.setdefault('throttle', self.throttle)
+
+        return walker_options
+
+    def _start(self):
+        '''
+            Set up a copy, returns the WorkerPool the files are fed to
+        '''
+        return WorkerPool(self._copy_entry, self.workers, self.workers * 64, 'alphavss-copier',
+                          setup=lambda: bytearray(self.buffer_size))
+
+    def _feed(self, pool, entry):
+        '''
+            Hand a file to the workers (entry is None once the walk is over), returns False when the pool stopped
+        '''
+        return entry is None or pool.put(entry)
+
+    def _finish(self, links):
+        '''
+            Once the workers are done: the other paths of the hard linked files ([(WalkEntry, rel_path of the copy)])
+        '''
+        self._make_links(links)
+
+    def _link_tracker(self):
+        if not self.hard_links:
+            return None
+
+        return LinkTracker(track_all=self.walker_options.get('follow_reparse_points', False))
+
+    def _make_links(self, links:list):
+        '''
+            Hard link the other paths of the files copied once ([(WalkEntry, rel_path of the copy)]), once every copy
+            is done.  A file system without hard links gets a copy
+        '''
+        self.links = 0
+        buf = None
+        for entry, first in links:
+            path = self.target_path(entry.rel_path)
+            try:
+                try:
+                    os.link(self.target_path(first), path)
+                except FileNotFoundError:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    os.link(self.target_path(first), path)
+            except OSError as e:
+                if self.debug:
+                    print(f'unable to hard link {entry.rel_path} to {first} ({e}), copying it')
+                buf = buf or bytearray(self.buffer_size)
+                try:
+                    self.stats.add(files=1, nbytes=self.copy_file(entry, buf))
+                except OSError as copy_error:
+                    self._error(entry.rel_path, copy_error)
+                continue
+            self.links += 1
+            self.stats.add(files=1)
+
+    def _make_dir(self, entry, dir_times):
+        path = self.target_path(entry.rel_path)
+        try:
+            os.makedirs(path, exist_ok=True)
+        except OSError as e:
+            self._error(entry.rel_path, e)
+            return
+        self.stats.add(dirs=1)
+        if self.preserve_times:
+            st = entry.stat()
+            dir_times.append((path, (st.st_atime_ns, st.st_mtime_ns)))
+
+    def _copy_entry(self, entry, buf):
+        try:
+            nbytes = self.copy_file(entry, buf)
+        except OSError as e:
+            self._error(entry.rel_path, e)
+        else:
+            self.stats.add(files=1, nbytes=nbytes)
+
+    def copy_file(self, entry, buf:bytearray):
+        '''
+            Copy a single WalkEntry to the target (using the worker's buffer), returns the number of bytes copied
+        '''
+        dst_path = self.target_path(entry.rel_path)
+        st = entry.stat()
+        try:
+            dst = open(dst_path, 'wb', buffering=0)
+        except FileNotFoundError:
+            # the walker can hand out a file before its directory entry (directories are scanned in parallel)
+            os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+            dst = open(dst_path, 'wb', buffering=0)
+        with dst, open(entry.path, 'rb', buffering=0) as src:
+            nbytes = copy_file_data(src, dst, st.st_size, buf, method=self.method, throttle=self.throttle)
+
+        if self.preserve_times:
+            os.utime(dst_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+        return nbytes
+
+    def _error(self, rel_path, exception):
+        self.stats.add(errors=1)
+        if self.onerror is not None:
+            self.onerror(rel_path, exception)
+        elif self.debug:
+            print(f'unable to copy {rel_path}: {exception}')
+
+
+def copy_snapshot(snapshot:object, target:str, **kwargs):
+    '''
+        Shortcut for SnapshotCopier(snapshot, target, **kwargs).copy()
+    '''
+    return SnapshotCopier(snapshot, target, **kwargs).copy()
@@ -0,0 +1,514 @@
+'''
+    Long running snapshot daemon with a local IPC API
+
+    Importing alphavss.models starts the CLR, loads AlphaVSS, builds a VssFactory and connects to WMI: a script that does one
+    query pays all of that every time it runs.  SnapshotServer keeps one warm backend (providers and factories per
+    context, the volume index, the snapshot objects it handed out) and serves requests from local clients:
+
+        * transport: multiprocessing.connection, a named pipe on Windows (\\\\.\\pipe\\alphavss), a Unix socket
+          elsewhere (the protocol and the clients can be exercised on Linux with the MemoryBackend)
+        * messages: one JSON object per message
+              request   {"id": 1, "method": "query", "params": {...}}
+              response  {"id": 1, "result": ...}  or  {"id": 1, "error": {"type": "Exception", "message": "..."}}
+        * methods: ping, volumes, query, backup, expose, unexpose, delete (see VSSBackend) and timings (seconds
+          spent per VSS call since the daemon started, all clients together)
+        * every client gets a thread, the VSS calls themselves are serialized (VSS runs one backup sequence at a time)
+
+    SnapshotClient mirrors the VSSProvider API (query_snapshots() returns snapshot sets holding snapshots that can be
+    exposed, unexposed and deleted), without loading the CLR in the client process.
+
+    Usage:
+        python -m alphavss.daemon                               # serve on the default address (run as administrator)
+
+        from alphavss.daemon import SnapshotClient
+
+        with SnapshotClient() as client:
+            for vss_set in client.query_snapshots():
+                print(vss_set.set_id, [snap.volume_name for snap in vss_set.snapshots])
+            vss_set = client.create_snapshot_set(['C:\\'])
+            vss_set.snapshots[0].expose_snapshot('R:\\')
+'''
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import tempfile
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+from alphavss.constants import Backup, ExposedLocally
+from alphavss.deadlines import PhaseTimeout, VSSPhaseTimeout
+from alphavss.throttle import normalize_volume_name
+
+if sys.platform == 'win32':
+    DEFAULT_ADDRESS = '\\\\.\\pipe\\alphavss'
+    FAMILY = 'AF_PIPE'
+else:
+    DEFAULT_ADDRESS = os.path.join(tempfile.gettempdir(), 'alphavss.sock')
+    FAMILY = 'AF_UNIX'
+
+METHODS = ('ping', 'volumes', 'query', 'backup', 'expose', 'unexpose', 'delete', 'timings')
+
+
+def snapshot_info(snapshot:object):
+    '''
+        JSON friendly description of a VSSSnapshot
+    '''
+    snap_object = snapshot.snap_object
+    try:
+        device_path = snapshot.get_device_path()
+    except Exception: #pylint:disable=W0703
+        device_path = None
+
+    return {'snap_id': str(snapshot.snap_id), 'set_id': str(getattr(snapshot, 'set_id', '') or '') or None,
+            'volume_name': snapshot.volume_name, 'device_path': device_path, 'exposed_path': snapshot.exposed_path,
+            'original_volume': str(snap_object.OriginalVolumeName) if snap_object is not None else None,
+            # sortable local time: 2022-07-27T21:04:05
+            'created': snap_object.CreationTimestamp.ToString('s') if snap_object is not None else None}
+
+
+def set_info(vss_set:object):
+    '''
+        JSON friendly description of a VSSSnapshotSet
+    '''
+    return {'set_id': str(vss_set.set_id), 'context': vss_set.context, 'volume_names': list(vss_set.volume_names or []),
+            'snapshots': [snapshot_info(snapshot) for snapshot in vss_set.snapshots]}
+
+
+class VSSBackend(object):
+    '''
+        The daemon's VSS state: providers (and their factories) per context, the volume index and the snapshot
+        objects returned by the last query/backup (an exposed snapshot keeps the components it was exposed with)
+    '''
+    def __init__(self, context:int=Backup, debug:bool=False):
+        from alphavss import models
+
+        self.models = models
+        self.context = context
+        self.debug = debug
+        self._providers = {}
+        self._sets = {}
+        self._snapshots = {}
+        models.warm_volume_index()
+
+    def _provider(self, operation, context):
+        key = (operation, context)
+        if key not in self._providers:
+            self._providers[key] = self.models.VSSProvider(operation=operation, context=context, debug=self.debug)
+
+        return self._providers[key]
+
+    def _remember(self, vss_set):
+        self._sets[str(vss_set.set_id)] = vss_set
+        for snapshot in vss_set.snapshots:
+            known = self._snapshots.get(str(snapshot.snap_id))
+            if known is not None and known.exposed_path:
+                # keep the object that exposed it (and its components), with the new properties
+                known.snap_object = snapshot.snap_object or known.snap_object
+                vss_set.snapshots[vss_set.snapshots.index(snapshot)] = known
+                continue
+            self._snapshots[str(snapshot.snap_id)] = snapshot
+
+    def _snapshot(self, snap_id):
+        snapshot = self._snapshots.get(str(snap_id).strip('{}').lower())
+        if snapshot is None:
+            self.query()
+            snapshot = self._snapshots.get(str(snap_id).strip('{}').lower())
+        if snapshot is None:
+            raise Exception(f'Snapshot not found: {snap_id}')
+
+        return snapshot
+
+    @property
+    def timings(self):
+        '''
+            Seconds spent per VSS call since reset_timings(), see models.timed()
+        '''
+        timings = {}
+        for provider in self._providers.values():
+            for phase, seconds in provider.timings.items():
+                timings[phase] = timings.get(phase, 0.0) + seconds
+
+        return timings
+
+    def reset_timings(self):
+        for provider in self._providers.values():
+            provider.timings.clear()
+
+    def volumes(self, refresh:bool=False):
+        return self.models.warm_volume_index(refresh=refresh)
+
+    def query(self, context:int=None):
+        vss_sets = self._provider('query', self.context if context is None else context).query_snapshots()
+        for vss_set in vss_sets:
+            self._remember(vss_set)
+
+        return [set_info(vss_set) for vss_set in vss_sets]
+
+    def backup(self, volume_names:list, context:int=None, deadlines:dict=None):
+        context = self.context if context is None else context
+        vss_set = self.models.VSSSnapshotSet(volume_names=volume_names, provider=self._provider('backup', context),
+                                             context=context, deadlines=deadlines, debug=self.debug)
+        self._remember(vss_set)
+
+        return set_info(vss_set)
+
+    def expose(self, snap_id:str, expose_path:str, attributes:int=ExposedLocally, path_from_root:str=None):
+        snapshot = self._snapshot(snap_id)
+        if not snapshot.expose_snapshot(expose_path, attributes=attributes, path_from_root=path_from_root):
+            raise Exception(f'Unable to expose snapshot {snap_id} to {expose_path}')
+
+        return snapshot_info(snapshot)
+
+    def unexpose(self, snap_id:str):
+        snapshot = self._snapshot(snap_id)
+        snapshot.unexpose_snapshot()
+
+        return snapshot_info(snapshot)
+
+    def delete(self, set_id:str, force_delete:bool=False):
+        vss_set = self._sets.get(str(set_id).strip('{}').lower())
+        if vss_set is None:
+            self.query()
+            vss_set = self._sets.get(str(set_id).strip('{}').lower())
+        if vss_set is None:
+            raise Exception(f'Snapshot set not found: {set_id}')
+        # a 'query' provider: no GatherWriterMetadata just to delete
+        provider = self._provider('query', vss_set.provider.context)
+        components = provider.create_backup_components()
+        provider._initialize(components)
+        deleted = vss_set.delete(components, force_delete=force_delete)
+        del self._sets[str(vss_set.set_id)]
+        for snapshot in vss_set.snapshots:
+            self._snapshots.pop(str(snapshot.snap_id), None)
+
+        return deleted
+
+
+class MemoryBackend(object):
+    '''
+        Backend with the VSSBackend methods and no VSS behind it: snapshot sets live in memory (clients and
+        the protocol can be developed and tested on any platform)
+    '''
+    def __init__(self, volumes:dict=None, context:int=Backup, debug:bool=False):
+        '''
+            volumes: (dict) drive letter -> volume GUID path, like get_drives() (default: C: and D:)
+        '''
+        self._volumes = volumes or {'C:': f'\\\\?\\Volume{{{uuid.uuid4()}}}\\', 'D:': f'\\\\?\\Volume{{{uuid.uuid4()}}}\\'}
+        self.context = context
+        self.debug = debug
+        self._sets = {}
+        self._devices = 0
+
+    def volumes(self, refresh:bool=False):
+        return dict(self._volumes)
+
+    def query(self, context:int=None):
+        return [json.loads(json.dumps(info)) for info in self._sets.values()
+                if context is None or info['context'] == context]
+
+    def backup(self, volume_names:list, context:int=None, deadlines:dict=None):
+        set_id = str(uuid.uuid4())
+        snapshots = []
+        for volume_name in volume_names:
+            volume = normalize_volume_name(volume_name)
+            if volume not in self._volumes:
+                raise Exception(f'Volume {volume_name} is not supported for Backup')
+            self._devices += 1
+            snapshots.append({'snap_id': str(uuid.uuid4()), 'set_id': set_id, 'volume_name': f'{volume}\\',
+                              'device_path': f'\\\\?\\GLOBALROOT\\Device\\HarddiskVolumeShadowCopy{self._devices}\\',
+                              'exposed_path': None, 'original_volume': self._volumes[volume],
+                              'created': time.strftime('%Y-%m-%dT%H:%M:%S')})
+        self._sets[set_id] = {'set_id': set_id, 'context': self.context if context is None else context,
+                              'volume_names': list(volume_names), 'snapshots': snapshots}
+
+        return self._sets[set_id]
+
+    def _snapshot(self, snap_id):
+        for info in self._sets.values():
+            for snapshot in info['snapshots']:
+                if snapshot['snap_id'] == str(snap_id).strip('{}').lower():
+                    return snapshot
+
+        raise Exception(f'Snapshot not found: {snap_id}')
+
+    def expose(self, snap_id:str, expose_path:str, attributes:int=ExposedLocally, path_from_root:str=None):
+        snapshot = self._snapshot(snap_id)
+        if snapshot['exposed_path']:
+            raise Exception(f'Unable to expose snapshot {snap_id} to {expose_path}')
+        snapshot['exposed_path'] = expose_path
+
+        return snapshot
+
+    def unexpose(self, snap_id:str):
+        snapshot = self._snapshot(snap_id)
+        snapshot['exposed_path'] = None
+
+        return snapshot
+
+    def delete(self, set_id:str, force_delete:bool=False):
+        info = self._sets.pop(str(set_id).strip('{}').lower(), None)
+        if info is None:
+            raise Exception(f'Snapshot set not found: {set_id}')
+
+        return len(info['snapshots'])
+
+
+class SnapshotServer(object):
+    '''
+        Serve a backend to local clients (see the module docstring)
+    '''
+    def __init__(self, backend:object=None, address:str=DEFAULT_ADDRESS, authkey:bytes=None, debug:bool=False):
+        '''
+            backend: (object) VSSBackend (default) or MemoryBackend
+            address: (str) named pipe (Windows) or Unix socket path
+            authkey: (bytes) shared secret the clients must present (multiprocessing.connection authentication)
+            debug: (bool) enables enhanced output
+        '''
+        self.backend = backend if backend is not None else VSSBackend(debug=debug)
+        self.address = address
+        self.authkey = authkey
+        self.debug = debug
+        self.requests = 0
+        self.started = time.monotonic()
+        self._lock = threading.Lock() # one VSS call at a time
+        self._listener = None
+        self._closing = False
+        self._thread = None
+
+    def listen(self):
+        if FAMILY == 'AF_UNIX' and os.path.exists(self.address):
+            # left behind by a daemon that didn't exit cleanly
+            os.remove(self.address)
+        self._listener = Listener(self.address, family=FAMILY, authkey=self.authkey)
+        if FAMILY == 'AF_UNIX':
+            # creating and deleting snapshots is for administrators: the socket is for the daemon's user only
+            os.chmod(self.address, 0o600)
+        if self.debug:
+            print(f'alphavss daemon listening on {self.address}')
+
+    def serve_forever(self):
+        if self._listener is None:
+            self.listen()
+        try:
+            while not self._closing:
+                try:
+                    conn = self._listener.accept()
+                except (OSError, AuthenticationError) as e:
+                    # a client with the wrong authkey doesn't stop the daemon either
+                    if self._closing:
+                        break
+                    if self.debug:
+                        print(f'accept failed: {e}')
+                    continue
+                if self._closing:
+                    conn.close()
+                    break
+                threading.Thread(target=self._serve_client, args=(conn,), name='alphavss-daemon-client',
+                                 daemon=True).start()
+        finally:
+            self._listener.close()
+
+    def start(self):
+        '''
+            Serve from a background thread (returns once the server listens)
+        '''
+        self.listen()
+        self._thread = threading.Thread(target=self.serve_forever, name='alphavss-daemon', daemon=True)
+        self._thread.start()
+
+        return self
+
+    def close(self):
+        self._closing = True
+        if self._listener is not None:
+            try:
+                # wake up accept()
+                Client(self.address, family=FAMILY, authkey=self.authkey).close()
+            except OSError:
+                pass
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _serve_client(self, conn):
+        try:
+            while True:
+                try:
+                    message = conn.recv_bytes()
+                except (EOFError, OSError):
+                    break
+                conn.send_bytes(json.dumps(self.handle(message)).encode('utf-8'))
+        finally:
+            conn.close()
+
+    def handle(self, message:bytes):
+        '''
+            Answer one request message (a response dict)
+        '''
+        request_id = None
+        try:
+            request = json.loads(message)
+            request_id = request.get('id')
+            method = request.get('method')
+            params = request.get('params') or {}
+            if method not in METHODS:
+                raise Exception(f'Unknown method: {method}')
+            if method == 'ping':
+                result = {'pid': os.getpid(), 'uptime': round(time.monotonic() - self.started, 3),
+                          'requests': self.requests}
+            elif method == 'timings':
+                with self._lock:
+                    result = dict(getattr(self.backend, 'timings', {}))
+            else:
+                with self._lock:
+                    result = getattr(self.backend, method)(**params)
+            self.requests += 1
+        except Exception as e: #pylint:disable=W0703
+            if self.debug:
+                print(f'request {request_id} failed: {e}')
+            error = {'type': e.__class__.__name__, 'message': str(e)}
+            if hasattr(e, 'info'):
+                # VSSPhaseTimeout: phase, deadline, elapsed... for the client to decide where to retry
+                error['timeout'] = e.info.as_dict()
+            return {'id': request_id, 'error': error}
+
+        return {'id': request_id, 'result': result}
+
+
+class SnapshotClient(object):
+    '''
+        Client of a SnapshotServer, mirrors the VSSProvider API
+    '''
+    def __init__(self, address:str=DEFAULT_ADDRESS, authkey:bytes=None, context:int=Backup):
+        self.address = address
+        self.context = context
+        self._conn = Client(address, family=FAMILY, authkey=authkey)
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def call(self, method:str, **params):
+        '''
+            Send one request, returns its result (raises the server's error)
+        '''
+        with self._lock:
+            self._next_id += 1
+            self._conn.send_bytes(json.dumps({'id': self._next_id, 'method': method, 'params': params}).encode('utf-8'))
+            response = json.loads(self._conn.recv_bytes())
+        if 'error' in response:
+            if 'timeout' in response['error']:
+                raise VSSPhaseTimeout(PhaseTimeout(**response['error']['timeout']))
+            raise Exception(f'{method} failed on the daemon: {response["error"]["type"]}: {response["error"]["message"]}')
+
+        return response['result']
+
+    def ping(self):
+        return self.call('ping')
+
+    def get_drives(self, refresh:bool=False):
+        return self.call('volumes', refresh=refresh)
+
+    def query_snapshots(self):
+        return [RemoteSnapshotSet(self, info) for info in self.call('query', context=self.context)]
+
+    def create_snapshot_set(self, volume_names:list, context:int=None, deadlines:dict=None):
+        '''
+            Take the snapshots of volume_names (ex. ['C:\\', 'D:\\']), returns a RemoteSnapshotSet
+
+            deadlines: (dict) seconds per VSS phase (see deadlines.py)
+        '''
+        return RemoteSnapshotSet(self, self.call('backup', volume_names=volume_names, deadlines=deadlines,
+                                                 context=self.context if context is None else context))
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class RemoteSnapshotSet(object):
+    '''
+        VSSSnapshotSet served by the daemon
+    '''
+    def __init__(self, client:SnapshotClient, info:dict):
+        self.client = client
+        self.set_id = info['set_id']
+        self.context = info['context']
+        self.volume_names = info['volume_names']
+        self.snapshots = [RemoteSnapshot(client, snapshot) for snapshot in info['snapshots']]
+
+    def __repr__(self):
+        return f'RemoteSnapshotSet({self.set_id}, {self.volume_names})'
+
+    def delete(self, force_delete:bool=False):
+        return self.client.call('delete', set_id=self.set_id, force_delete=force_delete)
+
+
+class RemoteSnapshot(object):
+    '''
+        VSSSnapshot served by the daemon
+    '''
+    def __init__(self, client:SnapshotClient, info:dict):
+        self.client = client
+        self._update(info)
+
+    def __repr__(self):
+        return f'RemoteSnapshot({self.snap_id}, {self.volume_name})'
+
+    def _update(self, info):
+        self.snap_id = info['snap_id']
+        self.set_id = info['set_id']
+        self.volume_name = info['volume_name']
+        self.device_path = info['device_path']
+        self.exposed_path = info['exposed_path']
+        self.original_volume = info['original_volume']
+        self.created = info['created']
+
+    def get_device_path(self):
+        return self.device_path
+
+    def expose_snapshot(self, expose_path:str, attributes:int=ExposedLocally, path_from_root:str=None):
+        self._update(self.client.call('expose', snap_id=self.snap_id, expose_path=expose_path, attributes=attributes,
+                                      path_from_root=path_from_root))
+
+        return True
+
+    def unexpose_snapshot(self):
+        self._update(self.client.call('unexpose', snap_id=self.snap_id))
+
+        return True
+
+
+def main(args:list=None):
+    parser = argparse.ArgumentParser(prog='python -m alphavss.daemon', description='alphavss snapshot daemon')
+    parser.add_argument('--address', default=DEFAULT_ADDRESS, help='named pipe / Unix socket to listen on')
+    parser.add_argument('--context', type=int, default=Backup, help='default snapshot context (AppRollback = 9)')
+    parser.add_argument('--memory', action='store_true', help='serve the in-memory backend (no VSS, for testing)')
+    parser.add_argument('--debug', action='store_true')
+    options = parser.parse_args(args)
+
+    if options.memory:
+        backend = MemoryBackend(context=options.context, debug=options.debug)
+    else:
+        backend = VSSBackend(context=options.context, debug=options.debug)
+    server = SnapshotServer(backend, address=options.address, debug=options.debug)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
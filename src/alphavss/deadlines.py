@@ -0,0 +1,115 @@
+'''
+    Deadlines and cancellation for the long VSS phases (GatherWriterMetadata, PrepareForBackup, DoSnapshotSet)
+
+    The synchronous calls block until VSS gives up on its own: a hung writer holds a backup window for its full
+    timeout and nothing aborts the backup.  run_phase() runs a phase through its asynchronous form (Begin<phase> /
+    End<phase>, an IVssAsync underneath), waits for it in short slices and, when the deadline passes or the cancel
+    event is set:
+
+        * cancels the asynchronous operation and calls AbortBackup() (the writers thaw, the set is dropped)
+        * disposes of the components object
+        * raises VSSPhaseTimeout, whose info (PhaseTimeout) tells a scheduler what happened: phase, deadline, time
+          spent, snapshot set, volumes, whether the abort went through
+
+    Deadlines are seconds per phase, ex. {'PrepareForBackup': 120, 'DoSnapshotSet': 60}; a phase missing from the
+    mapping (or None) runs without a deadline.  Give them to the VSSProvider (every set it backs up) or to one
+    VSSSnapshotSet (deadlines=..., cancel=threading.Event()).
+
+    The Begin<phase>(AsyncCallback, state) / End<phase>(IAsyncResult) pairs of IVssBackupComponents, returning an
+    IVssAsyncResult (AsyncWaitHandle, Cancel()), are the ones of AlphaVSS 2.0.0 (the DLLs under lib\AlphaVSS\2.0.0).
+    They are marked obsolete there in favor of the Task based <phase>Async methods, a later AlphaVSS that drops them
+    needs run_phase() ported to those.  A Replay (replay.py) answers them too.
+
+    Usage:
+        from alphavss.deadlines import VSSPhaseTimeout
+
+        try:
+            vss_set = VSSSnapshotSet(volume_names=['C:\\'], deadlines={'PrepareForBackup': 120, 'DoSnapshotSet': 60})
+        except VSSPhaseTimeout as e:
+            print(e.info.as_dict())      # retry elsewhere / later
+'''
+import time
+from collections import namedtuple
+
+PHASES = ('GatherWriterMetadata', 'PrepareForBackup', 'DoSnapshotSet')
+WAIT_SLICE = 0.25 # seconds between checks of the cancel event
+
+
+class PhaseTimeout(namedtuple('PhaseTimeout', ['phase', 'deadline', 'elapsed', 'cancelled', 'set_id', 'volume_names',
+                                               'aborted', 'abort_error'])):
+    '''
+        What a phase that didn't finish in time looked like
+    '''
+    __slots__ = ()
+
+    def as_dict(self):
+        info = self._asdict()
+        info['set_id'] = str(self.set_id) if self.set_id is not None else None
+        info['volume_names'] = list(self.volume_names or [])
+
+        return info
+
+
+class VSSPhaseTimeout(Exception):
+    '''
+        A VSS phase passed its deadline (or was cancelled) and the backup was aborted, see info
+    '''
+    def __init__(self, info:PhaseTimeout):
+        reason = 'was cancelled' if info.cancelled else f'passed its {info.deadline}s deadline'
+        super().__init__(f'{info.phase} {reason} after {info.elapsed:.1f}s '
+                         f'(backup {"aborted" if info.aborted else "NOT aborted: " + str(info.abort_error)})')
+        self.info = info
+
+
+def run_phase(components:object, phase:str, deadline:float=None, cancel:object=None, set_id:object=None,
+              volume_names:list=None, timings:dict=None):
+    '''
+        Run components.<phase>() with a deadline (seconds) and/or a cancel event (threading.Event)
+
+        Without either it is the plain synchronous call.  Returns the result of End<phase>, raises VSSPhaseTimeout
+        after aborting the backup
+    '''
+    start = time.perf_counter()
+    try:
+        if deadline is None and cancel is None:
+            return getattr(components, phase)()
+
+        result = getattr(components, f'Begin{phase}')(None, None)
+        wait_handle = result.AsyncWaitHandle
+        while True:
+            elapsed = time.perf_counter() - start
+            if cancel is not None and cancel.is_set():
+                _abort(components, result, phase, deadline, elapsed, True, set_id, volume_names)
+            if deadline is not None and elapsed >= deadline:
+                _abort(components, result, phase, deadline, elapsed, False, set_id, volume_names)
+            wait = WAIT_SLICE if cancel is not None else deadline - elapsed
+            if deadline is not None:
+                wait = min(wait, deadline - elapsed)
+            if wait_handle.WaitOne(max(1, int(wait * 1000))):
+                break
+
+        return getattr(components, f'End{phase}')(result)
+    finally:
+        if timings is not None:
+            timings[phase] = timings.get(phase, 0.0) + time.perf_counter() - start
+
+
+def _abort(components, result, phase, deadline, elapsed, cancelled, set_id, volume_names):
+    aborted = True
+    abort_error = None
+    try:
+        result.Cancel()
+    except Exception: #pylint:disable=W0703
+        # already finished / not cancellable: AbortBackup is what matters
+        pass
+    try:
+        components.AbortBackup()
+    except Exception as e: #pylint:disable=W0703
+        aborted = False
+        abort_error = str(e)
+    try:
+        components.Dispose()
+    except Exception: #pylint:disable=W0703
+        pass
+
+    raise VSSPhaseTimeout(PhaseTimeout(phase, deadline, elapsed, cancelled, set_id, volume_names, aborted, abort_error))
@@ -0,0 +1,644 @@
+'''
+    Content defined chunking and a deduplicated chunk store for snapshot backups
+
+    Consecutive persistent snapshots (AppRollback context) of the same volume are mostly identical, copying them file
+    by file stores the same data over and over.  ChunkStore splits the content read from a VSSSnapshot into chunks with
+    a rolling (gear) hash, so an insert in a file only changes the chunks around it, and stores every distinct chunk once:
+
+        store/
+            packs/pack-000001.pack      append only pack files: <20s digest> <B codec> <I length> data ...
+            index                       sorted fixed size records: <20s digest> <I pack> <Q offset> <I length>
+            snapshots/<name>.recipe     the files of an ingested snapshot and the digests of their chunks
+
+        * chunks are addressed by their blake2b (160 bit) digest
+        * the index costs 36 bytes per distinct chunk on disk and is memory mapped (binary searched) instead of being
+          loaded in a dict, so it stays workable for multi TB volumes (10 TB of 1 MB chunks ~ 360 MB of index); the
+          chunks added by an ingest are merged into it every FLUSH_CHUNKS new chunks, so the dict of the new ones stays
+          small too (~50 MB)
+        * the chunk boundaries are searched with numpy when it is installed (pip install numpy, ~50 MB/s per core),
+          otherwise with a pure Python loop over every byte (~7 MB/s per core: fine for small trees, days for a
+          multi TB volume); both find the exact same boundaries
+        * chunking and hashing run in a process pool (every core), the main process only looks up digests and
+          appends the new chunks to the current pack (the snapshot can't change, so new chunks are simply re-read)
+        * ingest() returns IngestStats with the throughput and the dedup ratio of the run
+
+    Usage:
+        from alphavss.dedup import ChunkStore
+
+        with ChunkStore('E:\\dedup') as store:
+            print(store.ingest(snap, 'C-20261019'))
+            store.restore('C-20261019', 'E:\\restore\\C')
+'''
+import os
+import json
+import mmap
+import time
+import zlib
+import struct
+import hashlib
+import collections
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import numpy
+except ImportError:
+    numpy = None
+from alphavss.walker import SnapshotWalker, snapshot_root
+from alphavss.archive import archive_path, CODEC_NONE, CODEC_ZLIB
+from alphavss.throttle import resolve_throttle
+
+DIGEST_SIZE = 20
+DEFAULT_MIN_SIZE = 256 * 1024
+DEFAULT_AVG_SIZE = 1024 * 1024
+DEFAULT_MAX_SIZE = 4 * 1024 * 1024
+DEFAULT_PACK_SIZE = 1024 * 1024 * 1024 # 1 GB
+READ_SIZE = 8 * 1024 * 1024
+FLUSH_CHUNKS = 256 * 1024 # new chunks kept in memory before the index is merged
+GEAR_WINDOW = 32 # bytes a gear hash depends on (each one is shifted out after 32 more)
+
+_INDEX_RECORD = struct.Struct(f'<{DIGEST_SIZE}sIQI')
+_PACK_RECORD = struct.Struct(f'<{DIGEST_SIZE}sBI')
+_RECIPE_RECORD = struct.Struct('<HQqI')
+RECIPE_MAGIC = b'AVSSRCP1'
+
+
+def _gear_table():
+    # 256 pseudo random 32 bit values, deterministic so chunk boundaries never change between runs/versions
+    table = []
+    for value in range(256):
+        table.append(int.from_bytes(hashlib.blake2b(bytes([value]), digest_size=4).digest(), 'little'))
+    return tuple(table)
+
+
+GEAR = _gear_table()
+_GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint32) if numpy is not None else None
+
+
+def chunk_digest(data:bytes):
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+def find_boundaries(data:object, min_size:int=DEFAULT_MIN_SIZE, avg_size:int=DEFAULT_AVG_SIZE,
+                    max_size:int=DEFAULT_MAX_SIZE, final:bool=True):
+    '''
+        Chunk end offsets in data (content defined with a gear rolling hash)
+
+        Nothing is hashed in the first min_size bytes of a chunk (cut point skipping), a chunk ends where the top bits of
+        the hash are all zero (about every avg_size - min_size bytes) or at max_size.
+        final: (bool) data is the end of the file, otherwise the last (incomplete) chunk is left out
+    '''
+    bits = max(1, (avg_size - min_size).bit_length() - 1)
+    mask = ((1 << bits) - 1) << (32 - bits)
+    if numpy is not None and len(data) > min_size:
+        return _find_boundaries_numpy(data, min_size, max_size, final, mask)
+    gear = GEAR
+    size = len(data)
+    boundaries = []
+    start = 0
+    while start < size:
+        end = min(size, start + max_size)
+        cut = end
+        if end - start > min_size:
+            h = 0
+            position = start + min_size
+            for byte in data[position:end]:
+                h = ((h << 1) + gear[byte]) & 0xFFFFFFFF
+                position += 1
+                if not h & mask:
+                    cut = position
+                    break
+        if cut == size and not final and cut - start < max_size:
+            # the chunk might continue in the next read
+            break
+        boundaries.append(cut)
+        start = cut
+
+    return boundaries
+
+
+def _window_hashes(data):
+    # gear hash of the GEAR_WINDOW bytes ending at every offset: sum(gear[data[p - k]] << k), built by doubling the
+    # window (1, 2, 4 ... 32 bytes) instead of one pass per byte of it (uint32 arithmetic wraps like the & 0xFFFFFFFF)
+    hashes = _GEAR_ARRAY[numpy.frombuffer(data, dtype=numpy.uint8)]
+    width = 1
+    while width < GEAR_WINDOW:
+        # the right hand side is a new array: the in place add doesn't see its own updates
+        hashes[width:] += hashes[:-width] << numpy.uint32(width)
+        width *= 2
+
+    return hashes
+
+
+def _find_boundaries_numpy(data, min_size, max_size, final, mask):
+    '''
+        find_boundaries() with the hashes computed by numpy for the whole buffer: same boundaries (the loop restarts its
+        hash at every chunk, so the first GEAR_WINDOW - 1 bytes after a restart are still hashed in Python)
+    '''
+    size = len(data)
+    candidates = numpy.flatnonzero((_window_hashes(data) & numpy.uint32(mask)) == 0)
+    gear = GEAR
+    boundaries = []
+    start = 0
+    while start < size:
+        end = min(size, start + max_size)
+        cut = end
+        if end - start > min_size:
+            position = start + min_size
+            found = None
+            h = 0
+            for offset in range(position, min(end, position + GEAR_WINDOW - 1)):
+                h = ((h << 1) + gear[data[offset]]) & 0xFFFFFFFF
+                if not h & mask:
+                    found = offset
+                    break
+            if found is None:
+                # from here on the loop's hash only covers the window: the precomputed one
+                index = numpy.searchsorted(candidates, position + GEAR_WINDOW - 1)
+                if index < len(candidates) and candidates[index] < end:
+                    found = int(candidates[index])
+            if found is not None:
+                cut = found + 1
+        if cut == size and not final and cut - start < max_size:
+            break
+        boundaries.append(cut)
+        start = cut
+
+    return boundaries
+
+
+def chunk_file(path:str, min_size:int=DEFAULT_MIN_SIZE, avg_size:int=DEFAULT_AVG_SIZE, max_size:int=DEFAULT_MAX_SIZE):
+    '''
+        [(length, digest), ...] of the chunks of a file
+
+        Runs in the chunking process pool, so it has to stay a module level function (picklable)
+    '''
+    chunks = []
+    pending = b''
+    with open(path, 'rb') as src:
+        while True:
+            data = src.read(READ_SIZE)
+            final = not data
+            buf = pending + data if pending else data
+            if not buf:
+                break
+            view = memoryview(buf)
+            start = 0
+            for cut in find_boundaries(view, min_size, avg_size, max_size, final=final):
+                chunks.append((cut - start, chunk_digest(view[start:cut])))
+                start = cut
+            pending = bytes(view[start:])
+            view.release()
+            if final:
+                break
+
+    return chunks
+
+
+class ChunkIndex(object):
+    '''
+        digest -> (pack id, offset, length)
+
+        The committed index is a sorted file of fixed size records searched through mmap, chunks added since the
+        last flush() are kept in a dict
+    '''
+    def __init__(self, path:str):
+        self.path = path
+        self._new = {}
+        self._file = None
+        self._map = None
+        self._count = 0
+        self._open()
+
+    def _open(self):
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            self._file = open(self.path, 'rb')
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._count = len(self._map) // _INDEX_RECORD.size
+
+    def _close(self):
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+        self._map = None
+        self._file = None
+        self._count = 0
+
+    def __len__(self):
+        return self._count + len(self._new)
+
+    @property
+    def pending(self):
+        '''
+            Chunks added since the last flush()
+        '''
+        return len(self._new)
+
+    def get(self, digest:bytes):
+        location = self._new.get(digest)
+        if location is not None:
+            return location
+
+        low = 0
+        high = self._count
+        record_size = _INDEX_RECORD.size
+        while low < high:
+            middle = (low + high) // 2
+            offset = middle * record_size
+            key = self._map[offset:offset + DIGEST_SIZE]
+            if key < digest:
+                low = middle + 1
+            elif key > digest:
+                high = middle
+            else:
+                return _INDEX_RECORD.unpack_from(self._map, offset)[1:]
+
+        return None
+
+    def __contains__(self, digest:bytes):
+        return self.get(digest) is not None
+
+    def add(self, digest:bytes, pack_id:int, offset:int, length:int):
+        self._new[digest] = (pack_id, offset, length)
+
+    def _committed(self):
+        for number in range(self._count):
+            yield _INDEX_RECORD.unpack_from(self._map, number * _INDEX_RECORD.size)
+
+    def flush(self):
+        '''
+            Merge the new chunks into the sorted index file (written to a temporary file and swapped in)
+        '''
+        if not self._new:
+            return
+        new = sorted((digest,) + location for digest, location in self._new.items())
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'wb', buffering=READ_SIZE) as index_file:
+            for record in _merge_sorted(self._committed(), new):
+                index_file.write(_INDEX_RECORD.pack(*record))
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        # the memory map has to go before the file can be replaced (Windows)
+        self._close()
+        os.replace(tmp_path, self.path)
+        self._new = {}
+        self._open()
+
+    def close(self):
+        self.flush()
+        self._close()
+
+
+def _merge_sorted(first, second):
+    second = iter(second)
+    pending = next(second, None)
+    for record in first:
+        while pending is not None and pending[0] < record[0]:
+            yield pending
+            pending = next(second, None)
+        yield record
+    while pending is not None:
+        yield pending
+        pending = next(second, None)
+
+
+class PackWriter(object):
+    '''
+        Appends chunks to the current pack file (a new pack is started once max_pack_size is reached)
+    '''
+    def __init__(self, pack_dir:str, max_pack_size:int=DEFAULT_PACK_SIZE):
+        self.pack_dir = pack_dir
+        self.max_pack_size = max_pack_size
+        os.makedirs(pack_dir, exist_ok=True)
+        numbers = [int(name[5:11]) for name in os.listdir(pack_dir) if name.startswith('pack-') and name.endswith('.pack')]
+        # never append to an existing pack (a crash could have left a partial record in it)
+        self.pack_id = max(numbers, default=0) + 1
+        self._file = None
+        self.offset = 0
+
+    def pack_path(self, pack_id:int):
+        return os.path.join(self.pack_dir, f'pack-{pack_id:06}.pack')
+
+    def write(self, digest:bytes, codec:int, data:bytes):
+        '''
+            Append a chunk, returns (pack id, offset of the record)
+        '''
+        if self._file is None or self.offset >= self.max_pack_size:
+            self._rotate()
+        offset = self.offset
+        self._file.write(_PACK_RECORD.pack(digest, codec, len(data)))
+        self._file.write(data)
+        self.offset += _PACK_RECORD.size + len(data)
+
+        return self.pack_id, offset
+
+    def _rotate(self):
+        self.close()
+        self._file = open(self.pack_path(self.pack_id), 'xb', buffering=READ_SIZE)
+        self.offset = 0
+
+    def sync(self):
+        '''
+            Make the chunks written so far durable (before the index points at them)
+        '''
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+            self.pack_id += 1
+
+
+class IngestStats(object):
+    def __init__(self):
+        self.files = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.chunks = 0
+        self.new_chunks = 0
+        self.bytes_new = 0
+        self.bytes_stored = 0
+        self.start = time.monotonic()
+        self.end = None
+
+    @property
+    def elapsed(self):
+        return (self.end or time.monotonic()) - self.start
+
+    @property
+    def dedup_ratio(self):
+        '''
+            bytes read / new bytes that had to be stored (before compression), higher is better
+        '''
+        if not self.bytes_new:
+            return float('inf') if self.bytes_in else 1.0
+
+        return self.bytes_in / self.bytes_new
+
+    @property
+    def mb_per_sec(self):
+        return self.bytes_in / (1024 * 1024) / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self):
+        return {'files': self.files, 'errors': self.errors, 'bytes_in': self.bytes_in, 'chunks': self.chunks,
+                'new_chunks': self.new_chunks, 'bytes_new': self.bytes_new, 'bytes_stored': self.bytes_stored,
+                'elapsed': round(self.elapsed, 3), 'mb_per_sec': round(self.mb_per_sec, 1),
+                'dedup_ratio': round(self.dedup_ratio, 2)}
+
+    def __str__(self):
+        return (f'{self.files} file(s), {self.bytes_in / (1024 * 1024):.1f} MB in {self.elapsed:.2f}s '
+                f'({self.mb_per_sec:.1f} MB/s), {self.chunks} chunk(s) / {self.new_chunks} new, '
+                f'{self.bytes_stored / (1024 * 1024):.1f} MB stored, dedup ratio {self.dedup_ratio:.2f}, '
+                f'{self.errors} error(s)')
+
+
+def _read_recipe_record(recipe):
+    header = recipe.read(_RECIPE_RECORD.size)
+    if not header:
+        return None
+    path_len, size, mtime_ns, count = _RECIPE_RECORD.unpack(header)
+    path = recipe.read(path_len).decode('utf-8')
+    digests = recipe.read(count * DIGEST_SIZE)
+
+    return path, size, mtime_ns, [digests[pos:pos + DIGEST_SIZE] for pos in range(0, len(digests), DIGEST_SIZE)]
+
+
+class ChunkStore(object):
+    '''
+        Deduplicated chunk store (see the module docstring for the layout), a single writer at a time
+    '''
+    def __init__(self, path:str, min_size:int=DEFAULT_MIN_SIZE, avg_size:int=DEFAULT_AVG_SIZE, max_size:int=DEFAULT_MAX_SIZE,
+                 compress:bool=True, max_pack_size:int=DEFAULT_PACK_SIZE, debug:bool=False):
+        '''
+            path: (str) directory of the store (created if it doesn't exist)
+            min_size/avg_size/max_size: (int) chunk sizes (they are saved in the store on creation and must not change)
+            compress: (bool) zlib compress the chunks in the packs
+            max_pack_size: (int) size a pack file grows to before a new one is started
+            debug: (bool) enables enhanced output
+        '''
+        self.path = path
+        self.debug = debug
+        self.compress = compress
+        os.makedirs(os.path.join(path, 'snapshots'), exist_ok=True)
+        config_path = os.path.join(path, 'config.json')
+        if os.path.exists(config_path):
+            with open(config_path, 'r', encoding='utf-8') as config_file:
+                config = json.load(config_file)
+        else:
+            config = {'min_size': min_size, 'avg_size': avg_size, 'max_size': max_size, 'digest': f'blake2b-{DIGEST_SIZE * 8}'}
+            with open(config_path, 'w', encoding='utf-8') as config_file:
+                json.dump(config, config_file)
+        self.min_size = config['min_size']
+        self.avg_size = config['avg_size']
+        self.max_size = config['max_size']
+        self.index = ChunkIndex(os.path.join(path, 'index'))
+        self.packs = PackWriter(os.path.join(path, 'packs'), max_pack_size=max_pack_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.packs.close()
+        self.index.close()
+
+    def recipe_path(self, name:str):
+        return os.path.join(self.path, 'snapshots', f'{name}.recipe')
+
+    def ingest(self, snapshot:object, name:str, workers:int=None, walker_options:dict=None, meta:dict=None,
+               throttle:object=None):
+        '''
+            Store every file of a snapshot, returns IngestStats
+
+            snapshot: (str or VSSSnapshot) what to store (see walker.snapshot_root())
+            name: (str) name of the recipe (how the snapshot is restored later)
+            workers: (int) chunking/hashing processes (default: os.cpu_count()), 0 chunks in this process
+            walker_options: (dict) keyword arguments for the SnapshotWalker (include, exclude...)
+            meta: (dict) extra JSON serializable information for the recipe header
+            throttle: (VolumeThrottle or IOScheduler) rate limits the reads of the snapshot (an IOScheduler is resolved
+                      with the snapshot's volume_name), shared with the walker unless walker_options has its own.  The
+                      chunking processes read the files, they are paced as they are handed out
+        '''
+        stats = IngestStats()
+        root = snapshot_root(snapshot)
+        throttle = resolve_throttle(throttle, snapshot)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        meta = dict(meta or {})
+        for key in ('set_id', 'snap_id', 'volume_name'):
+            value = getattr(snapshot, key, None)
+            if value is not None:
+                meta.setdefault(key, str(value))
+
+        walker_options = dict(walker_options or {})
+        walker_options['yield_dirs'] = False
+        walker_options.setdefault('throttle', throttle)
+        pool = ProcessPoolExecutor(max_workers=workers) if workers else None
+        in_flight = collections.deque()
+        tmp_path = f'{self.recipe_path(name)}.tmp'
+        try:
+            with open(tmp_path, 'wb', buffering=READ_SIZE) as recipe:
+                encoded = json.dumps(meta, sort_keys=True).encode('utf-8')
+                recipe.write(RECIPE_MAGIC + struct.pack('<I', len(encoded)) + encoded)
+                for entry in SnapshotWalker(root, debug=self.debug, **walker_options):
+                    if not entry.is_file():
+                        continue
+                    if throttle is not None:
+                        throttle.acquire(entry.size)
+                    if pool is not None:
+                        future = pool.submit(chunk_file, entry.path, self.min_size, self.avg_size, self.max_size)
+                    else:
+                        future = None
+                    in_flight.append((entry, future))
+                    # keep the pool busy without queueing the whole volume
+                    while len(in_flight) > max(1, workers) * 4 or (pool is None and in_flight):
+                        self._store_file(in_flight.popleft(), recipe, stats, throttle)
+                while in_flight:
+                    self._store_file(in_flight.popleft(), recipe, stats, throttle)
+            self.packs.close()
+            self.index.flush()
+            os.replace(tmp_path, self.recipe_path(name))
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        stats.end = time.monotonic()
+        if self.debug:
+            print(f'ingested {root} as {name}: {stats}')
+
+        return stats
+
+    def _store_file(self, item, recipe, stats, throttle=None):
+        entry, future = item
+        try:
+            if future is not None:
+                chunks = future.result()
+            else:
+                chunks = chunk_file(entry.path, self.min_size, self.avg_size, self.max_size)
+            src = None
+            offset = 0
+            try:
+                for length, digest in chunks:
+                    stats.chunks += 1
+                    if digest not in self.index:
+                        if src is None:
+                            src = open(entry.path, 'rb')
+                        src.seek(offset)
+                        if throttle is not None:
+                            # the new chunks are read a second time
+                            with throttle.read(length):
+                                data = src.read(length)
+                        else:
+                            data = src.read(length)
+                        self._store_chunk(digest, data, stats)
+                    offset += length
+            finally:
+                if src is not None:
+                    src.close()
+        except OSError as e:
+            stats.errors += 1
+            if self.debug:
+                print(f'unable to store {entry.path}: {e}')
+            return
+
+        st = entry.stat()
+        path = archive_path(entry.rel_path).encode('utf-8')
+        recipe.write(_RECIPE_RECORD.pack(len(path), offset, st.st_mtime_ns, len(chunks)) + path)
+        recipe.write(b''.join(digest for _, digest in chunks))
+        stats.files += 1
+        stats.bytes_in += offset
+
+    def _store_chunk(self, digest, data, stats):
+        codec = CODEC_NONE
+        payload = data
+        if self.compress:
+            compressed = zlib.compress(data, 1)
+            if len(compressed) < len(data):
+                codec = CODEC_ZLIB
+                payload = compressed
+        pack_id, offset = self.packs.write(digest, codec, payload)
+        self.index.add(digest, pack_id, offset, len(payload))
+        stats.new_chunks += 1
+        stats.bytes_new += len(data)
+        stats.bytes_stored += len(payload)
+        if self.index.pending >= FLUSH_CHUNKS:
+            # a first ingest of a large volume: don't hold every new chunk in memory until the end
+            self.packs.sync()
+            self.index.flush()
+
+    def read_chunk(self, digest:bytes):
+        '''
+            Content of a chunk (verified against its digest)
+        '''
+        location = self.index.get(digest)
+        if location is None:
+            raise Exception(f'Chunk not found in the store: {digest.hex()}')
+        pack_id, offset, length = location
+        with open(self.packs.pack_path(pack_id), 'rb') as pack:
+            pack.seek(offset)
+            stored_digest, codec, stored_length = _PACK_RECORD.unpack(pack.read(_PACK_RECORD.size))
+            payload = pack.read(stored_length)
+        data = zlib.decompress(payload) if codec == CODEC_ZLIB else payload
+        if stored_digest != digest or chunk_digest(data) != digest:
+            raise Exception(f'Corrupt chunk in pack {pack_id} at offset {offset}: {digest.hex()}')
+
+        return data
+
+    def _open_recipe(self, name):
+        recipe = open(self.recipe_path(name), 'rb', buffering=READ_SIZE)
+        if recipe.read(len(RECIPE_MAGIC)) != RECIPE_MAGIC:
+            recipe.close()
+            raise Exception(f'Not an alphavss recipe (bad magic): {name}')
+
+        return recipe
+
+    def scan_recipe(self, name:str):
+        '''
+            Generator returning (record offset, path, size, mtime_ns, [digests]) for every file of an ingested snapshot,
+            the offset is where recipe_entry() can read the file's record again
+        '''
+        with self._open_recipe(name) as recipe:
+            meta_len, = struct.unpack('<I', recipe.read(4))
+            offset = recipe.seek(meta_len, os.SEEK_CUR)
+            while True:
+                record = _read_recipe_record(recipe)
+                if record is None:
+                    return
+                yield (offset,) + record
+                offset = recipe.tell()
+
+    def iter_recipe(self, name:str):
+        '''
+            Generator returning (path, size, mtime_ns, [digests]) for every file of an ingested snapshot
+        '''
+        for record in self.scan_recipe(name):
+            yield record[1:]
+
+    def recipe_entry(self, name:str, offset:int):
+        '''
+            (path, size, mtime_ns, [digests]) of the recipe record at offset (see scan_recipe())
+        '''
+        with self._open_recipe(name) as recipe:
+            recipe.seek(offset)
+            record = _read_recipe_record(recipe)
+        if record is None:
+            raise Exception(f'No recipe record at offset {offset}: {name}')
+
+        return record
+
+    def restore(self, name:str, target:str, paths:list=None, **kwargs):
+        '''
+            Rebuild the files of an ingested snapshot under target (paths limits it to those archive paths and
+            directories), returns the number of files restored
+
+            kwargs are passed to the restore.SnapshotRestorer (workers, sparse, preallocate...)
+        '''
+        from alphavss.restore import ChunkStoreSource, SnapshotRestorer
+
+        return SnapshotRestorer(ChunkStoreSource(self, name), target, paths=paths, debug=self.debug, **kwargs).run().files
@@ -0,0 +1,275 @@
+'''
+    Shadow storage (diff area) usage sampling and pressure-aware snapshot scheduling
+
+    When the shadow storage of a volume fills up, Windows deletes the oldest snapshots without a word, and a diff area
+    under heavy copy-on-write churn makes reading the snapshots slow.  ShadowStorageSampler samples the used,
+    allocated and maximum space of the diff areas (Win32_ShadowStorage, mapped to drive letters with get_drives()) and
+    tracks how fast the used space grows.  PressureScheduler uses it before a new VSSSnapshotSet is created:
+
+        pressure = (used + reserve) / maximum       reserve = max(reserve_bytes, growth rate * horizon)
+
+        * below high: go
+        * above high: prune (a callback deleting old snapshot sets, ex. oldest_set_pruner()) and sample again, or wait
+          for the pressure to drop (up to max_wait), rather than letting VSS evict the snapshots a copy still needs
+        * volumes without a shadow storage association, or with an unbounded one, never hold anything up
+
+    The usage source is a callable returning {volume GUID path: ShadowStorage}: StaticStorageSource stands in for
+    WMI (tests, simulations, other platforms).
+
+    Usage:
+        from alphavss.diffarea import ShadowStorageSampler, PressureScheduler, oldest_set_pruner
+
+        provider = VSSProvider(context=AppRollback)
+        scheduler = PressureScheduler(ShadowStorageSampler(), high=0.8, prune=oldest_set_pruner(provider, keep=2))
+        vss_set = scheduler.create_set(['C:\\', 'D:\\'], lambda: VSSSnapshotSet(volume_names=['C:\\', 'D:\\'],
+                                                                                 provider=provider))
+'''
+import time
+import threading
+from collections import namedtuple
+from alphavss.volumes import ShadowStorage, UNBOUNDED, mount_key
+
+DEFAULT_HIGH = 0.80
+DEFAULT_INTERVAL = 30.0 # seconds between samples while waiting
+DEFAULT_MAX_WAIT = 600.0
+DEFAULT_HORIZON = 3600.0 # seconds a new snapshot is expected to live (the copy)
+MAX_PRUNES = 16 # per volume and decision
+MIN_RATE_INTERVAL = 1.0 # seconds between the samples a growth rate is computed from
+
+StorageSample = namedtuple('StorageSample', ['volume_name', 'guid_path', 'used', 'allocated', 'maximum', 'rate', 'time'])
+Decision = namedtuple('Decision', ['go', 'pressures', 'reasons'])
+
+
+def _default_source():
+    from alphavss.volumes import query_shadow_storage
+
+    return query_shadow_storage()
+
+
+def _default_volumes():
+    from alphavss.models import get_drives
+
+    return get_drives()
+
+
+class StaticStorageSource(object):
+    '''
+        Usage source with scripted values: StaticStorageSource({'\\\\?\\Volume{...}\\': (used, allocated, maximum)})
+
+        set() changes a volume (a test moves the usage between samples)
+    '''
+    def __init__(self, usage:dict=None):
+        self.usage = {}
+        for guid_path, values in (usage or {}).items():
+            self.set(guid_path, *values)
+
+    def set(self, guid_path:str, used:int, allocated:int=None, maximum:int=UNBOUNDED):
+        self.usage[guid_path] = ShadowStorage(guid_path, guid_path, used, used if allocated is None else allocated,
+                                              maximum)
+
+    def __call__(self):
+        return dict(self.usage)
+
+
+class ShadowStorageSampler(object):
+    '''
+        Samples the diff area usage per volume (see the module docstring)
+    '''
+    def __init__(self, source:object=None, volumes:object=None, clock:object=time.monotonic, debug:bool=False):
+        '''
+            source: (callable) returns {volume GUID path: ShadowStorage} (default: volumes.query_shadow_storage, WMI)
+            volumes: (callable) returns the get_drives() mapping {'C:': volume GUID path} (default: get_drives)
+            clock: (callable) time.monotonic (replace it to simulate time)
+            debug: (bool) enables enhanced output
+        '''
+        self.source = source or _default_source
+        self.volumes = volumes or _default_volumes
+        self.clock = clock
+        self.debug = debug
+        self.last = {}
+        self._names = None
+        self._lock = threading.Lock()
+
+    def _volume_name(self, guid_path, refresh=False):
+        if self._names is None or refresh:
+            self._names = {}
+            for name, volume in self.volumes().items():
+                self._names.setdefault(volume, f'{name}\\')
+
+        return self._names.get(guid_path)
+
+    def sample(self):
+        '''
+            {volume name ('C:\\', or the GUID path of a volume with no mount path): StorageSample}
+        '''
+        now = self.clock()
+        samples = {}
+        for guid_path, storage in self.source().items():
+            name = self._volume_name(guid_path) or self._volume_name(guid_path, refresh=True) or guid_path
+            with self._lock:
+                previous = self.last.get(guid_path)
+                if previous is not None and now - previous.time < MIN_RATE_INTERVAL:
+                    # too close to the last sample for a meaningful rate: keep that one as the reference
+                    sample = StorageSample(name, guid_path, storage.used, storage.allocated, storage.maximum,
+                                           previous.rate, previous.time)
+                else:
+                    rate = 0.0
+                    if previous is not None:
+                        # growth of the used space (bytes/s), smoothed; shrinking (snapshots deleted) doesn't count
+                        rate = max(0.0, (storage.used - previous.used) / (now - previous.time))
+                        rate = rate if not previous.rate else 0.5 * (rate + previous.rate)
+                    sample = StorageSample(name, guid_path, storage.used, storage.allocated, storage.maximum, rate, now)
+                    self.last[guid_path] = sample
+            samples[name] = sample
+        if self.debug:
+            for name, sample in samples.items():
+                print(f'shadow storage of {name}: {sample.used / 2 ** 30:.2f} GB used, '
+                      f'{sample.allocated / 2 ** 30:.2f} GB allocated, max '
+                      f'{"unbounded" if sample.maximum == UNBOUNDED else f"{sample.maximum / 2 ** 30:.2f} GB"}, '
+                      f'growing {sample.rate / 2 ** 20:.2f} MB/s')
+
+        return samples
+
+
+class PressureScheduler(object):
+    '''
+        Holds up (or prunes before) new snapshot sets while the shadow storage of their volumes is under pressure
+    '''
+    def __init__(self, sampler:ShadowStorageSampler, high:float=DEFAULT_HIGH, reserve_bytes:int=0,
+                 horizon:float=DEFAULT_HORIZON, prune:object=None, interval:float=DEFAULT_INTERVAL,
+                 max_wait:float=DEFAULT_MAX_WAIT, sleep:object=time.sleep, debug:bool=False):
+        '''
+            sampler: (ShadowStorageSampler) the usage
+            high: (float) pressure (0-1) above which a new set is held up
+            reserve_bytes: (int) room a new snapshot needs at least (its copy-on-write churn)
+            horizon: (float) seconds the new snapshot has to survive: the growth rate over that long is reserved too
+            prune: (callable) prune(volume_name, sample) deletes old snapshot(s) of that volume, returns True if it
+                   deleted anything (None: never prune, only wait)
+            interval: (float) seconds between samples while waiting
+            max_wait: (float) seconds to wait before giving up
+            sleep: (callable) time.sleep (replace it to simulate time)
+            debug: (bool) enables enhanced output
+        '''
+        self.sampler = sampler
+        self.high = high
+        self.reserve_bytes = reserve_bytes
+        self.horizon = horizon
+        self.prune = prune
+        self.interval = interval
+        self.max_wait = max_wait
+        self.sleep = sleep
+        self.debug = debug
+        self.prunes = 0
+        self.waits = 0
+
+    def pressure(self, sample:StorageSample):
+        '''
+            (used + reserve) / maximum, None for an unbounded shadow storage
+        '''
+        if not sample.maximum or sample.maximum == UNBOUNDED:
+            return None
+        reserve = max(self.reserve_bytes, sample.rate * self.horizon)
+
+        return (sample.used + reserve) / sample.maximum
+
+    def decide(self, volume_names:list, samples:dict=None):
+        '''
+            Decision for a new set of volume_names: go, {volume name: pressure}, reasons (why not)
+        '''
+        if samples is None:
+            samples = self.sampler.sample()
+        by_key = {mount_key(name): sample for name, sample in samples.items()}
+        pressures = {}
+        reasons = []
+        for volume_name in volume_names:
+            sample = by_key.get(mount_key(volume_name))
+            if sample is None:
+                # no shadow storage yet: created with the first snapshot
+                continue
+            pressure = self.pressure(sample)
+            pressures[volume_name] = pressure
+            if pressure is not None and pressure >= self.high:
+                reasons.append(f'{volume_name}: shadow storage at {pressure:.0%} (used {sample.used / 2 ** 30:.2f} GB '
+                               f'of {sample.maximum / 2 ** 30:.2f} GB, growing {sample.rate / 2 ** 20:.2f} MB/s)')
+
+        return Decision(not reasons, pressures, reasons)
+
+    def wait_for_room(self, volume_names:list):
+        '''
+            Prune and/or wait until a new set of volume_names can go, returns the last Decision (go is False when
+            max_wait passed first)
+        '''
+        waited = 0.0
+        pruned = {}
+        while True:
+            samples = self.sampler.sample()
+            decision = self.decide(volume_names, samples)
+            if decision.go:
+                return decision
+            if self.prune is not None:
+                pruned_any = False
+                for volume_name, pressure in decision.pressures.items():
+                    if pressure is None or pressure < self.high or pruned.get(volume_name, 0) >= MAX_PRUNES:
+                        continue
+                    sample = {mount_key(name): sample for name, sample in samples.items()}[mount_key(volume_name)]
+                    if self.prune(volume_name, sample):
+                        pruned[volume_name] = pruned.get(volume_name, 0) + 1
+                        self.prunes += 1
+                        pruned_any = True
+                        if self.debug:
+                            print(f'pruned a snapshot set of {volume_name} (shadow storage at {pressure:.0%})')
+                if pruned_any:
+                    # sample again right away
+                    continue
+            if waited >= self.max_wait:
+                if self.debug:
+                    print(f'gave up waiting for shadow storage room: {"; ".join(decision.reasons)}')
+                return decision
+            if self.debug:
+                print(f'waiting {self.interval}s for shadow storage room: {"; ".join(decision.reasons)}')
+            self.waits += 1
+            self.sleep(self.interval)
+            waited += self.interval
+
+    def create_set(self, volume_names:list, create:object):
+        '''
+            create() (ex. a lambda building the VSSSnapshotSet) once the shadow storage of volume_names has room,
+            raises an Exception when it doesn't within max_wait
+        '''
+        decision = self.wait_for_room(volume_names)
+        if not decision.go:
+            raise Exception(f'shadow storage pressure, snapshot set not created: {"; ".join(decision.reasons)}')
+
+        return create()
+
+
+def oldest_set_pruner(provider:object, keep:int=1, force_delete:bool=False):
+    '''
+        prune callback for PressureScheduler: deletes the oldest snapshot set holding a snapshot of the volume, as
+        long as more than keep sets hold one (provider: the VSSProvider querying the sets, its context decides which)
+    '''
+    from alphavss.throttle import normalize_volume_name
+
+    delete_providers = []
+
+    def prune(volume_name, sample):
+        volume = normalize_volume_name(volume_name)
+        sets = [vss_set for vss_set in provider.query_snapshots()
+                if any(normalize_volume_name(snapshot.volume_name) == volume for snapshot in vss_set.snapshots)]
+        if len(sets) <= keep:
+            return False
+        oldest = min(sets, key=lambda vss_set: min(snapshot.snap_object.CreationTimestamp.ToString('s')
+                                                   for snapshot in vss_set.snapshots))
+        if not delete_providers:
+            from alphavss.models import VSSProvider
+
+            # a 'query' provider: no GatherWriterMetadata just to delete
+            delete_providers.append(VSSProvider(operation='query', context=provider.context))
+        delete_provider = delete_providers[0]
+        components = delete_provider.create_backup_components()
+        delete_provider._initialize(components)
+        oldest.delete(components, force_delete=force_delete)
+
+        return True
+
+    return prune
@@ -0,0 +1,215 @@
+'''
+    Per physical disk copy scheduling for the snapshots in a VSSSnapshotSet
+
+    A snapshot set often spans volumes sharing a physical disk (C: and D: partitions of Disk 0) and volumes that don't
+    (E: on Disk 1).  Copying all of them at once thrashes the shared disk, copying them one after the other leaves the
+    independent disks idle.
+
+    DiskCopyScheduler groups the snapshots of a set by the physical disk under their volume_name (through a pluggable
+    resolver) and gives every disk its own copy worker pool:
+        * volumes on different disks are copied at the same time
+        * volumes on the same disk are copied one after the other (largest first) by that disk's pool
+    so the total backup time is bounded by the slowest disk instead of by random contention
+
+    Resolvers are callables taking a volume_name ('C:\\') and returning a hashable disk key:
+        * WMIDiskResolver: the real thing on Windows (Win32_LogicalDisk -> Win32_DiskPartition associations)
+        * StaticDiskResolver: a fixed mapping (for testing/faking the layout on other platforms)
+'''
+import os
+import shutil
+import threading
+from alphavss.walker import snapshot_root, snapshot_label
+from alphavss.copier import SnapshotCopier, CopyStats
+from alphavss.throttle import normalize_volume_name
+
+DEFAULT_WORKERS_PER_DISK = 4
+
+
+class WMIDiskResolver(object):
+    '''
+        Resolve a volume to the physical disk(s) it lives on with WMI (results are cached)
+
+        A volume spanning several disks (dynamic disks, storage spaces) gets a key with all of them,
+        ex. 'PhysicalDrive0', 'PhysicalDrive1+PhysicalDrive2'
+    '''
+    def __init__(self, debug:bool=False):
+        self.debug = debug
+        self._cache = {}
+        self._wmi = None
+
+    def __call__(self, volume_name:str):
+        letter = normalize_volume_name(volume_name)
+        if letter in self._cache:
+            return self._cache[letter]
+
+        if self._wmi is None:
+            import wmi #pylint:disable=C0415
+            self._wmi = wmi.WMI()
+
+        disks = set()
+        query = f'ASSOCIATORS OF {{Win32_LogicalDisk.DeviceID="{letter}"}} WHERE AssocClass = Win32_LogicalDiskToPartition'
+        for partition in self._wmi.query(query):
+            disks.add(int(partition.DiskIndex))
+
+        # a volume we can't map (mounted without a letter, etc) is treated as its own disk
+        key = '+'.join(f'PhysicalDrive{disk}' for disk in sorted(disks)) or letter
+        if self.debug:
+            print(f'volume {letter} is on {key}')
+        self._cache[letter] = key
+
+        return key
+
+
+class StaticDiskResolver(object):
+    '''
+        Resolve volumes with a fixed mapping, ex. StaticDiskResolver({'C:': 'disk0', 'D:': 'disk0', 'E:': 'disk1'})
+
+        Volumes missing from the mapping are their own disk
+    '''
+    def __init__(self, mapping:dict):
+        self.mapping = {normalize_volume_name(volume_name): disk for volume_name, disk in mapping.items()}
+
+    def __call__(self, volume_name:str):
+        key = normalize_volume_name(volume_name)
+        return self.mapping.get(key, key)
+
+
+def default_resolver():
+    '''
+        WMIDiskResolver on Windows, every volume is its own disk everywhere else
+    '''
+    if os.name == 'nt':
+        return WMIDiskResolver()
+
+    return StaticDiskResolver({})
+
+
+def group_volumes(volume_names:list, resolver:object=None):
+    '''
+        {disk key: [volume names on that disk]} (keeps the order of volume_names within a disk)
+    '''
+    resolver = resolver or default_resolver()
+    groups = {}
+    for volume_name in volume_names:
+        groups.setdefault(resolver(volume_name), []).append(volume_name)
+
+    return groups
+
+
+def estimate_used_bytes(snapshot:object):
+    '''
+        Bytes in use on the volume a snapshot is of (used to copy the biggest volumes of a disk first), 0 if unknown
+    '''
+    try:
+        return shutil.disk_usage(snapshot_root(snapshot)).used
+    except Exception: #pylint:disable=W0703
+        return 0
+
+
+class DiskCopyScheduler(object):
+    '''
+        Copy every snapshot of a VSSSnapshotSet with one worker pool per physical disk
+    '''
+    def __init__(self, snapshots:object, target:str, resolver:object=None, workers_per_disk:object=DEFAULT_WORKERS_PER_DISK,
+                 target_for:object=None, size_of:object=estimate_used_bytes, copier_options:dict=None, debug:bool=False):
+        '''
+            snapshots: (VSSSnapshotSet or list of VSSSnapshot) what to copy
+            target: (str) base directory, every snapshot gets a sub directory (see target_for)
+            resolver: (callable) volume_name -> disk key (default: default_resolver())
+            workers_per_disk: (int or dict) copy workers per disk, a dict gives per disk counts
+                              ({'PhysicalDrive0': 2, 'PhysicalDrive1': 16, None: 4} None being the default)
+            target_for: (callable) snapshot -> target directory (default: target\\<drive letter>)
+            size_of: (callable) snapshot -> expected bytes (orders the volumes of a disk biggest first), None to keep the set order
+            copier_options: (dict) keyword arguments for each SnapshotCopier (method, throttle, walker_options...)
+            debug: (bool) enables enhanced output
+        '''
+        self.snapshots = list(getattr(snapshots, 'snapshots', snapshots) or [])
+        if not self.snapshots:
+            raise Exception('DiskCopyScheduler needs at least one snapshot to copy')
+        self.target = target
+        self.resolver = resolver or default_resolver()
+        self.workers_per_disk = workers_per_disk
+        self.target_for = target_for or self._default_target
+        self.size_of = size_of
+        self.copier_options = copier_options or {}
+        self.debug = debug
+        self.results = {}
+
+    def _default_target(self, snapshot):
+        return os.path.join(self.target, snapshot_label(snapshot) or 'snapshot')
+
+    def workers_for(self, disk:object):
+        if isinstance(self.workers_per_disk, dict):
+            return self.workers_per_disk.get(disk, self.workers_per_disk.get(None, DEFAULT_WORKERS_PER_DISK))
+
+        return self.workers_per_disk
+
+    def plan(self):
+        '''
+            {disk key: [snapshots in the order they will be copied]}
+        '''
+        groups = {}
+        for snapshot in self.snapshots:
+            groups.setdefault(self.resolver(snapshot.volume_name), []).append(snapshot)
+
+        if self.size_of is not None:
+            for disk, snapshots in groups.items():
+                sizes = {id(snapshot): self.size_of(snapshot) for snapshot in snapshots}
+                groups[disk] = sorted(snapshots, key=lambda snapshot: sizes[id(snapshot)], reverse=True)
+
+        return groups
+
+    def run(self):
+        '''
+            Copy everything, returns {volume_name: CopyStats} (raises once every disk is done if any copy failed)
+        '''
+        groups = self.plan()
+        if self.debug:
+            for disk, snapshots in groups.items():
+                volumes = ', '.join(snapshot.volume_name for snapshot in snapshots)
+                print(f'{disk}: {self.workers_for(disk)} worker(s) for {volumes}')
+
+        self.results = {}
+        failures = {}
+        lock = threading.Lock()
+
+        def copy_disk(disk, snapshots):
+            for snapshot in snapshots:
+                try:
+                    copier = SnapshotCopier(snapshot, self.target_for(snapshot), workers=self.workers_for(disk),
+                                            debug=self.debug, **self.copier_options)
+                    stats = copier.copy()
+                except Exception as e: #pylint:disable=W0703
+                    with lock:
+                        failures[snapshot.volume_name] = e
+                    continue
+                with lock:
+                    self.results[snapshot.volume_name] = stats
+
+        threads = []
+        for disk, snapshots in groups.items():
+            thread = threading.Thread(target=copy_disk, args=(disk, snapshots), name=f'alphavss-disk-{disk}', daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        if failures:
+            failed = ', '.join(f'{volume_name} ({e})' for volume_name, e in failures.items())
+            raise Exception(f'Copying the snapshot(s) of these volume(s) failed: {failed}') from next(iter(failures.values()))
+
+        return self.results
+
+    def total(self):
+        '''
+            A single CopyStats adding up the last run (elapsed is the wall clock of the slowest disk)
+        '''
+        total = CopyStats()
+        if not self.results:
+            return total
+        total.start = min(stats.start for stats in self.results.values())
+        total.end = max(stats.end for stats in self.results.values())
+        for stats in self.results.values():
+            total.add(files=stats.files, dirs=stats.dirs, nbytes=stats.bytes, skipped=stats.skipped, errors=stats.errors)
+
+        return total
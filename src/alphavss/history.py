@@ -0,0 +1,343 @@
+'''
+    File version history index across snapshots ("all versions of X.docx")
+
+    Answering that question from VSS means exposing every set from query_snapshots() and probing the path in each one.
+    VersionIndex answers it from disk in milliseconds instead, from the tree listings of the snapshots (a manifest from
+    alphavss.manifest, or a walk of the snapshot when it is added):
+
+        index/
+            catalog.json                the indexed snapshots (snap_id, set_id, volume, creation time) and the segments
+            segment-000001.hix ...      sorted records <H key_len> <I snapshot> <Q size> <q mtime_ns> key
+                                        + a sparse index (every 64th key) and a <Q sparse offset> <I count> trailer
+
+        * keys are normalized paths: '<drive letter>/<path>' lower cased with '/' separators ('c/users/bob/x.docx')
+        * every add_snapshot() writes a new segment (incremental), segments are merged once there are too many
+        * a lookup is a binary search of the in memory sparse index of each segment, then a short scan of a memory map
+
+    Usage:
+        from alphavss.history import VersionIndex
+
+        index = VersionIndex('E:\\version-index')
+        index.update(provider.query_snapshots())              # index any set that isn't indexed yet
+        for version in index.history('C:\\Users\\bob\\X.docx'):
+            print(version.created, version.snap_id, version.size)
+'''
+import os
+import json
+import mmap
+import time
+import heapq
+import struct
+import bisect
+import threading
+from collections import namedtuple
+from alphavss.walker import SnapshotWalker, snapshot_root, snapshot_label
+from alphavss.archive import archive_path
+from alphavss.manifest import ManifestEntry, ManifestReader, sorted_entries
+
+MAGIC = b'AVSSHIX1'
+SPARSE_EVERY = 64
+MAX_SEGMENTS = 8
+
+_RECORD = struct.Struct('<HIQq')
+_SPARSE = struct.Struct('<HQ')
+_TRAILER = struct.Struct('<QI')
+
+Version = namedtuple('Version', ['path', 'snap_id', 'set_id', 'volume_name', 'created', 'size', 'mtime_ns'])
+
+
+def normalize_path(path:str, volume:str=''):
+    '''
+        'C:\\Users\\Bob\\X.docx' -> 'c/users/bob/x.docx', ('Users/Bob/X.docx', volume='C') -> 'c/users/bob/x.docx'
+    '''
+    path = path.replace('\\', '/')
+    if len(path) >= 2 and path[1] == ':':
+        volume = path[0]
+        path = path[2:]
+
+    return archive_path(volume, path).lower()
+
+
+class _SegmentWriter(object):
+    def __init__(self, path:str):
+        self.path = path
+        self._file = open(path, 'wb', buffering=1024 * 1024)
+        self._file.write(MAGIC)
+        self._offset = len(MAGIC)
+        self._sparse = []
+        self._count = 0
+
+    def write(self, key:str, ordinal:int, size:int, mtime_ns:int):
+        encoded = key.encode('utf-8')
+        if self._count % SPARSE_EVERY == 0:
+            self._sparse.append((encoded, self._offset))
+        record = _RECORD.pack(len(encoded), ordinal, size, mtime_ns) + encoded
+        self._file.write(record)
+        self._offset += len(record)
+        self._count += 1
+
+    def close(self):
+        sparse_offset = self._offset
+        for encoded, offset in self._sparse:
+            self._file.write(_SPARSE.pack(len(encoded), offset) + encoded)
+        self._file.write(_TRAILER.pack(sparse_offset, len(self._sparse)))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+
+class _Segment(object):
+    def __init__(self, path:str):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise Exception(f'Not an alphavss version index segment (bad magic): {path}')
+        self.data_end, count = _TRAILER.unpack_from(self._map, len(self._map) - _TRAILER.size)
+        self.keys = []
+        self.offsets = []
+        position = self.data_end
+        for _ in range(count):
+            key_len, offset = _SPARSE.unpack_from(self._map, position)
+            position += _SPARSE.size
+            self.keys.append(self._map[position:position + key_len].decode('utf-8'))
+            self.offsets.append(offset)
+            position += key_len
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def scan(self, start_key:str=''):
+        '''
+            Generator returning (key, ordinal, size, mtime_ns) from the first record >= start_key to the end
+        '''
+        block = max(0, bisect.bisect_left(self.keys, start_key) - 1)
+        position = self.offsets[block] if self.offsets else self.data_end
+        mapped = self._map
+        while position < self.data_end:
+            key_len, ordinal, size, mtime_ns = _RECORD.unpack_from(mapped, position)
+            position += _RECORD.size
+            key = mapped[position:position + key_len].decode('utf-8')
+            position += key_len
+            if key >= start_key:
+                yield key, ordinal, size, mtime_ns
+
+
+class VersionIndex(object):
+    '''
+        On disk index of every file version across the indexed snapshots
+    '''
+    def __init__(self, path:str, debug:bool=False):
+        self.path = path
+        self.debug = debug
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+        self.catalog_path = os.path.join(path, 'catalog.json')
+        if os.path.exists(self.catalog_path):
+            with open(self.catalog_path, 'r', encoding='utf-8') as catalog_file:
+                self.catalog = json.load(catalog_file)
+        else:
+            self.catalog = {'snapshots': [], 'segments': [], 'next_segment': 1}
+        self._segments = [_Segment(os.path.join(path, name)) for name in self.catalog['segments']]
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments:
+                segment.close()
+            self._segments = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _save_catalog(self):
+        tmp_path = f'{self.catalog_path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as catalog_file:
+            json.dump(self.catalog, catalog_file, indent=1)
+        os.replace(tmp_path, self.catalog_path)
+
+    @property
+    def snapshots(self):
+        '''
+            The indexed snapshots (list of dicts), in the order they were added
+        '''
+        return [snapshot for snapshot in self.catalog['snapshots'] if not snapshot.get('removed')]
+
+    def is_indexed(self, snap_id:object):
+        return any(snapshot['snap_id'] == str(snap_id) for snapshot in self.snapshots)
+
+    def add_snapshot(self, snapshot:object, manifest_path:str=None, created:str=None, walker_options:dict=None):
+        '''
+            Index the files of a snapshot
+
+            snapshot: (VSSSnapshot) the snapshot (its snap_id, set_id and volume_name are recorded)
+            manifest_path: (str) manifest of the snapshot (alphavss.manifest), the snapshot is walked when there is none
+            created: (str) creation time to record (default: the snapshot's CreationTimestamp, or now)
+            walker_options: (dict) keyword arguments for the SnapshotWalker when walking the snapshot
+        '''
+        snap_id = str(getattr(snapshot, 'snap_id', '') or snapshot)
+        if self.is_indexed(snap_id):
+            return False
+        volume = snapshot_label(snapshot)
+        if created is None:
+            snap_object = getattr(snapshot, 'snap_object', None)
+            created = str(snap_object.CreationTimestamp) if snap_object is not None else time.strftime('%Y-%m-%d %H:%M:%S')
+
+        if manifest_path:
+            entries = ManifestReader(manifest_path)
+        else:
+            entries = self._walk(snapshot, walker_options)
+        keyed = (entry._replace(path=normalize_path(entry.path, volume), digest=None) for entry in entries)
+
+        with self._lock:
+            ordinal = len(self.catalog['snapshots'])
+            name = f'segment-{self.catalog["next_segment"]:06}.hix'
+            writer = _SegmentWriter(os.path.join(self.path, name))
+            count = 0
+            for entry in sorted_entries(keyed):
+                writer.write(entry.path, ordinal, entry.size, entry.mtime_ns)
+                count += 1
+            writer.close()
+            self.catalog['snapshots'].append({'snap_id': snap_id, 'set_id': str(getattr(snapshot, 'set_id', '') or ''),
+                                              'volume_name': getattr(snapshot, 'volume_name', '') or '',
+                                              'created': created, 'files': count})
+            self.catalog['segments'].append(name)
+            self.catalog['next_segment'] += 1
+            self._save_catalog()
+            self._segments.append(_Segment(os.path.join(self.path, name)))
+            if self.debug:
+                print(f'indexed {count} file(s) of snapshot {snap_id} in {name}')
+            if len(self._segments) > MAX_SEGMENTS:
+                self.compact()
+
+        return True
+
+    def _walk(self, snapshot, walker_options):
+        walker_options = dict(walker_options or {})
+        walker_options['yield_dirs'] = False
+        for entry in SnapshotWalker(snapshot_root(snapshot), debug=self.debug, **walker_options):
+            if entry.is_file():
+                st = entry.stat()
+                yield ManifestEntry(archive_path(entry.rel_path), st.st_size, st.st_mtime_ns, 0, None)
+
+    def update(self, vss_sets:list, manifest_for:object=None):
+        '''
+            Index every snapshot of the sets (from VSSProvider.query_snapshots()) that isn't indexed yet, and forget the
+            indexed snapshots that are no longer there (deleted sets)
+
+            manifest_for: (callable) snapshot -> manifest path (or None to walk the snapshot)
+            returns (added, removed)
+        '''
+        present = set()
+        added = 0
+        for vss_set in vss_sets:
+            for snapshot in vss_set.snapshots:
+                present.add(str(snapshot.snap_id))
+                if not self.is_indexed(snapshot.snap_id):
+                    manifest_path = manifest_for(snapshot) if manifest_for is not None else None
+                    added += int(self.add_snapshot(snapshot, manifest_path=manifest_path))
+
+        removed = 0
+        for snapshot in self.snapshots:
+            if snapshot['snap_id'] not in present:
+                self.remove_snapshot(snapshot['snap_id'])
+                removed += 1
+
+        return added, removed
+
+    def remove_snapshot(self, snap_id:object):
+        '''
+            Forget a snapshot (its records are dropped at the next compaction)
+        '''
+        with self._lock:
+            for snapshot in self.catalog['snapshots']:
+                if snapshot['snap_id'] == str(snap_id):
+                    snapshot['removed'] = True
+            self._save_catalog()
+
+    def compact(self):
+        '''
+            Merge all the segments into one (dropping removed snapshots)
+        '''
+        with self._lock:
+            if not self._segments:
+                return
+            removed = {ordinal for ordinal, snapshot in enumerate(self.catalog['snapshots']) if snapshot.get('removed')}
+            name = f'segment-{self.catalog["next_segment"]:06}.hix'
+            writer = _SegmentWriter(os.path.join(self.path, name))
+            for key, ordinal, size, mtime_ns in heapq.merge(*(segment.scan() for segment in self._segments),
+                                                            key=lambda record: (record[0], record[1])):
+                if ordinal not in removed:
+                    writer.write(key, ordinal, size, mtime_ns)
+            writer.close()
+
+            old_names = self.catalog['segments']
+            self.catalog['segments'] = [name]
+            self.catalog['next_segment'] += 1
+            self._save_catalog()
+            for segment in self._segments:
+                segment.close()
+            for old_name in old_names:
+                os.remove(os.path.join(self.path, old_name))
+            self._segments = [_Segment(os.path.join(self.path, name))]
+            if self.debug:
+                print(f'compacted {len(old_names)} segment(s) into {name}')
+
+    def _version(self, key, ordinal, size, mtime_ns):
+        snapshot = self.catalog['snapshots'][ordinal]
+        if snapshot.get('removed'):
+            return None
+        return Version(key, snapshot['snap_id'], snapshot['set_id'], snapshot['volume_name'], snapshot['created'],
+                       size, mtime_ns)
+
+    def history(self, path:str, volume:str=''):
+        '''
+            Every indexed version of a file (oldest snapshot first)
+
+            path: (str) 'C:\\Users\\bob\\X.docx' (or a path relative to the volume given in volume='C')
+        '''
+        key = normalize_path(path, volume)
+        versions = []
+        with self._lock:
+            for segment in self._segments:
+                for record in segment.scan(key):
+                    if record[0] != key:
+                        break
+                    version = self._version(*record)
+                    if version is not None:
+                        versions.append((record[1], version))
+
+        return [version for _, version in sorted(versions, key=lambda item: item[0])]
+
+    def search(self, prefix:str, volume:str='', limit:int=None):
+        '''
+            Generator returning (key, [versions]) for every indexed path starting with prefix, in path order
+        '''
+        start = normalize_path(prefix, volume)
+        if prefix.replace('\\', '/').endswith('/'):
+            start += '/'
+        found = 0
+        with self._lock:
+            scans = [segment.scan(start) for segment in self._segments]
+            current = None
+            versions = []
+            for key, ordinal, size, mtime_ns in heapq.merge(*scans, key=lambda record: (record[0], record[1])):
+                if not key.startswith(start):
+                    break
+                if key != current:
+                    if versions:
+                        yield current, versions
+                        found += 1
+                        if limit is not None and found >= limit:
+                            return
+                    current = key
+                    versions = []
+                version = self._version(key, ordinal, size, mtime_ns)
+                if version is not None:
+                    versions.append(version)
+            if versions:
+                yield current, versions
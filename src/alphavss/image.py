@@ -0,0 +1,298 @@
+'''
+    Block level image backup of a VSSSnapshot (the shadow copy device read sequentially), changed blocks only
+
+    Copying a database volume file by file out of an exposed snapshot is slow (a few huge files, fragmented, and
+    every file open goes through the snapshot's file system).  ImageBackup reads the shadow copy device itself
+    (\\\\?\\GLOBALROOT\\Device\\HarddiskVolumeShadowCopyN) in large aligned blocks and keeps a raw image of the
+    volume up to date:
+
+        target.img              the image (same size as the volume), only the changed blocks are written
+        target.img.blockmap     header + one blake2b digest (16 bytes) per block: 4 KB per GB of volume with 4 MB
+                                blocks, memory mapped and compared with the new digests as they come in
+
+        * blocks are read and hashed on a pool of threads (hashlib releases the GIL), at most workers * 2 blocks are
+          in flight, the changed ones are written in order by the calling thread
+        * the blockmap header holds a clean flag: it is cleared (and flushed) before the first write and set again
+          after the image and the map were flushed, a map left unclean by a crash isn't trusted (every block is
+          written again)
+        * a volume that grew or shrank resizes the image and the map
+        * the source can be any file (a plain image on Linux), so the engine runs without Windows
+
+    Usage:
+        from alphavss.image import ImageBackup
+
+        stats = ImageBackup(vss_set.snapshots[0], 'E:\\images\\C.img').run()
+        print(stats)        # 476.9 GB read in 1203.45s (405.8 MB/s), 1843 of 122086 block(s) changed ...
+'''
+import os
+import sys
+import mmap
+import time
+import struct
+import hashlib
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024 # 4 MB
+DEFAULT_IMAGE_WORKERS = 4
+DIGEST_SIZE = 16
+ALIGNMENT = 4096 # sector alignment of the reads (largest common sector size)
+BLOCKMAP_MAGIC = b'AVSSBMAP'
+BLOCKMAP_CLEAN = 1
+IOCTL_DISK_GET_LENGTH_INFO = 0x7405C
+
+_HEADER = struct.Struct('<8sHHIIQ') # magic, version, flags, block size, digest size, image size
+
+
+def block_digest(data:object):
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+def source_path(source:object):
+    '''
+        Path to read an image from: the device path of a VSSSnapshot (no trailing backslash, it is a device, not a
+        directory), or source itself (a path)
+    '''
+    if hasattr(source, 'get_device_path'):
+        return source.get_device_path().rstrip('\\')
+
+    return source
+
+
+def device_size(path:str):
+    '''
+        Size in bytes of a file or (Windows) of a volume device, which has no file size: IOCTL_DISK_GET_LENGTH_INFO
+    '''
+    if sys.platform == 'win32' and (path.startswith('\\\\?\\GLOBALROOT\\') or path.startswith('\\\\.\\')):
+        import ctypes
+        from ctypes import wintypes
+
+        kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        kernel32.CreateFileW.restype = wintypes.HANDLE
+        # GENERIC_READ, FILE_SHARE_READ | FILE_SHARE_WRITE, OPEN_EXISTING
+        handle = kernel32.CreateFileW(path, 0x80000000, 3, None, 3, 0, None)
+        if handle == ctypes.c_void_p(-1).value:
+            raise ctypes.WinError(ctypes.get_last_error())
+        try:
+            length = ctypes.c_longlong(0)
+            returned = wintypes.DWORD(0)
+            if not kernel32.DeviceIoControl(wintypes.HANDLE(handle), IOCTL_DISK_GET_LENGTH_INFO, None, 0,
+                                            ctypes.byref(length), ctypes.sizeof(length), ctypes.byref(returned), None):
+                raise ctypes.WinError(ctypes.get_last_error())
+        finally:
+            kernel32.CloseHandle(wintypes.HANDLE(handle))
+
+        return length.value
+
+    return os.path.getsize(path)
+
+
+class BlockMap(object):
+    '''
+        The per block digests of an image, a memory mapped file: header + block count * DIGEST_SIZE bytes
+    '''
+    def __init__(self, path:str, block_size:int, image_size:int):
+        self.path = path
+        self.block_size = block_size
+        self.image_size = image_size
+        self.blocks = -(-image_size // block_size)
+        self.trusted = False
+        size = _HEADER.size + self.blocks * DIGEST_SIZE
+        existing = os.path.exists(path)
+        self._file = open(path, 'r+b' if existing else 'w+b')
+        if existing:
+            header = self._file.read(_HEADER.size)
+            if len(header) == _HEADER.size:
+                magic, _, flags, old_block_size, digest_size, _ = _HEADER.unpack(header)
+                # a map of another block size / digest (or unclean) can't be compared with
+                self.trusted = (magic == BLOCKMAP_MAGIC and flags & BLOCKMAP_CLEAN and old_block_size == block_size
+                                and digest_size == DIGEST_SIZE)
+        if not self.trusted:
+            self._file.truncate(0)
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        if not self.trusted:
+            # unknown digests: every block differs
+            self._map[_HEADER.size:] = bytes(self.blocks * DIGEST_SIZE)
+        self._write_header(0)
+
+    def _write_header(self, flags):
+        self._map[:_HEADER.size] = _HEADER.pack(BLOCKMAP_MAGIC, 1, flags, self.block_size, DIGEST_SIZE,
+                                                self.image_size)
+        self._map.flush()
+
+    def get(self, index:int):
+        offset = _HEADER.size + index * DIGEST_SIZE
+
+        return self._map[offset:offset + DIGEST_SIZE]
+
+    def set(self, index:int, digest:bytes):
+        offset = _HEADER.size + index * DIGEST_SIZE
+        self._map[offset:offset + DIGEST_SIZE] = digest
+
+    def close(self, clean:bool=True):
+        '''
+            Flush the digests, then mark the map clean (the image must have been flushed before)
+        '''
+        if self._map is None:
+            return
+        self._map.flush()
+        if clean:
+            self._write_header(BLOCKMAP_CLEAN)
+        self._map.close()
+        self._file.close()
+        self._map = None
+
+
+class ImageStats(object):
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.blocks = 0
+        self.changed = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.start = time.monotonic()
+        self.end = None
+
+    @property
+    def elapsed(self):
+        return (self.end or time.monotonic()) - self.start
+
+    @property
+    def mb_per_sec(self):
+        return self.bytes_read / (1024 * 1024) / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self):
+        return {'block_size': self.block_size, 'blocks': self.blocks, 'changed': self.changed,
+                'bytes_read': self.bytes_read, 'bytes_written': self.bytes_written, 'elapsed': round(self.elapsed, 3),
+                'mb_per_sec': round(self.mb_per_sec, 1)}
+
+    def __str__(self):
+        return (f'{self.bytes_read / 2 ** 30:.1f} GB read in {self.elapsed:.2f}s ({self.mb_per_sec:.1f} MB/s), '
+                f'{self.changed} of {self.blocks} block(s) changed, {self.bytes_written / 2 ** 20:.1f} MB written')
+
+
+class ImageBackup(object):
+    '''
+        Updates a raw image of a snapshot's volume with the blocks that changed since the last run (see the module
+        docstring)
+    '''
+    def __init__(self, source:object, target:str, block_size:int=DEFAULT_BLOCK_SIZE,
+                 workers:int=DEFAULT_IMAGE_WORKERS, throttle:object=None, debug:bool=False):
+        '''
+            source: (VSSSnapshot or str) the snapshot (its shadow copy device is read) or a file
+            target: (str) the image file (its block map is target + '.blockmap')
+            block_size: (int) bytes per block, a multiple of 4096 (the reads stay sector aligned)
+            workers: (int) threads reading and hashing blocks
+            throttle: (VolumeThrottle) rate limits the reads
+            debug: (bool) enables enhanced output
+        '''
+        if block_size <= 0 or block_size % ALIGNMENT:
+            raise Exception(f'block_size must be a multiple of {ALIGNMENT}: {block_size}')
+        self.path = source_path(source)
+        self.target = target
+        self.map_path = f'{target}.blockmap'
+        self.block_size = block_size
+        self.workers = workers
+        self.throttle = throttle
+        self.debug = debug
+        self._local = threading.local()
+        self._handles = []
+        self._handles_lock = threading.Lock()
+
+    def _source(self):
+        # one handle per worker thread (seek + read on a shared handle would race)
+        src = getattr(self._local, 'src', None)
+        if src is None:
+            src = open(self.path, 'rb', buffering=0)
+            self._local.src = src
+            with self._handles_lock:
+                self._handles.append(src)
+
+        return src
+
+    def _read_block(self, index, length, block_map):
+        src = self._source()
+        buf = bytearray(length)
+        view = memoryview(buf)
+        src.seek(index * self.block_size)
+        read = 0
+        while read < length:
+            if self.throttle is not None:
+                with self.throttle.read(length - read):
+                    count = src.readinto(view[read:])
+            else:
+                count = src.readinto(view[read:])
+            if not count:
+                raise Exception(f'{self.path}: short read at block {index} ({read} of {length} bytes)')
+            read += count
+        digest = block_digest(buf)
+        if digest == block_map.get(index):
+            return index, digest, None
+
+        return index, digest, buf
+
+    def run(self):
+        '''
+            Read the whole source, write the changed blocks, returns ImageStats
+        '''
+        size = device_size(self.path)
+        stats = ImageStats(self.block_size)
+        if not os.path.exists(self.target):
+            # a new image: nothing in the map can be trusted
+            with open(self.target, 'wb'):
+                pass
+            if os.path.exists(self.map_path):
+                os.remove(self.map_path)
+        block_map = BlockMap(self.map_path, self.block_size, size)
+        if self.debug:
+            print(f'imaging {self.path} ({size / 2 ** 30:.2f} GB, {block_map.blocks} block(s)) to {self.target} '
+                  f'({"compared with the last image" if block_map.trusted else "full write"})')
+        clean = False
+        try:
+            with open(self.target, 'r+b', buffering=0) as image:
+                image.truncate(size)
+                with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                    in_flight = collections.deque()
+                    for index in range(block_map.blocks):
+                        length = min(self.block_size, size - index * self.block_size)
+                        in_flight.append(pool.submit(self._read_block, index, length, block_map))
+                        if len(in_flight) >= self.workers * 2:
+                            self._store(in_flight.popleft().result(), image, block_map, stats)
+                    while in_flight:
+                        self._store(in_flight.popleft().result(), image, block_map, stats)
+                os.fsync(image.fileno())
+            clean = True
+        finally:
+            block_map.close(clean=clean)
+            for src in self._handles:
+                src.close()
+            self._handles = []
+            stats.end = time.monotonic()
+        if self.debug:
+            print(stats)
+
+        return stats
+
+    def _store(self, result, image, block_map, stats):
+        index, digest, data = result
+        stats.blocks += 1
+        stats.bytes_read += min(self.block_size, block_map.image_size - index * self.block_size)
+        if data is None:
+            return
+        image.seek(index * self.block_size)
+        view = memoryview(data)
+        written = 0
+        while written < len(data):
+            written += image.write(view[written:])
+        block_map.set(index, digest)
+        stats.changed += 1
+        stats.bytes_written += len(data)
+
+
+def image_snapshot(snapshot:object, target:str, **kwargs):
+    '''
+        ImageBackup(snapshot, target, **kwargs).run()
+    '''
+    return ImageBackup(snapshot, target, **kwargs).run()
@@ -0,0 +1,281 @@
+'''
+    Incremental snapshot inventory: added / removed / changed events instead of full query_snapshots() diffs
+
+    query_snapshots() builds a VSSSnapshotSet (and a VSSSnapshot with components of its own) for every set on the
+    system, and an agent that wants to know what changed keeps two of those inventories around to compare them.
+    InventoryWatcher calls QuerySnapshots once per poll and only keeps, per snapshot, its 16 byte id, the 16 byte id
+    of its set and a hash of its attributes:
+
+        * events: 'added' / 'removed' / 'changed' (exposed, attributes...) per snapshot, 'set_added' / 'set_removed'
+          when the first snapshot of a set shows up / the last one goes away
+        * delivered to the callbacks (subscribe()) and/or an async iterator (async for event in watcher.events())
+        * adaptive interval: back to min_interval after a poll that found changes, backoff times longer (up to
+          max_interval) after every quiet one; poke() asks for a poll right away (ex. after creating a set)
+
+    The source is a callable returning SnapshotEntry tuples: provider_source() queries VSS, StaticInventorySource is a
+    scripted stand-in (tests, other platforms).
+
+    Usage:
+        from alphavss.inventory import InventoryWatcher
+
+        watcher = InventoryWatcher(min_interval=5, max_interval=300)
+        watcher.subscribe(lambda event: print(event.kind, event.snap_id, event.entry))
+        watcher.start()
+        ...
+        watcher.stop()
+
+        # or, from asyncio code
+        async for event in InventoryWatcher().events():
+            catalog.update(event)
+'''
+import time
+import uuid
+import asyncio
+import threading
+from collections import namedtuple
+from alphavss.constants import Backup
+
+DEFAULT_MIN_INTERVAL = 5.0 # seconds
+DEFAULT_MAX_INTERVAL = 300.0
+DEFAULT_BACKOFF = 2.0
+
+ADDED = 'added'
+REMOVED = 'removed'
+CHANGED = 'changed'
+SET_ADDED = 'set_added'
+SET_REMOVED = 'set_removed'
+
+SnapshotEntry = namedtuple('SnapshotEntry', ['snap_id', 'set_id', 'original_volume', 'device_object', 'exposed_name',
+                                             'exposed_path', 'attributes', 'created'])
+InventoryEvent = namedtuple('InventoryEvent', ['kind', 'snap_id', 'set_id', 'entry']) # entry is None for removals
+
+
+def snapshot_entry(snap:object):
+    '''
+        SnapshotEntry of a VssSnapshotProperties object (one of the QuerySnapshots() results)
+    '''
+    return SnapshotEntry(str(snap.SnapshotId), str(snap.SnapshotSetId), str(snap.OriginalVolumeName),
+                         str(snap.SnapshotDeviceObject), str(snap.ExposedName) if snap.ExposedName else None,
+                         str(snap.ExposedPath) if snap.ExposedPath else None, int(snap.SnapshotAttributes),
+                         # sortable local time: 2022-07-27T21:04:05
+                         snap.CreationTimestamp.ToString('s'))
+
+
+def provider_source(provider:object=None, context:int=Backup):
+    '''
+        Source querying VSS with provider (default: a new 'query' VSSProvider of context): one components object and
+        one QuerySnapshots() per poll, no VSSSnapshotSet objects
+    '''
+    if provider is None:
+        from alphavss.models import VSSProvider
+
+        provider = VSSProvider(operation='query', context=context)
+
+    def source():
+        from alphavss.models import timed
+
+        components = provider.create_backup_components()
+        provider._initialize(components)
+        with timed(provider.timings, 'QuerySnapshots'):
+            snaps = components.QuerySnapshots()
+        entries = [snapshot_entry(snap) for snap in snaps]
+        del components
+
+        return entries
+
+    return source
+
+
+class StaticInventorySource(object):
+    '''
+        Source with scripted snapshots: add() / remove() / update() them between polls
+    '''
+    def __init__(self, entries:list=None):
+        self.entries = {}
+        self.polls = 0
+        for entry in entries or []:
+            self.add(entry)
+
+    def add(self, entry:SnapshotEntry):
+        self.entries[entry.snap_id] = entry
+
+    def remove(self, snap_id:str):
+        self.entries.pop(snap_id, None)
+
+    def update(self, snap_id:str, **changes):
+        self.entries[snap_id] = self.entries[snap_id]._replace(**changes)
+
+    def __call__(self):
+        self.polls += 1
+
+        return list(self.entries.values())
+
+
+def _fingerprint(entry):
+    # what can change on an existing snapshot (exposing it, attribute updates)
+    return hash((entry.device_object, entry.exposed_name, entry.exposed_path, entry.attributes))
+
+
+class InventoryWatcher(object):
+    '''
+        Polls the snapshot inventory and emits what changed (see the module docstring)
+    '''
+    def __init__(self, source:object=None, min_interval:float=DEFAULT_MIN_INTERVAL,
+                 max_interval:float=DEFAULT_MAX_INTERVAL, backoff:float=DEFAULT_BACKOFF, initial:bool=True,
+                 clock:object=time.monotonic, debug:bool=False):
+        '''
+            source: (callable) returns the SnapshotEntry of every snapshot (default: provider_source())
+            min_interval: (float) seconds between polls while the inventory changes
+            max_interval: (float) seconds between polls when it has been quiet for a while
+            backoff: (float) interval multiplier after a quiet poll
+            initial: (bool) the first poll reports every existing snapshot as added (False: it only primes the state)
+            clock: (callable) time.monotonic (replace it to simulate time)
+            debug: (bool) enables enhanced output
+        '''
+        self.source = source or provider_source()
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.initial = initial
+        self.clock = clock
+        self.debug = debug
+        self.interval = min_interval
+        self.polls = 0
+        self.last_poll = None
+        self.callback_errors = 0
+        self._snaps = {} # snapshot id (16 bytes) -> (set id (16 bytes), attribute fingerprint)
+        self._sets = {} # set id (16 bytes) -> snapshot count
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._snaps)
+
+    @property
+    def snapshot_ids(self):
+        return [str(uuid.UUID(bytes=snap_id)) for snap_id in self._snaps]
+
+    @property
+    def set_ids(self):
+        return [str(uuid.UUID(bytes=set_id)) for set_id in self._sets]
+
+    def subscribe(self, callback:object):
+        '''
+            callback(InventoryEvent) for every event of every later poll (what it raises is counted in callback_errors
+            and doesn't keep the event from the other callbacks, or the other events from it)
+        '''
+        self._callbacks.append(callback)
+
+    def unsubscribe(self, callback:object):
+        self._callbacks.remove(callback)
+
+    def poke(self):
+        '''
+            Poll now (the running loop wakes up) and restart from min_interval
+        '''
+        self.interval = self.min_interval
+        self._wake.set()
+
+    def poll(self):
+        '''
+            Query the inventory once, update the state and the interval, returns (and hands the callbacks) the events
+        '''
+        entries = self.source()
+        with self._lock:
+            events = self._diff(entries)
+            self.polls += 1
+            self.last_poll = self.clock()
+            if events:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.max_interval, self.interval * self.backoff)
+        if self.debug:
+            print(f'inventory poll {self.polls}: {len(entries)} snapshot(s), {len(events)} event(s), next poll in '
+                  f'{self.interval:.1f}s')
+        # the state is already updated: an event a callback misses is not reported again
+        for event in events:
+            for callback in list(self._callbacks):
+                try:
+                    callback(event)
+                except Exception as e: #pylint:disable=W0703
+                    self.callback_errors += 1
+                    if self.debug:
+                        print(f'inventory callback {callback!r} failed on {event.kind} {event.snap_id or event.set_id}: {e}')
+
+        return events
+
+    def _diff(self, entries):
+        quiet = self.polls == 0 and not self.initial
+        events = []
+        seen = {}
+        for entry in entries:
+            snap_id = uuid.UUID(entry.snap_id).bytes
+            set_id = uuid.UUID(entry.set_id).bytes
+            fingerprint = _fingerprint(entry)
+            seen[snap_id] = (set_id, fingerprint)
+            known = self._snaps.get(snap_id)
+            if known is None:
+                if set_id not in self._sets:
+                    self._sets[set_id] = 0
+                    events.append(InventoryEvent(SET_ADDED, None, entry.set_id, None))
+                self._sets[set_id] += 1
+                events.append(InventoryEvent(ADDED, entry.snap_id, entry.set_id, entry))
+            elif known[1] != fingerprint:
+                events.append(InventoryEvent(CHANGED, entry.snap_id, entry.set_id, entry))
+        for snap_id, (set_id, _) in self._snaps.items():
+            if snap_id in seen:
+                continue
+            events.append(InventoryEvent(REMOVED, str(uuid.UUID(bytes=snap_id)), str(uuid.UUID(bytes=set_id)), None))
+            self._sets[set_id] -= 1
+            if not self._sets[set_id]:
+                del self._sets[set_id]
+                events.append(InventoryEvent(SET_REMOVED, None, str(uuid.UUID(bytes=set_id)), None))
+        self._snaps = seen
+
+        return [] if quiet else events
+
+    def run(self):
+        '''
+            Poll until stop() (blocking), sleeping the adaptive interval in between
+        '''
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception as e: #pylint:disable=W0703
+                # a failed query (VSS busy...) is retried on the next round
+                if self.debug:
+                    print(f'inventory poll failed: {e}')
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def start(self):
+        '''
+            run() on a daemon thread
+        '''
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name='alphavss-inventory', daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self, timeout:float=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    async def events(self, loop:object=None):
+        '''
+            Async iterator of the events (the polls run in the default executor, the VSS calls block)
+        '''
+        loop = loop or asyncio.get_running_loop()
+        while not self._stop.is_set():
+            for event in await loop.run_in_executor(None, self.poll):
+                yield event
+            wake = loop.run_in_executor(None, self._wake.wait, self.interval)
+            await wake
+            self._wake.clear()
@@ -0,0 +1,361 @@
+'''
+    Resumable snapshot backups: a checkpoint journal for long copies out of a (persistent) snapshot set
+
+    Without a journal an interrupted copy starts over from scratch, with a new DoSnapshotSet.  BackupJob creates the
+    snapshot set in a persistent context (AppRollback: the snapshots survive the process and reboots) and journals the
+    copy as it goes; running the same job again re-opens the same set through query_snapshots() and only copies what
+    is missing.
+
+    The journal is an append only text file, one record per line:
+        J <job JSON>                    snapshot set ID, snapshot IDs per volume, target, context (first line)
+        F <size> <path JSON>            file copied completely
+        R <offset> <path JSON>          a big file is copied up to offset (its output offset, ranges of range_size)
+        V <volume JSON>                 every file of a volume is copied
+        Z                               job complete (the snapshot set was deleted)
+
+        * records are buffered and written + fsynced in batches (sync_every records or sync_interval seconds), the
+          cost is counted in BackupJournal.seconds: a couple of microseconds per file and one fsync per batch, under
+          1% of the copy time unless the files are nearly empty (100k empty files: ~3%)
+        * a line cut short by a crash is dropped when the journal is read again
+        * the journal only vouches for what the copy wrote: target files are not fsynced one by one, a power loss can
+          lose the last (unsynced) writes of the target even though the journal made it to disk
+
+    Usage:
+        from alphavss.journal import BackupJob
+
+        stats = BackupJob(['C:\\', 'D:\\'], 'E:\\backups\\nightly', 'E:\\backups\\nightly.journal').run()
+        # interrupted?  run the same line again, it continues where it stopped
+'''
+import os
+import json
+import time
+import threading
+from collections import namedtuple
+from alphavss.walker import SnapshotWalker, snapshot_label
+from alphavss.archive import archive_path
+from alphavss.copier import SnapshotCopier
+from alphavss.throttle import normalize_volume_name
+from alphavss.verify import truncate_partial_line
+from alphavss.constants import AppRollback
+
+DEFAULT_RANGE_SIZE = 64 * 1024 * 1024 # 64 MB
+DEFAULT_SYNC_EVERY = 1000
+DEFAULT_SYNC_INTERVAL = 1.0
+
+JournalState = namedtuple('JournalState', ['job', 'completed', 'partial', 'volumes_done', 'finished'])
+
+
+def read_journal(path:str):
+    '''
+        JournalState of a journal file (None if there is none yet)
+
+        completed: {path: size} of the files copied completely
+        partial: {path: offset} of the big files copied up to offset
+    '''
+    if not os.path.exists(path):
+        return None
+    job = None
+    completed = {}
+    partial = {}
+    volumes_done = set()
+    finished = False
+    with open(path, 'r', encoding='utf-8', newline='\n') as journal:
+        for line in journal:
+            if not line.endswith('\n'):
+                # cut short by a crash
+                break
+            kind, _, rest = line.rstrip('\n').partition('\t')
+            if kind == 'F':
+                size, _, record_path = rest.partition('\t')
+                record_path = json.loads(record_path)
+                completed[record_path] = int(size)
+                partial.pop(record_path, None)
+            elif kind == 'R':
+                offset, _, record_path = rest.partition('\t')
+                partial[json.loads(record_path)] = int(offset)
+            elif kind == 'V':
+                volumes_done.add(json.loads(rest))
+            elif kind == 'Z':
+                finished = True
+            elif kind == 'J':
+                job = json.loads(rest)
+            else:
+                raise Exception(f'Corrupt backup journal (unknown record {kind!r}): {path}')
+
+    return JournalState(job, completed, partial, volumes_done, finished)
+
+
+class BackupJournal(object):
+    '''
+        Append records to a backup journal (thread safe, fsynced in batches)
+    '''
+    def __init__(self, path:str, sync_every:int=DEFAULT_SYNC_EVERY, sync_interval:float=DEFAULT_SYNC_INTERVAL):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        truncate_partial_line(path)
+        self._file = open(path, 'a', encoding='utf-8', newline='\n')
+        self._lock = threading.Lock()
+        self._pending = []
+        self._last_sync = time.monotonic()
+        self.records = 0
+        self.syncs = 0
+        self.seconds = 0.0 # time spent journaling (writes and fsyncs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _write(self, line, sync=False):
+        with self._lock:
+            start = time.perf_counter()
+            # records are only buffered here, they go out (one write, one fsync) per batch
+            self._pending.append(line)
+            if sync or len(self._pending) >= self.sync_every or time.monotonic() - self._last_sync >= self.sync_interval:
+                self._sync()
+            self.seconds += time.perf_counter() - start
+
+    def _sync(self):
+        self.records += len(self._pending)
+        self._file.write(''.join(self._pending))
+        self._pending = []
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_sync = time.monotonic()
+        self.syncs += 1
+
+    def start(self, job:dict):
+        self._write(f'J\t{json.dumps(job, sort_keys=True)}\n', sync=True)
+
+    def file_done(self, path:str, size:int):
+        self._write(f'F\t{size}\t{json.dumps(path)}\n')
+
+    def range_done(self, path:str, offset:int):
+        self._write(f'R\t{offset}\t{json.dumps(path)}\n')
+
+    def volume_done(self, volume:str):
+        self._write(f'V\t{json.dumps(volume)}\n', sync=True)
+
+    def finish(self):
+        self._write('Z\n', sync=True)
+
+    def close(self):
+        with self._lock:
+            if self._pending:
+                self._sync()
+            self._file.close()
+
+
+class JournaledCopier(SnapshotCopier):
+    '''
+        SnapshotCopier that journals every copied file (and the progress of big files) and skips what a previous run
+        of the job already copied
+    '''
+    def __init__(self, snapshot:object, target:str, journal:BackupJournal, state:JournalState=None,
+                 prefix:str='', range_size:int=DEFAULT_RANGE_SIZE, **kwargs):
+        '''
+            journal: (BackupJournal) where the progress is recorded
+            state: (JournalState) progress of the previous runs (from read_journal())
+            prefix: (str) journal paths are '<prefix>/<path in the snapshot>' (the volume of a multi volume job)
+            range_size: (int) files bigger than this are journaled every range_size bytes (and resumed from there)
+            kwargs: SnapshotCopier arguments
+        '''
+        super().__init__(snapshot, target, **kwargs)
+        self.journal = journal
+        self.completed = state.completed if state is not None else {}
+        self.partial = state.partial if state is not None else {}
+        self.prefix = prefix
+        self.range_size = range_size
+        self.resumed = 0
+
+    def copy(self, entries:object=None):
+        if entries is None:
+            walker_options = dict(self.walker_options)
+            walker_options.setdefault('throttle', self.throttle)
+            entries = SnapshotWalker(self.root, debug=self.debug, **walker_options)
+
+        return super().copy(self._remaining(entries))
+
+    def _remaining(self, entries):
+        for entry in entries:
+            if entry.is_file() and self.completed.get(archive_path(self.prefix, entry.rel_path)) == entry.size:
+                self.resumed += 1
+                continue
+            yield entry
+
+    def copy_file(self, entry, buf:bytearray):
+        journal_path = archive_path(self.prefix, entry.rel_path)
+        start = self.partial.get(journal_path, 0)
+        if entry.size <= self.range_size and not start:
+            nbytes = super().copy_file(entry, buf)
+        else:
+            nbytes = self._copy_ranges(entry, buf, journal_path, start)
+        self.journal.file_done(journal_path, entry.size)
+
+        return nbytes
+
+    def _copy_ranges(self, entry, buf, journal_path, start):
+        '''
+            Copy a big file from start (what a previous run already copied), journaling every range_size bytes
+        '''
+        dst_path = self.target_path(entry.rel_path)
+        st = entry.stat()
+        if not os.path.exists(dst_path):
+            start = 0
+        try:
+            dst = open(dst_path, 'r+b' if start else 'wb', buffering=0)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+            dst = open(dst_path, 'wb', buffering=0)
+        view = memoryview(buf)
+        offset = start
+        with dst, open(entry.path, 'rb', buffering=0) as src:
+            src.seek(start)
+            dst.seek(start)
+            mark = start + self.range_size
+            while True:
+                if self.throttle is not None:
+                    with self.throttle.read(len(buf)):
+                        read = src.readinto(view)
+                else:
+                    read = src.readinto(view)
+                if not read:
+                    break
+                dst.write(view[:read])
+                offset += read
+                if offset >= mark:
+                    self.journal.range_done(journal_path, offset)
+                    mark = offset + self.range_size
+            # a resumed file may have more (unjournaled) data past the end
+            dst.truncate(offset)
+
+        if self.preserve_times:
+            os.utime(dst_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+        return offset - start
+
+
+class BackupJob(object):
+    '''
+        Copy every volume of a (persistent) snapshot set to a target, resumable through a journal
+    '''
+    def __init__(self, volume_names:list, target:str, journal_path:str, provider:object=None, context:int=AppRollback,
+                 delete_after:bool=True, range_size:int=DEFAULT_RANGE_SIZE, sync_every:int=DEFAULT_SYNC_EVERY,
+                 sync_interval:float=DEFAULT_SYNC_INTERVAL, copier_options:dict=None, debug:bool=False):
+        '''
+            volume_names: (list) ex. ['C:\\', 'D:\\']
+            target: (str) every volume is copied to <target>/<drive letter>
+            journal_path: (str) the job's journal (a new job starts when there is none, or the last one finished)
+            provider: (VSSProvider) used to create (and query) the snapshot set
+            context: (int) snapshot context, it has to be persistent for the set to outlive an interrupted job
+            delete_after: (bool) delete the snapshot set once everything is copied
+            range_size/sync_every/sync_interval: see JournaledCopier and BackupJournal
+            copier_options: (dict) keyword arguments for the SnapshotCopier (workers, walker_options, throttle...)
+            debug: (bool) enables enhanced output
+        '''
+        self.volume_names = volume_names
+        self.target = target
+        self.journal_path = journal_path
+        self.provider = provider
+        self.context = context
+        self.delete_after = delete_after
+        self.range_size = range_size
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.copier_options = copier_options or {}
+        self.debug = debug
+        self.resumed = False
+
+    def _provider(self, operation):
+        if self.provider is not None:
+            return self.provider
+
+        from alphavss.models import VSSProvider
+
+        return VSSProvider(operation=operation, context=self.context, debug=self.debug)
+
+    def create_set(self):
+        '''
+            Take the snapshots of the job (DoSnapshotSet)
+        '''
+        from alphavss.models import VSSSnapshotSet
+
+        return VSSSnapshotSet(volume_names=self.volume_names, provider=self._provider('backup'), context=self.context,
+                              debug=self.debug)
+
+    def reopen_set(self, set_id:str):
+        '''
+            The snapshot set of an interrupted job (None if it is gone)
+        '''
+        for vss_set in self._provider('query').query_snapshots():
+            if str(vss_set.set_id) == set_id:
+                return vss_set
+
+        return None
+
+    def delete_set(self, vss_set:object):
+        from alphavss.models import VSSProvider
+
+        # InitializeForBackup + SetContext is all DeleteSnapshotSet needs: a 'query' provider skips the
+        # GatherWriterMetadata of the backup provider
+        provider = VSSProvider(operation='query', context=vss_set.provider.context, debug=self.debug)
+        components = provider.create_backup_components()
+        provider._initialize(components)
+        vss_set.delete(components)
+
+    def run(self):
+        '''
+            Copy (or finish copying) every volume, returns {volume_name: CopyStats} of this run
+        '''
+        state = read_journal(self.journal_path)
+        vss_set = None
+        self.resumed = False
+        if state is not None and state.job is not None and not state.finished:
+            vss_set = self.reopen_set(state.job['set_id'])
+            if vss_set is not None:
+                self.resumed = True
+            elif self.debug:
+                print(f'snapshot set {state.job["set_id"]} of the interrupted job is gone, starting over')
+
+        if vss_set is None:
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+            state = None
+            vss_set = self.create_set()
+
+        results = {}
+        with BackupJournal(self.journal_path, sync_every=self.sync_every, sync_interval=self.sync_interval) as journal:
+            if state is None:
+                journal.start({'set_id': str(vss_set.set_id), 'context': self.context, 'target': self.target,
+                               'snapshots': {normalize_volume_name(snapshot.volume_name): str(snapshot.snap_id)
+                                             for snapshot in vss_set.snapshots},
+                               'created': time.strftime('%Y-%m-%d %H:%M:%S')})
+            volumes_done = state.volumes_done if state is not None else set()
+            for snapshot in vss_set.snapshots:
+                volume = normalize_volume_name(snapshot.volume_name)
+                if volume in volumes_done:
+                    continue
+                label = snapshot_label(snapshot)
+                copier = JournaledCopier(snapshot, os.path.join(self.target, label), journal, state=state, prefix=label,
+                                         range_size=self.range_size, debug=self.debug, **self.copier_options)
+                results[snapshot.volume_name] = copier.copy()
+                if copier.stats.errors:
+                    # not done: the next run retries the files that failed
+                    raise Exception(f'{copier.stats.errors} file(s) of {volume} failed to copy, run the job again to retry them')
+                journal.volume_done(volume)
+                if self.debug:
+                    print(f'{volume}: {copier.stats} ({copier.resumed} file(s) copied by a previous run)')
+
+            if self.delete_after:
+                self.delete_set(vss_set)
+            journal.finish()
+
+            if self.debug:
+                copy_seconds = sum(stats.elapsed for stats in results.values())
+                overhead = 100 * journal.seconds / copy_seconds if copy_seconds else 0.0
+                print(f'journal: {journal.records} record(s), {journal.syncs} fsync(s), {journal.seconds:.3f}s '
+                      f'({overhead:.2f}% of the copy)')
+
+        return results
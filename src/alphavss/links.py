@@ -0,0 +1,223 @@
+'''
+    Hard link (and duplicate file ID) detection for snapshot copies and backups
+
+    NTFS volumes are full of hard links (WinSxS alone holds tens of thousands) and, when reparse points are followed,
+    the same file can also show up under several paths.  Copied naively every one of those paths reads and writes the
+    data again.  LinkTracker remembers the identity of the files it has seen, keyed on (volume serial, file ID) as
+    os.stat() reports them (st_dev, st_ino), and tells the copy path when a file is one it already has:
+
+        * the SnapshotCopier (hard_links=True) creates a hard link in the target instead of a second copy
+        * the BackupPipeline (hard_links=True) writes an archive link record (path -> first path) instead of the data,
+          the restore engine turns it back into a hard link
+
+    Only files with a link count above 1 can have another path (unless reparse points are followed, then every file
+    is tracked), so the seen set usually stays small.  When it doesn't, SeenSet spills sorted runs to disk and keeps
+    answering from memory mapped binary searches: memory stays bounded on any volume.
+
+    Note: on Windows the stat results of os.scandir() carry no file ID or link count, the check costs an os.stat()
+          per file there (see WalkEntry.identity())
+'''
+import os
+import mmap
+import heapq
+import struct
+import shutil
+import tempfile
+import threading
+
+DEFAULT_MEMORY_LIMIT = 1000000 # keys kept in memory before a run is spilled
+DEFAULT_MAX_RUNS = 8
+KEY_SIZE = 24 # <8 bytes volume serial> <16 bytes file ID> (ReFS file IDs are 128 bit)
+
+_RUN_HEADER = struct.Struct('<Q')
+
+
+def identity_key(dev:int, ino:int):
+    '''
+        Fixed size, sortable key of a file identity
+    '''
+    return (dev & 0xFFFFFFFFFFFFFFFF).to_bytes(8, 'big') + ino.to_bytes(16, 'big')
+
+
+class _Run(object):
+    '''
+        Spilled part of a SeenSet: <Q count> <keys, KEY_SIZE each, sorted> <Q value offsets> * (count + 1) <values, utf-8>
+    '''
+    def __init__(self, path, key_size):
+        self.path = path
+        self.key_size = key_size
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.count, = _RUN_HEADER.unpack_from(self._map, 0)
+        self._keys = _RUN_HEADER.size
+        self._offsets = self._keys + self.count * key_size
+        self._values = self._offsets + (self.count + 1) * 8
+
+    @staticmethod
+    def write(path, items, key_size):
+        '''
+            Write sorted (key, value) pairs as a run (streamed: the offsets and values go through side files)
+        '''
+        count = 0
+        offset = 0
+        with open(path, 'wb') as run_file, open(f'{path}.offsets', 'w+b') as offsets, \
+             open(f'{path}.values', 'w+b') as values:
+            run_file.write(_RUN_HEADER.pack(0))
+            for key, value in items:
+                encoded = value.encode('utf-8')
+                run_file.write(key)
+                offsets.write(struct.pack('<Q', offset))
+                values.write(encoded)
+                offset += len(encoded)
+                count += 1
+            offsets.write(struct.pack('<Q', offset))
+            for side_file in (offsets, values):
+                side_file.seek(0)
+                shutil.copyfileobj(side_file, run_file, 1024 * 1024)
+            run_file.seek(0)
+            run_file.write(_RUN_HEADER.pack(count))
+        os.remove(f'{path}.offsets')
+        os.remove(f'{path}.values')
+
+    def _key(self, number):
+        position = self._keys + number * self.key_size
+        return self._map[position:position + self.key_size]
+
+    def _value(self, number):
+        start, end = struct.unpack_from('<QQ', self._map, self._offsets + number * 8)
+        return self._map[self._values + start:self._values + end].decode('utf-8')
+
+    def get(self, key):
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self._key(low) == key:
+            return self._value(low)
+
+        return None
+
+    def __iter__(self):
+        for number in range(self.count):
+            yield self._key(number), self._value(number)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+class SeenSet(object):
+    '''
+        {key (bytes): value (str)} mapping with bounded memory: past memory_limit keys, the keys in memory are spilled
+        to a sorted run on disk (runs are merged once there are more than max_runs)
+    '''
+    def __init__(self, key_size:int=KEY_SIZE, memory_limit:int=DEFAULT_MEMORY_LIMIT, max_runs:int=DEFAULT_MAX_RUNS,
+                 tmpdir:str=None):
+        self.key_size = key_size
+        self.memory_limit = memory_limit
+        self.max_runs = max_runs
+        self.tmpdir = tmpdir
+        self._memory = {}
+        self._runs = []
+        self._run_dir = None
+        self._run_number = 0
+        self.spills = 0
+
+    def __len__(self):
+        return len(self._memory) + sum(run.count for run in self._runs)
+
+    def get(self, key:bytes):
+        value = self._memory.get(key)
+        if value is not None:
+            return value
+        for run in reversed(self._runs):
+            value = run.get(key)
+            if value is not None:
+                return value
+
+        return None
+
+    def add(self, key:bytes, value:str):
+        self._memory[key] = value
+        if len(self._memory) >= self.memory_limit:
+            self._spill()
+
+    def _new_run_path(self):
+        if self._run_dir is None:
+            self._run_dir = tempfile.mkdtemp(prefix='alphavss-seen-', dir=self.tmpdir)
+        self._run_number += 1
+
+        return os.path.join(self._run_dir, f'run-{self._run_number:06}')
+
+    def _spill(self):
+        path = self._new_run_path()
+        _Run.write(path, sorted(self._memory.items()), self.key_size)
+        self._memory = {}
+        self._runs.append(_Run(path, self.key_size))
+        self.spills += 1
+        if len(self._runs) > self.max_runs:
+            path = self._new_run_path()
+            _Run.write(path, heapq.merge(*self._runs), self.key_size)
+            for run in self._runs:
+                run.close()
+                os.remove(run.path)
+            self._runs = [_Run(path, self.key_size)]
+
+    def close(self):
+        for run in self._runs:
+            run.close()
+        self._runs = []
+        self._memory = {}
+        if self._run_dir is not None:
+            shutil.rmtree(self._run_dir, ignore_errors=True)
+            self._run_dir = None
+
+
+class LinkTracker(object):
+    '''
+        Remembers the files seen by a copy/backup, check() returns the first path of a file seen before
+    '''
+    def __init__(self, track_all:bool=False, memory_limit:int=DEFAULT_MEMORY_LIMIT, tmpdir:str=None):
+        '''
+            track_all: (bool) track every file, not only the ones with a link count above 1 (needed when reparse
+                       points are followed: a file reached through a junction has a link count of 1)
+            memory_limit: (int) identities kept in memory before spilling to disk
+            tmpdir: (str) where the spilled runs go (default: the system temporary directory)
+        '''
+        self.track_all = track_all
+        self.seen = SeenSet(memory_limit=memory_limit, tmpdir=tmpdir)
+        self.links = 0
+        self._lock = threading.Lock()
+
+    def check(self, entry:object, path:str):
+        '''
+            entry: (WalkEntry) a file
+            path: (str) the path the copy/backup records it under
+
+            Returns the path recorded for the same file before (None the first time a file is seen)
+        '''
+        dev, ino, nlink = entry.identity()
+        if not ino or (nlink <= 1 and not self.track_all):
+            return None
+        key = identity_key(dev, ino)
+        with self._lock:
+            first = self.seen.get(key)
+            if first is None:
+                self.seen.add(key, path)
+                return None
+            self.links += 1
+
+        return first
+
+    def close(self):
+        self.seen.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
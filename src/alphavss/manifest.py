@@ -0,0 +1,358 @@
+'''
+    Per snapshot file manifests and change detection for incremental backups
+
+    A manifest is a compact binary list of every file in a snapshot (path, size, mtime, file ID and an optional hash)
+    sorted by path.  Comparing the tree of a new snapshot with the manifest of the previous one is a single merge pass
+    over two sorted streams, so only the files that changed have to be read, and neither side is ever loaded into a
+    dict (tens of millions of entries work in constant memory, the sort spills to temporary run files)
+
+    File format:
+        MAGIC                                   b'AVSSMAN1'
+        <B digest_len> <I meta_len> meta        meta is a utf-8 JSON object (set_id, snap_id, volume_name, hash...)
+        records, sorted by path:
+            <H path_len> <Q size> <q mtime_ns> <Q file_id> digest path
+
+    Usage (incremental copy):
+        from alphavss.manifest import ManifestBuilder
+
+        builder = ManifestBuilder(snap, 'E:\\backups\\C-20261019.avm', previous='E:\\backups\\C-20261018.avm')
+        SnapshotCopier(snap, 'E:\\backups\\C-20261019').copy(builder.changed_entries())
+        print(builder.stats)
+'''
+import os
+import json
+import heapq
+import struct
+import hashlib
+import tempfile
+from collections import namedtuple
+from alphavss.walker import SnapshotWalker, WalkEntry, snapshot_root
+from alphavss.archive import archive_path
+
+MAGIC = b'AVSSMAN1'
+DEFAULT_RUN_SIZE = 200000
+HASH_BUFFER_SIZE = 1024 * 1024
+
+_HEADER = struct.Struct('<BI')
+_RECORD = struct.Struct('<HQqQ')
+_FILE_ID_MASK = 0xFFFFFFFFFFFFFFFF
+
+ManifestEntry = namedtuple('ManifestEntry', ['path', 'size', 'mtime_ns', 'file_id', 'digest'])
+Change = namedtuple('Change', ['kind', 'old', 'new']) # kind: 'added', 'removed', 'modified' or 'unchanged'
+
+ADDED = 'added'
+REMOVED = 'removed'
+MODIFIED = 'modified'
+UNCHANGED = 'unchanged'
+
+
+def file_id_of(entry:object):
+    '''
+        File ID of a WalkEntry (os.DirEntry.stat() doesn't fill st_ino on Windows, os.stat() does)
+    '''
+    st = entry.stat()
+    if st.st_ino:
+        return st.st_ino & _FILE_ID_MASK
+
+    return os.stat(entry.path, follow_symlinks=False).st_ino & _FILE_ID_MASK
+
+
+def hash_file(path:str, hash_name:str, buf:bytearray=None):
+    '''
+        hashlib digest of a file's content (read with readinto and a reusable buffer)
+    '''
+    digest = hashlib.new(hash_name)
+    buf = buf or bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as src:
+        while True:
+            read = src.readinto(view)
+            if not read:
+                break
+            digest.update(view[:read])
+
+    return digest.digest()
+
+
+class ManifestWriter(object):
+    '''
+        Write ManifestEntry records (in path order) to a manifest file
+    '''
+    def __init__(self, path:str, meta:dict=None, digest_len:int=0):
+        self.path = path
+        self.meta = meta or {}
+        self.digest_len = digest_len
+        self.count = 0
+        self._last_path = None
+        self._empty_digest = b'\0' * digest_len
+        self._file = open(path, 'wb', buffering=HASH_BUFFER_SIZE)
+        encoded = json.dumps(self.meta, sort_keys=True).encode('utf-8')
+        self._file.write(MAGIC + _HEADER.pack(digest_len, len(encoded)) + encoded)
+
+    def write(self, entry:ManifestEntry):
+        if self._last_path is not None and entry.path <= self._last_path:
+            raise Exception(f'Manifest entries have to be written in path order: {entry.path!r} after {self._last_path!r}')
+        self._last_path = entry.path
+        encoded = entry.path.encode('utf-8')
+        digest = entry.digest or self._empty_digest
+        if len(digest) != self.digest_len:
+            raise Exception(f'Manifest digest length mismatch for {entry.path!r}: {len(digest)} != {self.digest_len}')
+        self._file.write(_RECORD.pack(len(encoded), entry.size, entry.mtime_ns, entry.file_id) + digest + encoded)
+        self.count += 1
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ManifestReader(object):
+    '''
+        Iterate over the ManifestEntry records of a manifest file (meta and digest_len are read from the header)
+    '''
+    def __init__(self, path:str):
+        self.path = path
+        with open(path, 'rb') as manifest_file:
+            if manifest_file.read(len(MAGIC)) != MAGIC:
+                raise Exception(f'Not an alphavss manifest (bad magic): {path}')
+            self.digest_len, meta_len = _HEADER.unpack(manifest_file.read(_HEADER.size))
+            self.meta = json.loads(manifest_file.read(meta_len).decode('utf-8'))
+            self._data_offset = manifest_file.tell()
+
+    def __iter__(self):
+        digest_len = self.digest_len
+        empty_digest = b'\0' * digest_len
+        with open(self.path, 'rb', buffering=HASH_BUFFER_SIZE) as manifest_file:
+            manifest_file.seek(self._data_offset)
+            read = manifest_file.read
+            while True:
+                header = read(_RECORD.size)
+                if not header:
+                    return
+                if len(header) != _RECORD.size:
+                    raise Exception(f'Truncated manifest: {self.path}')
+                path_len, size, mtime_ns, file_id = _RECORD.unpack(header)
+                digest = read(digest_len) if digest_len else None
+                path = read(path_len)
+                if len(path) != path_len or (digest is not None and len(digest) != digest_len):
+                    raise Exception(f'Truncated manifest: {self.path}')
+                if digest == empty_digest:
+                    # written without a hash (unreadable file)
+                    digest = None
+                yield ManifestEntry(path.decode('utf-8'), size, mtime_ns, file_id, digest)
+
+
+def sorted_entries(entries:object, run_size:int=DEFAULT_RUN_SIZE, digest_len:int=0, tmpdir:str=None):
+    '''
+        Generator returning ManifestEntry objects in path order
+
+        Up to run_size entries are sorted in memory, past that sorted runs are spilled to temporary files and merged
+    '''
+    run = []
+    runs = []
+    with tempfile.TemporaryDirectory(prefix='alphavss-manifest-', dir=tmpdir) as run_dir:
+        for entry in entries:
+            run.append(entry)
+            if len(run) >= run_size:
+                runs.append(_spill(run, run_dir, len(runs), digest_len))
+                run = []
+
+        run.sort(key=lambda entry: entry.path)
+        if not runs:
+            yield from run
+            return
+
+        if run:
+            runs.append(_spill(run, run_dir, len(runs), digest_len))
+        yield from heapq.merge(*(iter(ManifestReader(path)) for path in runs), key=lambda entry: entry.path)
+
+
+def _spill(run, run_dir, number, digest_len):
+    run.sort(key=lambda entry: entry.path)
+    path = os.path.join(run_dir, f'run-{number:06}.avm')
+    with ManifestWriter(path, digest_len=digest_len) as writer:
+        for entry in run:
+            writer.write(entry)
+
+    return path
+
+
+def is_modified(old:ManifestEntry, new:ManifestEntry):
+    '''
+        Metadata comparison (size, mtime and file ID when both sides know it)
+    '''
+    if old.size != new.size or old.mtime_ns != new.mtime_ns:
+        return True
+
+    return bool(old.file_id and new.file_id and old.file_id != new.file_id)
+
+
+def diff_entries(old:object, new:object, include_unchanged:bool=False):
+    '''
+        Merge two path ordered streams of ManifestEntry objects, generator returning Change objects
+    '''
+    old_iter = iter(old)
+    new_iter = iter(new)
+    old_entry = next(old_iter, None)
+    new_entry = next(new_iter, None)
+    while old_entry is not None or new_entry is not None:
+        if new_entry is None or (old_entry is not None and old_entry.path < new_entry.path):
+            yield Change(REMOVED, old_entry, None)
+            old_entry = next(old_iter, None)
+        elif old_entry is None or new_entry.path < old_entry.path:
+            yield Change(ADDED, None, new_entry)
+            new_entry = next(new_iter, None)
+        else:
+            if is_modified(old_entry, new_entry):
+                yield Change(MODIFIED, old_entry, new_entry)
+            elif include_unchanged:
+                yield Change(UNCHANGED, old_entry, new_entry)
+            old_entry = next(old_iter, None)
+            new_entry = next(new_iter, None)
+
+
+def diff_manifests(old_path:str, new_path:str, include_unchanged:bool=False):
+    '''
+        Changes between two manifest files (generator returning Change objects)
+    '''
+    return diff_entries(ManifestReader(old_path), ManifestReader(new_path), include_unchanged=include_unchanged)
+
+
+class ManifestStats(object):
+    def __init__(self):
+        self.added = 0
+        self.removed = 0
+        self.modified = 0
+        self.unchanged = 0
+        self.hashed = 0
+
+    def as_dict(self):
+        return {'added': self.added, 'removed': self.removed, 'modified': self.modified,
+                'unchanged': self.unchanged, 'hashed': self.hashed}
+
+    def __str__(self):
+        return (f'{self.added} added, {self.modified} modified, {self.removed} removed, '
+                f'{self.unchanged} unchanged ({self.hashed} hashed)')
+
+
+class ManifestBuilder(object):
+    '''
+        Build the manifest of a snapshot, comparing it with the previous snapshot's manifest along the way
+    '''
+    def __init__(self, snapshot:object, path:str, previous:str=None, hash_name:str=None, file_ids:bool=True,
+                 walker_options:dict=None, meta:dict=None, run_size:int=DEFAULT_RUN_SIZE, tmpdir:str=None, debug:bool=False):
+        '''
+            snapshot: (str or VSSSnapshot) what to list (see walker.snapshot_root())
+            path: (str) manifest file to write
+            previous: (str) manifest of the previous snapshot of the same volume (None = everything is added)
+            hash_name: (str) hashlib algorithm ('sha256', 'blake2b'...) to store content hashes with, only added and
+                       modified files are hashed, unchanged files keep the hash from the previous manifest
+            file_ids: (bool) record file IDs (an extra stat per file on Windows)
+            walker_options: (dict) keyword arguments for the SnapshotWalker (include, exclude, workers...)
+            meta: (dict) extra JSON serializable information for the manifest header
+            run_size: (int) entries sorted in memory before spilling to a temporary file
+            tmpdir: (str) where the sort runs are spilled to (default: the system temp dir)
+            debug: (bool) enables enhanced output
+        '''
+        self.snapshot = snapshot
+        self.root = snapshot_root(snapshot)
+        self.path = path
+        self.previous = ManifestReader(previous) if previous else None
+        self.hash_name = hash_name
+        self.digest_len = hashlib.new(hash_name).digest_size if hash_name else 0
+        self.file_ids = file_ids
+        self.walker_options = walker_options or {}
+        self.meta = dict(meta or {})
+        for key in ('set_id', 'snap_id', 'volume_name'):
+            value = getattr(snapshot, key, None)
+            if value is not None and key not in self.meta:
+                self.meta[key] = str(value)
+        self.meta['hash'] = hash_name
+        self.run_size = run_size
+        self.tmpdir = tmpdir
+        self.debug = debug
+        self.stats = ManifestStats()
+
+    def _walk(self):
+        walker_options = dict(self.walker_options)
+        walker_options['yield_dirs'] = False
+        for entry in SnapshotWalker(self.root, debug=self.debug, **walker_options):
+            if not entry.is_file():
+                continue
+            st = entry.stat()
+            file_id = file_id_of(entry) if self.file_ids else 0
+            yield ManifestEntry(archive_path(entry.rel_path), st.st_size, st.st_mtime_ns, file_id, None)
+
+    def entry_path(self, entry:ManifestEntry):
+        '''
+            Full path (in the snapshot) of a manifest entry
+        '''
+        return os.path.join(self.root, entry.path.replace('/', os.sep))
+
+    def changes(self):
+        '''
+            Generator returning every Change while the manifest is written (the manifest is complete once this is exhausted)
+        '''
+        self.stats = ManifestStats()
+        new = sorted_entries(self._walk(), run_size=self.run_size, tmpdir=self.tmpdir)
+        old = self.previous if self.previous is not None else []
+        buf = bytearray(HASH_BUFFER_SIZE) if self.hash_name else None
+        # hashes of a different algorithm can't be carried over
+        old_digests = self.previous is not None and self.previous.digest_len == self.digest_len
+        with ManifestWriter(self.path, meta=self.meta, digest_len=self.digest_len) as writer:
+            for change in diff_entries(old, new, include_unchanged=True):
+                entry = change.new
+                if change.kind == UNCHANGED:
+                    self.stats.unchanged += 1
+                    if self.hash_name:
+                        digest = change.old.digest if old_digests else None
+                        entry = entry._replace(digest=digest or self._hash(entry, buf))
+                elif change.kind == REMOVED:
+                    self.stats.removed += 1
+                else:
+                    if change.kind == ADDED:
+                        self.stats.added += 1
+                    else:
+                        self.stats.modified += 1
+                    if self.hash_name:
+                        entry = entry._replace(digest=self._hash(entry, buf))
+                if entry is not None:
+                    writer.write(entry)
+                    change = change._replace(new=entry)
+                yield change
+
+        if self.debug:
+            print(f'manifest {self.path}: {self.stats}')
+
+    def _hash(self, entry, buf):
+        try:
+            digest = hash_file(self.entry_path(entry), self.hash_name, buf)
+        except OSError as e:
+            if self.debug:
+                print(f'unable to hash {entry.path}: {e}')
+            return None
+        self.stats.hashed += 1
+        return digest
+
+    def changed_entries(self):
+        '''
+            Generator returning a WalkEntry for every added or modified file (feed it to SnapshotCopier.copy())
+        '''
+        for change in self.changes():
+            if change.kind in (ADDED, MODIFIED):
+                entry = change.new
+                yield WalkEntry(entry.path.rsplit('/', 1)[-1], self.entry_path(entry), entry.path.replace('/', os.sep),
+                                False, False)
+
+    def build(self):
+        '''
+            Write the manifest without doing anything with the changes, returns the ManifestStats
+        '''
+        for _ in self.changes():
+            pass
+
+        return self.stats
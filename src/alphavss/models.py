@@ -28,13 +28,17 @@
                    add expose_snapshot function
         20220727 - worked through bugs, and functionality issues in building the examples (expose/unexpose locally/remotely)
 '''
+import time
+import threading
 from os.path import exists
+from contextlib import contextmanager
 import wmi
 import clr
 import System #pylint:disable=E0401
 # Python .NET moduels will always show as reportMissingImports from Pylance or E0401 from Pylint
 from System import Guid #pylint:disable=E0401
 from alphavss.constants import ExposedLocally, ExposedRemotely, Backup, snapshot_attr_names
+from alphavss.deadlines import run_phase, VSSPhaseTimeout
 
 try:
     clr.AddReference("AlphaVSS.Common") #pylint:disable=I1101
@@ -43,16 +47,40 @@ except Exception as ex:
 
 import Alphaleonis.Win32.Vss as alphavsslib #pylint:disable=E0401,C0413
 
+# VSS creates one snapshot set at a time: held from StartSnapshotSet until DoSnapshotSet is done (or aborted)
+_SNAPSHOT_SET_SLOT = threading.BoundedSemaphore(1)
+SNAPSHOT_SET_SLOT_TIMEOUT = 300.0 # seconds prepare() waits for the slot before giving up
+
+
+@contextmanager
+def timed(timings:dict, phase:str):
+    '''
+        Add the time spent in the with block to timings[phase] (seconds)
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = timings.get(phase, 0.0) + time.perf_counter() - start
+
 
 class VSSProvider(object):
     '''
         AlphaVSS .NET Framework 4.5 Provider
     '''
-    def __init__(self, operation='backup', context=Backup, debug=False):
+    def __init__(self, operation='backup', context=Backup, capabilities=None, deadlines=None, debug=False):
+        '''
+            capabilities: (CapabilityCache) answers IsVolumeSupported from a cache (see capabilities.py)
+            deadlines: (dict) seconds allowed per VSS phase, ex. {'PrepareForBackup': 120, 'DoSnapshotSet': 60}
+                       (see deadlines.py), used by every snapshot set of this provider
+        '''
         self.debug = debug
         self.operation = operation
         self.context = context
+        self.capabilities = capabilities
+        self.deadlines = dict(deadlines or {})
         self.initialized_for = None
+        self.timings = {} # seconds spent per VSS call (phase) with this provider, see timed()
         try:
             self._object = alphavsslib.VssFactoryProvider.Default
         except Exception as e:
@@ -85,12 +113,13 @@ class VSSProvider(object):
             Prepare for Backup, Query or Expose
         '''
         if self.operation in ['backup', 'query']:
-            components.InitializeForBackup(None)
+            with timed(self.timings, 'InitializeForBackup'):
+                components.InitializeForBackup(None)
             self.initialized_for = self.operation
 
         components.SetContext(self.context)
         if self.operation == 'backup':
-            components.GatherWriterMetadata()
+            run_phase(components, 'GatherWriterMetadata', self.deadlines.get('GatherWriterMetadata'), timings=self.timings)
         # cant do this here because we need the snapshot objects for it
         # or store them somewhere/return the variable
         # if self.operation == 'query':
@@ -106,6 +135,15 @@ class VSSProvider(object):
         self.initialized_for = self.operation
         return True
 
+    def is_volume_supported(self, components, volume_name:str):
+        '''
+            components.IsVolumeSupported(volume_name), from the capability cache when the provider has one
+        '''
+        if self.capabilities is not None:
+            return self.capabilities.is_supported(volume_name, components=components)
+        with timed(self.timings, 'IsVolumeSupported'):
+            return components.IsVolumeSupported(volume_name)
+
     def create_backup_components(self):
         '''
             This object can only be used for a single Backup, Restore, or Query Operation
@@ -141,7 +179,8 @@ class VSSProvider(object):
         '''
         cmp = self.create_backup_components()
         self._initialize(cmp)
-        snaps = cmp.QuerySnapshots() # Snapshots
+        with timed(self.timings, 'QuerySnapshots'):
+            snaps = cmp.QuerySnapshots() # Snapshots
         vss_sets = []
         if self.debug:
             print(f'found {len(snaps)} snapshots')
@@ -219,8 +258,8 @@ class VSSSnapshot(object):
                     raise Exception('getting volume for snapshot set didnt match volume to snapshot id')
 
                 self.volume_name = volume_name
-                if not components.IsVolumeSupported(volume_name):
-                    raise Exception(f'Volume {volume_name} is not supported for {self.operation.capltalize()}')
+                if not self.provider.is_volume_supported(components, volume_name):
+                    raise Exception(f'Volume {volume_name} is not supported for {self.operation.capitalize()}')
 
     def get_drive_letter(self):
         '''
@@ -236,6 +275,21 @@ class VSSSnapshot(object):
 
         return None
 
+    def get_device_path(self):
+        '''
+            Return the shadow copy device path for this snapshot with a trailing backslash
+                ex. \\\\?\\GLOBALROOT\\Device\\HarddiskVolumeShadowCopy12\\
+
+            The device path can be read from (os.scandir/open) without exposing the snapshot first
+        '''
+        if self.snap_object is None:
+            try:
+                self.snap_object = self.components.GetSnapshotProperties(self.snap_id)
+            except Exception as e:
+                raise Exception(f'Error getting the snapshot properties for snapshot id: {self.snap_id}') from e
+
+        return f'{self.snap_object.SnapshotDeviceObject}\\'
+
     def expose_snapshot(self, expose_path:str, attributes=ExposedLocally, path_from_root=None):
         '''
             expose_path: (str, required) the path you want to expose the snapshot as
@@ -290,7 +344,8 @@ class VSSSnapshot(object):
         if self.debug:
             print(f'expose_snapshot: Exposing -> {self.snap_id} to {expose_path} -> {snapshot_attr_names[attributes]}')
         try:
-            exposed_path = cmp.ExposeSnapshot(self.snap_id, path_from_root, attributes, expose_path)
+            with timed(self.provider.timings, 'ExposeSnapshot'):
+                exposed_path = cmp.ExposeSnapshot(self.snap_id, path_from_root, attributes, expose_path)
             if not exposed_path == expose_path:
                 raise Exception('Exposing Snapshot did not return what we expected: {exposed_path} != {expose_path}')
             self.exposed_path = exposed_path
@@ -345,7 +400,9 @@ class VSSSnapshotSet(object):
     '''
     def __init__(self, volume_names:list=None, provider:object=None, system_state:bool=True, component_mode:bool=False,
                  partial_file_support:bool=False, operation:str='backup', backup_type:int=alphavsslib.VssBackupType.Full,
-                 context:int=Backup, set_id=None, snapshots:list=None, components:object=None, debug:bool=False):
+                 context:int=Backup, set_id=None, snapshots:list=None, components:object=None, deadlines:dict=None,
+                 cancel:object=None, defer:bool=False, slot_timeout:float=SNAPSHOT_SET_SLOT_TIMEOUT,
+                 debug:bool=False):
         '''
             volume_names: (list) ex. ['C:\\', 'D:\\', 'F:\\']
             provider: (object, optional) VSSProvider object, If you are querying snapshots from the VSSProvider object, the provider object gets passed in,
@@ -357,6 +414,15 @@ class VSSSnapshotSet(object):
             backup_type: (int) only tested with alphavss.VssBackupType.Full
             context: (int, default = 0 [Backup]) allows us to define different snapshot conext options (like Persistence across reboots AKA AppRollback)
             components: (object) only here in case you've created this object from a VSSProvider object
+            deadlines: (dict) seconds allowed per VSS phase (added to the provider's deadlines), a phase that runs late
+                       aborts the backup and raises deadlines.VSSPhaseTimeout, its info attribute (PhaseTimeout) tells
+                       what happened.  A deferred set also keeps it in self.timeout after prepare()/commit() timed out
+            cancel: (threading.Event) set it to abort the backup during PrepareForBackup/DoSnapshotSet
+            defer: (bool) stop after GatherWriterMetadata and the setup of the snapshots: prepare() (StartSnapshotSet to
+                   PrepareForBackup) and commit() (DoSnapshotSet) create them later, abort() gives the set up (see
+                   rotation.py).  Use the set as a context manager (with ... as vss_set:) to abort it on errors
+            slot_timeout: (float) seconds prepare() waits for another set to be created (one at a time) before it
+                          raises, None: no limit
             debug: (bool) enables enhanced output
         '''
         self.operations = ['backup', 'restore', 'query']
@@ -387,11 +453,19 @@ class VSSSnapshotSet(object):
             print('untested / uncoded configuration with component_mode = True')
         self.component_mode = component_mode
         self.backup_type = backup_type
+        self.cancel = cancel
+        self.timeout = None
+        self.slot_timeout = slot_timeout
+        self.components = None
+        self.prepared = None # the components of a prepared set waiting for commit()
+        self.created = False
 
         if not provider:
             self.provider = VSSProvider(debug=debug)
         else:
             self.provider = provider
+        self.deadlines = dict(self.provider.deadlines)
+        self.deadlines.update(deadlines or {})
 
         if not components:
             if self.debug:
@@ -411,9 +485,13 @@ class VSSSnapshotSet(object):
                 else:
                     self.volume_names = volume_names
             for volume_name in self.volume_names:
-                if not components.IsVolumeSupported(volume_name):
-                    raise Exception(f'Volume {volume_name} is not supported for {self.operation.capltalize()}')
-            self.backup(components)
+                if not self.provider.is_volume_supported(components, volume_name):
+                    raise Exception(f'Volume {volume_name} is not supported for {self.operation.capitalize()}')
+            self.components = components
+            if defer:
+                self._setup_snapshots()
+            else:
+                self.backup(components)
         elif operation.lower() == 'delete':
             self.delete(components)
         elif operation.lower() == 'query':
@@ -464,24 +542,91 @@ class VSSSnapshotSet(object):
             span multiple drives (MS SQL Server for one could have databases/logs on multiple drives with LOGS on one drive
             and MDF files on another drive --  standard practice for highly performant databases)
         '''
+        self.prepare(components)
 
-        set_id = components.StartSnapshotSet()
+        return self.commit()
+
+    def _setup_snapshots(self):
+        '''
+            The VSSSnapshot of every volume (their own components, initialized), before the set is started: their
+            snap_id / set_id are filled in by prepare()
+        '''
+        try:
+            for volume_name in self.volume_names:
+                snapshot = VSSSnapshot(volume_name=volume_name, snap_id=None, operation=self.operation,
+                                       provider=self.provider, debug=self.debug)
+                self.snapshots.append(snapshot)
+        except Exception:
+            # a VSSPhaseTimeout here comes from the snapshot's own components (run_phase disposed of them): the set
+            # isn't started, there is nothing to abort
+            self._release_snapshots()
+            raise
+
+    def prepare(self, components:object=None):
+        '''
+            First half of backup(): StartSnapshotSet, AddToSnapshotSet for every volume, SetBackupState and
+            PrepareForBackup.  Holds the snapshot set slot (one set is created at a time) until commit() or abort()
+        '''
+        if components is None:
+            components = self.components
+        if not self.snapshots:
+            self._setup_snapshots()
+        if not _SNAPSHOT_SET_SLOT.acquire(timeout=self.slot_timeout):
+            self._release_snapshots()
+            raise Exception(f'Another snapshot set is still being created after {self.slot_timeout}s, unable to '
+                            f'start the set of {self.volume_names}')
+        try:
+            set_id = components.StartSnapshotSet()
+        except Exception:
+            _SNAPSHOT_SET_SLOT.release()
+            self._release_snapshots()
+            raise
+        self.prepared = components
         self.set_id = Guid.Parse(set_id)
         if self.debug:
             print(f'set_id ->> {set_id}')
 
-        for volume_name in self.volume_names:
-            # we validated the volumes in _prepare
-            snap_id = components.AddToSnapshotSet(volume_name)
-            snap_id = Guid.Parse(snap_id)
-            if self.debug:
-                print(f'snap_id ->> {snap_id} == {volume_name}')
-            snapshot = VSSSnapshot(volume_name=volume_name, set_id=set_id, snap_id=snap_id, operation=self.operation, provider=self.provider, debug=self.debug)
-            self.snapshots.append(snapshot)
+        try:
+            for snapshot in self.snapshots:
+                # we validated the volumes in _prepare
+                snap_id = components.AddToSnapshotSet(snapshot.volume_name)
+                snap_id = Guid.Parse(snap_id)
+                if self.debug:
+                    print(f'snap_id ->> {snap_id} == {snapshot.volume_name}')
+                snapshot.snap_id = snap_id
+                snapshot.set_id = set_id
+
+            components.SetBackupState(self.component_mode, self.system_state, self.backup_type, self.partial_file_support)
+            run_phase(components, 'PrepareForBackup', self.deadlines.get('PrepareForBackup'), cancel=self.cancel,
+                      set_id=self.set_id, volume_names=self.volume_names, timings=self.provider.timings)
+        except VSSPhaseTimeout as e:
+            self._aborted(e)
+            raise
+        except Exception:
+            self.abort()
+            raise
+
+        return True
 
-        components.SetBackupState(self.component_mode, self.system_state, self.backup_type, self.partial_file_support)
-        components.PrepareForBackup()
-        components.DoSnapshotSet()
+    def commit(self):
+        '''
+            Second half of backup(): DoSnapshotSet on the prepared set, releases the snapshot set slot
+        '''
+        if self.prepared is None:
+            raise Exception(f'snapshot set {self.set_id} is not prepared')
+        components = self.prepared
+        try:
+            run_phase(components, 'DoSnapshotSet', self.deadlines.get('DoSnapshotSet'), cancel=self.cancel,
+                      set_id=self.set_id, volume_names=self.volume_names, timings=self.provider.timings)
+        except VSSPhaseTimeout as e:
+            self._aborted(e)
+            raise
+        except Exception:
+            self.abort()
+            raise
+        self.prepared = None
+        self.created = True
+        _SNAPSHOT_SET_SLOT.release()
 
         if self.debug:
             volumes =  ', '.join(name[:2] for name in self.volume_names) # truncate the '\\' on volume_name
@@ -493,13 +638,65 @@ class VSSSnapshotSet(object):
 
         return True
 
+    def abort(self):
+        '''
+            Give up a deferred or prepared set (AbortBackup once prepared), releases the snapshot set slot and the
+            components of the snapshots.  Sets that are not backups (query) and created sets have nothing to give up
+        '''
+        if self.operation != 'backup' or self.created or (self.prepared is None and not self.snapshots):
+            return False
+        if self.prepared is not None:
+            try:
+                self.prepared.AbortBackup()
+            except Exception as e: #pylint:disable=W0703
+                if self.debug:
+                    print(f'AbortBackup of {self.set_id} failed: {e}')
+        self._release_snapshots()
+        if self.debug:
+            print(f'backup of {self.volume_names} aborted')
+
+        return True
+
+    def _aborted(self, e):
+        # run_phase already aborted the backup, release what the snapshots hold too
+        self.timeout = e.info
+        self._release_snapshots()
+        if self.debug:
+            print(f'backup of {self.volume_names} aborted: {e}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        # a backup set still deferred or prepared (an error before commit()) is given up, the snapshots of a query
+        # set stay
+        if self.operation == 'backup' and not self.created:
+            self.abort()
+
+    def __del__(self):
+        # a prepared set dropped without commit() or abort() would hold the snapshot set slot for good
+        if getattr(self, 'prepared', None) is not None:
+            self.abort()
+
+    def _release_snapshots(self):
+        for snapshot in self.snapshots:
+            try:
+                snapshot.components.Dispose()
+            except Exception: #pylint:disable=W0703
+                pass
+        self.snapshots = []
+        if self.prepared is not None:
+            self.prepared = None
+            _SNAPSHOT_SET_SLOT.release()
+
 
     def delete(self, components, force_delete=False):
         '''
             Delete all the shadow copies in this Shadow Copy Set
         '''
         num_of_deletes = 0
-        num_of_deletes = components.DeleteSnapshotSet(self.set_id, force_delete)
+        with timed(self.provider.timings, 'DeleteSnapshotSet'):
+            num_of_deletes = components.DeleteSnapshotSet(self.set_id, force_delete)
 
         # I believe this is the number of snapshot deletes...  not set deletes
         return num_of_deletes
@@ -525,7 +722,8 @@ class VSSSnapshotSet(object):
                 alphavsslib.VssVolumeSnapshotAttributes.Persistent = 1
                 alphavsslib.VssVolumeSnapshotAttributes.NoAutoRelease = 8
         '''
-        snaps = components.QuerySnapshots() # list of snapshots
+        with timed(self.provider.timings, 'QuerySnapshots'):
+            snaps = components.QuerySnapshots() # list of snapshots
 
         snapshots = []
         vol_names = []
@@ -572,7 +770,24 @@ class VSSSnapshotSet(object):
         return False
 
 
-def get_drives(filter_letter:str=None):
+_volume_index = None # get_drives() mapping kept in memory, see warm_volume_index()
+VOLUME_RESOLVER = 'wmi' # default get_drives() resolver: 'wmi' or 'native' (volumes.NativeVolumeResolver)
+
+
+def warm_volume_index(refresh:bool=False):
+    '''
+        Keep the get_drives() mapping in memory: get_drives() answers from it (no WMI connection per call) until the
+        next refresh.  Meant for long running processes (see daemon.py), the volumes of a server rarely change
+    '''
+    global _volume_index #pylint:disable=W0603
+    if refresh or _volume_index is None:
+        _volume_index = None
+        _volume_index = get_drives()
+
+    return dict(_volume_index)
+
+
+def get_drives(filter_letter:str=None, resolver:str=None):
     '''
         Kind of have to temporarily use WMI for this.
             We need a Volume DeviceID to DriveLetter mapping
@@ -581,7 +796,21 @@ def get_drives(filter_letter:str=None):
         https://github.com/alphaleonis/AlphaFS/blob/develop/src/AlphaFS/Device/Volume/Volume.GetVolumeDisplayName.cs
 
         I believe this would replace the WMI code but for now, WMI does the job fine
+
+        resolver: (str) 'wmi' or 'native' (default: VOLUME_RESOLVER).  The native resolver (volumes.py) calls the Win32
+                  volume APIs, no WMI connection, and maps the volumes mounted on folders too ('D:\\Mounts\\Data').  An
+                  explicit resolver is always asked, the warm_volume_index() mapping only stands in for the default one
     '''
+    if _volume_index is not None and resolver is None:
+        return {letter: device_id for letter, device_id in _volume_index.items()
+                if not filter_letter or filter_letter.lower() == letter.lower()}
+    if (resolver or VOLUME_RESOLVER) == 'native':
+        from alphavss.volumes import NativeVolumeResolver
+
+        return NativeVolumeResolver().get_drives(filter_letter)
+    elif (resolver or VOLUME_RESOLVER) != 'wmi':
+        raise Exception(f'Unknown volume resolver: {resolver or VOLUME_RESOLVER}')
+
     volumes = {}
     c = wmi.WMI()
     # DriveType = 3 == Fixed Disks
@@ -0,0 +1,293 @@
+'''
+    Small file packing for snapshot copies
+
+    Copying a volume full of tiny files (profiles, source trees, caches) file by file spends its time creating,
+    opening, closing and setting the times of target files, not moving bytes.  SnapshotPacker copies a VSSSnapshot
+    like the SnapshotCopier, except that files smaller than threshold are appended to a few large pack segments
+    instead of becoming files of their own:
+
+        target/
+            ... the big files (and every directory), as the SnapshotCopier writes them
+            .alphavss-packs/segment-000001.pack ...     content of the small files, back to back
+            .alphavss-packs/index                       restore.RestoreIndex: path -> (segment, offset), size, mtime
+
+        * small files are read a directory at a time, ordered by file ID (MFT record order on NTFS) to keep the
+          reads of the snapshot close together
+        * every worker thread appends to its own segment (no locking on the data path), segments roll over at
+          segment_size.  A segment that can't be written (target full) fails the files of the group in it, the
+          worker carries on with a new segment
+        * PackSource gives random access to any packed file through the index, and plugs into the restore engine
+
+    Usage:
+        from alphavss.packer import SnapshotPacker, PackSource
+        from alphavss.restore import SnapshotRestorer
+
+        print(SnapshotPacker(snap, 'E:\\backups\\C').copy())
+        data = PackSource('E:\\backups\\C').read_file('Users/bob/AppData/Roaming/app/settings.ini')
+        SnapshotRestorer(PackSource('E:\\backups\\C'), 'D:\\restore', paths=['Users/bob']).run()
+'''
+import os
+import threading
+from alphavss.archive import archive_path
+from alphavss.copier import SnapshotCopier, WorkerPool
+from alphavss.restore import RestoreEntry, RestoreIndex, DirectorySource, write_restore_index
+
+PACK_DIR = '.alphavss-packs'
+DEFAULT_THRESHOLD = 64 * 1024 # 64 KB
+DEFAULT_SEGMENT_SIZE = 256 * 1024 * 1024 # 256 MB
+DEFAULT_GROUP_SIZE = 256
+SEGMENT_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+class _Segment(object):
+    def __init__(self, number, path):
+        self.number = number
+        self.file = open(path, 'wb', buffering=SEGMENT_BUFFER_SIZE)
+        self.offset = 0
+
+    def append(self, data):
+        offset = self.offset
+        self.file.write(data)
+        self.offset += len(data)
+
+        return offset
+
+    def close(self):
+        self.file.close()
+
+
+class SnapshotPacker(SnapshotCopier):
+    '''
+        SnapshotCopier that packs the small files into segments (see the module docstring)
+    '''
+    def __init__(self, snapshot:object, target:str, threshold:int=DEFAULT_THRESHOLD,
+                 segment_size:int=DEFAULT_SEGMENT_SIZE, group_size:int=DEFAULT_GROUP_SIZE, **kwargs):
+        '''
+            threshold: (int) files smaller than this are packed
+            segment_size: (int) size a segment grows to before the worker starts a new one
+            group_size: (int) small files of a directory handed to a worker at a time
+            kwargs: SnapshotCopier arguments (workers, buffer_size, walker_options, throttle...)
+        '''
+        super().__init__(snapshot, target, **kwargs)
+        self.threshold = threshold
+        self.segment_size = segment_size
+        self.group_size = group_size
+        self.pack_dir = os.path.join(target, PACK_DIR)
+        self.packed = 0
+        self.segments = 0
+        self._lock = threading.Lock()
+        self._index_entries = None
+        self._group = []
+        self._group_dir = None
+
+    def _walker_options(self):
+        walker_options = super()._walker_options()
+        walker_options['exclude'] = list(walker_options.get('exclude') or []) + [PACK_DIR]
+
+        return walker_options
+
+    def _start(self):
+        self.packed = 0
+        self.segments = 0
+        self._index_entries = []
+        self._group = []
+        self._group_dir = None
+        os.makedirs(self.pack_dir, exist_ok=True)
+
+        return WorkerPool(self._pack_item, self.workers, self.workers * 4, 'alphavss-packer',
+                          setup=lambda: {'buf': bytearray(self.buffer_size), 'segment': None},
+                          teardown=_close_segment)
+
+    def _feed(self, pool, entry):
+        # the big files are copied one by one, the small ones are handed out in groups of one directory
+        if entry is None:
+            group, self._group = self._group, []
+            return not group or pool.put(group)
+        if entry.size >= self.threshold:
+            return pool.put(entry)
+        # the walker hands out a directory's entries together, a group never spans directories
+        parent = os.path.dirname(entry.rel_path)
+        if self._group and (parent != self._group_dir or len(self._group) >= self.group_size):
+            group, self._group = self._group, []
+            if not pool.put(group):
+                return False
+        self._group_dir = parent
+        self._group.append(entry)
+
+        return True
+
+    def _finish(self, links):
+        # links to a packed file are index entries pointing at the same data, the others are hard links in the target
+        self._make_links([(entry, first) for entry, first in links if entry.size >= self.threshold])
+        self._link_packed([(entry, first) for entry, first in links if entry.size < self.threshold])
+        write_restore_index(os.path.join(self.pack_dir, 'index'), self._index_entries)
+        self._index_entries = None
+        if self.debug:
+            print(f'packed {self.packed} file(s) of {self.root} in {self.segments} segment(s)')
+
+    def _link_packed(self, links):
+        if not links:
+            return
+        packed = {entry.path: entry for entry in self._index_entries}
+        for entry, first in links:
+            first_entry = packed.get(archive_path(first))
+            if first_entry is None:
+                # the first path failed to pack
+                self._error(entry.rel_path, Exception(f'{first} (the same file) was not packed'))
+                continue
+            self._index_entries.append(first_entry._replace(path=archive_path(entry.rel_path)))
+            self.links += 1
+            self.stats.add(files=1)
+
+    def _new_segment(self):
+        with self._lock:
+            self.segments += 1
+            number = self.segments
+
+        return _Segment(number, os.path.join(self.pack_dir, f'segment-{number:06}.pack'))
+
+    def _pack_item(self, item, state):
+        # state: the worker's buffer and segment
+        if isinstance(item, list):
+            state['segment'] = self._pack(item, state['segment'])
+        else:
+            self._copy_entry(item, state['buf'])
+
+    def _pack(self, group, segment):
+        '''
+            Append a group of small files (of one directory) to the worker's segment, returns the segment in use
+        '''
+        # file ID order: the MFT records (and usually the data) of a directory's files are allocated in that order.
+        # scandir() leaves the file ID at 0 on Windows, identity() stats the file for it
+        group.sort(key=_file_id)
+        packed = []
+        nbytes = 0
+        for entry in group:
+            try:
+                if self.throttle is not None:
+                    with self.throttle.read(entry.size):
+                        data = _read_small(entry.path)
+                else:
+                    data = _read_small(entry.path)
+            except OSError as e:
+                self._error(entry.rel_path, e)
+                continue
+            st = entry.stat()
+            try:
+                if segment is None or (segment.offset and segment.offset + len(data) > self.segment_size):
+                    if segment is not None:
+                        segment.close()
+                        segment = None
+                    segment = self._new_segment()
+                offset = segment.append(data)
+            except OSError as e:
+                # target full or failing: what this group buffered in the segment is lost with it, the next file
+                # tries a new segment
+                self._lost(segment, packed + [(entry.rel_path, None)], e)
+                segment = None
+                packed = []
+                nbytes = 0
+                continue
+            packed.append((entry.rel_path, RestoreEntry(archive_path(entry.rel_path), False, len(data), st.st_mtime_ns,
+                                                        st.st_mode, [segment.number, offset], None)))
+            nbytes += len(data)
+
+        if segment is not None and packed:
+            # the index only points at data that made it to the segment file
+            try:
+                segment.file.flush()
+            except OSError as e:
+                self._lost(segment, packed, e)
+                segment = None
+                packed = []
+                nbytes = 0
+
+        with self._lock:
+            self._index_entries.extend(restore_entry for _, restore_entry in packed)
+            self.packed += len(packed)
+        self.stats.add(files=len(packed), nbytes=nbytes)
+
+        return segment
+
+    def _lost(self, segment, packed, e):
+        # the segment failed: it's closed, the files of the group written to it are errors
+        if segment is not None:
+            try:
+                segment.close()
+            except OSError:
+                pass
+        for rel_path, _ in packed:
+            self._error(rel_path, e)
+
+
+def _file_id(entry):
+    try:
+        return entry.identity()[1]
+    except OSError:
+        # the read reports it
+        return 0
+
+
+def _close_segment(state):
+    if state['segment'] is not None:
+        state['segment'].close()
+
+
+def _read_small(path):
+    with open(path, 'rb', buffering=0) as src:
+        return src.read()
+
+
+class PackSource(object):
+    '''
+        Read a packed copy: the big files from the target tree, the small ones from the segments (a restore source,
+        see restore.SnapshotRestorer)
+    '''
+    def __init__(self, target:str, debug:bool=False):
+        self.target = target
+        self.pack_dir = os.path.join(target, PACK_DIR)
+        self.index = RestoreIndex(os.path.join(self.pack_dir, 'index'))
+        self.files = DirectorySource(target, walker_options={'exclude': [PACK_DIR]}, debug=debug)
+        self.debug = debug
+        self._local = threading.local()
+
+    def entries(self, paths:list=None):
+        if paths is not None:
+            paths = [archive_path(path) for path in paths]
+        yield from self.files.entries(paths)
+        if paths is None or '' in paths:
+            yield from self.index
+            return
+        for path in paths:
+            yield from self.index.prefix(path)
+
+    def _segment(self, number):
+        segments = getattr(self._local, 'segments', None)
+        if segments is None:
+            segments = self._local.segments = {}
+        if number not in segments:
+            segments[number] = open(os.path.join(self.pack_dir, f'segment-{number:06}.pack'), 'rb', buffering=0)
+
+        return segments[number]
+
+    def read(self, entry:RestoreEntry):
+        if isinstance(entry.locators[0], str):
+            yield from self.files.read(entry)
+            return
+        number, offset = entry.locators
+        segment = self._segment(number)
+        segment.seek(offset)
+        yield 0, segment.read(entry.size)
+
+    def read_file(self, path:str):
+        '''
+            Content of a packed file (one index lookup, one read)
+        '''
+        entry = self.index.get(archive_path(path))
+        if entry is None:
+            raise Exception(f'{path} is not a packed file of {self.target}')
+
+        return b''.join(data for _, data in self.read(entry))
+
+    def close(self):
+        self.index.close()
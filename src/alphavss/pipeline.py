@@ -0,0 +1,411 @@
+'''
+    Bounded multi stage backup pipeline for a VSSSnapshotSet: read -> compress -> write
+
+    Reading, compressing and writing one after the other leaves two of the three idle at any time.  BackupPipeline
+    runs them as stages connected by bounded queues so they all work at once and memory stays flat:
+
+        walker -> [reader threads] -> queue -> [compression process pool] -> queue -> [writer] -> archive stream
+
+        * reader threads read the files of the snapshot(s) in chunk_size pieces
+        * a process pool compresses the chunks (zlib or lzma, the GIL doesn't get in the way)
+        * a single writer produces a streamable archive (see alphavss.archive, it can go to a pipe)
+        * when a later stage falls behind, the queues fill up and the earlier stages block (backpressure)
+
+    run() returns a PipelineStats with the utilization of every stage, the busiest stage is the bottleneck
+
+    Note: the compression pool starts processes, on Windows the script using this has to be protected by
+          if __name__ == '__main__':
+'''
+import os
+import time
+import queue
+import itertools
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from alphavss.walker import SnapshotWalker, snapshot_root, snapshot_label
+from alphavss.throttle import resolve_throttle
+from alphavss.links import LinkTracker
+from alphavss.archive import ArchiveWriter, archive_path, codec_id, compress_chunk, STATUS_OK, STATUS_FAILED
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024 # 1 MB
+DEFAULT_READERS = 4
+DEFAULT_QUEUE_SIZE = 32
+
+_DONE = object()
+
+
+class StageStats(object):
+    '''
+        Busy time of one pipeline stage (summed over its workers)
+    '''
+    def __init__(self, name:str, workers:int):
+        self.name = name
+        self.workers = workers
+        self.busy = 0.0
+        self.items = 0
+        self._lock = threading.Lock()
+
+    def add(self, seconds:float, items:int=1):
+        with self._lock:
+            self.busy += seconds
+            self.items += items
+
+    def utilization(self, elapsed:float):
+        '''
+            Fraction (0.0 - 1.0) of the available worker time this stage spent working
+        '''
+        if not elapsed or not self.workers:
+            return 0.0
+
+        return min(1.0, self.busy / (elapsed * self.workers))
+
+
+class PipelineStats(object):
+    '''
+        Totals and per stage utilization of a pipeline run
+    '''
+    def __init__(self, readers:int, compressors:int):
+        self.files = 0
+        self.dirs = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.start = time.monotonic()
+        self.end = None
+        self.stages = {'read': StageStats('read', readers),
+                       'compress': StageStats('compress', compressors),
+                       'write': StageStats('write', 1)}
+        self._lock = threading.Lock()
+
+    def add(self, files:int=0, dirs:int=0, errors:int=0, bytes_in:int=0):
+        with self._lock:
+            self.files += files
+            self.dirs += dirs
+            self.errors += errors
+            self.bytes_in += bytes_in
+
+    @property
+    def elapsed(self):
+        return (self.end or time.monotonic()) - self.start
+
+    @property
+    def ratio(self):
+        return self.bytes_out / self.bytes_in if self.bytes_in else 1.0
+
+    def utilization(self):
+        '''
+            {stage name: utilization}
+        '''
+        return {name: stage.utilization(self.elapsed) for name, stage in self.stages.items()}
+
+    def bottleneck(self):
+        utilization = self.utilization()
+        return max(utilization, key=utilization.get)
+
+    def as_dict(self):
+        return {'files': self.files, 'dirs': self.dirs, 'errors': self.errors, 'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out, 'elapsed': round(self.elapsed, 3),
+                'utilization': {name: round(value, 3) for name, value in self.utilization().items()},
+                'bottleneck': self.bottleneck()}
+
+    def __str__(self):
+        mb_in = self.bytes_in / (1024 * 1024)
+        stages = ', '.join(f'{name} {value:.0%}' for name, value in self.utilization().items())
+        return (f'{self.files} file(s), {mb_in:.1f} MB -> {self.bytes_out / (1024 * 1024):.1f} MB ({self.ratio:.0%}) '
+                f'in {self.elapsed:.2f}s ({mb_in / self.elapsed if self.elapsed else 0:.1f} MB/s), '
+                f'utilization: {stages} (bottleneck: {self.bottleneck()}), {self.errors} error(s)')
+
+
+class _DoneFuture(object):
+    '''
+        Stands in for a Future when a chunk is compressed in the dispatcher thread (compressors=0)
+    '''
+    def __init__(self, value):
+        self.value = value
+
+    def result(self):
+        return self.value
+
+
+class BackupPipeline(object):
+    '''
+        Read the snapshot(s), compress and write them to a streamable archive with every stage running at once
+    '''
+    def __init__(self, snapshots:object, output:object, codec:str='zlib', level:int=None, readers:int=DEFAULT_READERS,
+                 compressors:int=None, chunk_size:int=DEFAULT_CHUNK_SIZE, queue_size:int=DEFAULT_QUEUE_SIZE,
+                 walker_options:dict=None, throttle:object=None, hard_links:bool=False, debug:bool=False):
+        '''
+            snapshots: (VSSSnapshotSet, list of VSSSnapshot, VSSSnapshot or path) what to back up,
+                       every snapshot's files are stored under its drive letter ('C/Windows/...')
+            output: (str or file object) archive path, or an already opened binary stream (ex. a pipe)
+            codec: (str) 'zlib', 'lzma' or 'none'
+            level: (int) compression level (zlib 0-9, lzma preset 0-9)
+            readers: (int) reader threads
+            compressors: (int) compression processes (default: os.cpu_count()), 0 compresses in a thread instead
+            chunk_size: (int) size of the chunks files are read and compressed in
+            queue_size: (int) chunks that can wait between two stages (memory is about 2 * queue_size * chunk_size)
+            walker_options: (dict) keyword arguments for the SnapshotWalker (include, exclude...)
+            throttle: (VolumeThrottle or IOScheduler) rate limits the reads
+            hard_links: (bool) store the other paths of a hard linked file as link records, not data (see links.py)
+            debug: (bool) enables enhanced output
+        '''
+        if hasattr(snapshots, 'snapshots'):
+            snapshots = snapshots.snapshots
+        if not isinstance(snapshots, (list, tuple)):
+            snapshots = [snapshots]
+        self.snapshots = list(snapshots)
+        self.output = output
+        self.codec = codec_id(codec)
+        self.level = level
+        if readers < 1:
+            raise Exception(f'BackupPipeline needs at least 1 reader: {readers}')
+        self.readers = readers
+        if compressors is None:
+            compressors = os.cpu_count() or 1
+        self.compressors = compressors
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        self.walker_options = walker_options or {}
+        self.throttle = throttle
+        self.hard_links = hard_links
+        self.debug = debug
+        self.stats = None
+        self.links = 0
+
+        self._stop = threading.Event()
+        self._errors = []
+        self._file_ids = None
+        self._file_ids_lock = threading.Lock()
+
+    def run(self):
+        '''
+            Run the pipeline to completion, returns a PipelineStats
+        '''
+        self.stats = PipelineStats(self.readers, self.compressors or 1)
+        self._stop.clear()
+        self._errors = []
+        self._file_ids = itertools.count(1)
+
+        entries = queue.Queue(maxsize=self.queue_size)
+        chunks = queue.Queue(maxsize=self.queue_size)
+        compressed = queue.Queue(maxsize=self.queue_size)
+        pool = ProcessPoolExecutor(max_workers=self.compressors) if self.compressors else None
+
+        stream = self.output
+        close_stream = False
+        if isinstance(self.output, (str, os.PathLike)):
+            stream = open(self.output, 'wb')
+            close_stream = True
+
+        threads = [threading.Thread(target=self._guard, args=(self._feed, entries), name='alphavss-pipeline-walk', daemon=True),
+                   threading.Thread(target=self._guard, args=(self._dispatch, chunks, compressed, pool),
+                                    name='alphavss-pipeline-compress', daemon=True)]
+        for num in range(self.readers):
+            threads.append(threading.Thread(target=self._guard, args=(self._read, entries, chunks),
+                                            name=f'alphavss-pipeline-read-{num}', daemon=True))
+        try:
+            for thread in threads:
+                thread.start()
+            self._guard(self._write, compressed, stream)
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+            if pool is not None:
+                pool.shutdown()
+            if close_stream:
+                stream.close()
+
+        self.stats.end = time.monotonic()
+        if self._errors:
+            raise Exception(f'Backup pipeline failed: {self._errors[0]}') from self._errors[0]
+        if self.debug:
+            print(f'backup pipeline: {self.stats}')
+
+        return self.stats
+
+    def _guard(self, func, *args):
+        try:
+            func(*args)
+        except Exception as e: #pylint:disable=W0703
+            self._errors.append(e)
+            self._stop.set()
+
+    def _put(self, target_queue, item):
+        while not self._stop.is_set():
+            try:
+                target_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def _get(self, source_queue):
+        while not self._stop.is_set():
+            try:
+                return source_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+        return _DONE
+
+    def _feed(self, entries):
+        '''
+            walk stage: feeds (archive prefix, WalkEntry, throttle, first path of a hard link or None) to the readers
+        '''
+        tracker = None
+        if self.hard_links:
+            tracker = LinkTracker(track_all=self.walker_options.get('follow_reparse_points', False))
+        try:
+            for snapshot in self.snapshots:
+                prefix = snapshot_label(snapshot)
+                throttle = resolve_throttle(self.throttle, snapshot)
+                walker_options = dict(self.walker_options)
+                walker_options.setdefault('throttle', throttle)
+                for entry in SnapshotWalker(snapshot_root(snapshot), debug=self.debug, **walker_options):
+                    link = None
+                    if tracker is not None and entry.is_file():
+                        # decided here, on a single thread: the first path seen is the one that gets the data
+                        link = tracker.check(entry, archive_path(prefix, entry.rel_path))
+                    if not self._put(entries, (prefix, entry, throttle, link)):
+                        return
+        finally:
+            for _ in range(self.readers):
+                self._put(entries, _DONE)
+            if tracker is not None:
+                self.links = tracker.links
+                tracker.close()
+
+    def _read(self, entries, chunks):
+        '''
+            read stage: turns WalkEntries into ('D', ...), ('F', ...), ('C', ...), ('E', ...) and ('L', ...) items
+        '''
+        try:
+            while True:
+                item = self._get(entries)
+                if item is _DONE:
+                    return
+                prefix, entry, throttle, link = item
+                path = archive_path(prefix, entry.rel_path)
+                if link is not None:
+                    if not self._put(chunks, ('L', path, link)):
+                        return
+                    continue
+                st = entry.stat()
+                if entry.is_dir():
+                    self.stats.add(dirs=1)
+                    if not self._put(chunks, ('D', path, st.st_mode, st.st_mtime_ns)):
+                        return
+                elif entry.is_file():
+                    if not self._read_file(entry, path, st, throttle, chunks):
+                        return
+        finally:
+            self._put(chunks, _DONE)
+
+    def _read_file(self, entry, path, st, throttle, chunks):
+        with self._file_ids_lock:
+            file_id = next(self._file_ids)
+        if not self._put(chunks, ('F', file_id, path, st.st_mode, st.st_size, st.st_mtime_ns)):
+            return False
+
+        status = STATUS_OK
+        offset = 0
+        stage = self.stats.stages['read']
+        try:
+            with open(entry.path, 'rb', buffering=0) as src:
+                while True:
+                    start = time.perf_counter()
+                    if throttle is not None:
+                        with throttle.read(self.chunk_size):
+                            data = src.read(self.chunk_size)
+                    else:
+                        data = src.read(self.chunk_size)
+                    stage.add(time.perf_counter() - start)
+                    if not data:
+                        break
+                    if not self._put(chunks, ('C', file_id, offset, data)):
+                        return False
+                    offset += len(data)
+        except OSError as e:
+            status = STATUS_FAILED
+            self.stats.add(errors=1)
+            if self.debug:
+                print(f'unable to read {entry.path}: {e}')
+        else:
+            self.stats.add(files=1, bytes_in=offset)
+
+        return self._put(chunks, ('E', file_id, status))
+
+    def _dispatch(self, chunks, compressed, pool):
+        '''
+            compress stage: hands the chunks to the process pool (in order), everything else passes through
+        '''
+        finished = 0
+        try:
+            while finished < self.readers:
+                item = self._get(chunks)
+                if item is _DONE:
+                    if self._stop.is_set():
+                        return
+                    finished += 1
+                    continue
+                if item[0] == 'C':
+                    _, file_id, offset, data = item
+                    if pool is not None:
+                        future = pool.submit(compress_chunk, data, self.codec, self.level)
+                    else:
+                        future = _DoneFuture(compress_chunk(data, self.codec, self.level))
+                    item = ('C', file_id, offset, len(data), future)
+                if not self._put(compressed, item):
+                    return
+        finally:
+            self._put(compressed, _DONE)
+
+    def _write(self, compressed, stream):
+        '''
+            write stage: the only stage touching the archive stream
+        '''
+        writer = ArchiveWriter(stream)
+        write_stage = self.stats.stages['write']
+        compress_stage = self.stats.stages['compress']
+        # the readers run in parallel, a link can show up before its target is written: the link records go at the
+        # end of the archive, after every file (like the links of the SnapshotCopier, once every copy is done)
+        links = []
+        while True:
+            item = self._get(compressed)
+            if item is _DONE:
+                break
+            kind = item[0]
+            if kind == 'C':
+                _, file_id, offset, raw_len, future = item
+                codec, payload, seconds = future.result()
+                compress_stage.add(seconds)
+                start = time.perf_counter()
+                writer.write_chunk(file_id, offset, codec, raw_len, payload)
+            else:
+                start = time.perf_counter()
+                if kind == 'F':
+                    writer.start_file(*item[1:])
+                elif kind == 'E':
+                    writer.end_file(*item[1:])
+                elif kind == 'D':
+                    writer.write_dir(*item[1:])
+                elif kind == 'L':
+                    links.append(item[1:])
+            write_stage.add(time.perf_counter() - start)
+
+        if not self._stop.is_set():
+            start = time.perf_counter()
+            for path, target in links:
+                writer.write_link(path, target)
+            writer.close()
+            write_stage.add(time.perf_counter() - start)
+        self.stats.bytes_out = writer.offset
+
+
+def backup_to_archive(snapshots:object, output:object, **kwargs):
+    '''
+        Shortcut for BackupPipeline(snapshots, output, **kwargs).run()
+    '''
+    return BackupPipeline(snapshots, output, **kwargs).run()
@@ -0,0 +1,344 @@
+'''
+    Read-ahead (prefetching) reader for the files of a snapshot
+
+    Every read from a shadow copy goes through the copy-on-write diff area, so a single reader spends most of its time
+    waiting on one request at a time.  PrefetchReader knows the order the consumer will read in (a list of files, ex.
+    from the SnapshotWalker) and keeps several reads in flight ahead of it on a pool of threads:
+
+        * files are split in block_size blocks, blocks are handed out in the planned order (a big file is read by
+          several threads at once, small files are read ahead of the consumer)
+        * the memory used is bounded by budget: a block waiting for the consumer holds one of budget // block_size
+          reusable buffers, the readers stop when they run out
+        * blocks come back in order as memoryviews of those buffers (no copies), for hashing, compressing, writing...
+          A block's memoryview is only valid until the next block is requested (or block.release() is called), copy
+          it (bytes(block.data)) to keep it longer
+
+    Usage:
+        from alphavss.prefetch import PrefetchReader
+
+        digests = {}
+        for block in PrefetchReader(SnapshotWalker(snap, yield_dirs=False), budget=128 * 1024 * 1024):
+            digest = digests.setdefault(block.entry.rel_path, hashlib.sha256())
+            digest.update(block.data)
+'''
+import os
+import time
+import hashlib
+import threading
+from alphavss.walker import WalkEntry
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024 # 1 MB
+DEFAULT_BUDGET = 64 * 1024 * 1024 # 64 MB
+DEFAULT_PREFETCH_WORKERS = 4
+OPEN_FILES_PER_WORKER = 4
+
+
+class PrefetchBlock(object):
+    '''
+        One block of a file: data is a memoryview of a reader buffer (None when the file couldn't be read: see error)
+    '''
+    __slots__ = ('entry', 'offset', 'data', 'last', 'error', '_buffer', '_reader')
+
+    def __init__(self, entry, offset, data, last, error, buffer, reader):
+        self.entry = entry
+        self.offset = offset
+        self.data = data
+        self.last = last # the last block of the file
+        self.error = error
+        self._buffer = buffer
+        self._reader = reader
+
+    def release(self):
+        '''
+            Give the buffer back to the readers (the memoryview must not be used after this)
+        '''
+        if self._buffer is not None:
+            if self.data is not None:
+                self.data.release()
+                self.data = None
+            self._reader._release(self._buffer)
+            self._buffer = None
+
+
+class PrefetchStats(object):
+    def __init__(self):
+        self.files = 0
+        self.blocks = 0
+        self.bytes = 0
+        self.errors = 0
+        self.waited = 0.0 # time the consumer spent waiting for a block (0 = the reads were always ahead)
+        self.start = time.monotonic()
+        self.end = None
+
+    @property
+    def elapsed(self):
+        return (self.end or time.monotonic()) - self.start
+
+    @property
+    def mb_per_sec(self):
+        return self.bytes / (1024 * 1024) / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self):
+        return {'files': self.files, 'blocks': self.blocks, 'bytes': self.bytes, 'errors': self.errors,
+                'waited': round(self.waited, 3), 'elapsed': round(self.elapsed, 3), 'mb_per_sec': round(self.mb_per_sec, 1)}
+
+    def __str__(self):
+        return (f'{self.files} file(s), {self.blocks} block(s), {self.bytes / (1024 * 1024):.1f} MB in '
+                f'{self.elapsed:.2f}s ({self.mb_per_sec:.1f} MB/s), consumer waited {self.waited:.2f}s, '
+                f'{self.errors} error(s)')
+
+
+class PrefetchReader(object):
+    '''
+        Read a planned sequence of files ahead of the consumer (see the module docstring)
+    '''
+    def __init__(self, files:object, block_size:int=DEFAULT_BLOCK_SIZE, budget:int=DEFAULT_BUDGET,
+                 workers:int=DEFAULT_PREFETCH_WORKERS, throttle:object=None, debug:bool=False):
+        '''
+            files: (iterable) WalkEntry objects or paths, in the order they will be consumed (directories are skipped)
+            block_size: (int) size of the reads (and of the buffers)
+            budget: (int) memory for the buffers, budget // block_size blocks can be read ahead (at least workers + 1)
+            workers: (int) reader threads (requests in flight)
+            throttle: (VolumeThrottle) rate limits the reads
+            debug: (bool) enables enhanced output
+        '''
+        if workers < 1:
+            raise Exception(f'PrefetchReader needs at least 1 worker: {workers}')
+        self.files = files
+        self.block_size = block_size
+        self.buffers = max(workers + 1, budget // block_size)
+        self.workers = workers
+        self.throttle = throttle
+        self.debug = debug
+        self.stats = None
+
+        self._cond = None
+        self._free = None
+        self._plan = None
+        self._next = 0 # next sequence number to hand to a reader
+        self._done = None # {sequence number: PrefetchBlock}
+        self._failed = None # files with a read error (their other blocks are skipped)
+        self._stop = None
+        self._error = None # what stopped the plan or a reader, raised by blocks()
+
+    def _planned_blocks(self):
+        '''
+            Generator returning (entry, offset, last) for every block to read, in order
+        '''
+        for item in self.files:
+            entry = item if isinstance(item, WalkEntry) else _path_entry(item)
+            if entry.is_dir():
+                continue
+            try:
+                size = entry.size
+            except OSError as e:
+                yield entry, -1, e
+                continue
+            if size == 0:
+                yield entry, 0, True
+                continue
+            for offset in range(0, size, self.block_size):
+                yield entry, offset, offset + self.block_size >= size
+
+    def __iter__(self):
+        return self.blocks()
+
+    def blocks(self):
+        '''
+            Generator returning PrefetchBlock objects in the planned order (the previous block is released when the
+            next one is requested).  Nothing of a file comes after its error block
+
+            An exception of the plan (files raising, ex. a walker error) is raised once the blocks planned before it
+            are delivered, an exception of a reader thread (other than the OSError of a read) right away
+        '''
+        self.stats = PrefetchStats()
+        self._cond = threading.Condition()
+        self._free = [bytearray(self.block_size) for _ in range(self.buffers)]
+        self._plan = self._planned_blocks()
+        self._next = 0
+        self._done = {}
+        self._failed = set()
+        self._stop = threading.Event()
+        self._error = None
+
+        threads = []
+        for num in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f'alphavss-prefetch-{num}', daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        sequence = 0
+        block = None
+        failed_entry = None
+        try:
+            while True:
+                if block is not None:
+                    block.release()
+                start = time.perf_counter()
+                with self._cond:
+                    while sequence not in self._done:
+                        if (self._plan is None and sequence >= self._next) or self._stop.is_set():
+                            # everything planned was handed out and consumed (or a reader failed)
+                            block = None
+                            break
+                        self._cond.wait()
+                    else:
+                        block = self._done.pop(sequence)
+                self.stats.waited += time.perf_counter() - start
+                if block is None:
+                    break
+                sequence += 1
+                if block.entry is failed_entry:
+                    # read before the error showed up: the rest of a file already reported as failed
+                    block.release()
+                    block = None
+                    continue
+                if block.error is not None:
+                    failed_entry = block.entry
+                self._count(block)
+                yield block
+        finally:
+            self._stop.set()
+            with self._cond:
+                self._cond.notify_all()
+            for thread in threads:
+                thread.join()
+            self.stats.end = time.monotonic()
+        if self._error is not None:
+            raise self._error
+
+        if self.debug:
+            print(f'prefetch: {self.stats}')
+
+    def _count(self, block):
+        if block.error is not None:
+            self.stats.errors += 1
+            return
+        self.stats.blocks += 1
+        self.stats.bytes += len(block.data)
+        if block.last:
+            self.stats.files += 1
+
+    def _release(self, buffer):
+        with self._cond:
+            self._free.append(buffer)
+            self._cond.notify_all()
+
+    def _claim(self):
+        '''
+            Wait for a free buffer, then take the next planned block: (sequence, entry, offset, last, buffer)
+
+            The buffer comes first so the blocks handed out are always contiguous and each holds a buffer, the
+            block the consumer waits for is always being read (no deadlock on the budget)
+        '''
+        with self._cond:
+            while not self._free and not self._stop.is_set():
+                self._cond.wait()
+            while not self._stop.is_set() and self._plan is not None:
+                try:
+                    entry, offset, last = next(self._plan)
+                except StopIteration:
+                    self._plan = None
+                    self._cond.notify_all()
+                    break
+                except Exception as e: #pylint:disable=W0703
+                    # the plan itself failed (ex. a walker error): the blocks handed out so far are read, then blocks()
+                    # raises it
+                    self._plan = None
+                    if self._error is None:
+                        self._error = e
+                    self._cond.notify_all()
+                    if self.debug:
+                        print(f'prefetch plan failed: {e}')
+                    break
+                if entry.path in self._failed and offset > 0:
+                    continue
+                sequence = self._next
+                self._next += 1
+
+                return sequence, entry, offset, last, self._free.pop()
+
+        return None
+
+    def _worker(self):
+        open_files = {}
+        try:
+            while True:
+                claimed = self._claim()
+                if claimed is None:
+                    return
+                sequence, entry, offset, last, buffer = claimed
+                block = self._read(open_files, entry, offset, last, buffer)
+                with self._cond:
+                    self._done[sequence] = block
+                    self._cond.notify_all()
+        except BaseException as e: #pylint:disable=W0703
+            # the block this reader claimed never comes: stop, blocks() raises it
+            with self._cond:
+                if self._error is None:
+                    self._error = e
+                self._stop.set()
+                self._cond.notify_all()
+        finally:
+            for src in open_files.values():
+                src.close()
+
+    def _read(self, open_files, entry, offset, last, buffer):
+        if offset < 0:
+            # the plan couldn't stat the file (last holds the error)
+            return self._failed_block(entry, last, buffer)
+        try:
+            src = open_files.pop(entry.path, None)
+            if src is None:
+                if len(open_files) >= OPEN_FILES_PER_WORKER:
+                    open_files.pop(next(iter(open_files))).close()
+                src = open(entry.path, 'rb', buffering=0)
+            open_files[entry.path] = src
+            view = memoryview(buffer)
+            src.seek(offset)
+            if self.throttle is not None:
+                with self.throttle.read(len(buffer)):
+                    read = src.readinto(view)
+            else:
+                read = src.readinto(view)
+            if last:
+                src.close()
+                del open_files[entry.path]
+        except OSError as e:
+            return self._failed_block(entry, e, buffer)
+
+        return PrefetchBlock(entry, offset, view[:read], last, None, buffer, self)
+
+    def _failed_block(self, entry, error, buffer):
+        with self._cond:
+            self._failed.add(entry.path)
+            self._free.append(buffer)
+            self._cond.notify_all()
+        if self.debug:
+            print(f'prefetch: unable to read {entry.path}: {error}')
+
+        return PrefetchBlock(entry, 0, None, True, error, None, self)
+
+
+def _path_entry(path):
+    path = os.fspath(path)
+    return WalkEntry(os.path.basename(path), path, path, os.path.isdir(path), False)
+
+
+def hash_files(files:object, hash_name:str='sha256', **kwargs):
+    '''
+        Generator returning (entry, hex digest) for every file (in the planned order), read through a PrefetchReader
+        (kwargs), the digest is None when the file couldn't be read
+    '''
+    digest = None
+    for block in PrefetchReader(files, **kwargs):
+        if block.error is not None:
+            yield block.entry, None
+            digest = None
+            continue
+        if digest is None:
+            digest = hashlib.new(hash_name)
+        digest.update(block.data)
+        if block.last:
+            yield block.entry, digest.hexdigest()
+            digest = None
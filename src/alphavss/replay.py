@@ -0,0 +1,623 @@
+'''
+    Record/replay of the AlphaVSS calls made by models.py, to reproduce (and bisect) performance problems offline
+
+    Slowness at a customer site (VSSSnapshotSet.backup(), VSSProvider.query_snapshots() with hundreds of snapshots...)
+    depends on that site's inventory and writers.  Recorder wraps the VssFactory of a VSSProvider: every components
+    object it creates is a recording proxy, every call made on it goes to a trace file with its arguments, its result
+    (snapshot properties are copied property by property) or error, and its latency.
+
+    Replay feeds a trace back through models.py: the factory of the provider hands out components that answer every
+    call from the trace, at the recorded speed (speed=1.0), faster, or as fast as possible (speed=0, what is left is
+    the time spent in models.py itself).  Where the CLR, AlphaVSS or WMI are missing (a Linux build box), Replay
+    stands in for those modules while it is active, so models.py imports and runs unchanged.
+
+    The trace is JSON Lines:
+        {"trace": 1, "recorded": "...", "volumes": {"C:": "\\\\?\\Volume{...}\\"}}       header (get_drives())
+        {"components": 1, "method": "CreateVssBackupComponents", "seconds": 0.002}
+        {"components": 1, "method": "QuerySnapshots", "args": [], "result": [...], "seconds": 1.27}
+        {"components": 1, "method": "DoSnapshotSet", "args": [], "error": {"type": "...", "message": "..."}, ...}
+        {"components": 1, "method": "BeginPrepareForBackup", "args": [null, null], "result": {"$async": ...}, ...}
+        {"components": 1, "method": "EndPrepareForBackup", "args": [{"$async": ...}], "pending": 4.2, ...}
+
+        .NET values are tagged: {"$guid": "..."}, {"$datetime": "2022-07-27T21:04:05"},
+        {"$object": "Alphaleonis.Win32.Vss.VssSnapshotProperties", "properties": {...}}
+
+        The phases run with a deadline (deadlines.py) go through Begin<phase> / End<phase>: the IVssAsyncResult is
+        recorded as {"$async": "<phase>"} and End<phase> records how long the phase ran after its Begin ("pending").
+        On replay the async result completes after that time (at the replay speed), or never when the trace has no
+        End<phase> (the phase was cancelled or passed its deadline when it was recorded).
+
+    Usage:
+        from alphavss.replay import Recorder, Replay
+
+        # at the site
+        provider = VSSProvider(operation='query', context=AppRollback)
+        with Recorder(provider, 'query.trace'):
+            provider.query_snapshots()
+
+        # on the build box (any platform)
+        with Replay('query.trace', speed=0) as replay:
+            replay.provider(operation='query', context=AppRollback).query_snapshots()
+        print(replay.stats)
+'''
+import sys
+import json
+import time
+import types
+import threading
+
+TRACE_VERSION = 1
+
+
+def encode_value(value:object):
+    '''
+        JSON friendly copy of a value returned by (or passed to) AlphaVSS
+    '''
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [encode_value(item) for item in value]
+    if isinstance(value, (ReplayGuid, ReplayDateTime, ReplayObject, ReplayAsyncResult, _RecordingAsyncResult)):
+        return value.encode()
+    get_type = getattr(value, 'GetType', None)
+    if get_type is None:
+        return repr(value)
+    net_type = get_type()
+    name = str(net_type.FullName)
+    if name == 'System.Guid':
+        return {'$guid': str(value)}
+    if name == 'System.DateTime':
+        return {'$datetime': value.ToString('s')}
+    if net_type.IsEnum:
+        return int(value)
+    if hasattr(value, '__iter__'):
+        # IList<VssSnapshotProperties> etc.
+        return [encode_value(item) for item in value]
+
+    properties = {}
+    for prop in net_type.GetProperties():
+        try:
+            properties[str(prop.Name)] = encode_value(getattr(value, str(prop.Name)))
+        except Exception as e: #pylint:disable=W0703
+            properties[str(prop.Name)] = {'$error': str(e)}
+
+    return {'$object': name, 'properties': properties}
+
+
+class ReplayGuid(object):
+    '''
+        System.Guid of a trace (stands in for System.Guid when the CLR is missing)
+    '''
+    def __init__(self, value):
+        self.value = str(value).strip('{}').lower()
+
+    @classmethod
+    def Parse(cls, value): #pylint:disable=C0103
+        if isinstance(value, ReplayGuid):
+            return value
+        text = str(value).strip('{}')
+        if len(text) != 36 or text.count('-') != 4:
+            raise _FormatException(f'Unrecognized Guid format: {value}')
+
+        return cls(text)
+
+    def ToString(self, *args): #pylint:disable=C0103
+        return self.value
+
+    def encode(self):
+        return {'$guid': self.value}
+
+    def __str__(self):
+        return self.value
+
+    def __repr__(self):
+        return f'ReplayGuid({self.value})'
+
+    def __eq__(self, other):
+        return other is not None and str(other).strip('{}').lower() == self.value
+
+    def __hash__(self):
+        return hash(self.value)
+
+
+class ReplayDateTime(object):
+    def __init__(self, value):
+        self.value = value
+
+    def ToString(self, *args): #pylint:disable=C0103
+        return self.value
+
+    def encode(self):
+        return {'$datetime': self.value}
+
+    def __str__(self):
+        return self.value.replace('T', ' ')
+
+
+class ReplayObject(object):
+    '''
+        .NET object of a trace (ex. VssSnapshotProperties): its properties are attributes
+    '''
+    def __init__(self, type_name, properties):
+        self.type_name = type_name
+        self.properties = properties
+
+    def __getattr__(self, name):
+        properties = self.__dict__.get('properties')
+        if properties is None or name not in properties:
+            raise AttributeError(name)
+
+        return properties[name]
+
+    def ToString(self): #pylint:disable=C0103
+        return self.type_name
+
+    def encode(self):
+        return {'$object': self.type_name, 'properties': {name: encode_value(value)
+                                                         for name, value in self.properties.items()}}
+
+
+def decode_value(value:object, guid_parse:object=ReplayGuid.Parse):
+    '''
+        Value of a trace, back as objects models.py can use (guid_parse makes the GUIDs)
+    '''
+    if isinstance(value, list):
+        return [decode_value(item, guid_parse) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if '$guid' in value:
+        return guid_parse(value['$guid'])
+    if '$datetime' in value:
+        return ReplayDateTime(value['$datetime'])
+    if '$object' in value:
+        return ReplayObject(value['$object'], {name: decode_value(item, guid_parse)
+                                               for name, item in value['properties'].items()})
+
+    return value
+
+
+class ReplayAsyncResult(object):
+    '''
+        IVssAsyncResult of a replayed Begin<phase>: AsyncWaitHandle.WaitOne() returns True once the recorded run time
+        of the phase (pending seconds, None: it never completed) has been waited
+    '''
+    def __init__(self, replay, phase, pending):
+        self.phase = phase
+        self.pending = pending
+        self.cancelled = False
+        self._replay = replay
+
+    @property
+    def AsyncWaitHandle(self): #pylint:disable=C0103
+        return self
+
+    @property
+    def IsCompleted(self): #pylint:disable=C0103
+        return self.pending is not None and self.pending <= 0
+
+    def WaitOne(self, milliseconds:int=-1): #pylint:disable=C0103
+        if self.pending is None:
+            # recorded as cancelled / timed out: the deadline of the replay (real time) decides
+            if milliseconds >= 0:
+                time.sleep(milliseconds / 1000)
+            return False
+        speed = self._replay.speed
+        wait = self.pending
+        if milliseconds >= 0 and speed:
+            wait = min(wait, milliseconds / 1000 * speed)
+        self._replay._sleep(wait)
+        self.pending -= wait
+
+        return self.pending <= 0
+
+    def Cancel(self): #pylint:disable=C0103
+        self.cancelled = True
+
+    def encode(self):
+        return {'$async': self.phase}
+
+
+class _RecordingAsyncResult(object):
+    '''
+        IVssAsyncResult returned by a recorded Begin<phase>: passed through, unwrapped again for End<phase>
+    '''
+    def __init__(self, result, phase):
+        self._result = result
+        self.phase = phase
+        self.begun = time.perf_counter()
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__['_result'], name)
+
+    def encode(self):
+        return {'$async': self.phase}
+
+
+class _RecordingComponents(object):
+    '''
+        Proxy of an IVssBackupComponents: every method call goes to the trace
+    '''
+    def __init__(self, components, number, recorder):
+        self._components = components
+        self._number = number
+        self._recorder = recorder
+
+    def __getattr__(self, name):
+        attr = getattr(self._components, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args):
+            record = {'components': self._number, 'method': name, 'args': encode_value(list(args))}
+            start = time.perf_counter()
+            if name.startswith('End'):
+                for arg in args:
+                    if isinstance(arg, _RecordingAsyncResult):
+                        # how long the phase ran after its Begin (the caller waited for it meanwhile)
+                        record['pending'] = start - arg.begun
+                args = [arg._result if isinstance(arg, _RecordingAsyncResult) else arg for arg in args]
+            try:
+                result = attr(*args)
+            except Exception as e:
+                record['seconds'] = time.perf_counter() - start
+                record['error'] = {'type': e.__class__.__name__, 'message': str(e)}
+                self._recorder.write(record)
+                raise
+            record['seconds'] = time.perf_counter() - start
+            if name.startswith('Begin') and result is not None:
+                result = _RecordingAsyncResult(result, name[len('Begin'):])
+            record['result'] = encode_value(result)
+            self._recorder.write(record)
+
+            return result
+
+        return call
+
+
+class _RecordingFactory(object):
+    def __init__(self, factory, recorder):
+        self._factory = factory
+        self._recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self._factory, name)
+
+    def CreateVssBackupComponents(self): #pylint:disable=C0103
+        start = time.perf_counter()
+        components = self._factory.CreateVssBackupComponents()
+        number = self._recorder.new_components(time.perf_counter() - start)
+
+        return _RecordingComponents(components, number, self._recorder)
+
+
+class Recorder(object):
+    '''
+        Record the AlphaVSS calls made through a VSSProvider (the components it creates) to a trace file
+    '''
+    def __init__(self, provider:object, path:str, volumes:dict=None):
+        '''
+            provider: (VSSProvider) pass it to the VSSSnapshotSet/VSSSnapshot objects too, or their calls go unrecorded
+            path: (str) trace file (overwritten)
+            volumes: (dict) get_drives() mapping saved in the trace (default: get_drives())
+        '''
+        self.provider = provider
+        self.path = path
+        self.volumes = volumes
+        self.calls = 0
+        self._file = None
+        self._factory = None
+        self._components = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self.volumes is None:
+            from alphavss.models import get_drives
+
+            self.volumes = get_drives()
+        self._file = open(self.path, 'w', encoding='utf-8')
+        self._file.write(json.dumps({'trace': TRACE_VERSION, 'recorded': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                                     'volumes': self.volumes}) + '\n')
+        self._factory = self.provider.factory
+        self.provider.factory = _RecordingFactory(self._factory, self)
+
+        return self
+
+    def new_components(self, seconds):
+        with self._lock:
+            self._components += 1
+            number = self._components
+        self.write({'components': number, 'method': 'CreateVssBackupComponents', 'seconds': seconds})
+
+        return number
+
+    def write(self, record):
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self.calls += 1
+
+    def stop(self):
+        if self._file is not None:
+            self.provider.factory = self._factory
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def read_trace(path:str):
+    '''
+        (header, {components number: [call records]}) of a trace file
+    '''
+    header = None
+    calls = {}
+    with open(path, 'r', encoding='utf-8') as trace_file:
+        for line in trace_file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if header is None:
+                if record.get('trace') != TRACE_VERSION:
+                    raise Exception(f'{path} is not an alphavss trace (version {TRACE_VERSION})')
+                header = record
+                continue
+            calls.setdefault(record['components'], []).append(record)
+    if header is None:
+        raise Exception(f'{path} is empty')
+
+    return header, calls
+
+
+class ReplayStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.recorded = 0.0 # seconds the calls took when they were recorded
+        self.waited = 0.0 # seconds spent replaying them (sleeping at speed > 0)
+        self.start = time.monotonic()
+        self.end = None
+
+    @property
+    def elapsed(self):
+        return (self.end or time.monotonic()) - self.start
+
+    def as_dict(self):
+        return {'calls': self.calls, 'recorded': round(self.recorded, 6), 'waited': round(self.waited, 6),
+                'elapsed': round(self.elapsed, 6), 'models': round(self.elapsed - self.waited, 6)}
+
+    def __str__(self):
+        return (f'{self.calls} call(s) recorded in {self.recorded:.3f}s, replayed in {self.elapsed:.3f}s '
+                f'({self.elapsed - self.waited:.3f}s in models.py)')
+
+
+class _ReplayComponents(object):
+    '''
+        Answers the calls of one recorded components object, in the recorded order
+    '''
+    def __init__(self, replay, number, calls):
+        self._replay = replay
+        self._number = number
+        self._calls = calls
+        self._position = 0
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(*args):
+            return self._replay.answer(self, name, args)
+
+        return call
+
+
+class _ReplayFactory(object):
+    def __init__(self, replay):
+        self._replay = replay
+
+    def CreateVssBackupComponents(self): #pylint:disable=C0103
+        return self._replay.new_components()
+
+
+class Replay(object):
+    '''
+        Serve a trace to models.py (see the module docstring)
+    '''
+    def __init__(self, path:str, speed:float=1.0, strict:bool=False, debug:bool=False):
+        '''
+            path: (str) trace written by a Recorder
+            speed: (float) 1.0 = the recorded latencies, 2.0 = twice as fast, 0 = no waiting at all
+            strict: (bool) the arguments of every call must match the recorded ones
+            debug: (bool) enables enhanced output
+        '''
+        self.path = path
+        self.speed = speed
+        self.strict = strict
+        self.debug = debug
+        self.header, self.calls = read_trace(path)
+        self.volumes = self.header.get('volumes') or {}
+        self.stats = ReplayStats()
+        self.factory = _ReplayFactory(self)
+        self.models = None
+        self._next_components = 0
+        self._installed = []
+        self._lock = threading.Lock()
+        self._guid_parse = ReplayGuid.Parse
+        self._exceptions = {}
+        self._get_drives = None
+
+    def _sleep(self, seconds):
+        if self.speed and seconds:
+            time.sleep(seconds / self.speed)
+            self.stats.waited += seconds / self.speed
+
+    def new_components(self):
+        with self._lock:
+            self._next_components += 1
+            number = self._next_components
+        calls = self.calls.get(number)
+        if not calls or calls[0]['method'] != 'CreateVssBackupComponents':
+            raise Exception(f'replay diverged: the trace has no components object #{number}')
+        self.stats.calls += 1
+        self.stats.recorded += calls[0]['seconds']
+        self._sleep(calls[0]['seconds'])
+
+        return _ReplayComponents(self, number, calls[1:])
+
+    def answer(self, components, method, args):
+        '''
+            The recorded result of the next call of a components object (raises the recorded error)
+        '''
+        if components._position >= len(components._calls):
+            raise Exception(f'replay diverged: {method} called on components #{components._number} after the '
+                            f'end of its trace')
+        record = components._calls[components._position]
+        if record['method'] != method:
+            raise Exception(f'replay diverged: components #{components._number} call {components._position + 1} '
+                            f'is {method}, the trace has {record["method"]}')
+        if self.strict and encode_value(list(args)) != record['args']:
+            raise Exception(f'replay diverged: {method}{tuple(args)} was recorded with {record["args"]}')
+        components._position += 1
+        self.stats.calls += 1
+        self.stats.recorded += record['seconds'] + record.get('pending', 0.0)
+        self._sleep(record['seconds'])
+        if 'error' in record:
+            error = self._exceptions.get(record['error']['type'], Exception)
+            raise error(record['error']['message'])
+        result = record.get('result')
+        if isinstance(result, dict) and '$async' in result:
+            # the phase completes when its End<phase> was called (never, without one: cancelled / timed out)
+            end = None
+            if components._position < len(components._calls):
+                end = components._calls[components._position]
+            pending = end.get('pending', 0.0) if end and end['method'] == f'End{result["$async"]}' else None
+
+            return ReplayAsyncResult(self, result['$async'], pending)
+
+        return decode_value(result, self._guid_parse)
+
+    def _install(self, name, module):
+        sys.modules[name] = module
+        self._installed.append(name)
+
+    def _install_modules(self):
+        '''
+            Stand in for clr, System, wmi and AlphaVSS when they are missing (models.py imports them)
+        '''
+        replay = self
+        try:
+            import clr #pylint:disable=W0611,C0415
+        except ImportError:
+            clr_module = types.ModuleType('clr')
+            clr_module.AddReference = lambda name: None
+            self._install('clr', clr_module)
+
+            system = types.ModuleType('System')
+            system.Guid = ReplayGuid
+            system.FormatException = _FormatException
+            system.BadImageFormatException = type('BadImageFormatException', (Exception,), {})
+            self._install('System', system)
+
+            vss = types.ModuleType('Alphaleonis.Win32.Vss')
+            vss.VssFactoryProvider = types.SimpleNamespace(
+                Default=types.SimpleNamespace(GetVssFactory=lambda: replay.factory))
+            vss.VssBackupType = types.SimpleNamespace(Undefined=0, Full=1, Incremental=2, Differential=3, Log=4,
+                                                      Copy=5, Other=6)
+            for name in ('VssObjectAlreadyExistsException', 'VssBadStateException', 'VssObjectNotFoundException'):
+                setattr(vss, name, type(name, (Exception,), {}))
+                self._exceptions[name] = getattr(vss, name)
+            alphaleonis = types.ModuleType('Alphaleonis')
+            alphaleonis.Win32 = types.ModuleType('Alphaleonis.Win32')
+            alphaleonis.Win32.Vss = vss
+            self._install('Alphaleonis', alphaleonis)
+            self._install('Alphaleonis.Win32', alphaleonis.Win32)
+            self._install('Alphaleonis.Win32.Vss', vss)
+        else:
+            from System import Guid #pylint:disable=E0401,C0415
+            import Alphaleonis.Win32.Vss as alphavsslib #pylint:disable=E0401,C0415
+
+            self._guid_parse = Guid.Parse
+            self._exceptions = {name: getattr(alphavsslib, name) for name in dir(alphavsslib)
+                                if name.endswith('Exception')}
+
+        try:
+            import wmi #pylint:disable=W0611,C0415
+        except ImportError:
+            wmi_module = types.ModuleType('wmi')
+            wmi_module.WMI = lambda *args, **kwargs: _ReplayWMI(replay.volumes)
+            self._install('wmi', wmi_module)
+
+    def start(self):
+        self._install_modules()
+        if self._installed and 'alphavss.models' in sys.modules:
+            raise Exception('alphavss.models is already imported (with other modules than the replay ones)')
+        from alphavss import models
+
+        self.models = models
+        if 'wmi' not in self._installed:
+            # the trace's volumes, not this machine's
+            self._get_drives = models.get_drives
+            models.get_drives = lambda filter_letter=None, resolver=None: {
+                letter: device_id for letter, device_id in self.volumes.items()
+                if not filter_letter or filter_letter.lower() == letter.lower()}
+        self.stats = ReplayStats()
+
+        return self
+
+    def provider(self, **kwargs):
+        '''
+            A VSSProvider (kwargs) whose components come from the trace
+        '''
+        provider = self.models.VSSProvider(**kwargs)
+        provider.factory = self.factory
+
+        return provider
+
+    def stop(self):
+        self.stats.end = time.monotonic()
+        if self.debug:
+            print(f'replay of {self.path}: {self.stats}')
+        if self._get_drives is not None:
+            self.models.get_drives = self._get_drives
+            self._get_drives = None
+        if self._installed:
+            # models.py was imported with the stand-ins, it has to be imported again without them
+            sys.modules.pop('alphavss.models', None)
+            if hasattr(sys.modules['alphavss'], 'models'):
+                delattr(sys.modules['alphavss'], 'models')
+            for name in self._installed:
+                sys.modules.pop(name, None)
+            self._installed = []
+        self.models = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class _FormatException(Exception):
+    pass
+
+
+class _ReplayWMI(object):
+    '''
+        Answers the Win32_Volume query of get_drives() with the volumes of the trace
+    '''
+    def __init__(self, volumes):
+        self.volumes = volumes
+
+    def query(self, wql):
+        return [_ReplayWMIObject({'DriveLetter': letter, 'DeviceID': device_id})
+                for letter, device_id in self.volumes.items()]
+
+
+class _ReplayWMIObject(object):
+    def __init__(self, properties):
+        self.properties = properties
+
+    def wmi_property(self, name):
+        return types.SimpleNamespace(value=self.properties.get(name))
@@ -0,0 +1,657 @@
+'''
+    Parallel restore of files from a backup of a VSSSnapshotSet
+
+    VSSProvider(operation='restore') prepares the VSS side of a restore, SnapshotRestorer moves the data.  It restores
+    selected paths (or everything) from one of these sources into a target directory:
+
+        DirectorySource(snapshot)           an exposed snapshot, a snapshot device path or a copy made by the copier
+        ArchiveSource('C.avss')             an archive written by the BackupPipeline (a file, not a pipe)
+        ChunkStoreSource(store, 'C-1019')   a snapshot ingested in a dedup.ChunkStore
+
+        * files are restored on a pool of worker threads, with large sequential writes (write_size)
+        * the target files are preallocated to their final size (fewer fragments, no repeated size extensions)
+        * big files are restored sparse: all zero blocks become holes instead of being written
+        * archive and chunk store sources keep a sorted index next to the backup (<archive>.idx, <recipe>.idx, built
+          by a single scan the first time) so restoring one file or one directory doesn't read the whole backup
+
+    Usage:
+        from alphavss.restore import SnapshotRestorer, ArchiveSource
+
+        stats = SnapshotRestorer(ArchiveSource('E:\\backups\\C.avss'), 'D:\\restore', paths=['C/Users/bob']).run()
+        print(stats)
+'''
+import os
+import abc
+import sys
+import mmap
+import stat
+import ntpath
+import struct
+import threading
+from collections import namedtuple
+from alphavss.walker import SnapshotWalker, snapshot_root
+from alphavss.archive import (archive_path, iter_archive, read_record, decompress_chunk, DirRecord, FileRecord,
+                              ChunkRecord, EndRecord, LinkRecord, STATUS_OK)
+from alphavss.copier import CopyStats, WorkerPool
+
+DEFAULT_RESTORE_WORKERS = 8
+DEFAULT_WRITE_SIZE = 8 * 1024 * 1024 # 8 MB
+SPARSE_BLOCK = 64 * 1024 # NTFS sparse allocation unit
+SPARSE_MIN_SIZE = 16 * 1024 * 1024 # files smaller than this are never made sparse
+READ_SIZE = 8 * 1024 * 1024
+
+INDEX_MAGIC = b'AVSSRIX2'
+_INDEX_HEADER = struct.Struct('<Qq') # size and mtime_ns of the indexed backup (a stale index is rebuilt)
+_INDEX_RECORD = struct.Struct('<HBIQqIH')
+_INDEX_TRAILER = struct.Struct('<QQ')
+
+FSCTL_SET_SPARSE = 0x900C4
+
+# link: path of the file this one is a hard link to (its locators are empty)
+RestoreEntry = namedtuple('RestoreEntry', ['path', 'is_dir', 'size', 'mtime_ns', 'mode', 'locators', 'sparse', 'link'],
+                          defaults=[None])
+
+
+def write_restore_index(index_path:str, entries:object, source_size:int=0, source_mtime_ns:int=0):
+    '''
+        Write a RestoreIndex of RestoreEntry objects (in any order)
+
+        INDEX_MAGIC <Q source size> <q source mtime_ns>
+        records: <H path_len> <B is_dir> <I mode> <Q size> <q mtime_ns> <I count> <H link_len> path link
+                 <Q locator> * count
+        table: <Q record offset> for every record, in path order
+        trailer: <Q table offset> <Q records>
+    '''
+    offsets = []
+    tmp_path = f'{index_path}.tmp'
+    with open(tmp_path, 'wb', buffering=READ_SIZE) as index_file:
+        index_file.write(INDEX_MAGIC + _INDEX_HEADER.pack(source_size, source_mtime_ns))
+        position = len(INDEX_MAGIC) + _INDEX_HEADER.size
+        for entry in entries:
+            encoded = entry.path.encode('utf-8')
+            link = (entry.link or '').encode('utf-8')
+            record = (_INDEX_RECORD.pack(len(encoded), int(entry.is_dir), entry.mode, entry.size, entry.mtime_ns,
+                                         len(entry.locators), len(link)) + encoded + link +
+                      struct.pack(f'<{len(entry.locators)}Q', *entry.locators))
+            index_file.write(record)
+            offsets.append((entry.path, position))
+            position += len(record)
+
+        offsets.sort()
+        index_file.write(struct.pack(f'<{len(offsets)}Q', *(offset for _, offset in offsets)))
+        index_file.write(_INDEX_TRAILER.pack(position, len(offsets)))
+    os.replace(tmp_path, index_path)
+
+
+class RestoreIndex(object):
+    '''
+        Memory mapped, binary searched index of the entries of a backup (see write_restore_index())
+    '''
+    def __init__(self, index_path:str):
+        self.path = index_path
+        self._file = open(index_path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            self.close()
+            raise Exception(f'Not an alphavss restore index (bad magic): {index_path}')
+        self.source_size, self.source_mtime_ns = _INDEX_HEADER.unpack_from(self._map, len(INDEX_MAGIC))
+        self._table, self.count = _INDEX_TRAILER.unpack_from(self._map, len(self._map) - _INDEX_TRAILER.size)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __len__(self):
+        return self.count
+
+    def _entry(self, number):
+        offset, = struct.unpack_from('<Q', self._map, self._table + number * 8)
+        path_len, is_dir, mode, size, mtime_ns, count, link_len = _INDEX_RECORD.unpack_from(self._map, offset)
+        offset += _INDEX_RECORD.size
+        path = self._map[offset:offset + path_len].decode('utf-8')
+        offset += path_len
+        link = self._map[offset:offset + link_len].decode('utf-8') if link_len else None
+        locators = list(struct.unpack_from(f'<{count}Q', self._map, offset + link_len))
+
+        return RestoreEntry(path, bool(is_dir), size, mtime_ns, mode, locators, None, link)
+
+    def _first(self, path):
+        '''
+            Number of the first entry >= path
+        '''
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(middle).path < path:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def get(self, path:str):
+        '''
+            RestoreEntry of an archive path, None if it isn't in the backup
+        '''
+        number = self._first(path)
+        if number < self.count:
+            entry = self._entry(number)
+            if entry.path == path:
+                return entry
+
+        return None
+
+    def prefix(self, path:str):
+        '''
+            Generator returning the entry of path and every entry under it, in path order
+        '''
+        entry = self.get(path)
+        if entry is not None:
+            yield entry
+        # '/' sorts before the characters of most names, but not all of them ('a/b!' < 'a/b/c'), so scan from 'a/b/'
+        for number in range(self._first(path + '/'), self.count):
+            entry = self._entry(number)
+            if not entry.path.startswith(path + '/'):
+                return
+            yield entry
+
+    def __iter__(self):
+        for number in range(self.count):
+            yield self._entry(number)
+
+
+class _IndexedSource(abc.ABC):
+    '''
+        Base of the sources that keep a RestoreIndex next to the backup (a source implements _scan() and read())
+    '''
+    def __init__(self, backup_path:str, index_path:str=None, debug:bool=False):
+        self.backup_path = backup_path
+        self.index_path = index_path or f'{backup_path}.idx'
+        self.debug = debug
+        self._index = None
+        self._lock = threading.Lock()
+
+    @property
+    def index(self):
+        with self._lock:
+            if self._index is None:
+                st = os.stat(self.backup_path)
+                index = None
+                if os.path.exists(self.index_path):
+                    try:
+                        index = RestoreIndex(self.index_path)
+                    except Exception: #pylint:disable=W0703
+                        # written by an older version, rebuilt below
+                        index = None
+                if index is None or (index.source_size, index.source_mtime_ns) != (st.st_size, st.st_mtime_ns):
+                    if index is not None:
+                        index.close()
+                    self.build_index()
+                    index = RestoreIndex(self.index_path)
+                self._index = index
+
+            return self._index
+
+    def build_index(self):
+        st = os.stat(self.backup_path)
+        write_restore_index(self.index_path, self._scan(), st.st_size, st.st_mtime_ns)
+        if self.debug:
+            print(f'indexed {self.backup_path} in {self.index_path}')
+
+    @abc.abstractmethod
+    def _scan(self):
+        '''
+            Generator returning the RestoreEntry of everything in the backup (what the index is built from)
+        '''
+
+    @abc.abstractmethod
+    def read(self, entry:RestoreEntry):
+        '''
+            Generator returning (offset, data) pieces of a file's content
+        '''
+
+    def entries(self, paths:list=None):
+        '''
+            Generator returning the RestoreEntry objects of the selected paths (everything when paths is None)
+        '''
+        if paths is None or '' in paths:
+            yield from self.index
+            return
+        for path in paths:
+            yield from self.index.prefix(path)
+
+    def close(self):
+        with self._lock:
+            if self._index is not None:
+                self._index.close()
+                self._index = None
+
+
+class ArchiveSource(_IndexedSource):
+    '''
+        Restore from an archive written by the BackupPipeline (locators are the offsets of the file's chunk records)
+    '''
+    def __init__(self, archive_file:str, index_path:str=None, debug:bool=False):
+        super().__init__(archive_file, index_path=index_path, debug=debug)
+        self._local = threading.local()
+        self._streams = [] # every thread's stream, closed by close()
+
+    def _scan(self):
+        open_files = {}
+        with open(self.backup_path, 'rb', buffering=READ_SIZE) as stream:
+            records = iter_archive(stream)
+            offset = stream.tell()
+            for record in records:
+                if isinstance(record, ChunkRecord):
+                    if record.file_id in open_files:
+                        open_files[record.file_id][1].append(offset)
+                elif isinstance(record, FileRecord):
+                    open_files[record.file_id] = (record, [])
+                elif isinstance(record, EndRecord):
+                    file_record, locators = open_files.pop(record.file_id, (None, None))
+                    if file_record is not None and record.status == STATUS_OK:
+                        yield RestoreEntry(file_record.path, False, file_record.size, file_record.mtime_ns,
+                                           file_record.mode, locators, None)
+                    elif file_record is not None and self.debug:
+                        print(f'{file_record.path} is incomplete in the archive, it can\'t be restored')
+                elif isinstance(record, DirRecord):
+                    yield RestoreEntry(record.path, True, 0, record.mtime_ns, record.mode, [], None)
+                elif isinstance(record, LinkRecord):
+                    yield RestoreEntry(record.path, False, 0, 0, 0, [], None, record.target)
+                offset = stream.tell()
+
+    def read(self, entry:RestoreEntry):
+        '''
+            Generator returning (offset, data) pieces of a file's content
+        '''
+        stream = getattr(self._local, 'stream', None)
+        if stream is None:
+            stream = open(self.backup_path, 'rb', buffering=0)
+            self._local.stream = stream
+            with self._lock:
+                self._streams.append(stream)
+        for locator in entry.locators:
+            stream.seek(locator)
+            record = read_record(stream)
+            if not isinstance(record, ChunkRecord):
+                raise Exception(f'Corrupt archive index: no chunk of {entry.path} at offset {locator}')
+            yield record.offset, decompress_chunk(record.codec, record.data)
+
+    def close(self):
+        '''
+            Close the index and the archive streams of the restore threads (Windows can't move or delete an open
+            archive)
+        '''
+        super().close()
+        with self._lock:
+            streams = self._streams
+            self._streams = []
+            # threads reading again after close() open a new stream
+            self._local = threading.local()
+        for stream in streams:
+            stream.close()
+
+
+class ChunkStoreSource(_IndexedSource):
+    '''
+        Restore a snapshot ingested in a dedup.ChunkStore (locators are the offset of the file's recipe record)
+    '''
+    def __init__(self, store:object, name:str, index_path:str=None, debug:bool=False):
+        super().__init__(store.recipe_path(name), index_path=index_path, debug=debug)
+        self.store = store
+        self.name = name
+
+    def _scan(self):
+        for offset, path, size, mtime_ns, _ in self.store.scan_recipe(self.name):
+            yield RestoreEntry(path, False, size, mtime_ns, 0, [offset], None)
+
+    def read(self, entry:RestoreEntry):
+        _, _, _, digests = self.store.recipe_entry(self.name, entry.locators[0])
+        offset = 0
+        for digest in digests:
+            data = self.store.read_chunk(digest)
+            yield offset, data
+            offset += len(data)
+
+
+class DirectorySource(object):
+    '''
+        Restore from a directory tree (an exposed snapshot, a snapshot device path or a copy of a snapshot)
+
+        Selected files are looked up directly, only selected directories are walked
+    '''
+    def __init__(self, snapshot:object, read_size:int=DEFAULT_WRITE_SIZE, walker_options:dict=None, debug:bool=False):
+        self.root = snapshot_root(snapshot)
+        self.read_size = read_size
+        self.walker_options = walker_options or {}
+        self.debug = debug
+
+    def _entry(self, st):
+        is_dir = stat.S_ISDIR(st.st_mode)
+        sparse = None
+        if not is_dir:
+            attributes = getattr(st, 'st_file_attributes', None)
+            if attributes is not None:
+                sparse = bool(attributes & 0x200) # FILE_ATTRIBUTE_SPARSE_FILE
+            elif hasattr(st, 'st_blocks'):
+                sparse = st.st_blocks * 512 < st.st_size
+
+        return is_dir, sparse
+
+    def entries(self, paths:list=None):
+        for path in (paths if paths is not None else ['']):
+            full_path = os.path.join(self.root, path.replace('/', os.sep)) if path else self.root
+            try:
+                st = os.stat(full_path, follow_symlinks=False)
+            except OSError:
+                if self.debug:
+                    print(f'{path} is not in {self.root}')
+                continue
+            is_dir, sparse = self._entry(st)
+            if path:
+                yield RestoreEntry(path, is_dir, st.st_size, st.st_mtime_ns, st.st_mode, [full_path], sparse)
+            if not is_dir:
+                continue
+            for entry in SnapshotWalker(full_path, debug=self.debug, **self.walker_options):
+                st = entry.stat()
+                is_dir, sparse = self._entry(st)
+                yield RestoreEntry(archive_path(path, entry.rel_path), is_dir, st.st_size, st.st_mtime_ns, st.st_mode,
+                                   [entry.path], sparse)
+
+    def read(self, entry:RestoreEntry):
+        with open(entry.locators[0], 'rb', buffering=0) as src:
+            offset = 0
+            while True:
+                data = src.read(self.read_size)
+                if not data:
+                    return
+                yield offset, data
+                offset += len(data)
+
+    def close(self):
+        pass
+
+
+def _set_sparse(dst):
+    '''
+        Mark an open file sparse (NTFS needs this before holes can exist, other file systems have them by default)
+    '''
+    if sys.platform != 'win32':
+        return True
+    import ctypes
+    import msvcrt
+    from ctypes import wintypes
+
+    returned = wintypes.DWORD()
+    handle = msvcrt.get_osfhandle(dst.fileno())
+    return bool(ctypes.windll.kernel32.DeviceIoControl(wintypes.HANDLE(handle), FSCTL_SET_SPARSE, None, 0, None, 0,
+                                                       ctypes.byref(returned), None))
+
+
+def _preallocate(dst, size):
+    if size <= 0:
+        return
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(dst.fileno(), 0, size)
+            return
+        except OSError:
+            pass
+    # SetEndOfFile on Windows: NTFS allocates the clusters of a (non sparse) file up front
+    dst.truncate(size)
+
+
+def write_sparse(dst, offset:int, data:bytes):
+    '''
+        Write data at offset, skipping (leaving holes for) the all zero SPARSE_BLOCK blocks, returns bytes written
+    '''
+    written = 0
+    view = memoryview(data)
+    position = 0
+    length = len(data)
+    while position < length:
+        end = min(position + SPARSE_BLOCK, length)
+        if data.count(0, position, end) == end - position:
+            position = end
+            continue
+        # extend the run of non zero blocks, they go out in one write
+        while end < length:
+            block_end = min(end + SPARSE_BLOCK, length)
+            if data.count(0, end, block_end) == block_end - end:
+                break
+            end = block_end
+        dst.seek(offset + position)
+        dst.write(view[position:end])
+        written += end - position
+        position = end
+
+    return written
+
+
+class SnapshotRestorer(object):
+    '''
+        Restore selected paths of a backup (see the sources above) into a target directory
+    '''
+    def __init__(self, source:object, target:str, paths:list=None, workers:int=DEFAULT_RESTORE_WORKERS,
+                 write_size:int=DEFAULT_WRITE_SIZE, preallocate:bool=True, sparse:bool=True, preserve_times:bool=True,
+                 overwrite:bool=True, onerror:object=None, debug:bool=False):
+        '''
+            source: (DirectorySource, ArchiveSource or ChunkStoreSource) what to restore from
+            target: (str) directory the selected paths are restored under (with their full archive path)
+            paths: (list) archive paths ('/' separators) of the files and directories to restore, None restores all
+            workers: (int) restore threads
+            write_size: (int) file content is written out in blocks of (up to) this size
+            preallocate: (bool) allocate the target files to their final size before writing
+            sparse: (bool) leave holes for the all zero blocks of big (or sparse source) files
+            preserve_times: (bool) restore file and directory mtimes
+            overwrite: (bool) replace existing files (otherwise they are skipped)
+            onerror: (callable) called with (path, exception) when a file can't be restored (what it raises stops the
+                     restore and is raised by run())
+            debug: (bool) enables enhanced output
+        '''
+        if workers < 1:
+            raise Exception(f'SnapshotRestorer needs at least 1 worker: {workers}')
+        self.source = source
+        self.target = target
+        self.paths = [archive_path(path) for path in paths] if paths is not None else None
+        self.workers = workers
+        self.write_size = write_size
+        self.preallocate = preallocate
+        self.sparse = sparse
+        self.preserve_times = preserve_times
+        self.overwrite = overwrite
+        self.onerror = onerror
+        self.debug = debug
+        self.stats = None
+
+    def target_path(self, path:str):
+        '''
+            Where an archive path is restored, under the target: absolute, drive qualified and '..' paths (a damaged or
+            hostile backup) raise instead of escaping it
+        '''
+        if not path:
+            return self.target
+        parts = path.replace('\\', '/').split('/')
+        if (path.startswith(('/', '\\')) or ntpath.splitdrive(path)[0] or os.path.isabs(path) or '..' in parts
+                or ':' in parts[0]):
+            raise Exception(f'Unsafe path in the backup (outside of the target), not restored: {path}')
+        target = os.path.abspath(self.target)
+        dst_path = os.path.join(target, os.sep.join(part for part in parts if part and part != '.'))
+        if os.path.commonpath([target, dst_path]) != target:
+            raise Exception(f'Unsafe path in the backup (outside of the target), not restored: {path}')
+
+        return dst_path
+
+    def run(self):
+        '''
+            Restore the selected paths, returns CopyStats
+        '''
+        self.stats = CopyStats()
+        pool = WorkerPool(self._restore_entry, self.workers, self.workers * 4, 'alphavss-restore')
+
+        dirs = []
+        links = []
+        try:
+            for entry in self.source.entries(self.paths):
+                if entry.is_dir:
+                    try:
+                        os.makedirs(self.target_path(entry.path), exist_ok=True)
+                    except Exception as e: #pylint:disable=W0703
+                        self._error(entry.path, e)
+                        continue
+                    dirs.append(entry)
+                    self.stats.add(dirs=1)
+                elif entry.link is not None:
+                    # after the files: the file it links to may still be in the queue
+                    links.append(entry)
+                elif not pool.put(entry):
+                    # a worker failed, join() raises its error
+                    break
+        except BaseException:
+            pool.join(check=False)
+            raise
+        pool.join()
+
+        for entry in links:
+            try:
+                self.restore_link(entry)
+                self.stats.add(files=1)
+            except Exception as e: #pylint:disable=W0703
+                self._error(entry.path, e)
+
+        if self.preserve_times:
+            # deepest first, restoring the files changed the mtimes of their directories
+            for entry in sorted(dirs, key=lambda entry: entry.path.count('/'), reverse=True):
+                try:
+                    os.utime(self.target_path(entry.path), ns=(entry.mtime_ns, entry.mtime_ns))
+                except OSError as e:
+                    self._error(entry.path, e)
+
+        self.stats.finish()
+        if self.debug:
+            print(f'restored into {self.target}: {self.stats}')
+
+        return self.stats
+
+    def _restore_entry(self, entry):
+        try:
+            nbytes = self.restore_file(entry)
+            if nbytes is None:
+                self.stats.add(skipped=1)
+            else:
+                self.stats.add(files=1, nbytes=nbytes)
+        except Exception as e: #pylint:disable=W0703
+            self._error(entry.path, e)
+
+    def restore_file(self, entry:RestoreEntry, dst_path:str=None):
+        '''
+            Restore a single RestoreEntry (to dst_path, default: its place under the target), returns the number of
+            bytes written (None when an existing file was skipped)
+        '''
+        dst_path = dst_path or self.target_path(entry.path)
+        if not self.overwrite and os.path.exists(dst_path):
+            return None
+        try:
+            dst = open(dst_path, 'wb', buffering=0)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+            dst = open(dst_path, 'wb', buffering=0)
+
+        sparse = self.sparse and (entry.sparse if entry.sparse is not None else entry.size >= SPARSE_MIN_SIZE)
+        written = 0
+        with dst:
+            if sparse:
+                sparse = _set_sparse(dst)
+            if sparse:
+                dst.truncate(entry.size)
+            elif self.preallocate:
+                _preallocate(dst, entry.size)
+
+            pending = []
+            pending_offset = 0
+            pending_size = 0
+            for offset, data in self.source.read(entry):
+                # coalesce consecutive pieces into write_size writes
+                if pending and (offset != pending_offset + pending_size or pending_size + len(data) > self.write_size):
+                    written += self._write(dst, pending_offset, pending, sparse)
+                    pending = []
+                if not pending:
+                    pending_offset = offset
+                    pending_size = 0
+                pending.append(data)
+                pending_size += len(data)
+            if pending:
+                written += self._write(dst, pending_offset, pending, sparse)
+
+            if sparse or not self.preallocate:
+                dst.truncate(entry.size)
+
+        if self.preserve_times:
+            os.utime(dst_path, ns=(entry.mtime_ns, entry.mtime_ns))
+
+        return written
+
+    def restore_link(self, entry:RestoreEntry, dst_path:str=None):
+        '''
+            Restore a hard link entry: a hard link to the restored file, or a copy of it (the file it links to wasn't
+            selected, or the target has no hard links)
+        '''
+        dst_path = dst_path or self.target_path(entry.path)
+        first_path = self.target_path(entry.link)
+        if not self.overwrite and os.path.exists(dst_path):
+            return
+        if os.path.exists(dst_path):
+            os.remove(dst_path)
+        if os.path.exists(first_path):
+            try:
+                os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+                os.link(first_path, dst_path)
+                return
+            except OSError as e:
+                if self.debug:
+                    print(f'unable to hard link {entry.path} to {entry.link} ({e}), restoring a copy')
+        for first in self.source.entries([entry.link]):
+            if first.path == entry.link and not first.is_dir and first.link is None:
+                self.restore_file(first, dst_path)
+                return
+
+        raise Exception(f'{entry.link} (the file {entry.path} links to) is not in the backup')
+
+    def _write(self, dst, offset, pieces, sparse):
+        data = pieces[0] if len(pieces) == 1 else b''.join(pieces)
+        if sparse:
+            return write_sparse(dst, offset, data)
+        dst.seek(offset)
+        dst.write(data)
+
+        return len(data)
+
+    def _error(self, path, exception):
+        self.stats.add(errors=1)
+        if self.onerror is not None:
+            self.onerror(path, exception)
+        elif self.debug:
+            print(f'unable to restore {path}: {exception}')
+
+
+def restore_file(source:object, path:str, dst_path:str, **kwargs):
+    '''
+        Restore one file (found through the source's index, nothing else is read) to dst_path, returns bytes written
+    '''
+    path = archive_path(path)
+    for entry in source.entries([path]):
+        if entry.path == path and not entry.is_dir:
+            if entry.link is not None:
+                # a hard link: restore the data of the file it links to
+                return restore_file(source, entry.link, dst_path, **kwargs)
+            return SnapshotRestorer(source, os.path.dirname(dst_path), **kwargs).restore_file(entry, dst_path)
+
+    raise Exception(f'{path} is not a file in the backup')
+
+
+def restore_snapshot(source:object, target:str, **kwargs):
+    '''
+        Shortcut for SnapshotRestorer(source, target, **kwargs).run()
+    '''
+    return SnapshotRestorer(source, target, **kwargs).run()
@@ -0,0 +1,271 @@
+'''
+    Pipelined snapshot rotation: the next snapshot set is prepared while the current one is being copied
+
+    A plain rotation (snapshot, copy, delete, repeat) pays the whole VSS sequence on the critical path of every cycle:
+    InitializeForBackup, GatherWriterMetadata (every writer answers), the per snapshot components, PrepareForBackup,
+    and the deletes.  RotationScheduler overlaps them with the copy of the previous set:
+
+        copy thread (caller)    |-- copy set N ---------------------------|commit N+1|-- copy set N+1 ---------- ...
+        prepare thread          |-- metadata N+1 --|  wait  |-- prepare --|          |-- metadata N+2 --| ...
+        delete thread           |-- delete expired sets --|                          |-- delete --|
+
+        * the next set is created deferred (VSSSnapshotSet(defer=True): InitializeForBackup, GatherWriterMetadata and
+          the components of its snapshots) on a background thread, right after the current set is committed
+        * VSS creates one set at a time (VSS_E_SNAPSHOT_SET_IN_PROGRESS for any other requestor meanwhile): models.py
+          holds a snapshot set slot from StartSnapshotSet to the end of DoSnapshotSet.  The prepare thread only starts
+          the set (StartSnapshotSet to PrepareForBackup) so that it ends about when the copy does: the last copy time
+          and the last prepare time tell when (the first cycle waits for the end of the copy), so the slot is held
+          for the end of the copy and the commit, not for the whole copy
+        * sets beyond the keep most recent ones are deleted on another thread while the copy runs (never the one being
+          copied), with a 'query' provider (no GatherWriterMetadata for a delete)
+        * a prepare that fails is retried in line (the plain, serial path) and a failed copy gives up (abort()) the
+          next set before the error is raised
+
+    The set factory, the copy and the delete are callables, so the pipeline can be exercised with fakes.
+
+    Usage:
+        from alphavss.rotation import RotationScheduler
+
+        def copy(vss_set):
+            copy_snapshot(vss_set.snapshots[0], 'E:\\backup\\C')
+
+        scheduler = RotationScheduler(['C:\\'], copy, provider=VSSProvider(context=AppRollback), keep=2, period=900)
+        print(scheduler.run(cycles=24))
+'''
+import time
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_KEEP = 2
+
+
+class RotationStats(object):
+    def __init__(self):
+        self.cycles = 0
+        self.created = 0
+        self.deleted = 0
+        self.delete_errors = 0
+        self.prepare_retries = 0
+        self.prepare_time = 0.0 # spent preparing sets (mostly hidden behind the copies)
+        self.prepare_wait = 0.0 # spent waiting for a prepare after a copy (on the critical path)
+        self.commit_time = 0.0
+        self.copy_time = 0.0
+        self.start = time.monotonic()
+        self.end = None
+        self._lock = threading.Lock()
+
+    def add(self, **counters):
+        with self._lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    @property
+    def elapsed(self):
+        return (self.end or time.monotonic()) - self.start
+
+    @property
+    def sets_per_hour(self):
+        return self.created * 3600 / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self):
+        return {'cycles': self.cycles, 'created': self.created, 'deleted': self.deleted,
+                'delete_errors': self.delete_errors, 'prepare_retries': self.prepare_retries,
+                'prepare_time': round(self.prepare_time, 3), 'prepare_wait': round(self.prepare_wait, 3),
+                'commit_time': round(self.commit_time, 3), 'copy_time': round(self.copy_time, 3),
+                'elapsed': round(self.elapsed, 3), 'sets_per_hour': round(self.sets_per_hour, 1)}
+
+    def __str__(self):
+        return (f'{self.cycles} cycle(s) in {self.elapsed:.2f}s ({self.sets_per_hour:.1f} sets/h): {self.created} '
+                f'set(s) created, {self.deleted} deleted, copy {self.copy_time:.2f}s, prepare {self.prepare_time:.2f}s '
+                f'({self.prepare_wait:.2f}s waited), commit {self.commit_time:.2f}s')
+
+
+class RotationScheduler(object):
+    '''
+        Snapshot, copy, rotate: with the preparation of the next set and the deletes overlapped with the copy (see the
+        module docstring)
+    '''
+    def __init__(self, volume_names:list, copy:object, provider:object=None, keep:int=DEFAULT_KEEP,
+                 period:float=0.0, create_set:object=None, delete_set:object=None, set_options:dict=None,
+                 debug:bool=False):
+        '''
+            volume_names: (list) ex. ['C:\\', 'D:\\']
+            copy: (callable) copy(vss_set) copies a committed set
+            provider: (VSSProvider) the backup provider of the sets (default: a new one)
+            keep: (int) sets kept after a cycle (the one just copied included), older ones are deleted
+            period: (float) minimum seconds between two snapshots (0: as fast as the copies go)
+            create_set: (callable) create_set() returns a deferred set: an object with prepare(), commit(), abort()
+                        and snapshots (default: VSSSnapshotSet(volume_names, provider, defer=True, **set_options))
+            delete_set: (callable) delete_set(vss_set) deletes a set (default: DeleteSnapshotSet with a 'query'
+                        provider of the same context)
+            set_options: (dict) more VSSSnapshotSet arguments (deadlines, system_state...)
+            debug: (bool) enables enhanced output
+        '''
+        if keep < 1:
+            raise Exception(f'keep must be at least 1 (the set being copied): {keep}')
+        self.volume_names = list(volume_names)
+        self.copy = copy
+        self.provider = provider
+        self.keep = keep
+        self.period = period
+        self.create_set = create_set or self._create_set
+        self.delete_set = delete_set or self._delete_set
+        self.set_options = dict(set_options or {})
+        self.debug = debug
+        self.sets = collections.deque() # committed sets, oldest first
+        self.stats = None
+        self._stop = threading.Event()
+        self._delete_provider = None
+        self._copy_seconds = None # the last copy and the last prepare(), to start the next one in time
+        self._prepare_seconds = 0.0
+
+    def _create_set(self):
+        from alphavss.models import VSSProvider, VSSSnapshotSet
+
+        if self.provider is None:
+            self.provider = VSSProvider(debug=self.debug)
+
+        return VSSSnapshotSet(volume_names=self.volume_names, provider=self.provider, context=self.provider.context,
+                              defer=True, debug=self.debug, **self.set_options)
+
+    def _delete_set(self, vss_set):
+        if self._delete_provider is None:
+            from alphavss.models import VSSProvider
+
+            self._delete_provider = VSSProvider(operation='query', context=vss_set.provider.context, debug=self.debug)
+        components = self._delete_provider.create_backup_components()
+        self._delete_provider._initialize(components)
+
+        return vss_set.delete(components)
+
+    def stop(self):
+        '''
+            Finish the current cycle and return from run()
+        '''
+        self._stop.set()
+
+    def _prepare(self, copied=None, copy_start=None, last_commit=None):
+        '''
+            A deferred set, started (prepare()) near the end of the copy that began at copy_start (copied is set when
+            it is done), or right away without one
+        '''
+        start = time.monotonic()
+        try:
+            vss_set = self.create_set()
+        finally:
+            self.stats.add(prepare_time=time.monotonic() - start)
+        try:
+            if copied is not None:
+                self._wait_for_copy(copied, copy_start, last_commit)
+                if self._stop.is_set():
+                    # not committed anyway: don't take the snapshot set slot
+                    return vss_set
+            start = time.monotonic()
+            vss_set.prepare()
+            self._prepare_seconds = time.monotonic() - start
+            self.stats.add(prepare_time=self._prepare_seconds)
+        except Exception:
+            vss_set.abort()
+            raise
+
+        return vss_set
+
+    def _wait_for_copy(self, copied, copy_start, last_commit):
+        # the set holds the snapshot set slot from its prepare() to its commit(): end the prepare with the copy
+        if self._copy_seconds is None:
+            copied.wait()
+        else:
+            copied.wait(max(0.0, copy_start + self._copy_seconds - self._prepare_seconds - time.monotonic()))
+        if self.period and last_commit is not None:
+            self._stop.wait(max(0.0, last_commit + self.period - self._prepare_seconds - time.monotonic()))
+
+    def _commit(self, vss_set, last_commit):
+        if self.period and last_commit is not None:
+            # the period is a minimum: wait for the rest of it (stop() cuts it short)
+            self._stop.wait(max(0.0, last_commit + self.period - time.monotonic()))
+        start = time.monotonic()
+        vss_set.commit()
+        self.stats.add(created=1, commit_time=time.monotonic() - start)
+        self.sets.append(vss_set)
+        if self.debug:
+            print(f'snapshot set {getattr(vss_set, "set_id", None)} created ({len(self.sets)} kept)')
+
+        return start
+
+    def _delete(self, vss_set):
+        try:
+            self.delete_set(vss_set)
+            self.stats.add(deleted=1)
+            if self.debug:
+                print(f'snapshot set {getattr(vss_set, "set_id", None)} deleted')
+        except Exception as e: #pylint:disable=W0703
+            # left for the next rotation (or an admin): the pipeline goes on
+            self.stats.add(delete_errors=1)
+            if self.debug:
+                print(f'unable to delete snapshot set {getattr(vss_set, "set_id", None)}: {e}')
+
+    def _expire(self, delete_pool, deletes):
+        while len(self.sets) > self.keep:
+            deletes.append(delete_pool.submit(self._delete, self.sets.popleft()))
+
+    def run(self, cycles:int=None):
+        '''
+            Rotate until stop() (or for cycles cycles), returns RotationStats
+        '''
+        self.stats = RotationStats()
+        self._stop.clear()
+        deletes = []
+        with ThreadPoolExecutor(max_workers=1) as prepare_pool, ThreadPoolExecutor(max_workers=1) as delete_pool:
+            pending = prepare_pool.submit(self._prepare)
+            last_commit = None
+            try:
+                while not self._stop.is_set() and (cycles is None or self.stats.cycles < cycles):
+                    wait_start = time.monotonic()
+                    try:
+                        current = pending.result()
+                    except Exception as e: #pylint:disable=W0703
+                        # the background prepare failed (deadline, writer error...): once more, in line
+                        if self.debug:
+                            print(f'prepare failed ({e}), retrying')
+                        self.stats.add(prepare_retries=1)
+                        current = self._prepare()
+                    pending = None
+                    if self._stop.is_set():
+                        # stopped meanwhile: the set wasn't started (see _prepare()), it is given up
+                        current.abort()
+                        break
+                    self.stats.add(prepare_wait=time.monotonic() - wait_start)
+                    last_commit = self._commit(current, last_commit)
+
+                    # the current set is created: the next one can be set up (and the old ones deleted) meanwhile
+                    self.stats.add(cycles=1)
+                    copied = threading.Event()
+                    start = time.monotonic()
+                    if not self._stop.is_set() and (cycles is None or self.stats.cycles < cycles):
+                        pending = prepare_pool.submit(self._prepare, copied, start, last_commit)
+                    self._expire(delete_pool, deletes)
+                    try:
+                        self.copy(current)
+                    except BaseException:
+                        # the next set is given up below: it must not start (take the snapshot set slot) meanwhile
+                        self._stop.set()
+                        raise
+                    finally:
+                        copied.set()
+                    self._copy_seconds = time.monotonic() - start
+                    self.stats.add(copy_time=self._copy_seconds)
+            finally:
+                if pending is not None:
+                    # stopped, or the copy failed: give up the next set
+                    try:
+                        pending.result().abort()
+                    except Exception: #pylint:disable=W0703
+                        pass
+                for delete in deletes:
+                    delete.result()
+                self.stats.end = time.monotonic()
+        if self.debug:
+            print(self.stats)
+
+        return self.stats
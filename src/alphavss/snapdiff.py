@@ -0,0 +1,248 @@
+'''
+    Fast diff between two snapshots of the same volume ("what changed between snapshot A and B")
+
+    SnapshotDiff walks both trees at the same time on a pool of worker threads (each task lists the same directory in
+    both snapshots), compares the metadata of the entries first and only hashes files whose size matches but whose
+    mtime doesn't.  Changes are streamed from a generator as they are found:
+
+        for change in SnapshotDiff(snap_a, snap_b, exclude=['System Volume Information']):
+            print(change.kind, change.path)
+
+        * kinds: 'added', 'removed', 'modified' (content or size changed) and, with report_touched=True,
+          'touched' (metadata changed, content identical)
+        * an added/removed directory is reported along with everything under it (expand=False only reports the directory)
+        * trust_dir_mtime=True skips a subtree whose directory mtime is the same in both snapshots.  A directory mtime
+          only changes when entries are created/deleted/renamed in it (not when a file is rewritten in place, and not for
+          changes further down), so only use it on trees where files are never modified in place (archives, logs...)
+'''
+import os
+import hashlib
+import threading
+from collections import namedtuple
+from alphavss.walker import DirectoryPool, WalkEntry, snapshot_root, compile_globs, match_globs, is_reparse_point
+from alphavss.throttle import resolve_throttle
+
+DEFAULT_WORKERS = 8
+HASH_BUFFER_SIZE = 1024 * 1024
+
+ADDED = 'added'
+REMOVED = 'removed'
+MODIFIED = 'modified'
+TOUCHED = 'touched'
+
+DiffEntry = namedtuple('DiffEntry', ['kind', 'path', 'is_dir', 'old', 'new']) # old/new are WalkEntry objects (or None)
+
+_BOTH = 0
+_ONLY_OLD = 1
+_ONLY_NEW = 2
+
+
+def _hash(path, buf, throttle=None, size=0):
+    digest = hashlib.sha256()
+    view = memoryview(buf)
+    offset = 0
+    with open(path, 'rb', buffering=0) as src:
+        while True:
+            if throttle is not None:
+                # size: what the file is expected to hold, the last read only counts what is left
+                with throttle.read(min(len(view), max(size - offset, 1))):
+                    read = src.readinto(view)
+            else:
+                read = src.readinto(view)
+            if not read:
+                break
+            digest.update(view[:read])
+            offset += read
+
+    return digest.digest()
+
+
+class SnapshotDiff(object):
+    '''
+        Stream the differences between two snapshots (or any two directory trees)
+    '''
+    def __init__(self, old:object, new:object, workers:int=DEFAULT_WORKERS, exclude:list=None, expand:bool=True,
+                 report_touched:bool=False, trust_dir_mtime:bool=False, max_batches:int=16, onerror:object=None,
+                 follow_reparse_points:bool=False, throttle:object=None, debug:bool=False):
+        '''
+            old/new: (str or VSSSnapshot) the two snapshots (see walker.snapshot_root())
+            workers: (int) directory worker threads
+            exclude: (list) globs of entries to ignore (see walker.compile_globs())
+            expand: (bool) report the contents of added/removed directories too
+            report_touched: (bool) report files whose metadata changed but content didn't
+            trust_dir_mtime: (bool) skip subtrees whose directory mtime didn't change (see the module docstring)
+            max_batches: (int) batches of changes that can wait for the caller before the workers block
+            onerror: (callable) called with the OSError of a directory/file that can't be read (what it raises stops
+                     the diff and is raised by the iteration)
+            follow_reparse_points: (bool) descend into symlinked directories and junctions (like the SnapshotWalker,
+                                   they are compared as entries but not descended by default: junctions like
+                                   'Application Data' loop)
+            throttle: (VolumeThrottle or IOScheduler) rate limits the reads of both snapshots: every directory listing
+                      is a read operation, plus the hashed files (an IOScheduler is resolved with the volume_name of
+                      the new snapshot, both are snapshots of the same volume)
+            debug: (bool) enables enhanced output
+        '''
+        self.old_root = snapshot_root(old)
+        self.new_root = snapshot_root(new)
+        if workers < 1:
+            raise Exception(f'SnapshotDiff needs at least 1 worker: {workers}')
+        self.workers = workers
+        self.exclude = compile_globs(exclude)
+        self.expand = expand
+        self.report_touched = report_touched
+        self.trust_dir_mtime = trust_dir_mtime
+        self.max_batches = max_batches
+        self.onerror = onerror
+        self.follow_reparse_points = follow_reparse_points
+        self.throttle = resolve_throttle(throttle, new)
+        self.debug = debug
+
+        # counters for the last diff
+        self.dirs = 0
+        self.pruned = 0
+        self.hashed = 0
+
+        self._lock = None
+        self._pool = None
+
+    def __iter__(self):
+        '''
+            Generator returning DiffEntry objects (in no particular order), closing it early stops the workers
+        '''
+        self.dirs = 0
+        self.pruned = 0
+        self.hashed = 0
+        self._lock = threading.Lock()
+        # a task lists the same directory in both snapshots
+        self._pool = DirectoryPool(self._compare, [('', _BOTH)], self.workers, self.max_batches, 'alphavss-diff',
+                                   setup=lambda: bytearray(HASH_BUFFER_SIZE))
+        for changes in self._pool.results():
+            yield from changes
+
+        if self.debug:
+            print(f'diffed {self.old_root} -> {self.new_root}: {self.dirs} dir(s), {self.pruned} pruned, {self.hashed} hashed')
+
+    def summary(self):
+        '''
+            Run the whole diff, returns {kind: count}
+        '''
+        counts = {ADDED: 0, REMOVED: 0, MODIFIED: 0, TOUCHED: 0}
+        for change in self:
+            counts[change.kind] += 1
+
+        return counts
+
+    def _list(self, root, rel_path):
+        '''
+            {name: WalkEntry} of a directory in one of the snapshots, and the names of its directories not to descend
+            into (reparse points)
+        '''
+        entries = {}
+        reparse_points = set()
+        path = os.path.join(root, rel_path) if rel_path else root
+        if self.throttle is not None:
+            self.throttle.acquire()
+        try:
+            with os.scandir(path) as it:
+                for dir_entry in it:
+                    entry_rel_path = os.path.join(rel_path, dir_entry.name) if rel_path else dir_entry.name
+                    if self.exclude and match_globs(self.exclude, dir_entry.name, entry_rel_path):
+                        continue
+                    is_symlink = dir_entry.is_symlink()
+                    is_dir = dir_entry.is_dir(follow_symlinks=self.follow_reparse_points)
+                    if is_dir and not self.follow_reparse_points and is_reparse_point(dir_entry):
+                        reparse_points.add(dir_entry.name)
+                    entries[dir_entry.name] = WalkEntry(dir_entry.name, dir_entry.path, entry_rel_path, is_dir,
+                                                        is_symlink, dir_entry.stat(follow_symlinks=False))
+        except OSError as e:
+            self._error(e)
+
+        return entries, reparse_points
+
+    def _error(self, exception):
+        if self.onerror is not None:
+            self.onerror(exception)
+        elif self.debug:
+            print(f'snapshot diff: {exception}')
+
+    def _compare(self, item, buf):
+        '''
+            Compare one directory ((rel_path, side)), returns the subdirectories still to compare
+        '''
+        rel_path, side = item
+        with self._lock:
+            self.dirs += 1
+        old, old_reparse = self._list(self.old_root, rel_path) if side != _ONLY_NEW else ({}, set())
+        new, new_reparse = self._list(self.new_root, rel_path) if side != _ONLY_OLD else ({}, set())
+        changes = []
+        subdirs = []
+        for name, old_entry in old.items():
+            new_entry = new.get(name)
+            if new_entry is None or new_entry.is_dir() != old_entry.is_dir():
+                changes.append(DiffEntry(REMOVED, old_entry.rel_path, old_entry.is_dir(), old_entry, None))
+                if old_entry.is_dir() and self.expand and name not in old_reparse:
+                    subdirs.append((old_entry.rel_path, _ONLY_OLD))
+                continue
+            if old_entry.is_dir():
+                if name not in old_reparse and name not in new_reparse and not self._prune(old_entry, new_entry):
+                    subdirs.append((old_entry.rel_path, _BOTH))
+                continue
+            kind = self._compare_file(old_entry, new_entry, buf)
+            if kind is not None:
+                changes.append(DiffEntry(kind, old_entry.rel_path, False, old_entry, new_entry))
+
+        for name, new_entry in new.items():
+            old_entry = old.get(name)
+            if old_entry is None or new_entry.is_dir() != old_entry.is_dir():
+                changes.append(DiffEntry(ADDED, new_entry.rel_path, new_entry.is_dir(), None, new_entry))
+                if new_entry.is_dir() and self.expand and name not in new_reparse:
+                    subdirs.append((new_entry.rel_path, _ONLY_NEW))
+
+        if changes and not self._pool.put(changes):
+            return None
+
+        return subdirs
+
+    def _prune(self, old_entry, new_entry):
+        if not self.trust_dir_mtime:
+            return False
+        if old_entry.stat().st_mtime_ns != new_entry.stat().st_mtime_ns:
+            return False
+        with self._lock:
+            self.pruned += 1
+
+        return True
+
+    def _compare_file(self, old_entry, new_entry, buf):
+        '''
+            None (identical), MODIFIED or TOUCHED
+        '''
+        old_stat = old_entry.stat()
+        new_stat = new_entry.stat()
+        if old_stat.st_size != new_stat.st_size:
+            return MODIFIED
+        if old_stat.st_mtime_ns == new_stat.st_mtime_ns:
+            return None
+        if old_entry.is_symlink() or new_entry.is_symlink():
+            return MODIFIED
+
+        # same size, different mtime: the content decides
+        try:
+            same = (_hash(old_entry.path, buf, self.throttle, old_stat.st_size)
+                    == _hash(new_entry.path, buf, self.throttle, new_stat.st_size))
+        except OSError as e:
+            self._error(e)
+            return MODIFIED
+        with self._lock:
+            self.hashed += 1
+        if not same:
+            return MODIFIED
+
+        return TOUCHED if self.report_touched else None
+
+
+def diff_snapshots(old:object, new:object, **kwargs):
+    '''
+        Shortcut for iterating over SnapshotDiff(old, new, **kwargs)
+    '''
+    return iter(SnapshotDiff(old, new, **kwargs))
@@ -0,0 +1,346 @@
+'''
+    I/O rate limiting for reads out of a VSSSnapshot
+
+    Reads from a snapshot hit the same spindles as the live volume (and the copy-on-write diff area), so a full speed
+    backup copy shows up as latency spikes for everything else on those disks (SQL Server for one).
+
+    IOScheduler hands out a VolumeThrottle per volume (keyed by the volume_name of each VSSSnapshot) which:
+        * caps bytes/s and IOPS with token buckets
+        * can use different limits at different times of day (schedule)
+        * backs off when the measured read latency goes above a target, and speeds back up when it recovers
+
+    Every read/copy path in this package (SnapshotWalker, SnapshotCopier...) takes a throttle= argument
+
+    Config (a dict, or a JSON file for load_throttle_config()):
+        {
+            "default": {"bytes_per_sec": "200MB", "iops": 5000},
+            "volumes": {
+                "C:": {
+                    "bytes_per_sec": "50MB",
+                    "iops": 1000,
+                    "latency_target_ms": 20,
+                    "schedule": [
+                        {"start": "08:00", "end": "18:00", "days": ["mon", "tue", "wed", "thu", "fri"], "bytes_per_sec": "10MB"},
+                        {"start": "22:00", "end": "06:00", "bytes_per_sec": null}
+                    ]
+                }
+            }
+        }
+        * sizes are bytes (int) or strings like '512KB', '50MB', '1.5GB' (/s is optional), null = unlimited
+        * the first matching schedule entry overrides the volume limits it mentions
+'''
+import re
+import json
+import time
+import datetime
+import threading
+from contextlib import contextmanager
+
+_SIZE_UNITS = {'': 1, 'B': 1, 'K': 1024, 'KB': 1024, 'M': 1024 ** 2, 'MB': 1024 ** 2,
+               'G': 1024 ** 3, 'GB': 1024 ** 3, 'T': 1024 ** 4, 'TB': 1024 ** 4}
+_DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+# how often the schedule and the latency based adjustments are re-evaluated (seconds)
+ADJUST_INTERVAL = 1.0
+
+
+def parse_size(value):
+    '''
+        Turn 1048576, '1048576', '1MB', '1 MB/s' or '1.5G' into a number of bytes (None/0 stays None = unlimited)
+    '''
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value) or None
+
+    match = re.fullmatch(r'\s*([0-9.]+)\s*([a-zA-Z]*?)\s*(/s)?\s*', str(value))
+    if not match or match.group(2).upper() not in _SIZE_UNITS:
+        raise Exception(f'Unable to parse the size: {value!r} (ex. 1048576, 512KB, 50MB, 1.5GB)')
+
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()]) or None
+
+
+def normalize_volume_name(volume_name:str):
+    '''
+        'c:\\', 'C:' and 'c' all become 'C:' (volume GUID paths just lose their trailing backslash)
+    '''
+    name = (volume_name or '').rstrip('\\/')
+    if len(name) <= 2 and name[:1].isalpha():
+        return f'{name[:1].upper()}:'
+
+    return name
+
+
+class TokenBucket(object):
+    '''
+        Thread safe token bucket, rate is tokens per second (None = unlimited)
+
+        consume() never refuses a request, it takes the tokens (going into debt if it has to) and sleeps until
+        the debt would have been paid off, so large requests are allowed but paid for
+    '''
+    def __init__(self, rate:float=None, burst:float=None):
+        self._lock = threading.Lock()
+        self.rate = None
+        self.burst = None
+        self.tokens = 0.0
+        self.last = time.monotonic()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate:float=None, burst:float=None):
+        with self._lock:
+            self.rate = rate or None
+            # default burst is one second worth of tokens
+            self.burst = burst or self.rate
+            if self.rate:
+                self.tokens = min(self.tokens, self.burst)
+
+    def reserve(self, amount:float):
+        '''
+            Take amount tokens, returns how long the caller has to wait (seconds) before using them
+        '''
+        with self._lock:
+            if not self.rate:
+                return 0.0
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def consume(self, amount:float):
+        '''
+            Take amount tokens, sleeping as long as needed, returns the time waited
+        '''
+        wait = self.reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
+
+        return wait
+
+
+class ScheduleWindow(object):
+    '''
+        Time of day window overriding the limits of a VolumeThrottle
+
+        start/end: (str) 'HH:MM' local time (end before start wraps around midnight)
+        days: (list) ['mon', 'tue', ...] the window starts on (default every day)
+        limits: (dict) bytes_per_sec/iops to use inside the window
+    '''
+    def __init__(self, start:str, end:str, days:list=None, limits:dict=None):
+        self.start = self._parse_time(start)
+        self.end = self._parse_time(end)
+        self.days = None
+        if days:
+            self.days = set()
+            for day in days:
+                if day.lower()[:3] not in _DAYS:
+                    raise Exception(f'Unknown day in throttle schedule: {day}')
+                self.days.add(_DAYS.index(day.lower()[:3]))
+        self.limits = limits or {}
+
+    @staticmethod
+    def _parse_time(value):
+        try:
+            return datetime.datetime.strptime(value, '%H:%M').time()
+        except (TypeError, ValueError) as e:
+            raise Exception(f'Throttle schedule times look like HH:MM: {value!r}') from e
+
+    def matches(self, now:datetime.datetime):
+        current = now.time()
+        weekday = now.weekday()
+        if self.start <= self.end:
+            inside = self.start <= current < self.end
+        else:
+            # wraps around midnight, after midnight belongs to the window that started the day before
+            inside = current >= self.start or current < self.end
+            if inside and current < self.end:
+                weekday = (weekday - 1) % 7
+
+        return inside and (self.days is None or weekday in self.days)
+
+
+class VolumeThrottle(object):
+    '''
+        Bytes/s and IOPS limits for the reads of a single volume
+    '''
+    def __init__(self, volume_name:str='', bytes_per_sec:object=None, iops:int=None, schedule:list=None,
+                 latency_target_ms:float=None, min_factor:float=0.1, clock:object=None, debug:bool=False):
+        '''
+            volume_name: (str) the volume this throttle is for (informational)
+            bytes_per_sec: (int or str) read bandwidth cap (see parse_size), None = unlimited
+            iops: (int) read operations per second cap, None = unlimited
+            schedule: (list) ScheduleWindow objects or dicts like {'start': '08:00', 'end': '18:00', 'bytes_per_sec': '10MB'}
+            latency_target_ms: (float) back off (multiply the limits by a factor down to min_factor) while the
+                               average read latency is above this, None disables the adaptation
+            min_factor: (float) lowest fraction of the configured limits the adaptation goes down to
+            clock: (callable) returns the current datetime.datetime (for testing schedules)
+            debug: (bool) enables enhanced output
+        '''
+        self.volume_name = volume_name
+        self.bytes_per_sec = parse_size(bytes_per_sec)
+        self.iops = int(iops) if iops else None
+        self.schedule = []
+        for window in schedule or []:
+            if isinstance(window, dict):
+                limits = {key: window[key] for key in ('bytes_per_sec', 'iops') if key in window}
+                window = ScheduleWindow(window.get('start'), window.get('end'), days=window.get('days'), limits=limits)
+            self.schedule.append(window)
+        self.latency_target = latency_target_ms / 1000.0 if latency_target_ms else None
+        self.min_factor = min_factor
+        self.clock = clock or datetime.datetime.now
+        self.debug = debug
+
+        self.factor = 1.0
+        self.latency = None # moving average of the read latency (seconds)
+        self.waited = 0.0 # total time spent sleeping in acquire()
+        self._byte_bucket = TokenBucket()
+        self._op_bucket = TokenBucket()
+        self._lock = threading.Lock()
+        self._next_adjust = 0.0
+        self._adjust(force=True)
+
+    def current_limits(self):
+        '''
+            (bytes_per_sec, iops) configured for right now (schedule applied, before the latency factor)
+        '''
+        bytes_per_sec = self.bytes_per_sec
+        iops = self.iops
+        if self.schedule:
+            now = self.clock()
+            for window in self.schedule:
+                if window.matches(now):
+                    if 'bytes_per_sec' in window.limits:
+                        bytes_per_sec = parse_size(window.limits['bytes_per_sec'])
+                    if 'iops' in window.limits:
+                        iops = int(window.limits['iops']) if window.limits['iops'] else None
+                    break
+
+        return bytes_per_sec, iops
+
+    def _adjust(self, force:bool=False):
+        now = time.monotonic()
+        with self._lock:
+            if not force and now < self._next_adjust:
+                return
+            self._next_adjust = now + ADJUST_INTERVAL
+            if self.latency_target and self.latency is not None:
+                if self.latency > self.latency_target:
+                    # back off fast, recover slowly (AIMD)
+                    self.factor = max(self.min_factor, self.factor * 0.7)
+                else:
+                    self.factor = min(1.0, self.factor + 0.05)
+            factor = self.factor
+
+        bytes_per_sec, iops = self.current_limits()
+        self._byte_bucket.set_rate(bytes_per_sec * factor if bytes_per_sec else None)
+        self._op_bucket.set_rate(iops * factor if iops else None)
+
+    @property
+    def unlimited(self):
+        return not self._byte_bucket.rate and not self._op_bucket.rate and not self.latency_target
+
+    def acquire(self, nbytes:int=0, ops:int=1):
+        '''
+            Wait until nbytes (and ops read operations) can be read without going over the limits
+        '''
+        self._adjust()
+        wait = max(self._op_bucket.reserve(ops), self._byte_bucket.reserve(nbytes) if nbytes else 0.0)
+        if wait > 0:
+            time.sleep(wait)
+            with self._lock:
+                self.waited += wait
+
+        return wait
+
+    def record_latency(self, seconds:float):
+        '''
+            Feed a measured read latency into the adaptation (exponential moving average)
+        '''
+        if not self.latency_target:
+            return
+        with self._lock:
+            if self.latency is None:
+                self.latency = seconds
+            else:
+                self.latency = self.latency * 0.9 + seconds * 0.1
+
+    @contextmanager
+    def read(self, nbytes:int=0):
+        '''
+            with throttle.read(len(buf)):
+                f.readinto(buf)
+
+            acquires the tokens before the read and measures its latency
+        '''
+        self.acquire(nbytes)
+        start = time.monotonic()
+        yield
+        self.record_latency(time.monotonic() - start)
+
+    def __repr__(self):
+        return (f'<VolumeThrottle {self.volume_name!r} bytes_per_sec={self._byte_bucket.rate} '
+                f'iops={self._op_bucket.rate} factor={self.factor:.2f}>')
+
+
+class IOScheduler(object):
+    '''
+        Hands out one VolumeThrottle per volume from a config dict (see the module docstring)
+    '''
+    def __init__(self, config:dict=None, clock:object=None, debug:bool=False):
+        self.config = config or {}
+        self.clock = clock
+        self.debug = debug
+        self._throttles = {}
+        self._lock = threading.Lock()
+        self._volume_config = {}
+        for volume_name, volume_config in (self.config.get('volumes') or {}).items():
+            self._volume_config[normalize_volume_name(volume_name)] = volume_config
+
+    def for_volume(self, volume_name:str):
+        '''
+            The VolumeThrottle for a volume ('C:\\', 'C:', '\\\\?\\Volume{...}\\'), volumes that aren't configured
+            get their own throttle with the default limits
+        '''
+        key = normalize_volume_name(volume_name)
+        with self._lock:
+            throttle = self._throttles.get(key)
+            if throttle is None:
+                settings = dict(self.config.get('default') or {})
+                settings.update(self._volume_config.get(key) or {})
+                try:
+                    throttle = VolumeThrottle(volume_name=key, clock=self.clock, debug=self.debug, **settings)
+                except TypeError as e:
+                    raise Exception(f'Invalid throttle config for volume {key}: {settings}') from e
+                if self.debug:
+                    print(f'throttle for {key}: {throttle}')
+                self._throttles[key] = throttle
+
+        return throttle
+
+    def for_snapshot(self, snapshot:object):
+        '''
+            The VolumeThrottle for the volume a VSSSnapshot was taken of (plain paths get the default throttle)
+        '''
+        return self.for_volume(getattr(snapshot, 'volume_name', '') or '')
+
+
+def load_throttle_config(path:str, clock:object=None, debug:bool=False):
+    '''
+        Build an IOScheduler from a JSON config file
+    '''
+    with open(path, 'r', encoding='utf-8') as config_file:
+        config = json.load(config_file)
+
+    return IOScheduler(config, clock=clock, debug=debug)
+
+
+def resolve_throttle(throttle:object, snapshot:object):
+    '''
+        Accept either a VolumeThrottle or an IOScheduler (resolved with the snapshot's volume) or None
+    '''
+    if throttle is not None and hasattr(throttle, 'for_snapshot'):
+        return throttle.for_snapshot(snapshot)
+
+    return throttle
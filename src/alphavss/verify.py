@@ -0,0 +1,334 @@
+'''
+    Parallel integrity verification of a copy of a snapshot (and checksum manifests of snapshot contents)
+
+    SnapshotVerifier hashes every file of a snapshot and its copy in a target directory with a process pool (the
+    snapshot side and the target side of a file are separate tasks, so both disks are read at the same time), large
+    files are hashed through mmap (no copies through python buffers).
+
+    The result is a checksum manifest in the format of sha256sum (and friends):
+        <hex digest> *<path relative to the snapshot root, '/' separators>
+    it can be checked later with verify_manifest() or sha256sum -c.  The manifest is appended to as files are verified
+    and flushed at least every FLUSH_INTERVAL seconds, running the same verification again resumes where it was
+    interrupted (at most the files of the last FLUSH_INTERVAL are hashed again).  Files that don't match are listed in
+    <manifest>.mismatch, they are not verified again on resume either:
+        MISMATCH <snapshot digest> <copy digest> *<path>
+        MISSING (<why the copy can't be read>) *<path>
+        ERROR (<why the snapshot file can't be read>) *<path>
+
+    throttle= limits the reads of the snapshot (the hashing processes read it, the files are paced as they are handed
+    to them)
+
+    Usage:
+        from alphavss.verify import SnapshotVerifier
+
+        if __name__ == '__main__':  # the process pool needs this on Windows
+            stats = SnapshotVerifier(snap, 'E:\\backups\\C', 'E:\\backups\\C.sha256').run()
+            print(stats)
+'''
+import os
+import mmap
+import time
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from alphavss.walker import SnapshotWalker, snapshot_root
+from alphavss.archive import archive_path
+from alphavss.throttle import resolve_throttle
+
+DEFAULT_MMAP_THRESHOLD = 8 * 1024 * 1024
+HASH_BUFFER_SIZE = 1024 * 1024
+FLUSH_INTERVAL = 1.0 # seconds
+
+
+def hash_path(path:str, hash_name:str='sha256', mmap_threshold:int=DEFAULT_MMAP_THRESHOLD):
+    '''
+        (hex digest, size) of a file, (None, error message) when it can't be read
+
+        Runs in the process pool, so it has to stay a module level function (picklable)
+    '''
+    digest = hashlib.new(hash_name)
+    try:
+        with open(path, 'rb', buffering=0) as src:
+            size = os.fstat(src.fileno()).st_size
+            if size >= mmap_threshold:
+                with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    digest.update(mapped)
+            else:
+                buf = bytearray(min(HASH_BUFFER_SIZE, max(size, 1)))
+                view = memoryview(buf)
+                size = 0
+                while True:
+                    read = src.readinto(view)
+                    if not read:
+                        break
+                    digest.update(view[:read])
+                    size += read
+    except (OSError, ValueError) as e:
+        return None, str(e)
+
+    return digest.hexdigest(), size
+
+
+def read_manifest_paths(manifest_path:str):
+    '''
+        Set of the paths already in a checksum manifest (what a resumed verification skips)
+    '''
+    done = set()
+    if not os.path.exists(manifest_path):
+        return done
+    with open(manifest_path, 'r', encoding='utf-8', newline='\n') as manifest:
+        for line in manifest:
+            if not line.endswith('\n'):
+                # the last line of an interrupted run, verify that file again
+                break
+            _, _, path = line.rstrip('\n').partition(' *')
+            if path:
+                done.add(path)
+
+    return done
+
+
+def read_mismatch_paths(mismatch_path:str):
+    '''
+        {path: 'MISMATCH', 'MISSING' or 'ERROR'} of the files already in a .mismatch list
+    '''
+    found = {}
+    if not os.path.exists(mismatch_path):
+        return found
+    with open(mismatch_path, 'r', encoding='utf-8', newline='\n') as mismatches:
+        for line in mismatches:
+            if not line.endswith('\n'):
+                break
+            head, _, path = line.rstrip('\n').partition(' *')
+            if path:
+                found[path] = head.partition(' ')[0]
+
+    return found
+
+
+def _detail(text):
+    # the path of a .mismatch line starts after the first ' *'
+    return str(text).replace('*', '').replace('\n', ' ')
+
+
+def truncate_partial_line(manifest_path:str):
+    '''
+        Drop an incomplete last line (left by an interrupted run) so appending starts on a fresh line
+    '''
+    if not os.path.exists(manifest_path):
+        return
+    with open(manifest_path, 'rb+') as manifest:
+        data_end = manifest.seek(0, os.SEEK_END)
+        position = data_end
+        while position > 0:
+            step = min(4096, position)
+            manifest.seek(position - step)
+            block = manifest.read(step)
+            newline = block.rfind(b'\n')
+            if newline != -1:
+                position = position - step + newline + 1
+                break
+            position -= step
+        if position != data_end:
+            manifest.truncate(position)
+
+
+class VerifyStats(object):
+    def __init__(self, sides:int=2):
+        self.sides = sides # trees read (snapshot and target, or just one)
+        self.files = 0
+        self.bytes = 0
+        self.ok = 0
+        self.mismatched = 0
+        self.missing = 0
+        self.errors = 0
+        self.resumed = 0
+        self.start = time.monotonic()
+        self.end = None
+
+    @property
+    def elapsed(self):
+        return (self.end or time.monotonic()) - self.start
+
+    @property
+    def mb_per_sec(self):
+        return self.sides * self.bytes / (1024 * 1024) / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def verified(self):
+        return not (self.mismatched or self.missing or self.errors)
+
+    def as_dict(self):
+        return {'files': self.files, 'bytes': self.bytes, 'ok': self.ok, 'mismatched': self.mismatched,
+                'missing': self.missing, 'errors': self.errors, 'resumed': self.resumed,
+                'elapsed': round(self.elapsed, 3), 'mb_per_sec': round(self.mb_per_sec, 1)}
+
+    def __str__(self):
+        return (f'{self.files} file(s) ({self.resumed} already verified), {self.ok} ok, {self.mismatched} mismatched, '
+                f'{self.missing} missing, {self.errors} error(s), {self.bytes / (1024 * 1024):.1f} MB in '
+                f'{self.elapsed:.2f}s ({self.mb_per_sec:.1f} MB/s read)')
+
+
+class SnapshotVerifier(object):
+    '''
+        Hash a snapshot and its copy side by side, writing a (resumable) checksum manifest
+    '''
+    def __init__(self, snapshot:object, target:str, manifest_path:str, hash_name:str='sha256', workers:int=None,
+                 mmap_threshold:int=DEFAULT_MMAP_THRESHOLD, walker_options:dict=None, throttle:object=None,
+                 debug:bool=False):
+        '''
+            snapshot: (str or VSSSnapshot) the source of the copy (see walker.snapshot_root())
+            target: (str) directory the snapshot was copied to (None only writes the manifest of the snapshot)
+            manifest_path: (str) checksum manifest to write (and resume from)
+            hash_name: (str) hashlib algorithm
+            workers: (int) hashing processes (default: os.cpu_count())
+            mmap_threshold: (int) files this big (or bigger) are hashed through mmap
+            walker_options: (dict) keyword arguments for the SnapshotWalker (include, exclude...)
+            throttle: (VolumeThrottle or IOScheduler) rate limits the reads of the snapshot (an IOScheduler is resolved
+                      with the snapshot's volume_name), shared with the walker unless walker_options has its own
+            debug: (bool) enables enhanced output
+        '''
+        self.root = snapshot_root(snapshot)
+        self.target = target
+        self.manifest_path = manifest_path
+        self.hash_name = hash_name
+        hashlib.new(hash_name) # fail early on an unknown algorithm
+        self.workers = workers or os.cpu_count() or 1
+        self.mmap_threshold = mmap_threshold
+        self.walker_options = walker_options or {}
+        self.throttle = resolve_throttle(throttle, snapshot)
+        self.debug = debug
+        self.stats = None
+
+    def run(self):
+        '''
+            Verify everything not already in the manifest, returns VerifyStats
+        '''
+        self.stats = VerifyStats(sides=1 if self.target is None else 2)
+        mismatch_path = f'{self.manifest_path}.mismatch'
+        truncate_partial_line(self.manifest_path)
+        truncate_partial_line(mismatch_path)
+        done = read_manifest_paths(self.manifest_path)
+        failed = read_mismatch_paths(mismatch_path)
+        walker_options = dict(self.walker_options)
+        walker_options['yield_dirs'] = False
+        walker_options.setdefault('throttle', self.throttle)
+
+        in_flight = {}
+        max_in_flight = self.workers * 8
+        flushed = time.monotonic()
+        with ProcessPoolExecutor(max_workers=self.workers) as pool, \
+             open(self.manifest_path, 'a', encoding='utf-8', newline='\n') as manifest, \
+             open(mismatch_path, 'a', encoding='utf-8', newline='\n') as mismatches:
+            for entry in SnapshotWalker(self.root, debug=self.debug, **walker_options):
+                if not entry.is_file():
+                    continue
+                path = archive_path(entry.rel_path)
+                if path in done or path in failed:
+                    # verified by an earlier run, the files that failed count again (they are not fixed by resuming)
+                    self.stats.resumed += 1
+                    self._count_failed(failed.get(path))
+                    continue
+                if self.throttle is not None:
+                    self.throttle.acquire(entry.size)
+                source = pool.submit(hash_path, entry.path, self.hash_name, self.mmap_threshold)
+                copy = None
+                if self.target is not None:
+                    copy = pool.submit(hash_path, os.path.join(self.target, entry.rel_path), self.hash_name, self.mmap_threshold)
+                in_flight[source] = (path, copy)
+                while len(in_flight) >= max_in_flight:
+                    self._collect(in_flight, manifest, mismatches)
+                    if time.monotonic() - flushed >= FLUSH_INTERVAL:
+                        # what an interrupted run keeps
+                        manifest.flush()
+                        mismatches.flush()
+                        flushed = time.monotonic()
+            while in_flight:
+                self._collect(in_flight, manifest, mismatches)
+
+        self.stats.end = time.monotonic()
+        if self.debug:
+            print(f'verified {self.root} against {self.target}: {self.stats}')
+
+        return self.stats
+
+    def _count_failed(self, kind):
+        if kind == 'MISMATCH':
+            self.stats.mismatched += 1
+        elif kind == 'MISSING':
+            self.stats.missing += 1
+        elif kind is not None:
+            self.stats.errors += 1
+
+    def _collect(self, in_flight, manifest, mismatches):
+        '''
+            Record the files whose snapshot side finished hashing
+        '''
+        finished, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+        for source in finished:
+            path, copy = in_flight.pop(source)
+            digest, size = source.result()
+            self.stats.files += 1
+            if digest is None:
+                self.stats.errors += 1
+                mismatches.write(f'ERROR ({_detail(size)}) *{path}\n')
+                continue
+            self.stats.bytes += size
+            if copy is not None:
+                copy_digest, copy_detail = copy.result()
+                if copy_digest is None:
+                    self.stats.missing += 1
+                    mismatches.write(f'MISSING ({_detail(copy_detail)}) *{path}\n')
+                    continue
+                if copy_digest != digest:
+                    self.stats.mismatched += 1
+                    mismatches.write(f'MISMATCH {digest} {copy_digest} *{path}\n')
+                    continue
+            self.stats.ok += 1
+            manifest.write(f'{digest} *{path}\n')
+
+
+def verify_manifest(manifest_path:str, root:str, hash_name:str='sha256', workers:int=None,
+                    mmap_threshold:int=DEFAULT_MMAP_THRESHOLD):
+    '''
+        Check a directory tree (a restore, a copy, an exposed snapshot) against a checksum manifest
+
+        Returns (VerifyStats, [paths that failed])
+    '''
+    stats = VerifyStats(sides=1)
+    failed = []
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool, \
+         open(manifest_path, 'r', encoding='utf-8', newline='\n') as manifest:
+        in_flight = {}
+
+        def collect():
+            finished, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+            for future in finished:
+                path, expected = in_flight.pop(future)
+                digest, size = future.result()
+                stats.files += 1
+                if digest is None:
+                    stats.missing += 1
+                    failed.append(path)
+                elif digest != expected:
+                    stats.bytes += size
+                    stats.mismatched += 1
+                    failed.append(path)
+                else:
+                    stats.bytes += size
+                    stats.ok += 1
+
+        for line in manifest:
+            expected, _, path = line.rstrip('\n').partition(' *')
+            if not path:
+                continue
+            future = pool.submit(hash_path, os.path.join(root, path.replace('/', os.sep)), hash_name, mmap_threshold)
+            in_flight[future] = (path, expected)
+            if len(in_flight) >= workers * 8:
+                collect()
+        while in_flight:
+            collect()
+
+    stats.end = time.monotonic()
+
+    return stats, failed
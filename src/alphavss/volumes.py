@@ -0,0 +1,268 @@
+'''
+    Native volume enumeration (Win32 volume APIs through ctypes), the fast alternative to the WMI get_drives()
+
+    get_drives() connects to WMI and queries Win32_Volume: a few hundred milliseconds per call, and only the drive
+    letters of fixed disks are mapped (a volume mounted on a folder has no letter and its snapshots can't be matched
+    to a volume name).  NativeVolumeResolver asks the volume manager directly:
+
+        FindFirstVolumeW / FindNextVolumeW          every volume GUID path (\\\\?\\Volume{...}\\)
+        GetVolumePathNamesForVolumeNameW            every mount path of a volume (C:\\, D:\\Mounts\\Data\\ ...)
+        GetDriveTypeW / GetVolumeInformationW       drive type (3 = fixed) and file system
+
+    The ctypes calls live in Win32VolumeAPI and return raw values (the mount paths come back as the REG_MULTI_SZ
+    style buffer the API fills), everything else is plain Python: give the resolver any object with the same four
+    methods to run it without Windows (StaticVolumeAPI answers from a mapping).
+
+    The resolver is selected in models.get_drives(resolver='native') (or models.VOLUME_RESOLVER = 'native' for every
+    call), the WMI code stays the default.
+
+    Usage:
+        from alphavss.volumes import NativeVolumeResolver
+
+        resolver = NativeVolumeResolver()
+        print(resolver.get_drives())        # {'C:': '\\\\?\\Volume{...}\\', 'D:\\Mounts\\Data': '\\\\?\\Volume{...}\\'}
+        for volume in resolver.volumes():
+            print(volume.guid_path, volume.mount_paths, volume.filesystem)
+'''
+import sys
+from collections import namedtuple
+
+DRIVE_FIXED = 3
+ERROR_NO_MORE_FILES = 18
+ERROR_MORE_DATA = 234
+MAX_PATH = 260
+
+VolumeInfo = namedtuple('VolumeInfo', ['guid_path', 'mount_paths', 'drive_type', 'filesystem'])
+
+
+def parse_multi_sz(raw:str):
+    '''
+        Mount paths in the buffer filled by GetVolumePathNamesForVolumeNameW: strings ended by a NUL, the list ended by
+        an empty string
+    '''
+    paths = []
+    for path in raw.split('\0'):
+        if not path:
+            break
+        paths.append(path)
+
+    return paths
+
+
+def mount_key(mount_path:str):
+    '''
+        Key of a mount path in a get_drives() mapping: 'C:\\' -> 'C:', 'd:\\Mounts\\Data\\' -> 'D:\\Mounts\\Data'
+    '''
+    path = mount_path.rstrip('\\')
+
+    return path[:1].upper() + path[1:]
+
+
+class Win32VolumeAPI(object):
+    '''
+        The Win32 volume functions (kernel32 through ctypes), raw values only
+    '''
+    def __init__(self):
+        import ctypes
+        from ctypes import wintypes
+
+        self.ctypes = ctypes
+        kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        self._find_first = kernel32.FindFirstVolumeW
+        self._find_first.argtypes = [wintypes.LPWSTR, wintypes.DWORD]
+        self._find_first.restype = wintypes.HANDLE
+        self._find_next = kernel32.FindNextVolumeW
+        self._find_next.argtypes = [wintypes.HANDLE, wintypes.LPWSTR, wintypes.DWORD]
+        self._find_next.restype = wintypes.BOOL
+        self._find_close = kernel32.FindVolumeClose
+        self._find_close.argtypes = [wintypes.HANDLE]
+        self._find_close.restype = wintypes.BOOL
+        self._path_names = kernel32.GetVolumePathNamesForVolumeNameW
+        self._path_names.argtypes = [wintypes.LPCWSTR, wintypes.LPWSTR, wintypes.DWORD, wintypes.LPDWORD]
+        self._path_names.restype = wintypes.BOOL
+        self._drive_type = kernel32.GetDriveTypeW
+        self._drive_type.argtypes = [wintypes.LPCWSTR]
+        self._drive_type.restype = wintypes.UINT
+        self._volume_information = kernel32.GetVolumeInformationW
+        self._volume_information.argtypes = [wintypes.LPCWSTR, wintypes.LPWSTR, wintypes.DWORD, wintypes.LPDWORD,
+                                             wintypes.LPDWORD, wintypes.LPDWORD, wintypes.LPWSTR, wintypes.DWORD]
+        self._volume_information.restype = wintypes.BOOL
+        self._invalid_handle = ctypes.c_void_p(-1).value
+
+    def _error(self, function):
+        error = self.ctypes.get_last_error()
+
+        return OSError(error, f'{function} failed: {self.ctypes.FormatError(error).strip()}')
+
+    def volume_guid_paths(self):
+        '''
+            Generator returning every volume GUID path (\\\\?\\Volume{...}\\)
+        '''
+        buf = self.ctypes.create_unicode_buffer(MAX_PATH)
+        handle = self._find_first(buf, MAX_PATH)
+        if handle == self._invalid_handle:
+            raise self._error('FindFirstVolumeW')
+        try:
+            while True:
+                yield buf.value
+                if not self._find_next(handle, buf, MAX_PATH):
+                    if self.ctypes.get_last_error() == ERROR_NO_MORE_FILES:
+                        break
+                    raise self._error('FindNextVolumeW')
+        finally:
+            self._find_close(handle)
+
+    def volume_path_names(self, guid_path:str):
+        '''
+            Raw mount path buffer of a volume (see parse_multi_sz)
+        '''
+        size = MAX_PATH
+        while True:
+            buf = self.ctypes.create_unicode_buffer(size)
+            needed = self.ctypes.c_ulong(0)
+            if self._path_names(guid_path, buf, size, self.ctypes.byref(needed)):
+                return buf[:needed.value]
+            if self.ctypes.get_last_error() != ERROR_MORE_DATA:
+                raise self._error('GetVolumePathNamesForVolumeNameW')
+            size = max(needed.value, size * 2)
+
+    def drive_type(self, guid_path:str):
+        return self._drive_type(guid_path)
+
+    def filesystem(self, guid_path:str):
+        '''
+            File system name (NTFS, ReFS...), None for a volume that isn't ready (empty card reader, ...)
+        '''
+        name = self.ctypes.create_unicode_buffer(MAX_PATH + 1)
+        if not self._volume_information(guid_path, None, 0, None, None, None, name, MAX_PATH + 1):
+            return None
+
+        return name.value
+
+
+class StaticVolumeAPI(object):
+    '''
+        Win32VolumeAPI stand-in answering from a mapping (tests, benchmarks, other platforms):
+            StaticVolumeAPI({'\\\\?\\Volume{...}\\': (['C:\\', 'D:\\Mounts\\Data\\'], DRIVE_FIXED, 'NTFS')})
+    '''
+    def __init__(self, volumes:dict):
+        self.volumes = dict(volumes)
+
+    def volume_guid_paths(self):
+        return iter(self.volumes)
+
+    def volume_path_names(self, guid_path:str):
+        # the buffer GetVolumePathNamesForVolumeNameW fills: NUL ended strings, ended by an empty one
+        return ''.join(f'{path}\0' for path in self.volumes[guid_path][0]) + '\0'
+
+    def drive_type(self, guid_path:str):
+        return self.volumes[guid_path][1]
+
+    def filesystem(self, guid_path:str):
+        return self.volumes[guid_path][2]
+
+
+class NativeVolumeResolver(object):
+    '''
+        Volumes and their mount paths from the Win32 volume APIs (see the module docstring)
+    '''
+    def __init__(self, api:object=None, drive_types:tuple=(DRIVE_FIXED,), debug:bool=False):
+        '''
+            api: (object) Win32VolumeAPI (default) or any object with the same methods
+            drive_types: (tuple) drive types to report (default: fixed disks, like the WMI get_drives()), None for all
+            debug: (bool) enables enhanced output
+        '''
+        if api is None:
+            if sys.platform != 'win32':
+                raise Exception('NativeVolumeResolver needs Windows (or an api object)')
+            api = Win32VolumeAPI()
+        self.api = api
+        self.drive_types = drive_types
+        self.debug = debug
+
+    def volumes(self):
+        '''
+            VolumeInfo of every volume (mount paths sorted: drive letters first)
+        '''
+        volumes = []
+        for guid_path in self.api.volume_guid_paths():
+            if not guid_path.endswith('\\'):
+                guid_path += '\\'
+            drive_type = self.api.drive_type(guid_path)
+            if self.drive_types is not None and drive_type not in self.drive_types:
+                continue
+            try:
+                mount_paths = parse_multi_sz(self.api.volume_path_names(guid_path))
+            except OSError as e:
+                # a volume going away while we enumerate
+                if self.debug:
+                    print(f'unable to get the mount paths of {guid_path}: {e}')
+                continue
+            mount_paths.sort(key=lambda path: (len(path.rstrip('\\')) > 2, path.lower()))
+            volumes.append(VolumeInfo(guid_path, mount_paths, drive_type, self.api.filesystem(guid_path)))
+
+        return volumes
+
+    def get_drives(self, filter_letter:str=None, mount_folders:bool=True):
+        '''
+            The models.get_drives() mapping: {'C:': volume GUID path}, plus the folder mounts
+            ({'D:\\Mounts\\Data': volume GUID path}) when mount_folders is True
+        '''
+        letters = {}
+        folders = {}
+        for volume in self.volumes():
+            for mount_path in volume.mount_paths:
+                key = mount_key(mount_path)
+                if len(key) == 2:
+                    letters.setdefault(key, volume.guid_path)
+                elif mount_folders:
+                    folders.setdefault(key, volume.guid_path)
+        if filter_letter:
+            return {key: guid_path for key, guid_path in letters.items() if key.lower() == filter_letter.lower()}
+        letters.update(folders)
+
+        return letters
+
+    def mount_paths(self):
+        '''
+            {volume GUID path: [mount paths]}
+        '''
+        return {volume.guid_path: volume.mount_paths for volume in self.volumes()}
+
+
+ShadowStorage = namedtuple('ShadowStorage', ['volume', 'diff_volume', 'used', 'allocated', 'maximum'])
+UNBOUNDED = 0xFFFFFFFFFFFFFFFF # MaxSpace of a shadow storage with no limit
+
+
+def parse_wmi_volume_ref(ref:str):
+    '''
+        Volume GUID path of a Win32_Volume reference (as Win32_ShadowStorage.Volume / .DiffVolume hold them):
+            'Win32_Volume.DeviceID="\\\\\\\\?\\\\Volume{...}\\\\"' -> '\\\\?\\Volume{...}\\'
+    '''
+    ref = str(ref)
+    start = ref.find('DeviceID="')
+    if start < 0:
+        return None
+    value = ref[start + len('DeviceID="'):].rsplit('"', 1)[0]
+
+    return value.replace('\\\\', '\\')
+
+
+def query_shadow_storage():
+    '''
+        {volume GUID path: ShadowStorage} of the volumes with a shadow storage (diff area) association, from WMI
+        (Win32_ShadowStorage, sizes in bytes)
+    '''
+    import wmi #pylint:disable=C0415
+
+    storage = {}
+    for association in wmi.WMI().query('SELECT * FROM Win32_ShadowStorage'):
+        volume = parse_wmi_volume_ref(association.wmi_property('Volume').value)
+        if volume is None:
+            continue
+        storage[volume] = ShadowStorage(volume, parse_wmi_volume_ref(association.wmi_property('DiffVolume').value),
+                                        int(association.wmi_property('UsedSpace').value or 0),
+                                        int(association.wmi_property('AllocatedSpace').value or 0),
+                                        int(association.wmi_property('MaxSpace').value or 0))
+
+    return storage
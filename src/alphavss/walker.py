@@ -0,0 +1,429 @@
+'''
+    Streaming, parallel directory walker for the contents of a VSSSnapshot
+
+    Once a snapshot exists you typically want to enumerate everything in it (to copy, hash or index it).
+    os.walk() does that one directory at a time on a single thread, and a shadow copy has a high per-request latency
+    (every read goes through the copy-on-write diff area), so the walk spends most of its time waiting.
+
+    SnapshotWalker runs os.scandir() on a pool of directory worker threads and hands the entries back to the caller
+    in batches through a bounded queue:
+        * memory stays bounded no matter how many files a volume holds (batch_size * max_batches entries plus the
+          directories still waiting to be scanned)
+        * include/exclude globs are applied during the traversal, so excluded directories are never opened
+        * the directory worker threads are a DirectoryPool, also used to walk two snapshots at once (snapdiff.py)
+
+    Usage:
+        from alphavss.walker import SnapshotWalker
+
+        walker = SnapshotWalker(snapshot, exclude=['System Volume Information', '*.tmp'])
+        for batch in walker.batches():
+            for entry in batch:
+                print(entry.rel_path, entry.size)
+
+    snapshot can be a VSSSnapshot (its exposed_path is used when it has been exposed, otherwise the shadow copy device
+    path) or any plain path (which makes this usable/benchmarkable on any platform)
+'''
+import os
+import re
+import stat
+import queue
+import fnmatch
+import threading
+from alphavss.throttle import resolve_throttle, normalize_volume_name
+
+DEFAULT_WORKERS = 8
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_MAX_BATCHES = 16
+
+# Windows junctions and symlinks are reparse points (not available on other platforms)
+FILE_ATTRIBUTE_REPARSE_POINT = getattr(stat, 'FILE_ATTRIBUTE_REPARSE_POINT', 0x400)
+
+_DONE = object()
+
+
+def snapshot_root(snapshot):
+    '''
+        Figure out where the contents of a snapshot can be read from
+
+        snapshot: (str or VSSSnapshot) a path is returned as is, a VSSSnapshot returns its exposed_path when it
+                  has been exposed (expose_snapshot), otherwise its device path (get_device_path)
+    '''
+    if isinstance(snapshot, (str, bytes, os.PathLike)):
+        return os.fspath(snapshot)
+
+    if getattr(snapshot, 'exposed_path', None):
+        return snapshot.exposed_path
+
+    if hasattr(snapshot, 'get_device_path'):
+        return snapshot.get_device_path()
+
+    raise Exception(f'Unable to determine the root path of the snapshot: {snapshot}')
+
+
+def snapshot_label(snapshot):
+    '''
+        Short name for a snapshot in target directories and archives: the drive letter of its volume ('C'),
+        the snapshot id when the volume has no drive letter, '' for a plain path
+    '''
+    if isinstance(snapshot, (str, bytes, os.PathLike)):
+        return ''
+
+    name = normalize_volume_name(getattr(snapshot, 'volume_name', '') or '')
+    if len(name) == 2 and name.endswith(':'):
+        return name[:1]
+
+    return str(getattr(snapshot, 'snap_id', '') or name).strip('{}')
+
+
+def compile_globs(patterns):
+    '''
+        Turn a list of fnmatch style globs into compiled regexes
+
+        A pattern without a path separator is matched against the entry name (ex. '*.tmp', 'pagefile.sys'),
+        a pattern with a separator is matched against the path relative to the snapshot root (ex. 'Windows/Temp/*')
+        Matching is case insensitive on Windows (os.path.normcase)
+    '''
+    compiled = []
+    for pattern in patterns or []:
+        pattern = os.path.normcase(pattern.replace('/', os.sep).strip(os.sep))
+        compiled.append((os.sep in pattern, re.compile(fnmatch.translate(pattern))))
+
+    return compiled
+
+
+def match_globs(compiled, name, rel_path):
+    '''
+        True if the entry name or relative path matches any of the compiled globs (from compile_globs)
+    '''
+    for has_sep, regex in compiled:
+        if regex.match(os.path.normcase(rel_path if has_sep else name)):
+            return True
+
+    return False
+
+
+def is_reparse_point(dir_entry:object):
+    '''
+        True for an os.DirEntry that is a symlink or (on Windows) a junction or other reparse point: the directories a
+        walk doesn't descend into unless told to
+    '''
+    if dir_entry.is_symlink() or os.name != 'nt':
+        return dir_entry.is_symlink()
+    attributes = getattr(dir_entry.stat(follow_symlinks=False), 'st_file_attributes', 0)
+
+    return bool(attributes & FILE_ATTRIBUTE_REPARSE_POINT)
+
+
+class DirectoryPool(object):
+    '''
+        Worker threads working through a tree of directories
+
+        scan(item) handles one directory (an item of roots, or one it returned) and returns the items of its
+        subdirectories, it hands its results to the caller of results() with put().  Directories are taken depth
+        first, which keeps the list of pending directories short.  The first exception that escapes scan() stops the
+        workers and is raised by results()
+    '''
+    def __init__(self, scan:object, roots:list, workers:int, max_batches:int, name:str, setup:object=None):
+        '''
+            scan: (callable) scan(item) (scan(item, state) with setup), returns the subdirectory items (None: none)
+            roots: (list) the first items
+            workers: (int) number of threads
+            max_batches: (int) results that can wait for the caller before the workers block
+            name: (str) thread name prefix
+            setup: (callable) returns the state of a worker (a buffer...), created on the worker's thread
+        '''
+        self.scan = scan
+        self.workers = workers
+        self.name = name
+        self.setup = setup
+        self._cond = threading.Condition()
+        self._pending = list(roots)
+        self._busy = 0
+        self._results = queue.Queue(maxsize=max_batches)
+        self._stop = threading.Event()
+        self._closed = threading.Event()
+        self._error = None
+
+    def results(self):
+        '''
+            Generator returning what the workers put(), until every directory is scanned.  Closing it early (break)
+            stops the workers
+        '''
+        threads = []
+        for num in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f'{self.name}-{num}', daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        finished = 0
+        try:
+            while finished < len(threads):
+                item = self._results.get()
+                if item is _DONE:
+                    finished += 1
+                    continue
+                yield item
+        finally:
+            self._closed.set()
+            self._stop.set()
+            with self._cond:
+                self._cond.notify_all()
+            for thread in threads:
+                thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _worker(self):
+        try:
+            state = self.setup() if self.setup is not None else None
+            while True:
+                with self._cond:
+                    while not self._pending and self._busy and not self._stop.is_set():
+                        self._cond.wait()
+                    if self._stop.is_set() or not self._pending:
+                        # nothing left to scan, and nobody is scanning something that could add more
+                        self._cond.notify_all()
+                        break
+                    item = self._pending.pop()
+                    self._busy += 1
+
+                subdirs = None
+                try:
+                    subdirs = self.scan(item) if self.setup is None else self.scan(item, state)
+                finally:
+                    with self._cond:
+                        # in the same critical section: a worker must never see no pending work and nobody busy while
+                        # subdirectories are still on their way
+                        self._busy -= 1
+                        if subdirs:
+                            self._pending.extend(subdirs)
+                        self._cond.notify_all()
+        except BaseException as e: #pylint:disable=W0703
+            # the first error stops the pool, results() raises it
+            with self._cond:
+                if self._error is None:
+                    self._error = e
+                self._stop.set()
+                self._cond.notify_all()
+        finally:
+            self._put(_DONE, always=True)
+
+    def put(self, item:object):
+        '''
+            Hand a result to the caller (blocks while max_batches are waiting), False once the pool is stopped
+        '''
+        return self._put(item)
+
+    def _put(self, item, always=False):
+        # always: until the caller is gone
+        while always or not self._stop.is_set():
+            try:
+                self._results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                if always and self._closed.is_set():
+                    return False
+
+        return False
+
+
+class WalkEntry(object):
+    '''
+        os.DirEntry look-alike returned by SnapshotWalker
+
+        os.DirEntry objects can't outlive their scandir() iterator in a meaningful way (and can't be created by hand),
+        so the walker copies what it needs into one of these
+    '''
+    __slots__ = ('name', 'path', 'rel_path', '_is_dir', '_is_symlink', '_stat')
+
+    def __init__(self, name:str, path:str, rel_path:str, is_dir:bool, is_symlink:bool, stat_result:object=None):
+        self.name = name
+        self.path = path
+        self.rel_path = rel_path
+        self._is_dir = is_dir
+        self._is_symlink = is_symlink
+        self._stat = stat_result
+
+    def __repr__(self):
+        return f'<WalkEntry {self.rel_path!r}>'
+
+    def __fspath__(self):
+        return self.path
+
+    def is_dir(self):
+        return self._is_dir
+
+    def is_file(self):
+        return not self._is_dir and not self._is_symlink
+
+    def is_symlink(self):
+        return self._is_symlink
+
+    def stat(self):
+        '''
+            lstat() result of the entry (cached, and free on Windows when the walker was created with stat=True)
+        '''
+        if self._stat is None:
+            self._stat = os.stat(self.path, follow_symlinks=False)
+
+        return self._stat
+
+    def inode(self):
+        return self.stat().st_ino
+
+    def identity(self):
+        '''
+            (volume serial, file ID, link count) of the entry
+
+            The stat results of os.scandir() leave these at 0 on Windows, an os.stat() of the file fills them in
+        '''
+        st = self.stat()
+        if not st.st_ino:
+            st = os.stat(self.path, follow_symlinks=False)
+            self._stat = st
+
+        return st.st_dev, st.st_ino, st.st_nlink
+
+    @property
+    def size(self):
+        return self.stat().st_size
+
+    @property
+    def mtime_ns(self):
+        return self.stat().st_mtime_ns
+
+
+class SnapshotWalker(object):
+    '''
+        Walk the contents of a snapshot with a pool of os.scandir() worker threads
+    '''
+    def __init__(self, snapshot:object, include:list=None, exclude:list=None, workers:int=DEFAULT_WORKERS,
+                 batch_size:int=DEFAULT_BATCH_SIZE, max_batches:int=DEFAULT_MAX_BATCHES, yield_dirs:bool=True,
+                 stat:bool=True, follow_reparse_points:bool=False, throttle:object=None, onerror:object=None,
+                 debug:bool=False):
+        '''
+            snapshot: (str or VSSSnapshot) what to walk (see snapshot_root())
+            include: (list) globs a file must match to be returned (directories are always traversed)
+            exclude: (list) globs of files and directories to skip (excluded directories are not traversed)
+            workers: (int) number of directory worker threads
+            batch_size: (int) number of entries handed to the caller at a time
+            max_batches: (int) number of batches that can be waiting for the caller before the workers block
+            yield_dirs: (bool) return directory entries too (not just files)
+            stat: (bool) lstat() every entry during the walk (free on Windows, a syscall per entry elsewhere)
+                  otherwise WalkEntry.stat() does it on demand
+            follow_reparse_points: (bool) descend into symlinked directories and junctions
+                  (off by default, a snapshot of C:\\ has junction loops like "Application Data")
+            throttle: (VolumeThrottle or IOScheduler) every directory scan counts as a read operation against its IOPS
+            onerror: (callable) called with the OSError of a directory that can't be scanned (like os.walk), the
+                     walk stops and batches() raises what it raises
+            debug: (bool) enables enhanced output
+        '''
+        self.root = snapshot_root(snapshot)
+        self.include = compile_globs(include)
+        self.exclude = compile_globs(exclude)
+        if workers < 1:
+            raise Exception(f'SnapshotWalker needs at least 1 worker: {workers}')
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.yield_dirs = yield_dirs
+        self.stat = stat
+        self.follow_reparse_points = follow_reparse_points
+        self.throttle = resolve_throttle(throttle, snapshot)
+        self.onerror = onerror
+        self.debug = debug
+
+        # counters for the last walk
+        self.files = 0
+        self.dirs = 0
+        self.errors = 0
+
+        self._lock = None
+        self._pool = None
+
+    def __iter__(self):
+        for batch in self.batches():
+            yield from batch
+
+    def batches(self):
+        '''
+            Generator returning lists (up to batch_size long) of WalkEntry objects
+
+            The order of the entries is not deterministic (directories are scanned in parallel)
+            Closing the generator early (break) stops the workers, an exception in a worker (onerror raising) stops
+            the walk and is raised here
+        '''
+        self.files = 0
+        self.dirs = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._pool = DirectoryPool(self._scan, [(self.root, '')], self.workers, self.max_batches, 'alphavss-walker')
+        yield from self._pool.results()
+
+        if self.debug:
+            print(f'walked {self.root}: {self.files} file(s), {self.dirs} dir(s), {self.errors} error(s)')
+
+    def _scan(self, item):
+        '''
+            Scan a single directory ((path, rel_path)), queueing its entries and returning its subdirectories
+        '''
+        path, rel_path = item
+        subdirs = []
+        batch = []
+        files = 0
+        dirs = 0
+        if self.throttle is not None:
+            self.throttle.acquire()
+        try:
+            with os.scandir(path) as it:
+                for dir_entry in it:
+                    name = dir_entry.name
+                    entry_rel_path = os.path.join(rel_path, name) if rel_path else name
+                    if self.exclude and match_globs(self.exclude, name, entry_rel_path):
+                        continue
+
+                    is_symlink = dir_entry.is_symlink()
+                    is_dir = dir_entry.is_dir(follow_symlinks=self.follow_reparse_points)
+                    stat_result = None
+                    if self.stat:
+                        stat_result = dir_entry.stat(follow_symlinks=False)
+
+                    if is_dir:
+                        dirs += 1
+                        if self.follow_reparse_points or not is_reparse_point(dir_entry):
+                            subdirs.append((dir_entry.path, entry_rel_path))
+                        if not self.yield_dirs:
+                            continue
+                    else:
+                        if self.include and not match_globs(self.include, name, entry_rel_path):
+                            continue
+                        files += 1
+
+                    batch.append(WalkEntry(name, dir_entry.path, entry_rel_path, is_dir, is_symlink, stat_result))
+                    if len(batch) >= self.batch_size:
+                        if not self._pool.put(batch):
+                            return None
+                        batch = []
+        except OSError as e:
+            with self._lock:
+                self.errors += 1
+            if self.onerror is not None:
+                self.onerror(e)
+            elif self.debug:
+                print(f'unable to scan {path}: {e}')
+
+        if batch:
+            self._pool.put(batch)
+
+        with self._lock:
+            self.files += files
+            self.dirs += dirs
+
+        return subdirs
+
+
+def walk_snapshot(snapshot:object, **kwargs):
+    '''
+        Shortcut for iterating over every WalkEntry in a snapshot (kwargs are passed to SnapshotWalker)
+    '''
+    return iter(SnapshotWalker(snapshot, **kwargs))
@@ -0,0 +1,66 @@
+'''
+    Benchmark of file by file copying (SnapshotCopier) vs small file packing (SnapshotPacker) (runs on Windows or Linux)
+
+    usage: python benchmark_packer.py [tree_root] [number_of_files] [target_root]
+
+    The tree is built on the first run (100,000 files of 1-8 KB by default, 1000 per directory) and reused
+    afterwards.  Point tree_root at an exposed snapshot to benchmark a real volume (use number_of_files = 0 so nothing
+    gets created).  The copies go to target_root (a temporary directory by default) and are deleted after each run
+'''
+import os
+import sys
+import time
+import shutil
+import tempfile
+from alphavss.copier import SnapshotCopier
+from alphavss.packer import SnapshotPacker, PackSource
+
+
+tree_root = sys.argv[1] if len(sys.argv) > 1 else os.path.join(tempfile.gettempdir(), 'alphavss-packer-bench')
+number_of_files = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+target_root = sys.argv[3] if len(sys.argv) > 3 else tempfile.gettempdir()
+files_per_dir = 1000
+
+
+def build_tree(root, count):
+    marker = os.path.join(root, f'.built-{count}')
+    if count == 0 or os.path.exists(marker):
+        return
+    print(f'building {count} small files under {root} (only done once)...')
+    made = 0
+    while made < count:
+        path = os.path.join(root, f'd{made // files_per_dir:05}')
+        os.makedirs(path, exist_ok=True)
+        for num in range(min(files_per_dir, count - made)):
+            with open(os.path.join(path, f'f{num:04}.dat'), 'wb') as dst:
+                dst.write(os.urandom(1024 * (1 + (made + num) % 8)))
+        made += files_per_dir
+    with open(marker, 'wb'):
+        pass
+
+
+def bench(name, copier_class, **kwargs):
+    target = os.path.join(target_root, 'alphavss-packer-bench-target')
+    shutil.rmtree(target, ignore_errors=True)
+    start = time.perf_counter()
+    stats = copier_class(tree_root, target, **kwargs).copy()
+    elapsed = time.perf_counter() - start
+    print(f'{name:<36} {stats.files:>10} files  {elapsed:8.2f}s  {stats.files / elapsed:10.0f} files/s  '
+          f'{stats.bytes / (1024 * 1024) / elapsed:8.1f} MB/s')
+    if copier_class is SnapshotPacker:
+        start = time.perf_counter()
+        source = PackSource(target)
+        probes = [entry.path for entry in source.index][::max(1, len(source.index) // 1000)]
+        for path in probes:
+            source.read_file(path)
+        source.close()
+        elapsed = time.perf_counter() - start
+        print(f'{"  random reads from the packs":<36} {len(probes):>10} files  {elapsed:8.2f}s  '
+              f'{len(probes) / elapsed:10.0f} files/s')
+    shutil.rmtree(target, ignore_errors=True)
+
+
+build_tree(tree_root, number_of_files)
+for workers in (1, 8):
+    bench(f'SnapshotCopier workers={workers}', SnapshotCopier, workers=workers)
+    bench(f'SnapshotPacker workers={workers}', SnapshotPacker, workers=workers)
@@ -0,0 +1,54 @@
+'''
+    Benchmark of SnapshotVerifier over a synthetic tree and a copy of it (runs on Windows or Linux)
+
+    usage: python benchmark_verify.py [work_dir] [number_of_files]
+
+    The tree (a mix of small files and a few large ones) and its copy are built on the first run and reused afterwards,
+    the verification is run with an increasing number of hashing processes
+'''
+import os
+import sys
+import time
+import shutil
+import tempfile
+from alphavss.copier import SnapshotCopier
+from alphavss.verify import SnapshotVerifier
+
+
+work_dir = sys.argv[1] if len(sys.argv) > 1 else os.path.join(tempfile.gettempdir(), 'alphavss-verify-bench')
+number_of_files = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+source = os.path.join(work_dir, 'source')
+target = os.path.join(work_dir, 'target')
+
+
+def build_tree():
+    marker = os.path.join(work_dir, f'.built-{number_of_files}')
+    if os.path.exists(marker):
+        return
+    shutil.rmtree(work_dir, ignore_errors=True)
+    print(f'building {number_of_files} files under {source} (only done once)...')
+    block = os.urandom(1024 * 1024)
+    for num in range(number_of_files):
+        path = os.path.join(source, f'd{num // 1000:04}')
+        os.makedirs(path, exist_ok=True)
+        # 1 in 1000 files is 64 MB, the rest 4 KB - 64 KB
+        size = 64 * 1024 * 1024 if num % 1000 == 999 else 4096 * (1 + num % 16)
+        with open(os.path.join(path, f'f{num:06}.dat'), 'wb') as dst:
+            while size > 0:
+                dst.write(block[:min(size, len(block))])
+                size -= len(block)
+    SnapshotCopier(source, target).copy()
+    with open(marker, 'wb'):
+        pass
+
+
+if __name__ == '__main__':
+    build_tree()
+    for workers in (1, 2, 4, 8):
+        manifest_path = os.path.join(work_dir, f'manifest-{workers}.sha256')
+        for path in (manifest_path, f'{manifest_path}.mismatch'):
+            if os.path.exists(path):
+                os.remove(path)
+        start = time.perf_counter()
+        stats = SnapshotVerifier(source, target, manifest_path, workers=workers).run()
+        print(f'workers={workers:<3} {time.perf_counter() - start:8.2f}s  {stats}')
@@ -0,0 +1,69 @@
+'''
+    Benchmark of os.walk() vs SnapshotWalker over a synthetic tree (runs on Windows or Linux)
+
+    usage: python benchmark_walker.py [tree_root] [number_of_files]
+
+    The tree is built on the first run (1,000,000 empty files by default, 1000 per directory, 2 levels deep)
+    and reused afterwards.  Point tree_root at an exposed snapshot to benchmark a real volume
+    (use number_of_files = 0 so nothing gets created)
+'''
+import os
+import sys
+import time
+import tempfile
+from alphavss.walker import SnapshotWalker
+
+
+tree_root = sys.argv[1] if len(sys.argv) > 1 else os.path.join(tempfile.gettempdir(), 'alphavss-walker-bench')
+number_of_files = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+files_per_dir = 1000
+dirs_per_level = 32
+
+
+def build_tree(root, count):
+    marker = os.path.join(root, f'.built-{count}')
+    if count == 0 or os.path.exists(marker):
+        return
+    print(f'building {count} files under {root} (only done once)...')
+    made = 0
+    while made < count:
+        dir_num = made // files_per_dir
+        path = os.path.join(root, f'd{dir_num // dirs_per_level:04}', f'd{dir_num % dirs_per_level:02}')
+        os.makedirs(path, exist_ok=True)
+        for num in range(min(files_per_dir, count - made)):
+            with open(os.path.join(path, f'f{num:04}.dat'), 'wb'):
+                pass
+        made += files_per_dir
+    with open(marker, 'wb'):
+        pass
+
+
+def bench(name, func):
+    start = time.perf_counter()
+    entries = func()
+    elapsed = time.perf_counter() - start
+    print(f'{name:<32} {entries:>10} entries  {elapsed:8.2f}s  {entries / elapsed:12.0f} entries/s')
+
+
+def run_os_walk():
+    entries = 0
+    for dirpath, dirnames, filenames in os.walk(tree_root):
+        for name in dirnames + filenames:
+            os.stat(os.path.join(dirpath, name), follow_symlinks=False)
+        entries += len(dirnames) + len(filenames)
+    return entries
+
+
+def run_walker(workers):
+    def run():
+        entries = 0
+        for batch in SnapshotWalker(tree_root, workers=workers).batches():
+            entries += len(batch)
+        return entries
+    return run
+
+
+build_tree(tree_root, number_of_files)
+bench('os.walk + lstat', run_os_walk)
+for workers in (1, 4, 8, 16):
+    bench(f'SnapshotWalker workers={workers}', run_walker(workers))
@@ -0,0 +1,123 @@
+'''
+    CapabilityCache and plan() on fixed volume mappings and fake VSS components
+'''
+from alphavss.capabilities import CapabilityCache, plan, MAX_VOLUMES_PER_SET
+from alphavss.constants import AppRollback
+
+GUIDS = {'C:': '\\\\?\\Volume{c}\\', 'D:': '\\\\?\\Volume{d}\\', 'E:': '\\\\?\\Volume{e}\\',
+         'D:\\Mounts\\Again': '\\\\?\\Volume{d}\\', 'F:': '\\\\?\\Volume{f}\\'}
+FILESYSTEMS = {'\\\\?\\Volume{c}\\': 'NTFS', '\\\\?\\Volume{d}\\': 'ReFS', '\\\\?\\Volume{e}\\': 'FAT32',
+               '\\\\?\\Volume{f}\\': 'NTFS'}
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeComponents(object):
+    '''
+        IsVolumeSupported() of the VSS components: every volume but F:
+    '''
+    def __init__(self):
+        self.probed = []
+        self.calls = []
+
+    def InitializeForBackup(self, xml):
+        self.calls.append('InitializeForBackup')
+
+    def SetContext(self, context):
+        self.calls.append(f'SetContext({context})')
+
+    def IsVolumeSupported(self, volume_name):
+        self.probed.append(volume_name)
+        return not volume_name.startswith('F:')
+
+
+class FakeProvider(object):
+    def __init__(self, capabilities=None, context=AppRollback):
+        self.capabilities = capabilities
+        self.context = context
+        self.components = FakeComponents()
+
+    def create_backup_components(self):
+        return self.components
+
+
+def cache(clock=None, **kwargs):
+    return CapabilityCache(volumes=lambda: GUIDS, shadow_storage=lambda: {'\\\\?\\Volume{c}\\': object()},
+                           filesystem=FILESYSTEMS.get, clock=clock or Clock(), **kwargs)
+
+
+def test_cache_ttl(tmp_path):
+    clock = Clock()
+    path = str(tmp_path / 'capabilities.json')
+    capabilities = cache(clock, path=path, ttl=60)
+    components = FakeComponents()
+    assert capabilities.is_supported('C:\\', components) and not capabilities.is_supported('F:\\', components)
+    assert capabilities.is_supported('c:\\', components)
+    assert components.probed == ['C:\\', 'F:\\'] and (capabilities.probes, capabilities.hits) == (2, 1)
+    entry = capabilities.get('C:\\')
+    assert (entry.guid_path, entry.filesystem, entry.shadow_storage, entry.checked) == (
+        GUIDS['C:'], 'NTFS', True, clock.now)
+
+    # another process shares the file
+    other = cache(clock, path=path, ttl=60)
+    clock.now += 60
+    assert other.check(['C:\\', 'F:\\'], components=components)[1].supported is False
+    assert len(components.probed) == 2
+    clock.now += 1
+    assert other.get('C:\\') is None
+    assert other.is_supported('C:\\', components) and components.probed[2:] == ['C:\\']
+
+    capabilities.invalidate('F:\\')
+    assert capabilities.get('F:\\') is None
+    # a volume the mapping doesn't know can only be asked
+    assert capabilities.is_supported('X:\\', components) and not capabilities.is_supported('X:\\')
+    assert components.probed[-1] == 'X:\\'
+
+
+def test_plan_problems_and_warnings():
+    provider = FakeProvider()
+    backup_plan = plan(['C:\\', 'D:\\', 'E:\\', 'D:\\Mounts\\Again\\', 'F:\\', 'Z:\\'], provider=provider,
+                       cache=cache())
+    assert not backup_plan.ok
+    assert backup_plan.problems == ['Z:\\: unknown volume', 'D:\\Mounts\\Again\\: the same volume as D:\\',
+                                    'F:\\: not supported by the snapshot provider (IsVolumeSupported)']
+    assert backup_plan.warnings == [
+        'D:\\: no shadow storage configured (created on the first snapshot, default size)',
+        'E:\\: FAT32 file system',
+        'E:\\: no shadow storage configured (created on the first snapshot, default size)',
+        'D:\\Mounts\\Again\\: no shadow storage configured (created on the first snapshot, default size)',
+        'F:\\: no shadow storage configured (created on the first snapshot, default size)']
+    assert backup_plan.volumes[-1] is None and backup_plan.volumes[0].supported
+    # probed with a components object of the provider: no GatherWriterMetadata
+    assert provider.components.calls == ['InitializeForBackup', f'SetContext({AppRollback})']
+    assert sorted(provider.components.probed) == ['C:\\', 'D:\\', 'D:\\Mounts\\Again\\', 'E:\\', 'F:\\']
+    assert 'WILL FAIL' in str(backup_plan) and backup_plan.as_dict()['ok'] is False
+
+
+def test_plan_calls():
+    capabilities = cache()
+    provider = FakeProvider(capabilities=capabilities)
+    backup_plan = plan(['C:\\'], provider=provider)
+    assert backup_plan.ok and backup_plan.warnings == [] and backup_plan.context == AppRollback
+    initialize = ['CreateVssBackupComponents', 'InitializeForBackup', f'SetContext({AppRollback})',
+                  'GatherWriterMetadata']
+    # the provider has the cache: the set doesn't call IsVolumeSupported()
+    assert backup_plan.calls == initialize + ['StartSnapshotSet', 'AddToSnapshotSet(C:\\)'] + initialize + [
+        'SetBackupState', 'PrepareForBackup', 'DoSnapshotSet']
+    assert 'IsVolumeSupported(C:\\)' in plan(['C:\\'], provider=FakeProvider(), cache=capabilities).calls
+    # cached: nothing is probed again
+    assert capabilities.probes == 1
+
+
+def test_plan_too_many_volumes():
+    volume_names = [f'\\\\?\\Volume{{{number}}}\\' for number in range(MAX_VOLUMES_PER_SET + 1)]
+    capabilities = CapabilityCache(volumes=dict, shadow_storage=dict, filesystem=lambda guid_path: 'NTFS')
+    backup_plan = plan(volume_names, provider=FakeProvider(), cache=capabilities)
+    assert backup_plan.problems == [f'{MAX_VOLUMES_PER_SET + 1} volumes, a snapshot set holds '
+                                    f'{MAX_VOLUMES_PER_SET} at most']
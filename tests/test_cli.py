@@ -0,0 +1,64 @@
+'''
+    The alphavss command line on the MemoryBackend, directly and through a daemon
+'''
+import io
+import os
+import sys
+import json
+import pytest
+from alphavss.cli import CommandRunner, build_parser
+from alphavss.daemon import SnapshotServer, MemoryBackend
+
+
+class TimedBackend(MemoryBackend):
+    '''
+        MemoryBackend whose backup() counts like the VSS calls of a VSSBackend
+    '''
+    def __init__(self):
+        super().__init__()
+        self.timings = {}
+
+    def backup(self, volume_names, context=None, deadlines=None):
+        self.timings['DoSnapshotSet'] = self.timings.get('DoSnapshotSet', 0.0) + 1.5
+
+        return super().backup(volume_names, context=context, deadlines=deadlines)
+
+
+def runner(*args, backend=None):
+    out = io.StringIO()
+    command_runner = CommandRunner(build_parser().parse_args(list(args) + ['query']), out=out)
+    if backend is not None:
+        command_runner.backend = backend
+
+    return command_runner, out
+
+
+def lines(out):
+    return [json.loads(line) for line in out.getvalue().splitlines()]
+
+
+def test_prune_keeps_the_sets_of_unknown_age():
+    backend = MemoryBackend()
+    command_runner, out = runner('--memory', backend=backend)
+    for created in ['2022-07-25T10:00:00', '2022-07-26T10:00:00', None, '2022-07-27T10:00:00']:
+        info = backend.backup(['C:\\'])
+        info['snapshots'][0]['created'] = created
+    unknown = [set_id for set_id, info in backend._sets.items() if info['snapshots'][0]['created'] is None]
+    assert command_runner.run_batch(['prune --keep 1'])
+    result = lines(out)[-1]['result']
+    assert len(result['deleted']) == 2
+    assert unknown[0] in result['kept'] and len(result['kept']) == 2
+    assert unknown[0] in backend._sets
+
+
+def test_daemon_timings(tmp_path):
+    address = (f'\\\\.\\pipe\\alphavss-cli-test-{os.getpid()}' if sys.platform == 'win32'
+               else str(tmp_path / 'alphavss.sock'))
+    with SnapshotServer(TimedBackend(), address=address):
+        command_runner, out = runner('--daemon', address, '--timings')
+        assert command_runner.run_batch(['create C:', 'create D:', 'query'])
+        command_runner.backend.client.close()
+    create, second, query = lines(out)
+    assert create['timings'] == {'DoSnapshotSet': pytest.approx(1.5)}
+    assert second['timings'] == {'DoSnapshotSet': pytest.approx(1.5)}
+    assert query['timings'] == {}
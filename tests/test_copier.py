@@ -0,0 +1,138 @@
+'''
+    SnapshotCopier and SnapshotPacker on plain directory trees, and workers that fail
+'''
+import os
+import threading
+import pytest
+from alphavss.walker import WalkEntry
+from alphavss.copier import SnapshotCopier, WorkerPool
+from alphavss import packer as packer_module
+from alphavss.packer import SnapshotPacker, PackSource
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / 'source'
+    for number in range(40):
+        path = root / f'dir{number % 4}' / f'file{number}.txt'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'%d' % number * (number * 100))
+
+    return root
+
+
+def run_with_timeout(target, seconds=20):
+    '''
+        target() on a thread, returns (its result or exception), fails the test when it hangs
+    '''
+    outcome = []
+
+    def run():
+        try:
+            outcome.append(target())
+        except BaseException as e: #pylint:disable=W0703
+            outcome.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(seconds)
+    assert not thread.is_alive(), 'hung'
+
+    return outcome[0]
+
+
+def missing_entries(tmp_path, count, stat_result=None):
+    # entries of files deleted after the walk (stat_result: what the walker saw)
+    return [WalkEntry(f'gone{number}', str(tmp_path / 'gone' / f'gone{number}'), f'gone{number}', False, False,
+                      stat_result) for number in range(count)]
+
+
+def raising_onerror(path, e):
+    raise RuntimeError(f'giving up on {path}')
+
+
+def test_copy_tree(tree, tmp_path):
+    stats = SnapshotCopier(str(tree), str(tmp_path / 'copy'), workers=4).copy()
+    assert (stats.files, stats.dirs, stats.errors) == (40, 4, 0)
+    assert (tmp_path / 'copy' / 'dir3' / 'file7.txt').read_bytes() == (tree / 'dir3' / 'file7.txt').read_bytes()
+
+
+def test_copy_errors_go_to_onerror(tmp_path):
+    errors = []
+    stats = SnapshotCopier(str(tmp_path), str(tmp_path / 'copy'), workers=2,
+                           onerror=lambda path, e: errors.append(path)).copy(missing_entries(tmp_path, 10))
+    assert stats.errors == 10 and len(errors) == 10
+
+
+def test_raising_onerror_stops_the_copy(tmp_path):
+    copier = SnapshotCopier(str(tmp_path), str(tmp_path / 'copy'), workers=2, onerror=raising_onerror)
+    result = run_with_timeout(lambda: copier.copy(missing_entries(tmp_path, 2000)))
+    assert isinstance(result, RuntimeError)
+
+
+def test_pack_tree(tree, tmp_path):
+    target = str(tmp_path / 'packed')
+    packer = SnapshotPacker(str(tree), target, threshold=2000, workers=3)
+    stats = packer.copy()
+    assert stats.files == 40 and stats.errors == 0
+    assert packer.packed == 10
+    source = PackSource(target)
+    try:
+        assert source.read_file('dir1/file5.txt') == (tree / 'dir1' / 'file5.txt').read_bytes()
+    finally:
+        source.close()
+    assert os.path.exists(os.path.join(target, 'dir3', 'file39.txt'))
+
+
+@pytest.mark.parametrize('size', [10, 100000])
+def test_raising_onerror_stops_the_packer(tmp_path, size):
+    # packed (small) and copied (big) files
+    (tmp_path / 'seen').write_bytes(b'x' * size)
+    entries = missing_entries(tmp_path, 2000, os.stat(tmp_path / 'seen'))
+    packer = SnapshotPacker(str(tmp_path), str(tmp_path / 'packed'), workers=2, group_size=4, onerror=raising_onerror)
+    result = run_with_timeout(lambda: packer.copy(entries))
+    assert isinstance(result, RuntimeError)
+
+
+def test_segment_write_errors(tree, tmp_path, monkeypatch):
+    append = packer_module._Segment.append
+
+    def full(segment, data):
+        if data.startswith(b'7'):
+            raise OSError(28, 'No space left on device')
+        return append(segment, data)
+
+    monkeypatch.setattr(packer_module._Segment, 'append', full)
+    errors = []
+    target = str(tmp_path / 'packed')
+    packer = SnapshotPacker(str(tree), target, threshold=2000, workers=2,
+                            onerror=lambda path, e: errors.append(path))
+    stats = packer.copy()
+    # file7 and the files of its group already in the lost segment
+    assert os.path.join('dir3', 'file7.txt') in errors
+    assert stats.errors == len(errors) and packer.packed + len(errors) == 10
+    source = PackSource(target)
+    try:
+        for entry in source.index:
+            assert source.read_file(entry.path) == (tree / entry.path).read_bytes()
+    finally:
+        source.close()
+
+
+def test_worker_pool_failure():
+    handled = []
+
+    def handle(item):
+        if item == 3:
+            raise ValueError(item)
+        handled.append(item)
+
+    pool = WorkerPool(handle, 2, 2, 'test-pool')
+    fed = 0
+    for item in range(10000):
+        if not pool.put(item):
+            break
+        fed += 1
+    with pytest.raises(ValueError):
+        pool.join()
+    assert fed < 10000
@@ -0,0 +1,104 @@
+'''
+    The daemon protocol with the MemoryBackend: a SnapshotServer on a Unix socket (a named pipe on Windows) and its
+    SnapshotClient
+'''
+import os
+import sys
+import json
+import subprocess
+import pytest
+from alphavss.daemon import SnapshotServer, SnapshotClient, MemoryBackend
+from alphavss.deadlines import PhaseTimeout, VSSPhaseTimeout
+
+VOLUMES = {'C:': '\\\\?\\Volume{00000000-0000-0000-0000-000000000001}\\',
+           'D:': '\\\\?\\Volume{00000000-0000-0000-0000-000000000002}\\'}
+
+
+@pytest.fixture
+def address(tmp_path):
+    if sys.platform == 'win32':
+        return f'\\\\.\\pipe\\alphavss-test-{os.getpid()}'
+
+    return str(tmp_path / 'alphavss.sock')
+
+
+@pytest.fixture
+def client(address):
+    with SnapshotServer(MemoryBackend(volumes=VOLUMES), address=address, authkey=b'secret'):
+        with SnapshotClient(address, authkey=b'secret') as snapshot_client:
+            yield snapshot_client
+
+
+def test_ping_and_volumes(client):
+    assert client.ping()['pid'] == os.getpid()
+    assert client.get_drives() == VOLUMES
+
+
+def test_snapshot_set_lifecycle(client):
+    vss_set = client.create_snapshot_set(['C:\\', 'd:'])
+    assert [snapshot.volume_name for snapshot in vss_set.snapshots] == ['C:\\', 'D:\\']
+    assert vss_set.snapshots[0].original_volume == VOLUMES['C:']
+    assert [found.set_id for found in client.query_snapshots()] == [vss_set.set_id]
+
+    snapshot = vss_set.snapshots[0]
+    assert snapshot.expose_snapshot('R:\\')
+    assert snapshot.exposed_path == 'R:\\'
+    with pytest.raises(Exception, match='Unable to expose'):
+        snapshot.expose_snapshot('S:\\')
+    assert snapshot.unexpose_snapshot()
+    assert snapshot.exposed_path is None
+
+    assert vss_set.delete() == 2
+    assert client.query_snapshots() == []
+    with pytest.raises(Exception, match='Snapshot set not found'):
+        vss_set.delete()
+
+
+def test_errors(client):
+    with pytest.raises(Exception, match='not supported'):
+        client.create_snapshot_set(['Z:\\'])
+    with pytest.raises(Exception, match='Unknown method'):
+        client.call('format', volume='C:')
+
+
+def test_wrong_authkey(address):
+    with SnapshotServer(MemoryBackend(volumes=VOLUMES), address=address, authkey=b'secret'):
+        with pytest.raises(Exception):
+            SnapshotClient(address, authkey=b'wrong')
+        # still serving the others
+        with SnapshotClient(address, authkey=b'secret') as snapshot_client:
+            assert snapshot_client.ping()['requests'] == 0
+
+
+def test_phase_timeout_reaches_the_client():
+    class SlowBackend(MemoryBackend):
+        def backup(self, volume_names, context=None, deadlines=None):
+            raise VSSPhaseTimeout(PhaseTimeout('DoSnapshotSet', 60, 60.5, False, None, volume_names, True, None))
+
+    response = SnapshotServer(SlowBackend(volumes=VOLUMES)).handle(
+        json.dumps({'id': 7, 'method': 'backup', 'params': {'volume_names': ['C:\\']}}).encode('utf-8'))
+    assert response['id'] == 7
+    assert response['error']['type'] == 'VSSPhaseTimeout'
+    assert response['error']['timeout']['phase'] == 'DoSnapshotSet'
+    assert response['error']['timeout']['volume_names'] == ['C:\\']
+
+
+def test_client_does_not_load_the_models():
+    # models loads the CLR (wmi, pythonnet): a client process doesn't pay for it
+    code = 'import sys, alphavss.daemon; print("alphavss.models" in sys.modules)'
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                            env=dict(os.environ, PYTHONPATH=os.path.join(os.path.dirname(__file__), '..', 'src')))
+    assert result.stdout.strip() == 'False'
+
+
+def test_package_exports_are_lazy(tmp_path):
+    from alphavss.replay import Replay
+    import alphavss
+
+    path = tmp_path / 'empty.trace'
+    path.write_text(json.dumps({'trace': 1, 'volumes': VOLUMES}) + '\n')
+    with Replay(str(path), speed=0) as replay:
+        assert alphavss.VSSProvider is replay.models.VSSProvider
+        assert alphavss.VSSSnapshotSet is replay.models.VSSSnapshotSet
+    with pytest.raises(AttributeError):
+        alphavss.VSSMissing
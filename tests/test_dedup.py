@@ -0,0 +1,43 @@
+'''
+    ChunkStore ingest and restore of plain directory trees
+'''
+import os
+from contextlib import contextmanager
+from alphavss.dedup import ChunkStore
+
+
+class CountingThrottle(object):
+    '''
+        VolumeThrottle stand-in counting what is acquired
+    '''
+    def __init__(self):
+        self.nbytes = 0
+        self.ops = 0
+
+    def acquire(self, nbytes=0, ops=1):
+        self.nbytes += nbytes
+        self.ops += ops
+
+    @contextmanager
+    def read(self, nbytes=0):
+        self.acquire(nbytes)
+        yield
+
+
+def test_ingest_dedups_and_restores(tmp_path):
+    source = tmp_path / 'source'
+    (source / 'docs').mkdir(parents=True)
+    data = os.urandom(3000)
+    (source / 'a.bin').write_bytes(data)
+    (source / 'docs' / 'copy of a.bin').write_bytes(data)
+    throttle = CountingThrottle()
+    with ChunkStore(str(tmp_path / 'store'), min_size=256, avg_size=1024, max_size=4096) as store:
+        stats = store.ingest(str(source), 'first', workers=0, throttle=throttle)
+        assert stats.files == 2 and stats.bytes_in == 6000
+        # the second copy is only referenced
+        assert stats.bytes_new == 3000
+        # both files are chunked, the new chunks are read again: 2 directories, 2 files, the chunks of a.bin
+        assert throttle.nbytes == 6000 + 3000
+        assert throttle.ops == 2 + 2 + stats.new_chunks
+        assert store.restore('first', str(tmp_path / 'restored')) == 2
+    assert (tmp_path / 'restored' / 'docs' / 'copy of a.bin').read_bytes() == data
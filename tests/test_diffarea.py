@@ -0,0 +1,91 @@
+'''
+    Shadow storage sampling and pressure-aware scheduling with a StaticStorageSource and a simulated clock
+'''
+import pytest
+from alphavss.diffarea import ShadowStorageSampler, PressureScheduler, StaticStorageSource, MIN_RATE_INTERVAL
+from alphavss.volumes import UNBOUNDED
+
+C = '\\\\?\\Volume{00000000-0000-0000-0000-000000000001}\\'
+D = '\\\\?\\Volume{00000000-0000-0000-0000-000000000002}\\'
+GB = 2 ** 30
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def sampler(source, clock):
+    return ShadowStorageSampler(source, volumes=lambda: {'C:': C, 'D:': D}, clock=clock)
+
+
+def test_sample_names_and_rate():
+    clock = Clock()
+    source = StaticStorageSource({C: (10 * GB, 12 * GB, 100 * GB), D: (1 * GB, 1 * GB, UNBOUNDED)})
+    storage = sampler(source, clock)
+    samples = storage.sample()
+    assert set(samples) == {'C:\\', 'D:\\'}
+    assert samples['C:\\'].rate == 0.0
+
+    clock.sleep(10)
+    source.set(C, 10 * GB + 100 * 2 ** 20, 12 * GB, 100 * GB)
+    assert storage.sample()['C:\\'].rate == pytest.approx(10 * 2 ** 20)
+
+    # samples too close together keep the last rate (and the last reference)
+    clock.sleep(MIN_RATE_INTERVAL / 10)
+    source.set(C, 20 * GB, 20 * GB, 100 * GB)
+    assert storage.sample()['C:\\'].rate == pytest.approx(10 * 2 ** 20)
+
+    # shrinking (snapshots deleted) isn't negative growth
+    clock.sleep(10)
+    source.set(C, 1 * GB, 20 * GB, 100 * GB)
+    assert storage.sample()['C:\\'].rate == pytest.approx(5 * 2 ** 20)
+
+
+def test_decide():
+    clock = Clock()
+    source = StaticStorageSource({C: (85 * GB, 90 * GB, 100 * GB), D: (99 * GB, 99 * GB, UNBOUNDED)})
+    scheduler = PressureScheduler(sampler(source, clock), high=0.8)
+    decision = scheduler.decide(['C:\\', 'D:\\', 'E:\\'])
+    assert not decision.go
+    assert decision.pressures == {'C:\\': pytest.approx(0.85), 'D:\\': None}
+    assert len(decision.reasons) == 1 and decision.reasons[0].startswith('C:\\')
+    assert scheduler.decide(['D:\\', 'E:\\']).go
+
+    # the reserve counts: 70 GB used + 15 GB needed by the new snapshot
+    source.set(C, 70 * GB, 90 * GB, 100 * GB)
+    assert scheduler.decide(['C:\\']).go
+    assert not PressureScheduler(scheduler.sampler, high=0.8, reserve_bytes=15 * GB).decide(['C:\\']).go
+
+
+def test_prune_until_room():
+    clock = Clock()
+    source = StaticStorageSource({C: (95 * GB, 95 * GB, 100 * GB)})
+    pruned = []
+
+    def prune(volume_name, sample):
+        pruned.append(volume_name)
+        source.set(C, sample.used - 10 * GB, sample.allocated, sample.maximum)
+        return True
+
+    scheduler = PressureScheduler(sampler(source, clock), high=0.8, prune=prune, sleep=clock.sleep)
+    assert scheduler.create_set(['C:\\'], lambda: 'created') == 'created'
+    assert pruned == ['C:\\', 'C:\\']
+    assert scheduler.waits == 0
+
+
+def test_wait_then_give_up():
+    clock = Clock()
+    source = StaticStorageSource({C: (95 * GB, 95 * GB, 100 * GB)})
+    scheduler = PressureScheduler(sampler(source, clock), high=0.8, prune=lambda volume_name, sample: False,
+                                  interval=30, max_wait=90, sleep=clock.sleep)
+    with pytest.raises(Exception, match='shadow storage pressure'):
+        scheduler.create_set(['C:\\'], lambda: 'created')
+    assert scheduler.waits == 3
+    assert clock.now == 1090.0
@@ -0,0 +1,88 @@
+'''
+    DiskCopyScheduler on fake snapshots of plain directory trees laid out with a StaticDiskResolver
+'''
+import pytest
+from alphavss import disks
+from alphavss.copier import SnapshotCopier
+from alphavss.disks import DiskCopyScheduler, StaticDiskResolver, group_volumes
+
+LAYOUT = {'C:': 'disk0', 'd:\\': 'disk0', 'E': 'disk1'}
+
+
+class FakeSnapshot(object):
+    '''
+        What the scheduler and the copier use of a VSSSnapshot: its volume and where it is exposed
+    '''
+    def __init__(self, volume_name, exposed_path):
+        self.volume_name = volume_name
+        self.exposed_path = exposed_path
+
+
+@pytest.fixture
+def snapshots(tmp_path):
+    result = []
+    for letter, count in [('C', 1), ('D', 3), ('E', 2), ('F', 1)]:
+        root = tmp_path / 'volumes' / letter
+        for number in range(count):
+            path = root / f'file{number}.txt'
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(letter.encode() * (number + 1))
+        result.append(FakeSnapshot(f'{letter}:\\', str(root)))
+
+    return result
+
+
+def test_static_resolver():
+    resolver = StaticDiskResolver(LAYOUT)
+    assert resolver('c:\\') == resolver('D:') == 'disk0'
+    assert resolver('E:\\') == 'disk1'
+    # volumes missing from the mapping are their own disk
+    assert resolver('f:\\') == 'F:'
+    assert group_volumes(['C:\\', 'E:\\', 'D:\\', 'F:\\'], resolver) == {
+        'disk0': ['C:\\', 'D:\\'], 'disk1': ['E:\\'], 'F:': ['F:\\']}
+
+
+def test_plan_groups_by_disk_biggest_first(snapshots, tmp_path):
+    sizes = {'C:\\': 10, 'D:\\': 30, 'E:\\': 5, 'F:\\': 1}
+    scheduler = DiskCopyScheduler(snapshots, str(tmp_path / 'copy'), resolver=StaticDiskResolver(LAYOUT),
+                                  size_of=lambda snapshot: sizes[snapshot.volume_name])
+    plan = {disk: [snapshot.volume_name for snapshot in group] for disk, group in scheduler.plan().items()}
+    assert plan == {'disk0': ['D:\\', 'C:\\'], 'disk1': ['E:\\'], 'F:': ['F:\\']}
+    scheduler.size_of = None
+    assert [snapshot.volume_name for snapshot in scheduler.plan()['disk0']] == ['C:\\', 'D:\\']
+
+
+def test_workers_per_disk(snapshots, tmp_path, monkeypatch):
+    workers = {}
+
+    class RecordingCopier(SnapshotCopier):
+        def __init__(self, snapshot, target, **kwargs):
+            workers[snapshot.volume_name] = kwargs['workers']
+            super().__init__(snapshot, target, **kwargs)
+
+    monkeypatch.setattr(disks, 'SnapshotCopier', RecordingCopier)
+    scheduler = DiskCopyScheduler(snapshots, str(tmp_path / 'copy'), resolver=StaticDiskResolver(LAYOUT),
+                                  workers_per_disk={'disk0': 1, 'disk1': 3, None: 2}, size_of=None)
+    results = scheduler.run()
+    assert workers == {'C:\\': 1, 'D:\\': 1, 'E:\\': 3, 'F:\\': 2}
+    assert {volume_name: stats.files for volume_name, stats in results.items()} == {
+        'C:\\': 1, 'D:\\': 3, 'E:\\': 2, 'F:\\': 1}
+    assert scheduler.total().files == 7
+    assert (tmp_path / 'copy' / 'D' / 'file2.txt').read_bytes() == b'DDD'
+    assert scheduler.workers_for('disk9') == 2
+
+
+def test_failed_disk_raises_after_the_others(snapshots, tmp_path, monkeypatch):
+    class FailingCopier(SnapshotCopier):
+        def copy(self, entries=None):
+            if self.snapshot.volume_name == 'E:\\':
+                raise OSError('disk1 is gone')
+            return super().copy(entries)
+
+    monkeypatch.setattr(disks, 'SnapshotCopier', FailingCopier)
+    scheduler = DiskCopyScheduler(snapshots, str(tmp_path / 'copy'), resolver=StaticDiskResolver(LAYOUT))
+    with pytest.raises(Exception, match='E:') as raised:
+        scheduler.run()
+    assert isinstance(raised.value.__cause__, OSError)
+    # the other disks were still copied
+    assert sorted(scheduler.results) == ['C:\\', 'D:\\', 'F:\\']
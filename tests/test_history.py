@@ -0,0 +1,108 @@
+'''
+    VersionIndex over fake snapshots of plain directory trees: lookups and prefix searches across segments
+'''
+import os
+import pytest
+from alphavss import history as history_module
+from alphavss.history import VersionIndex, normalize_path
+
+
+class FakeSnapshot(object):
+    '''
+        What the index uses of a VSSSnapshot: its ids, its volume and where it is exposed
+    '''
+    def __init__(self, number, exposed_path, volume_name='C:\\'):
+        self.snap_id = f'{{snap-{number}}}'
+        self.set_id = f'{{set-{number}}}'
+        self.volume_name = volume_name
+        self.exposed_path = exposed_path
+
+
+def write(root, rel_path, data):
+    path = root / rel_path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+
+@pytest.fixture
+def snapshots(tmp_path):
+    '''
+        3 snapshots of C: (Users/Bob/X.docx changes size every time, 100 files under Data, Data/old.txt goes away)
+    '''
+    result = []
+    for number in range(3):
+        root = tmp_path / f'snap{number}'
+        write(root, 'Users/Bob/X.docx', b'x' * (number + 1))
+        write(root, 'Users/Bobby/Y.docx', b'y')
+        for file_number in range(100):
+            write(root, f'Data/file{file_number:03}.bin', b'd')
+        if number == 0:
+            write(root, 'Data/old.txt', b'old')
+        result.append(FakeSnapshot(number, str(root)))
+
+    return result
+
+
+def test_normalize_path():
+    assert normalize_path('C:\\Users\\Bob\\X.docx') == 'c/users/bob/x.docx'
+    assert normalize_path('Users/Bob/X.docx', volume='C') == 'c/users/bob/x.docx'
+
+
+def test_history_across_segments(snapshots, tmp_path):
+    with VersionIndex(str(tmp_path / 'index')) as index:
+        for number, snapshot in enumerate(snapshots):
+            assert index.add_snapshot(snapshot, created=f'2026-10-1{number}')
+        assert not index.add_snapshot(snapshots[0])
+        assert len(index.catalog['segments']) == 3
+        versions = index.history('c:\\users\\bob\\x.docx')
+        assert [(version.snap_id, version.created, version.size) for version in versions] == [
+            ('{snap-0}', '2026-10-10', 1), ('{snap-1}', '2026-10-11', 2), ('{snap-2}', '2026-10-12', 3)]
+        assert [version.snap_id for version in index.history('Data/old.txt', volume='C')] == ['{snap-0}']
+        # past the first block of the sparse index
+        assert len(index.history('C:\\Data\\file099.bin')) == 3
+        assert index.history('C:\\Data\\missing.bin') == []
+
+    # and again from disk
+    with VersionIndex(str(tmp_path / 'index')) as index:
+        assert len(index.history('C:\\Users\\Bob\\X.docx')) == 3
+
+
+def test_search_across_segments(snapshots, tmp_path):
+    with VersionIndex(str(tmp_path / 'index')) as index:
+        for snapshot in snapshots:
+            index.add_snapshot(snapshot, created='2026-10-19')
+        found = [(key, [version.snap_id for version in versions]) for key, versions in index.search('C:\\Users')]
+        assert found == [('c/users/bob/x.docx', ['{snap-0}', '{snap-1}', '{snap-2}']),
+                         ('c/users/bobby/y.docx', ['{snap-0}', '{snap-1}', '{snap-2}'])]
+        # a trailing separator only matches inside the directory
+        assert [key for key, _ in index.search('C:\\Users\\Bob\\')] == ['c/users/bob/x.docx']
+        assert [key for key, _ in index.search('c:\\users\\bob')] == ['c/users/bob/x.docx', 'c/users/bobby/y.docx']
+        data = list(index.search('C:\\Data\\'))
+        assert len(data) == 101 and data[-1] == ('c/data/old.txt', index.history('C:\\Data\\old.txt'))
+        assert [key for key, _ in index.search('C:\\Data\\', limit=2)] == ['c/data/file000.bin', 'c/data/file001.bin']
+        assert list(index.search('D:\\')) == []
+
+
+def test_removed_snapshots_and_compaction(snapshots, tmp_path, monkeypatch):
+    monkeypatch.setattr(history_module, 'MAX_SEGMENTS', 2)
+    with VersionIndex(str(tmp_path / 'index')) as index:
+        for snapshot in snapshots:
+            index.add_snapshot(snapshot, created='2026-10-19')
+        # the third segment compacted everything into one
+        assert len(index.catalog['segments']) == 1
+        assert sorted(os.listdir(str(tmp_path / 'index'))) == ['catalog.json', index.catalog['segments'][0]]
+        assert len(index.history('C:\\Users\\Bob\\X.docx')) == 3
+
+        class FakeSet(object):
+            def __init__(self, snapshots):
+                self.snapshots = snapshots
+
+        assert index.update([FakeSet(snapshots[1:])]) == (0, 1)
+        assert [version.snap_id for version in index.history('C:\\Users\\Bob\\X.docx')] == ['{snap-1}', '{snap-2}']
+        assert list(index.search('C:\\Data\\old')) == []
+        index.compact()
+        assert [version.size for version in index.history('C:\\Users\\Bob\\X.docx')] == [2, 3]
+        # a snapshot that comes back is indexed again
+        assert index.update([FakeSet(snapshots)]) == (1, 0)
+        assert [version.snap_id for version in index.history('C:\\Users\\Bob\\X.docx')] == [
+            '{snap-1}', '{snap-2}', '{snap-0}']
@@ -0,0 +1,74 @@
+'''
+    ImageBackup against plain files: full image, changed blocks only, a volume that grows/shrinks, a crashed run
+'''
+import os
+import pytest
+from alphavss.image import ImageBackup, BlockMap
+
+BLOCK = 64 * 1024
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'volume.bin'
+    path.write_bytes(os.urandom(BLOCK * 20 + 8192))
+
+    return path
+
+
+def backup(source, target, **kwargs):
+    return ImageBackup(str(source), str(target), block_size=BLOCK, workers=4, **kwargs).run()
+
+
+def test_full_then_incremental(source, tmp_path):
+    target = tmp_path / 'volume.img'
+    stats = backup(source, target)
+    assert (stats.blocks, stats.changed) == (21, 21)
+    assert target.read_bytes() == source.read_bytes()
+
+    assert backup(source, target).changed == 0
+
+    with open(source, 'r+b') as volume:
+        volume.seek(BLOCK * 3 + 100)
+        volume.write(b'changed')
+        volume.seek(BLOCK * 20)
+        volume.write(b'tail')
+    stats = backup(source, target)
+    assert stats.changed == 2
+    assert stats.bytes_written == BLOCK + 8192
+    assert target.read_bytes() == source.read_bytes()
+
+
+def test_resize(source, tmp_path):
+    target = tmp_path / 'volume.img'
+    backup(source, target)
+    with open(source, 'ab') as volume:
+        volume.write(os.urandom(BLOCK))
+    # the short last block and the new one
+    assert backup(source, target).changed == 2
+    assert target.read_bytes() == source.read_bytes()
+
+    with open(source, 'r+b') as volume:
+        volume.truncate(BLOCK * 5)
+    assert backup(source, target).changed == 0
+    assert target.read_bytes() == source.read_bytes()
+
+
+def test_unclean_map_is_not_trusted(source, tmp_path):
+    target = tmp_path / 'volume.img'
+    backup(source, target)
+    # a run that died before its map was marked clean
+    BlockMap(f'{target}.blockmap', BLOCK, os.path.getsize(source)).close(clean=False)
+    assert backup(source, target).changed == 21
+
+
+def test_block_size_change_rewrites(source, tmp_path):
+    target = tmp_path / 'volume.img'
+    backup(source, target)
+    stats = ImageBackup(str(source), str(target), block_size=BLOCK * 2).run()
+    assert stats.changed == stats.blocks == 11
+
+
+def test_unaligned_block_size(source, tmp_path):
+    with pytest.raises(Exception, match='multiple of 4096'):
+        ImageBackup(str(source), str(tmp_path / 'volume.img'), block_size=1000)
@@ -0,0 +1,96 @@
+'''
+    InventoryWatcher on a StaticInventorySource: events, callbacks and the adaptive interval
+'''
+import uuid
+import asyncio
+import pytest
+from alphavss.inventory import (InventoryWatcher, StaticInventorySource, SnapshotEntry, ADDED, REMOVED, CHANGED,
+                                SET_ADDED, SET_REMOVED)
+
+VOLUME = '\\\\?\\Volume{00000000-0000-0000-0000-000000000001}\\'
+
+
+def entry(set_id, number):
+    return SnapshotEntry(str(uuid.uuid4()), set_id, VOLUME, f'\\\\?\\GLOBALROOT\\Device\\HarddiskVolumeShadowCopy{number}',
+                         None, None, 0, '2026-10-19T12:00:00')
+
+
+def kinds(events):
+    return sorted(event.kind for event in events)
+
+
+@pytest.fixture
+def source():
+    set_id = str(uuid.uuid4())
+
+    return StaticInventorySource([entry(set_id, 1), entry(set_id, 2)])
+
+
+def test_events(source):
+    watcher = InventoryWatcher(source)
+    assert kinds(watcher.poll()) == [ADDED, ADDED, SET_ADDED]
+    assert watcher.poll() == []
+    first, second = list(source.entries)
+    source.update(first, exposed_name='R:\\')
+    assert [(event.kind, event.snap_id) for event in watcher.poll()] == [(CHANGED, first)]
+    new_set = str(uuid.uuid4())
+    source.add(entry(new_set, 3))
+    source.remove(second)
+    assert kinds(watcher.poll()) == [ADDED, REMOVED, SET_ADDED]
+    source.remove(first)
+    events = watcher.poll()
+    assert kinds(events) == [REMOVED, SET_REMOVED]
+    assert len(watcher) == 1 and watcher.set_ids == [new_set]
+
+
+def test_initial_false_only_primes(source):
+    watcher = InventoryWatcher(source, initial=False)
+    assert watcher.poll() == []
+    assert len(watcher) == 2
+
+
+def test_interval_backoff(source):
+    now = [100.0]
+    watcher = InventoryWatcher(source, min_interval=5, max_interval=30, backoff=2, clock=lambda: now[0])
+    watcher.poll()
+    assert watcher.interval == 5 and watcher.last_poll == 100.0
+    intervals = []
+    for _ in range(4):
+        watcher.poll()
+        intervals.append(watcher.interval)
+    assert intervals == [10, 20, 30, 30]
+    source.add(entry(str(uuid.uuid4()), 4))
+    watcher.poll()
+    assert watcher.interval == 5
+    watcher.poll()
+    watcher.poke()
+    assert watcher.interval == 5
+
+
+def test_a_failing_callback_does_not_lose_events(source):
+    watcher = InventoryWatcher(source)
+    received = []
+
+    def failing(event):
+        raise ValueError(event.kind)
+
+    watcher.subscribe(failing)
+    watcher.subscribe(received.append)
+    events = watcher.poll()
+    assert received == events and len(events) == 3
+    assert watcher.callback_errors == 3
+
+
+def test_async_events(source):
+    watcher = InventoryWatcher(source, min_interval=0.01)
+
+    async def first_events(count):
+        received = []
+        async for event in watcher.events():
+            received.append(event)
+            if len(received) == count:
+                break
+
+        return received
+
+    assert kinds(asyncio.run(first_events(3))) == [ADDED, ADDED, SET_ADDED]
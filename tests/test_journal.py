@@ -0,0 +1,163 @@
+'''
+    BackupJob on fake (persistent) snapshot sets of plain directory trees: interrupted jobs resume from the journal
+'''
+import os
+from contextlib import contextmanager
+import pytest
+from alphavss.journal import BackupJob, BackupJournal, read_journal
+
+BIG_SIZE = 5000
+RANGE_SIZE = 1000
+
+
+class FakeSnapshot(object):
+    def __init__(self, volume_name, snap_id, exposed_path):
+        self.volume_name = volume_name
+        self.snap_id = snap_id
+        self.exposed_path = exposed_path
+
+
+class FakeSet(object):
+    def __init__(self, set_id, snapshots):
+        self.set_id = set_id
+        self.snapshots = snapshots
+
+
+class FakeProvider(object):
+    '''
+        query_snapshots() of a VSSProvider in a persistent context: the sets the jobs created that weren't deleted
+    '''
+    def __init__(self):
+        self.sets = []
+
+    def query_snapshots(self):
+        return list(self.sets)
+
+
+class FakeJob(BackupJob):
+    '''
+        BackupJob whose snapshots are the plain directory trees of roots ({volume_name: path})
+    '''
+    def __init__(self, roots, *args, **kwargs):
+        super().__init__(list(roots), *args, **kwargs)
+        self.roots = roots
+        self.created = 0
+        self.deleted = []
+
+    def create_set(self):
+        self.created += 1
+        vss_set = FakeSet(f'{{set-{self.created}}}', [FakeSnapshot(volume_name, f'{{snap-{self.created}-{number}}}', root)
+                                                      for number, (volume_name, root) in enumerate(self.roots.items())])
+        self.provider.sets.append(vss_set)
+
+        return vss_set
+
+    def delete_set(self, vss_set):
+        self.deleted.append(vss_set.set_id)
+        self.provider.sets.remove(vss_set)
+
+
+class FailingThrottle(object):
+    '''
+        Lets the first reads of the copy through, then fails every read (a disk that went away)
+    '''
+    def __init__(self, reads):
+        self.reads = reads
+
+    def acquire(self, nbytes=0, ops=1):
+        pass
+
+    @contextmanager
+    def read(self, nbytes=0):
+        self.reads -= 1
+        if self.reads < 0:
+            raise OSError(5, 'Input/output error')
+        yield
+
+
+@pytest.fixture
+def roots(tmp_path):
+    result = {}
+    for letter in 'CD':
+        root = tmp_path / 'volumes' / letter
+        for number in range(8):
+            path = root / f'dir{number % 2}' / f'file{number}.txt'
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(letter.encode() * (number + 1) * 10)
+        (root / 'big.bin').write_bytes(bytes(range(250)) * (BIG_SIZE // 250))
+        result[f'{letter}:\\'] = str(root)
+
+    return result
+
+
+def job(roots, tmp_path, provider, throttle=None):
+    return FakeJob(roots, str(tmp_path / 'target'), str(tmp_path / 'job.journal'), provider=provider,
+                   range_size=RANGE_SIZE, sync_every=1,
+                   copier_options={'workers': 1, 'buffer_size': 250, 'throttle': throttle})
+
+
+def same_trees(roots, target):
+    for volume_name, root in roots.items():
+        for directory, _, names in os.walk(root):
+            for name in names:
+                rel_path = os.path.relpath(os.path.join(directory, name), root)
+                with open(os.path.join(directory, name), 'rb') as src, \
+                        open(os.path.join(target, volume_name[0], rel_path), 'rb') as dst:
+                    assert src.read() == dst.read(), rel_path
+
+
+def test_resume_after_an_interrupted_job(roots, tmp_path):
+    provider = FakeProvider()
+    # C: makes it (250 bytes per read), the copy of D: fails part way
+    interrupted = job(roots, tmp_path, provider, FailingThrottle(8 + BIG_SIZE // 250 + 12))
+    with pytest.raises(Exception, match='run the job again'):
+        interrupted.run()
+    state = read_journal(str(tmp_path / 'job.journal'))
+    assert not state.finished and state.job['set_id'] == '{set-1}'
+    assert len(state.volumes_done) in (0, 1) and provider.sets
+    copied = sum(state.completed.values()) + sum(state.partial.values())
+    assert copied > 0
+
+    resumed = job(roots, tmp_path, provider)
+    results = resumed.run()
+    assert resumed.resumed and resumed.created == 0 and resumed.deleted == ['{set-1}']
+    total = 2 * (BIG_SIZE + sum((number + 1) * 10 for number in range(8)))
+    # only what the journal didn't have was copied again
+    assert sum(stats.bytes for stats in results.values()) == total - copied
+    same_trees(roots, str(tmp_path / 'target'))
+    assert read_journal(str(tmp_path / 'job.journal')).finished
+
+    # a finished job starts a new one
+    again = job(roots, tmp_path, provider)
+    again.run()
+    assert not again.resumed and again.created == 1
+
+
+def test_interrupted_job_whose_set_is_gone(roots, tmp_path):
+    provider = FakeProvider()
+    with pytest.raises(Exception, match='run the job again'):
+        job(roots, tmp_path, provider, FailingThrottle(3)).run()
+    provider.sets = []
+    restarted = job(roots, tmp_path, provider)
+    results = restarted.run()
+    assert not restarted.resumed and restarted.created == 1
+    assert sum(stats.files for stats in results.values()) == 18
+    assert read_journal(str(tmp_path / 'job.journal')).job['set_id'] == '{set-1}'
+
+
+def test_journal_drops_a_line_cut_short(tmp_path):
+    path = str(tmp_path / 'job.journal')
+    with BackupJournal(path, sync_every=100) as journal:
+        journal.start({'set_id': '{set}'})
+        journal.file_done('C/a.txt', 10)
+        journal.range_done('C/big.bin', 1000)
+        journal.range_done('C/big.bin', 2000)
+        journal.volume_done('C:')
+    with open(path, 'a', encoding='utf-8', newline='\n') as journal_file:
+        journal_file.write('F\t20\t"C/b.t')
+    state = read_journal(path)
+    assert state.completed == {'C/a.txt': 10} and state.partial == {'C/big.bin': 2000}
+    assert state.volumes_done == {'C:'} and not state.finished
+    with BackupJournal(path) as journal:
+        journal.file_done('C/b.txt', 20)
+    assert read_journal(path).completed == {'C/a.txt': 10, 'C/b.txt': 20}
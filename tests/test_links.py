@@ -0,0 +1,79 @@
+'''
+    SeenSet spills and merges, LinkTracker and the hard link copy on a plain directory tree
+'''
+import os
+import pytest
+from alphavss.links import SeenSet, LinkTracker, identity_key
+from alphavss.walker import SnapshotWalker
+from alphavss.copier import SnapshotCopier
+
+
+def key(number):
+    return identity_key(1, number)
+
+
+def test_seen_set_spills_and_merges(tmp_path):
+    # added out of order, so every run (and the merged run) has to be sorted
+    numbers = [(number * 37) % 101 for number in range(101)]
+    seen = SeenSet(memory_limit=10, max_runs=3, tmpdir=str(tmp_path))
+    for number in numbers:
+        assert seen.get(key(number)) is None
+        seen.add(key(number), f'path{number}')
+    assert seen.spills == 10 and len(seen._runs) <= 3
+    assert len(seen) == 101
+    for number in numbers:
+        assert seen.get(key(number)) == f'path{number}'
+    assert seen.get(key(101)) is None and seen.get(identity_key(2, 5)) is None
+    (run_dir,) = os.listdir(str(tmp_path))
+    # the merged runs and their side files are gone
+    assert len(os.listdir(str(tmp_path / run_dir))) == len(seen._runs)
+    seen.close()
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_seen_set_unicode_values(tmp_path):
+    seen = SeenSet(memory_limit=2, tmpdir=str(tmp_path))
+    for number, value in enumerate(['C/ä.txt', 'C/日本.txt', '', 'C/b.txt']):
+        seen.add(key(number), value)
+    assert [seen.get(key(number)) for number in range(4)] == ['C/ä.txt', 'C/日本.txt', '', 'C/b.txt']
+    seen.close()
+
+
+@pytest.fixture
+def linked_tree(tmp_path):
+    root = tmp_path / 'source'
+    (root / 'a').mkdir(parents=True)
+    (root / 'b').mkdir()
+    for number in range(30):
+        (root / 'a' / f'file{number}.txt').write_bytes(b'%d' % number)
+        os.link(root / 'a' / f'file{number}.txt', root / 'b' / f'link{number}.txt')
+    (root / 'single.txt').write_bytes(b'single')
+
+    return root
+
+
+def test_link_tracker(linked_tree):
+    entries = sorted((entry for entry in SnapshotWalker(str(linked_tree)) if entry.is_file()),
+                     key=lambda entry: entry.rel_path)
+    with LinkTracker(memory_limit=4) as tracker:
+        firsts = {entry.rel_path: tracker.check(entry, entry.rel_path) for entry in entries}
+        assert tracker.links == 30 and tracker.seen.spills > 0
+    assert firsts[os.path.join('b', 'link7.txt')] == os.path.join('a', 'file7.txt')
+    assert firsts[os.path.join('a', 'file7.txt')] is None and firsts['single.txt'] is None
+    with LinkTracker() as tracker:
+        # a file with a single link is only tracked with track_all
+        single = next(entry for entry in entries if entry.rel_path == 'single.txt')
+        assert tracker.check(single, 'x') is None and len(tracker.seen) == 0
+    with LinkTracker(track_all=True) as tracker:
+        assert tracker.check(single, 'x') is None and tracker.check(single, 'y') == 'x'
+
+
+def test_copy_hard_links(linked_tree, tmp_path):
+    target = tmp_path / 'copy'
+    copier = SnapshotCopier(str(linked_tree), str(target), workers=3, hard_links=True)
+    stats = copier.copy()
+    assert (stats.files, stats.errors, copier.links) == (61, 0, 30)
+    for number in range(30):
+        first = target / 'a' / f'file{number}.txt'
+        assert os.path.samefile(first, target / 'b' / f'link{number}.txt')
+        assert first.read_bytes() == b'%d' % number
@@ -0,0 +1,92 @@
+'''
+    ManifestBuilder on plain directory trees: the merge pass against the previous manifest, with and without spills
+'''
+import os
+import hashlib
+import pytest
+from alphavss.manifest import (ManifestBuilder, ManifestReader, ManifestEntry, sorted_entries, diff_manifests,
+                               ADDED, REMOVED, MODIFIED)
+
+MTIME = 1600000000
+
+
+def write(root, rel_path, data, mtime=MTIME):
+    path = root / rel_path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    os.utime(path, (mtime, mtime))
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / 'snapshot'
+    for number in range(12):
+        write(root, f'dir{number % 3}/file{number:02}.txt', b'%d' % number)
+
+    return root
+
+
+def change_paths(changes):
+    return sorted((change.kind, (change.new or change.old).path) for change in changes if change.kind != 'unchanged')
+
+
+def test_sorted_entries_spill(tmp_path):
+    entries = [ManifestEntry(f'f{number:03}', number, 0, 0, None) for number in range(50)]
+    reversed_entries = list(reversed(entries))
+    assert list(sorted_entries(reversed_entries, run_size=7, tmpdir=str(tmp_path))) == entries
+    assert list(sorted_entries(reversed_entries)) == entries
+    # the spilled runs are gone
+    assert os.listdir(str(tmp_path)) == []
+
+
+@pytest.mark.parametrize('run_size', [3, 1000])
+def test_incremental_changes(tree, tmp_path, run_size):
+    first = str(tmp_path / 'first.avm')
+    stats = ManifestBuilder(str(tree), first, hash_name='sha256', run_size=run_size, tmpdir=str(tmp_path)).build()
+    assert (stats.added, stats.hashed) == (12, 12)
+    entries = list(ManifestReader(first))
+    assert [entry.path for entry in entries] == sorted(entry.path for entry in entries)
+    assert entries[0].path == 'dir0/file00.txt' and entries[0].digest == hashlib.sha256(b'0').digest()
+
+    write(tree, 'dir1/file04.txt', b'changed', MTIME + 60)
+    write(tree, 'dir2/new.txt', b'new')
+    os.remove(tree / 'dir0' / 'file03.txt')
+    second = str(tmp_path / 'second.avm')
+    builder = ManifestBuilder(str(tree), second, previous=first, hash_name='sha256', run_size=run_size,
+                              tmpdir=str(tmp_path))
+    changed = sorted(entry.rel_path.replace(os.sep, '/') for entry in builder.changed_entries())
+    assert changed == ['dir1/file04.txt', 'dir2/new.txt']
+    assert str(builder.stats) == '1 added, 1 modified, 1 removed, 10 unchanged (2 hashed)'
+    assert change_paths(diff_manifests(first, second)) == [
+        (ADDED, 'dir2/new.txt'), (MODIFIED, 'dir1/file04.txt'), (REMOVED, 'dir0/file03.txt')]
+    digests = {entry.path: entry.digest for entry in ManifestReader(second)}
+    # the unchanged files kept the hash of the first manifest
+    assert digests['dir0/file06.txt'] == hashlib.sha256(b'6').digest()
+    assert digests['dir1/file04.txt'] == hashlib.sha256(b'changed').digest()
+
+
+def test_same_size_and_mtime_is_unchanged(tree, tmp_path):
+    first = str(tmp_path / 'first.avm')
+    ManifestBuilder(str(tree), first, file_ids=False, run_size=2).build()
+    write(tree, 'dir0/file00.txt', b'9')
+    stats = ManifestBuilder(str(tree), str(tmp_path / 'second.avm'), previous=first, file_ids=False, run_size=2).build()
+    assert (stats.modified, stats.unchanged, stats.hashed) == (0, 12, 0)
+
+
+def test_meta_and_bad_manifests(tree, tmp_path):
+    class FakeSnapshot(object):
+        volume_name = 'C:\\'
+        snap_id = '{1234}'
+        exposed_path = str(tree)
+
+    path = str(tmp_path / 'meta.avm')
+    ManifestBuilder(FakeSnapshot(), path, meta={'job': 'nightly'}).build()
+    assert ManifestReader(path).meta == {'hash': None, 'job': 'nightly', 'snap_id': '{1234}', 'volume_name': 'C:\\'}
+    (tmp_path / 'bad.avm').write_bytes(b'not a manifest')
+    with pytest.raises(Exception, match='bad magic'):
+        ManifestReader(str(tmp_path / 'bad.avm'))
+    with open(path, 'rb') as manifest_file:
+        data = manifest_file.read()
+    (tmp_path / 'truncated.avm').write_bytes(data[:-3])
+    with pytest.raises(Exception, match='Truncated'):
+        list(ManifestReader(str(tmp_path / 'truncated.avm')))
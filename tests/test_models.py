@@ -0,0 +1,159 @@
+'''
+    VSSSnapshotSet without Windows (models.py imported through a Replay): the snapshot set slot and deferred sets
+'''
+import json
+import uuid
+import pytest
+from alphavss.replay import Replay
+from alphavss.deadlines import VSSPhaseTimeout
+
+VOLUME = '\\\\?\\Volume{00000000-0000-0000-0000-000000000001}\\'
+SET_ID = uuid.uuid4()
+# what QuerySnapshots() returns: one snapshot set with a snapshot of C:
+SNAPSHOTS = [type('VssSnapshotProperties', (), {'SnapshotSetId': SET_ID, 'SnapshotId': uuid.uuid4(),
+                                                'OriginalVolumeName': VOLUME})()]
+
+
+class Components(object):
+    def __init__(self, created):
+        self.calls = []
+        created.append(self)
+
+    def __getattr__(self, name):
+        if name[0].isupper():
+            return lambda *args: self.calls.append(name)
+        raise AttributeError(name)
+
+    def GatherWriterMetadata(self):
+        self.calls.append('GatherWriterMetadata')
+
+    def IsVolumeSupported(self, volume_name):
+        return True
+
+    def StartSnapshotSet(self):
+        self.calls.append('StartSnapshotSet')
+        return str(uuid.uuid4())
+
+    def AddToSnapshotSet(self, volume_name):
+        return str(uuid.uuid4())
+
+    def QuerySnapshots(self):
+        return SNAPSHOTS
+
+
+class Factory(object):
+    def __init__(self):
+        self.created = []
+
+    def CreateVssBackupComponents(self):
+        return Components(self.created)
+
+
+@pytest.fixture
+def replay(tmp_path):
+    path = tmp_path / 'empty.trace'
+    path.write_text(json.dumps({'trace': 1, 'volumes': {'C:': VOLUME}}) + '\n')
+    with Replay(str(path), speed=0) as replay:
+        yield replay
+
+
+def new_set(replay, factory, **kwargs):
+    provider = replay.provider(operation='backup')
+    provider.factory = factory
+
+    return replay.models.VSSSnapshotSet(volume_names=['C:\\'], provider=provider, **kwargs)
+
+
+def slot_free(replay):
+    slot = replay.models._SNAPSHOT_SET_SLOT
+    if not slot.acquire(blocking=False):
+        return False
+    slot.release()
+
+    return True
+
+
+def test_deferred_set_does_not_hold_the_slot(replay):
+    factory = Factory()
+    vss_set = new_set(replay, factory, defer=True)
+    assert len(vss_set.snapshots) == 1
+    assert 'StartSnapshotSet' not in factory.created[0].calls
+    assert slot_free(replay)
+    vss_set.prepare()
+    assert not slot_free(replay)
+    vss_set.commit()
+    assert vss_set.created and slot_free(replay)
+    assert factory.created[0].calls[-2:] == ['PrepareForBackup', 'DoSnapshotSet']
+    # nothing to give up once created
+    assert not vss_set.abort()
+
+
+def test_slot_timeout(replay):
+    factory = Factory()
+    first = new_set(replay, factory, defer=True)
+    first.prepare()
+    second = new_set(replay, factory, defer=True, slot_timeout=0.05)
+    with pytest.raises(Exception, match='still being created'):
+        second.prepare()
+    assert second.snapshots == []
+    first.abort()
+    assert 'AbortBackup' in factory.created[0].calls
+    assert slot_free(replay)
+
+
+def test_context_manager_aborts(replay):
+    factory = Factory()
+    with pytest.raises(KeyError):
+        with new_set(replay, factory, defer=True) as vss_set:
+            vss_set.prepare()
+            raise KeyError('copy failed')
+    assert vss_set.prepared is None and vss_set.snapshots == []
+    assert slot_free(replay)
+
+
+def test_snapshot_setup_timeout_does_not_start_the_set(replay):
+    factory = Factory()
+    provider = replay.provider(operation='backup', deadlines={'GatherWriterMetadata': 0.05})
+    provider.factory = factory
+    original = Components.GatherWriterMetadata
+
+    def begin(components, callback, state):
+        # the set's GatherWriterMetadata completes, the one of its snapshot never does
+        done = len(factory.created) == 1
+        wait_handle = type('WaitHandle', (), {'WaitOne': lambda self, milliseconds: done})()
+
+        return type('AsyncResult', (), {'AsyncWaitHandle': wait_handle, 'Cancel': lambda self: None})()
+
+    Components.BeginGatherWriterMetadata = begin
+    Components.EndGatherWriterMetadata = lambda components, result: original(components)
+    try:
+        with pytest.raises(VSSPhaseTimeout):
+            replay.models.VSSSnapshotSet(volume_names=['C:\\'], provider=provider)
+    finally:
+        del Components.BeginGatherWriterMetadata, Components.EndGatherWriterMetadata
+    set_components, snapshot_components = factory.created
+    assert 'StartSnapshotSet' not in set_components.calls
+    assert 'AbortBackup' not in set_components.calls
+    assert 'AbortBackup' in snapshot_components.calls
+    assert slot_free(replay)
+
+
+def test_context_manager_keeps_the_snapshots_of_a_query_set(replay):
+    factory = Factory()
+    provider = replay.provider(operation='query')
+    provider.factory = factory
+    vss_sets = provider.query_snapshots()
+    assert len(vss_sets) == 1
+    with vss_sets[0] as vss_set:
+        assert vss_set.operation == 'query'
+    assert len(vss_set.snapshots) == 1 and vss_set.snapshots[0].volume_name == 'C:\\'
+    assert not vss_set.abort()
+    assert len(vss_set.snapshots) == 1
+
+
+def test_explicit_resolver_bypasses_the_volume_index(replay):
+    models = replay.models
+    assert models.warm_volume_index() == {'C:': VOLUME}
+    assert models.get_drives(filter_letter='c:') == {'C:': VOLUME}
+    with pytest.raises(Exception, match='Unknown volume resolver'):
+        models.get_drives(resolver='bogus')
@@ -0,0 +1,52 @@
+'''
+    BackupPipeline of a plain directory tree to an archive: records, hard links and the restore of the archive
+'''
+import os
+import pytest
+from alphavss.archive import iter_archive, FileRecord, EndRecord, LinkRecord
+from alphavss.pipeline import BackupPipeline
+from alphavss.restore import SnapshotRestorer, ArchiveSource
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / 'source'
+    (root / 'big').mkdir(parents=True)
+    # the first path of every linked file is big, its links are seen while it is still being read
+    for number in range(4):
+        (root / 'big' / f'file{number}.bin').write_bytes(os.urandom(64 * 1024))
+        os.link(root / 'big' / f'file{number}.bin', root / f'link{number}.bin')
+    (root / 'small.txt').write_bytes(b'small')
+
+    return root
+
+
+def test_links_come_after_their_target(tree, tmp_path):
+    archive = str(tmp_path / 'backup.avss')
+    stats = BackupPipeline(str(tree), archive, codec='none', readers=4, compressors=0, chunk_size=1024,
+                           hard_links=True).run()
+    assert stats.files == 5
+    ended = set()
+    paths = {}
+    links = []
+    with open(archive, 'rb') as stream:
+        for record in iter_archive(stream):
+            if isinstance(record, FileRecord):
+                paths[record.file_id] = record.path
+            elif isinstance(record, EndRecord):
+                ended.add(paths[record.file_id])
+            elif isinstance(record, LinkRecord):
+                assert record.target in ended, f'{record.path} comes before the end of {record.target}'
+                links.append(record.path)
+    assert len(links) == 4
+
+    source = ArchiveSource(archive)
+    try:
+        restored = SnapshotRestorer(source, str(tmp_path / 'restored')).run()
+    finally:
+        source.close()
+    assert restored.errors == 0
+    for number in range(4):
+        first, link = sorted([f'big/file{number}.bin', f'link{number}.bin'])
+        assert os.path.samefile(tmp_path / 'restored' / first, tmp_path / 'restored' / link)
+        assert (tmp_path / 'restored' / link).read_bytes() == (tree / link).read_bytes()
@@ -0,0 +1,113 @@
+'''
+    PrefetchReader on plain files: the planned order, read errors and failures of the plan or a reader
+'''
+import os
+import hashlib
+import threading
+import pytest
+from alphavss import prefetch
+from alphavss.prefetch import PrefetchReader, hash_files
+
+BLOCK = 4096
+
+
+@pytest.fixture
+def files(tmp_path):
+    paths = []
+    for number, size in enumerate([0, 100, BLOCK, BLOCK * 5 + 7, 3000, BLOCK * 3]):
+        path = tmp_path / f'file{number}.bin'
+        path.write_bytes(os.urandom(size))
+        paths.append(str(path))
+
+    return paths
+
+
+def digests(paths):
+    found = []
+    for path in paths:
+        with open(path, 'rb') as src:
+            found.append((path, hashlib.sha256(src.read()).hexdigest()))
+
+    return found
+
+
+def run_with_timeout(target, seconds=20):
+    outcome = []
+
+    def run():
+        try:
+            outcome.append(target())
+        except BaseException as e: #pylint:disable=W0703
+            outcome.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(seconds)
+    assert not thread.is_alive(), 'hung'
+
+    return outcome[0]
+
+
+def test_blocks_in_order(files):
+    reader = PrefetchReader(files, block_size=BLOCK, budget=BLOCK * 4, workers=3)
+    assert [(entry.path, digest) for entry, digest in hash_files(files, block_size=BLOCK, budget=BLOCK * 4,
+                                                                workers=3)] == digests(files)
+    offsets = [(block.entry.path, block.offset) for block in reader]
+    assert offsets == sorted(offsets, key=lambda item: (files.index(item[0]), item[1]))
+    assert reader.stats.files == len(files) and reader.stats.errors == 0
+
+
+def test_missing_file(files, tmp_path):
+    planned = files[:2] + [str(tmp_path / 'missing.bin')] + files[2:]
+    results = list(hash_files(planned, block_size=BLOCK, workers=2))
+    assert results[2][1] is None
+    assert [(entry.path, digest) for entry, digest in results if digest is not None] == digests(files)
+
+
+def test_read_error_mid_file(files, monkeypatch):
+    # the third block of the big file fails while its other blocks are in flight
+    big = files[3]
+
+    class FailingFile(object):
+        def __init__(self, path):
+            self.path = path
+            self.file = open(path, 'rb', buffering=0)
+
+        def seek(self, offset):
+            if self.path == big and offset == 2 * BLOCK:
+                raise OSError(5, 'Input/output error')
+            return self.file.seek(offset)
+
+        def __getattr__(self, name):
+            return getattr(self.file, name)
+
+    monkeypatch.setattr(prefetch, 'open', lambda path, *args, **kwargs: FailingFile(path), raising=False)
+    results = list(hash_files(files, block_size=BLOCK, budget=BLOCK * 16, workers=4))
+    assert [entry.path for entry, _ in results] == files
+    assert dict((entry.path, digest) for entry, digest in results)[big] is None
+    assert [(entry.path, digest) for entry, digest in results if entry.path != big] == [
+        item for item in digests(files) if item[0] != big]
+
+
+def test_plan_error_is_raised_after_the_planned_blocks(files):
+    def plan():
+        yield from files[:3]
+        raise ValueError('walker failed')
+
+    reader = PrefetchReader(plan(), block_size=BLOCK, workers=3)
+    delivered = []
+    with pytest.raises(ValueError, match='walker failed'):
+        for block in reader:
+            delivered.append(block.entry.path)
+    assert sorted(set(delivered)) == sorted(files[:3])
+    assert reader.stats.files == 3
+
+
+def test_reader_error_is_raised(files):
+    class Throttle(object):
+        def read(self, nbytes=0):
+            raise RuntimeError('throttle failed')
+
+    reader = PrefetchReader(files, block_size=BLOCK, workers=3, throttle=Throttle())
+    result = run_with_timeout(lambda: list(reader))
+    assert isinstance(result, RuntimeError)
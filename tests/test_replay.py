@@ -0,0 +1,115 @@
+'''
+    Record/replay of the asynchronous VSS phases (Begin<phase> / End<phase>) that run_phase() uses with a deadline
+'''
+import time
+import types
+import threading
+import pytest
+from alphavss.replay import Recorder, Replay, ReplayAsyncResult
+from alphavss.deadlines import run_phase, VSSPhaseTimeout
+
+
+class WaitHandle(object):
+    def __init__(self, done):
+        self.done = done
+
+    def WaitOne(self, milliseconds):
+        return self.done.wait(milliseconds / 1000)
+
+
+class AsyncResult(object):
+    def __init__(self, seconds):
+        self.done = threading.Event()
+        self.AsyncWaitHandle = WaitHandle(self.done)
+        self.cancelled = False
+        self.timer = threading.Timer(seconds, self.done.set)
+        self.timer.start()
+
+    def Cancel(self):
+        self.cancelled = True
+        self.timer.cancel()
+
+
+class Components(object):
+    '''
+        PrepareForBackup runs for seconds
+    '''
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.ended = []
+        self.aborted = False
+
+    def BeginPrepareForBackup(self, callback, state):
+        return AsyncResult(self.seconds)
+
+    def EndPrepareForBackup(self, result):
+        # the real async result, not the recording proxy
+        assert isinstance(result, AsyncResult)
+        self.ended.append(result)
+
+    def AbortBackup(self):
+        self.aborted = True
+
+    def Dispose(self):
+        pass
+
+
+class Factory(object):
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def CreateVssBackupComponents(self):
+        return Components(self.seconds)
+
+
+def record(path, seconds, deadline):
+    provider = types.SimpleNamespace(factory=Factory(seconds))
+    with Recorder(provider, str(path), volumes={}):
+        components = provider.factory.CreateVssBackupComponents()
+        try:
+            run_phase(components, 'PrepareForBackup', deadline=deadline)
+        except VSSPhaseTimeout:
+            pass
+
+
+def replay_phase(path, deadline, speed=0):
+    replay = Replay(str(path), speed=speed, strict=True)
+    components = replay.factory.CreateVssBackupComponents()
+    start = time.monotonic()
+    run_phase(components, 'PrepareForBackup', deadline=deadline)
+
+    return replay, time.monotonic() - start
+
+
+def test_async_phase_replayed(tmp_path):
+    path = tmp_path / 'prepare.trace'
+    record(path, 0.2, deadline=5)
+    replay, elapsed = replay_phase(path, deadline=5)
+    assert elapsed < 0.1
+    # the time the phase ran is part of the recorded time
+    assert replay.stats.calls == 3
+    assert replay.stats.recorded >= 0.2
+    replay, elapsed = replay_phase(path, deadline=5, speed=1.0)
+    assert elapsed >= 0.15
+
+
+def test_async_phase_replayed_past_a_shorter_deadline(tmp_path):
+    path = tmp_path / 'prepare.trace'
+    record(path, 0.3, deadline=5)
+    with pytest.raises(VSSPhaseTimeout) as error:
+        replay_phase(path, deadline=0.05, speed=1.0)
+    # the trace has no AbortBackup (the phase completed when it was recorded): the replay diverged there
+    assert not error.value.info.aborted
+    assert 'replay diverged' in error.value.info.abort_error
+
+
+def test_timed_out_phase_never_completes(tmp_path):
+    path = tmp_path / 'timeout.trace'
+    record(path, 5, deadline=0.05)
+    components = Replay(str(path), speed=0, strict=True).factory.CreateVssBackupComponents()
+    result = components.BeginPrepareForBackup(None, None)
+    assert isinstance(result, ReplayAsyncResult)
+    assert not result.AsyncWaitHandle.WaitOne(10)
+    with pytest.raises(VSSPhaseTimeout) as error:
+        replay_phase(path, deadline=0.05)
+    assert error.value.info.aborted
@@ -0,0 +1,85 @@
+'''
+    Restore from archives written with an ArchiveWriter: paths that would land outside of the target are refused
+'''
+import os
+import pytest
+from alphavss.archive import ArchiveWriter, CODEC_NONE
+from alphavss.restore import SnapshotRestorer, ArchiveSource
+
+
+def write_archive(path, files, links=()):
+    with open(path, 'wb') as stream:
+        writer = ArchiveWriter(stream)
+        for file_id, (name, data) in enumerate(files, 1):
+            writer.start_file(file_id, name, 0o644, len(data), 0)
+            writer.write_chunk(file_id, 0, CODEC_NONE, len(data), data)
+            writer.end_file(file_id)
+        for name, target in links:
+            writer.write_link(name, target)
+        writer.close()
+
+
+def restore(tmp_path, files, links=()):
+    archive = str(tmp_path / 'backup.avss')
+    write_archive(archive, files, links)
+    target = tmp_path / 'target'
+    target.mkdir()
+    errors = []
+    source = ArchiveSource(archive)
+    try:
+        stats = SnapshotRestorer(source, str(target), workers=2,
+                                 onerror=lambda path, e: errors.append(path)).run()
+    finally:
+        source.close()
+
+    return target, stats, errors
+
+
+def test_restore_files_and_links(tmp_path):
+    target, stats, errors = restore(tmp_path, [('C/a.txt', b'a' * 10), ('C/d/b.txt', b'b')], [('C/c.txt', 'C/a.txt')])
+    assert not errors
+    assert stats.files == 3
+    assert (target / 'C' / 'd' / 'b.txt').read_bytes() == b'b'
+    assert (target / 'C' / 'c.txt').read_bytes() == b'a' * 10
+
+
+@pytest.mark.parametrize('name', ['../escaped.txt', 'C/../../escaped.txt', '/escaped.txt', 'C:/escaped.txt',
+                                  'C:escaped.txt', '\\\\server\\share\\escaped.txt'])
+def test_paths_outside_of_the_target_are_refused(tmp_path, name):
+    target, stats, errors = restore(tmp_path, [(name, b'x'), ('C/ok.txt', b'ok')])
+    assert errors == [name]
+    assert stats.errors == 1
+    assert (target / 'C' / 'ok.txt').read_bytes() == b'ok'
+    assert not (tmp_path / 'escaped.txt').exists()
+    assert not os.path.exists('/escaped.txt')
+
+
+def test_link_outside_of_the_target_is_refused(tmp_path):
+    target, _, errors = restore(tmp_path, [('C/a.txt', b'a')], [('../escaped.txt', 'C/a.txt'),
+                                                                ('C/b.txt', '../../etc/passwd')])
+    assert sorted(errors) == ['../escaped.txt', 'C/b.txt']
+    assert not (tmp_path / 'escaped.txt').exists()
+    assert not (target / 'C' / 'b.txt').exists()
+
+
+def test_target_path(tmp_path):
+    restorer = SnapshotRestorer(None, str(tmp_path))
+    assert restorer.target_path('C/./a/b.txt') == os.path.join(str(tmp_path), 'C', 'a', 'b.txt')
+    assert restorer.target_path('') == str(tmp_path)
+    with pytest.raises(Exception, match='Unsafe path'):
+        restorer.target_path('C/a/../../..')
+
+
+def test_raising_onerror_stops_the_restore(tmp_path):
+    archive = str(tmp_path / 'backup.avss')
+    write_archive(archive, [(f'../escaped{number}.txt', b'x') for number in range(500)])
+    source = ArchiveSource(archive)
+
+    def onerror(path, e):
+        raise RuntimeError(f'giving up on {path}')
+
+    try:
+        with pytest.raises(RuntimeError, match='giving up'):
+            SnapshotRestorer(source, str(tmp_path / 'target'), workers=2, onerror=onerror).run()
+    finally:
+        source.close()
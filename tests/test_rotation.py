@@ -0,0 +1,121 @@
+'''
+    Pipelined rotation with fake sets: when the next set takes the snapshot set slot, failures and stop()
+'''
+import time
+import threading
+import pytest
+from alphavss.rotation import RotationScheduler
+
+COPY = 0.3
+PREPARE = 0.05
+
+
+class FakeSet(object):
+    '''
+        prepare() takes the (single) snapshot set slot, commit() / abort() give it back
+    '''
+    slot = threading.Lock()
+
+    def __init__(self, number, events, fail_prepare=False):
+        self.number = number
+        self.events = events
+        self.fail_prepare = fail_prepare
+        self.snapshots = []
+        self.state = 'deferred'
+
+    def prepare(self):
+        if self.fail_prepare:
+            raise Exception('writer error')
+        assert self.slot.acquire(blocking=False), 'two sets started at once'
+        self.events.append(('prepare', self.number, time.monotonic()))
+        time.sleep(PREPARE)
+        self.state = 'prepared'
+
+    def commit(self):
+        assert self.state == 'prepared'
+        self.events.append(('commit', self.number, time.monotonic()))
+        self.state = 'created'
+        self.slot.release()
+
+    def abort(self):
+        if self.state == 'prepared':
+            self.slot.release()
+        if self.state != 'created':
+            self.state = 'aborted'
+
+
+class Sets(object):
+    def __init__(self, fail_prepare=()):
+        self.events = []
+        self.created = []
+        self.fail_prepare = fail_prepare
+
+    def __call__(self):
+        vss_set = FakeSet(len(self.created) + 1, self.events, len(self.created) + 1 in self.fail_prepare)
+        self.created.append(vss_set)
+
+        return vss_set
+
+    def times(self, kind):
+        return {number: at for event, number, at in self.events if event == kind}
+
+
+def copier(sets, seconds=COPY, fail=None):
+    copies = {}
+
+    def copy(vss_set):
+        copies[vss_set.number] = time.monotonic()
+        if fail is not None and vss_set.number == fail:
+            raise Exception('copy failed')
+        time.sleep(seconds)
+
+    return copy, copies
+
+
+def test_next_set_starts_near_the_end_of_the_copy():
+    sets = Sets()
+    copy, copies = copier(sets)
+    deleted = []
+    scheduler = RotationScheduler(['C:\\'], copy, keep=2, create_set=sets, delete_set=deleted.append)
+    stats = scheduler.run(cycles=3)
+    assert stats.created == 3
+    assert [vss_set.state for vss_set in sets.created] == ['created'] * 3
+    assert deleted == [sets.created[0]]
+    prepares = sets.times('prepare')
+    # the first copy has no estimate: the next set starts after it
+    assert prepares[2] >= copies[1] + COPY
+    # then it starts about PREPARE before the copy ends, not when it begins
+    assert copies[2] + COPY - PREPARE - 0.05 <= prepares[3] < copies[2] + COPY
+
+
+def test_failed_copy_gives_up_the_next_set():
+    sets = Sets()
+    copy, _ = copier(sets, fail=2)
+    scheduler = RotationScheduler(['C:\\'], copy, create_set=sets, delete_set=lambda vss_set: None)
+    with pytest.raises(Exception, match='copy failed'):
+        scheduler.run(cycles=5)
+    assert [vss_set.state for vss_set in sets.created] == ['created', 'created', 'aborted']
+    # never started: the slot is free
+    assert FakeSet.slot.acquire(blocking=False)
+    FakeSet.slot.release()
+
+
+def test_stop_during_a_copy():
+    sets = Sets()
+    copy, _ = copier(sets)
+    scheduler = RotationScheduler(['C:\\'], copy, create_set=sets, delete_set=lambda vss_set: None)
+    threading.Timer(COPY / 2, scheduler.stop).start()
+    stats = scheduler.run()
+    assert stats.created == 1
+    assert [vss_set.state for vss_set in sets.created] == ['created', 'aborted']
+    assert 2 not in sets.times('prepare')
+
+
+def test_failed_prepare_is_retried_in_line():
+    sets = Sets(fail_prepare=(2,))
+    copy, _ = copier(sets, seconds=0.01)
+    scheduler = RotationScheduler(['C:\\'], copy, create_set=sets, delete_set=lambda vss_set: None)
+    stats = scheduler.run(cycles=2)
+    assert stats.created == 2
+    assert stats.prepare_retries == 1
+    assert [vss_set.state for vss_set in sets.created] == ['created', 'aborted', 'created']
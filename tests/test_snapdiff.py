@@ -0,0 +1,110 @@
+'''
+    SnapshotDiff between two plain directory trees: what is added, removed, modified or touched
+'''
+import os
+from contextlib import contextmanager
+import pytest
+from alphavss.snapdiff import SnapshotDiff, ADDED, REMOVED, MODIFIED, TOUCHED
+
+MTIME = 1600000000
+
+
+def write(root, rel_path, data, mtime=MTIME):
+    path = root / rel_path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    os.utime(path, (mtime, mtime))
+
+
+@pytest.fixture
+def trees(tmp_path):
+    old = tmp_path / 'old'
+    new = tmp_path / 'new'
+    for root in (old, new):
+        write(root, 'same.txt', b'same')
+        write(root, 'docs/same.txt', b'same')
+        write(root, 'logs/keep.log', b'log')
+    write(old, 'removed.txt', b'gone')
+    write(new, 'added.txt', b'new')
+    write(old, 'resized.txt', b'short')
+    write(new, 'resized.txt', b'longer')
+    write(old, 'docs/rewritten.txt', b'aaaa')
+    write(new, 'docs/rewritten.txt', b'bbbb', MTIME + 60)
+    write(old, 'docs/touched.txt', b'cccc')
+    write(new, 'docs/touched.txt', b'cccc', MTIME + 60)
+    write(new, 'newdir/a.txt', b'a')
+    write(new, 'newdir/sub/b.txt', b'b')
+    write(old, 'olddir/c.txt', b'c')
+
+    return old, new
+
+
+def changes(old, new, **kwargs):
+    return sorted((change.kind, change.path.replace(os.sep, '/')) for change in SnapshotDiff(str(old), str(new),
+                                                                                             workers=3, **kwargs))
+
+
+def test_diff(trees):
+    old, new = trees
+    diff = SnapshotDiff(str(old), str(new), workers=3)
+    assert sorted((change.kind, change.path.replace(os.sep, '/')) for change in diff) == [
+        (ADDED, 'added.txt'), (ADDED, 'newdir'), (ADDED, 'newdir/a.txt'), (ADDED, 'newdir/sub'),
+        (ADDED, 'newdir/sub/b.txt'), (MODIFIED, 'docs/rewritten.txt'), (MODIFIED, 'resized.txt'),
+        (REMOVED, 'olddir'), (REMOVED, 'olddir/c.txt'), (REMOVED, 'removed.txt')]
+    # only the files of the same size and a different mtime are hashed
+    assert diff.hashed == 2
+
+
+def test_touched_and_not_expanded(trees):
+    old, new = trees
+    found = changes(old, new, report_touched=True, expand=False, exclude=['*.log', 'resized.txt'])
+    assert (TOUCHED, 'docs/touched.txt') in found
+    assert (ADDED, 'newdir') in found and (ADDED, 'newdir/a.txt') not in found
+    assert (REMOVED, 'olddir') in found and (REMOVED, 'olddir/c.txt') not in found
+    assert not any(path == 'resized.txt' for _, path in found)
+
+
+def test_trust_dir_mtime(trees):
+    old, new = trees
+    for root in (old, new):
+        os.utime(root / 'docs', (MTIME, MTIME))
+    diff = SnapshotDiff(str(old), str(new), trust_dir_mtime=True)
+    found = sorted(change.path.replace(os.sep, '/') for change in diff)
+    # the files of docs were rewritten in place: the directory mtime doesn't tell
+    assert 'docs/rewritten.txt' not in found and 'resized.txt' in found
+    assert diff.pruned >= 1
+    assert (MODIFIED, 'docs/rewritten.txt') in changes(old, new)
+
+
+def test_raising_onerror_stops_the_diff(tmp_path):
+    def onerror(e):
+        raise e
+
+    (tmp_path / 'new').mkdir()
+    with pytest.raises(FileNotFoundError):
+        list(SnapshotDiff(str(tmp_path / 'missing'), str(tmp_path / 'new'), workers=4, onerror=onerror))
+
+
+def test_throttle(trees):
+    class Throttle(object):
+        def __init__(self):
+            self.nbytes = 0
+            self.ops = 0
+
+        def acquire(self, nbytes=0, ops=1):
+            self.nbytes += nbytes
+            self.ops += ops
+
+        @contextmanager
+        def read(self, nbytes=0):
+            self.acquire(nbytes)
+            yield
+
+    old, new = trees
+    throttle = Throttle()
+    diff = SnapshotDiff(str(old), str(new), throttle=throttle)
+    list(diff)
+    # 9 directory listings (root, docs and logs in both, newdir, newdir/sub, olddir), 2 files hashed on both sides:
+    # a read of their 4 bytes and the read that finds the end of the file
+    assert throttle.ops == 9 + 2 * 2 * 2
+    assert throttle.nbytes == 2 * 2 * (4 + 1)
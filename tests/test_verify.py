@@ -0,0 +1,64 @@
+'''
+    SnapshotVerifier on plain directory trees: the manifest, the .mismatch list, resuming and the throttle
+'''
+import pytest
+from alphavss.verify import SnapshotVerifier, verify_manifest
+
+
+class CountingThrottle(object):
+    '''
+        VolumeThrottle stand-in counting what is acquired
+    '''
+    def __init__(self):
+        self.nbytes = 0
+        self.ops = 0
+
+    def acquire(self, nbytes=0, ops=1):
+        self.nbytes += nbytes
+        self.ops += ops
+
+
+@pytest.fixture
+def trees(tmp_path):
+    source = tmp_path / 'source'
+    copy = tmp_path / 'copy'
+    for root in (source, copy):
+        (root / 'docs').mkdir(parents=True)
+        (root / 'a.txt').write_bytes(b'a' * 100)
+        (root / 'docs' / 'b.txt').write_bytes(b'b' * 200)
+    (source / 'docs' / 'changed.txt').write_bytes(b'old')
+    (copy / 'docs' / 'changed.txt').write_bytes(b'new')
+    (source / 'not copied.txt').write_bytes(b'*')
+
+    return source, copy
+
+
+def test_verify_and_resume(trees, tmp_path):
+    source, copy = trees
+    manifest = str(tmp_path / 'copy.sha256')
+    stats = SnapshotVerifier(str(source), str(copy), manifest, workers=2).run()
+    assert (stats.files, stats.ok, stats.mismatched, stats.missing) == (4, 2, 1, 1)
+    with open(f'{manifest}.mismatch', encoding='utf-8') as mismatches:
+        lines = mismatches.read().splitlines()
+    assert sorted(line.partition(' ')[0] for line in lines) == ['MISMATCH', 'MISSING']
+    assert sorted(line.partition(' *')[2] for line in lines) == ['docs/changed.txt', 'not copied.txt']
+
+    # nothing is hashed again, the files that failed still count
+    stats = SnapshotVerifier(str(source), str(copy), manifest, workers=2).run()
+    assert (stats.files, stats.resumed, stats.mismatched, stats.missing) == (0, 4, 1, 1)
+    assert not stats.verified
+    with open(f'{manifest}.mismatch', encoding='utf-8') as mismatches:
+        assert mismatches.read().splitlines() == lines
+
+    stats, failed = verify_manifest(manifest, str(copy), workers=2)
+    assert stats.ok == 2 and not failed
+
+
+def test_throttle(trees, tmp_path):
+    source, _ = trees
+    throttle = CountingThrottle()
+    stats = SnapshotVerifier(str(source), None, str(tmp_path / 'source.sha256'), workers=1, throttle=throttle).run()
+    assert stats.ok == 4
+    assert throttle.nbytes == 100 + 200 + 3 + 1
+    # the directory scans of the walker, and every file
+    assert throttle.ops == 2 + 4
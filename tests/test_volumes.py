@@ -0,0 +1,64 @@
+'''
+    volumes.py without Windows: the mount path parsing and the NativeVolumeResolver against a StaticVolumeAPI
+'''
+from alphavss.volumes import (parse_multi_sz, mount_key, parse_wmi_volume_ref, NativeVolumeResolver, StaticVolumeAPI,
+                              DRIVE_FIXED)
+
+SYSTEM = '\\\\?\\Volume{00000000-0000-0000-0000-000000000001}\\'
+DATA = '\\\\?\\Volume{00000000-0000-0000-0000-000000000002}\\'
+USB = '\\\\?\\Volume{00000000-0000-0000-0000-000000000003}\\'
+RESERVED = '\\\\?\\Volume{00000000-0000-0000-0000-000000000004}\\'
+
+
+def resolver(**kwargs):
+    return NativeVolumeResolver(api=StaticVolumeAPI({
+        SYSTEM: (['C:\\'], DRIVE_FIXED, 'NTFS'),
+        # a folder mount listed before its drive letter
+        DATA: (['C:\\Mounts\\Data\\', 'D:\\'], DRIVE_FIXED, 'ReFS'),
+        USB: (['E:\\'], 2, 'FAT32'),
+        RESERVED: ([], DRIVE_FIXED, 'NTFS'),
+    }), **kwargs)
+
+
+def test_parse_multi_sz():
+    assert parse_multi_sz('C:\\\0D:\\Mounts\\Data\\\0\0') == ['C:\\', 'D:\\Mounts\\Data\\']
+    assert parse_multi_sz('\0') == []
+    assert parse_multi_sz('') == []
+    # whatever follows the empty string that ends the list is not a path
+    assert parse_multi_sz('C:\\\0\0garbage\0') == ['C:\\']
+
+
+def test_mount_key():
+    assert mount_key('C:\\') == 'C:'
+    assert mount_key('c:') == 'C:'
+    assert mount_key('d:\\Mounts\\Data\\') == 'D:\\Mounts\\Data'
+
+
+def test_parse_wmi_volume_ref():
+    assert parse_wmi_volume_ref('Win32_Volume.DeviceID="\\\\\\\\?\\\\Volume{1}\\\\"') == '\\\\?\\Volume{1}\\'
+    assert parse_wmi_volume_ref('Win32_Volume.Name="C:\\\\"') is None
+
+
+def test_volumes_sorted_and_filtered():
+    volumes = {volume.guid_path: volume for volume in resolver().volumes()}
+    # fixed disks only, by default
+    assert set(volumes) == {SYSTEM, DATA, RESERVED}
+    # drive letters first
+    assert volumes[DATA].mount_paths == ['D:\\', 'C:\\Mounts\\Data\\']
+    assert volumes[DATA].filesystem == 'ReFS'
+    assert {volume.guid_path for volume in resolver(drive_types=None).volumes()} == {SYSTEM, DATA, USB, RESERVED}
+
+
+def test_get_drives_with_folder_mounts():
+    assert resolver().get_drives() == {'C:': SYSTEM, 'D:': DATA, 'C:\\Mounts\\Data': DATA}
+    assert resolver().get_drives(mount_folders=False) == {'C:': SYSTEM, 'D:': DATA}
+
+
+def test_get_drives_filter_letter():
+    assert resolver().get_drives(filter_letter='d:') == {'D:': DATA}
+    assert resolver().get_drives(filter_letter='E:') == {}
+    assert resolver(drive_types=None).get_drives(filter_letter='E:') == {'E:': USB}
+
+
+def test_mount_paths():
+    assert resolver().mount_paths()[RESERVED] == []
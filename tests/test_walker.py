@@ -0,0 +1,81 @@
+'''
+    SnapshotWalker on a plain directory tree: globs, batches and errors
+'''
+import os
+import threading
+import pytest
+from alphavss.walker import SnapshotWalker, compile_globs, match_globs
+
+
+@pytest.fixture
+def tree(tmp_path):
+    for rel_path in ['a.txt', 'b.tmp', 'docs/c.txt', 'docs/deep/d.txt', 'docs/deep/e.tmp', 'skip/f.txt',
+                     'Windows/Temp/g.txt', 'Windows/h.txt']:
+        path = tmp_path / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'x' * len(rel_path))
+
+    return tmp_path
+
+
+def rel_paths(walker, files_only=True):
+    return sorted(entry.rel_path.replace(os.sep, '/') for entry in walker if not (files_only and entry.is_dir()))
+
+
+def test_walk_everything(tree):
+    walker = SnapshotWalker(str(tree), workers=4)
+    assert rel_paths(walker) == ['Windows/Temp/g.txt', 'Windows/h.txt', 'a.txt', 'b.tmp', 'docs/c.txt',
+                                 'docs/deep/d.txt', 'docs/deep/e.tmp', 'skip/f.txt']
+    assert (walker.files, walker.dirs, walker.errors) == (8, 5, 0)
+    entry = next(entry for entry in SnapshotWalker(str(tree)) if entry.name == 'c.txt')
+    assert entry.size == len('docs/c.txt') and entry.is_file()
+
+
+def test_globs(tree):
+    walker = SnapshotWalker(str(tree), include=['*.txt'], exclude=['skip', 'Windows/Temp/*'])
+    assert rel_paths(walker) == ['Windows/h.txt', 'a.txt', 'docs/c.txt', 'docs/deep/d.txt']
+    assert rel_paths(SnapshotWalker(str(tree), exclude=['docs', 'Windows'], yield_dirs=False)) == [
+        'a.txt', 'b.tmp', 'skip/f.txt']
+    compiled = compile_globs(['*.tmp', 'docs/deep'])
+    assert match_globs(compiled, 'e.tmp', 'x/e.tmp')
+    assert match_globs(compiled, 'deep', os.path.join('docs', 'deep'))
+    assert not match_globs(compiled, 'deep', 'deep')
+
+
+def test_batches(tree):
+    walker = SnapshotWalker(str(tree), batch_size=2, max_batches=1, workers=3)
+    batches = list(walker.batches())
+    assert all(len(batch) <= 2 for batch in batches)
+    assert sum(len(batch) for batch in batches) == 13
+
+
+def test_break_stops_the_workers(tree):
+    before = threading.active_count()
+    for batch in SnapshotWalker(str(tree), batch_size=1, max_batches=1).batches():
+        break
+    assert threading.active_count() == before
+
+
+def test_onerror_is_called(tmp_path):
+    errors = []
+    walker = SnapshotWalker(str(tmp_path / 'missing'), onerror=errors.append)
+    assert list(walker) == []
+    assert walker.errors == 1 and isinstance(errors[0], FileNotFoundError)
+
+
+def test_raising_onerror_stops_the_walk(tmp_path):
+    def onerror(e):
+        raise e
+
+    walker = SnapshotWalker(str(tmp_path / 'missing'), onerror=onerror, workers=4)
+    with pytest.raises(FileNotFoundError):
+        list(walker)
+
+
+def test_other_exceptions_stop_the_walk(tree):
+    class Throttle(object):
+        def acquire(self):
+            raise ValueError('throttle failed')
+
+    with pytest.raises(ValueError, match='throttle failed'):
+        list(SnapshotWalker(str(tree), throttle=Throttle(), batch_size=1, max_batches=1))